@@ -1,37 +1,46 @@
-from flask import Flask, request, jsonify, render_template, session, redirect, url_for
+from flask import Flask, Response, request, jsonify, render_template, session, redirect, url_for, stream_with_context, g
 from flask_cors import CORS
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
-import boto3
+import contextvars
+import hmac
 import json
 import os
 import logging
 import bcrypt
-import re
-import requests
-import sys
-import subprocess
-import tempfile
-from io import StringIO
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
-from botocore.exceptions import ClientError, NoCredentialsError
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
-from database import get_db_connection, init_database, generate_share_hash
-from googleapiclient.discovery import build
+from database import (
+    borrow_connection, close_request_connection, get_pool_stats,
+    init_database, generate_share_hash
+)
+from providers import get_adapter, get_supported_models, usage_from_headers
+from history import HistoryManager, estimate_tokens
+from cache import cache_stats, get_cache
+from search import SearchCache, get_search_client, get_intent_classifier
+from bedrock import BEDROCK_RETRY_AFTER, bedrock_stats, error_status, get_bedrock_router
+from timing import StageTimer
+import metrics
+import tracing
+from logs import configure_logging, get_request_id, log_payload, logging_stats, set_request_id
+from webhook_worker import WEBHOOK_ASYNC, get_webhook_pool, get_webhook_pool_stats
+from usage_writer import get_usage_writer_stats
+from sandbox import SANDBOX_POOL, SandboxBusy, execute_snippet, stream_snippet, get_sandbox_pool, sandbox_stats
 from lemonsqueezy import (
-    LemonSqueezyService, UsageTracker, 
+    LemonSqueezyService, get_lemonsqueezy_client,
     create_checkout_session, check_user_quota, 
-    log_api_usage, get_user_usage_stats
+    reserve_user_quota, release_user_quota, invalidate_quota_cache,
+    record_api_usage, get_user_usage_stats
 )
 
 # Load environment variables
 load_dotenv()
 
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+configure_logging()
+tracing.configure_tracing()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -57,6 +66,65 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# One pooled connection per request, shared by load_user, the views and the
+# billing helpers; released (and rolled back on error) when the request ends
+app.teardown_appcontext(close_request_connection)
+
+# Apply stored webhook events left over from earlier runs and new ones
+if WEBHOOK_ASYNC:
+    get_webhook_pool().start()
+
+# Warm the code execution workers before the first snippet arrives
+if SANDBOX_POOL:
+    get_sandbox_pool('python').start()
+    get_sandbox_pool('javascript').start()
+
+@app.before_request
+def assign_request_id():
+    # Tags every log record of this request; callers may pass their own ID
+    set_request_id(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def expose_request_id(response):
+    response.headers['X-Request-ID'] = get_request_id()
+    return response
+
+@app.before_request
+def start_request_clock():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    # Labelled by route template, not path, so IDs in URLs add no series
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe_request(request.method, route, response.status_code, time.perf_counter() - started)
+    return response
+
+@app.before_request
+def start_request_trace():
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.trace_root = tracing.start_trace(
+        f'{request.method} {route}', request_id=get_request_id(),
+        traceparent=request.headers.get('traceparent'),
+        **{'http.method': request.method, 'http.route': route}
+    )
+
+@app.after_request
+def record_trace_status(response):
+    root = g.get('trace_root')
+    if root is not None:
+        root.set(**{'http.status_code': response.status_code})
+        if response.status_code >= 500:
+            g.trace_error = f'HTTP {response.status_code}'
+    return response
+
+@app.teardown_request
+def end_request_trace(exc=None):
+    # Streamed responses tear down after the last chunk, so the trace covers them
+    tracing.end_trace(g.pop('trace_root', None), exc or g.pop('trace_error', None))
+
 # User class for Flask-Login
 class User(UserMixin):
     def __init__(self, id, username, email):
@@ -64,33 +132,37 @@ class User(UserMixin):
         self.username = username
         self.email = email
 
+# Identity of recently seen users, so authenticated requests skip the
+# users lookup; entries are dropped on logout, settings changes and webhooks
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 10000))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 300))
+user_cache = get_cache('users', USER_CACHE_SIZE, USER_CACHE_TTL)
+
 @login_manager.user_loader
 def load_user(user_id):
-    connection = get_db_connection()
     try:
-        with connection.cursor() as cursor:
-            cursor.execute("SELECT id, username, email FROM users WHERE id = %s", (user_id,))
-            user_data = cursor.fetchone()
-            if user_data:
-                return User(user_data['id'], user_data['username'], user_data['email'])
-    finally:
-        connection.close()
-    return None
-
-# Initialize AWS Bedrock client
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return None
+    user_data = user_cache.get(user_id)
+    if user_data is None:
+        with borrow_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT id, username, email FROM users WHERE id = %s", (user_id,))
+                user_data = cursor.fetchone()
+        if not user_data:
+            return None
+        user_cache.set(user_id, user_data)
+    return User(user_data['id'], user_data['username'], user_data['email'])
+
+MODEL_ID = os.getenv('BEDROCK_MODEL_ID', 'amazon.nova-pro-v1:0')
+
+# Initialize AWS Bedrock clients (regions, pool, retries and timeouts from BEDROCK_*)
 try:
-    bedrock_runtime = boto3.client(
-        service_name='bedrock-runtime',
-        region_name=os.getenv('AWS_REGION', 'eu-north-1'),
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY')
-    )
+    get_bedrock_router().client(MODEL_ID)
     logger.info("AWS Bedrock client initialized successfully")
 except Exception as e:
     logger.error(f"Failed to initialize AWS Bedrock client: {e}")
-    bedrock_runtime = None
-
-MODEL_ID = os.getenv('BEDROCK_MODEL_ID', 'amazon.nova-pro-v1:0')
 
 # Google Custom Search setup
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
@@ -98,41 +170,18 @@ GOOGLE_SEARCH_ENGINE_ID = os.getenv('GOOGLE_SEARCH_ENGINE_ID')
 
 def needs_web_search(message: str) -> bool:
     """Detect if a message requires web search"""
-    search_keywords = [
-        'latest', 'recent', 'current', 'today', 'now', 'news',
-        'what is happening', 'what happened', 'update on',
-        'weather', 'stock', 'price', 'score', 'result',
-        'search for', 'find', 'look up', 'who is', 'what is', 'whats', "what's", 'when is', 'where is', 'how to',
-        'define', 'definition', 'wiki', 'wikipedia', 'google', 'bing', 'yahoo'
-    ]
-    message_lower = message.lower()
-    return any(keyword in message_lower for keyword in search_keywords)
+    return get_intent_classifier().needs_search(message)
+
+search_cache = SearchCache()
 
 def perform_web_search(query: str, num_results: int = 5) -> List[Dict]:
-    """Perform Google Custom Search and return results"""
+    """Perform Google Custom Search (through the search cache) and return results"""
     if not GOOGLE_API_KEY or not GOOGLE_SEARCH_ENGINE_ID:
         logger.warning("Google API credentials not configured")
         return []
     
     try:
-        service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
-        result = service.cse().list(
-            q=query,
-            cx=GOOGLE_SEARCH_ENGINE_ID,
-            num=num_results
-        ).execute()
-        
-        search_results = []
-        if 'items' in result:
-            for item in result['items']:
-                search_results.append({
-                    'title': item.get('title', ''),
-                    'link': item.get('link', ''),
-                    'snippet': item.get('snippet', '')
-                })
-        
-        logger.info(f"Found {len(search_results)} search results for: {query}")
-        return search_results
+        return search_cache.get_or_search(query, num_results, get_search_client().search)
     except Exception as e:
         logger.error(f"Web search error: {e}")
         return []
@@ -175,8 +224,7 @@ def load_chat(share_hash):
         return redirect(url_for('index'))
     
     # Verify the session belongs to the current user
-    connection = get_db_connection()
-    try:
+    with borrow_connection() as connection:
         with connection.cursor() as cursor:
             cursor.execute(
                 "SELECT id, user_id, share_hash FROM chat_sessions WHERE share_hash = %s",
@@ -192,8 +240,6 @@ def load_chat(share_hash):
             
             # Session is valid, render chat with share_hash parameter
             return render_template('chat.html', share_hash=share_hash, session_id=session_data['id'])
-    finally:
-        connection.close()
 
 # Authentication endpoints
 @app.route('/api/register', methods=['POST'])
@@ -216,8 +262,7 @@ def register():
         # Hash password
         password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
         
-        connection = get_db_connection()
-        try:
+        with borrow_connection() as connection:
             with connection.cursor() as cursor:
                 # Check if username or email exists
                 cursor.execute("SELECT id FROM users WHERE username = %s OR email = %s", (username, email))
@@ -244,8 +289,6 @@ def register():
                         'email': email
                     }
                 })
-        finally:
-            connection.close()
             
     except Exception as e:
         logger.error(f"Registration error: {e}")
@@ -262,8 +305,7 @@ def login():
         if not username or not password:
             return jsonify({'error': 'Username and password are required'}), 400
         
-        connection = get_db_connection()
-        try:
+        with borrow_connection() as connection:
             with connection.cursor() as cursor:
                 # Find user
                 cursor.execute(
@@ -286,6 +328,7 @@ def login():
                 # Log in the user
                 user = User(user_data['id'], user_data['username'], user_data['email'])
                 login_user(user, remember=True)
+                user_cache.set(user.id, {'id': user.id, 'username': user.username, 'email': user.email})
                 
                 return jsonify({
                     'success': True,
@@ -295,8 +338,6 @@ def login():
                         'email': user_data['email']
                     }
                 })
-        finally:
-            connection.close()
             
     except Exception as e:
         logger.error(f"Login error: {e}")
@@ -306,6 +347,7 @@ def login():
 @login_required
 def logout():
     """Log out the current user"""
+    user_cache.delete(current_user.id)
     logout_user()
     return jsonify({'success': True})
 
@@ -320,20 +362,354 @@ def get_user():
     })
 
 # Chat endpoints
+CHAT_SYSTEM_PROMPT = (
+    "You are ZED, a helpful AI assistant. "
+    "CRITICAL: Jump straight to your answer. Never write any analysis like 'The user wants...', 'User is asking...', or 'I should...'. "
+    "Do NOT write <reasoning> tags or show your thinking process. Start directly with the actual answer. "
+    "Always respond in the same language as the user's question - never translate. "
+    "If asked in Arabic, respond ONLY in Arabic. If asked in Bengali, respond ONLY in Bengali. "
+    "Be brief and conversational unless detailed explanation is requested. "
+    "Give the direct answer immediately without preamble or meta-commentary."
+)
+
+HISTORY_SUMMARY_MODEL = os.getenv('HISTORY_SUMMARY_MODEL')
+
+def summarize_history(previous_summary: Optional[str], messages: List[Dict]) -> str:
+    """Fold older turns into the session's running summary with a small model"""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = (
+        "Update the summary of this conversation with the new turns below. "
+        "Keep names, facts, decisions and open questions; stay under 200 words. "
+        "Reply with the summary only, in the conversation's language.\n\n"
+        f"Current summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"
+    )
+    request_body = get_adapter(HISTORY_SUMMARY_MODEL).build_request([{'role': 'user', 'content': prompt}])
+    summary, _ = invoke_chat_model(HISTORY_SUMMARY_MODEL, request_body)
+    return summary
+
+history_manager = HistoryManager(summarizer=summarize_history if HISTORY_SUMMARY_MODEL else None)
+
+def prepare_chat_turn(connection, user_id: int, user_message: str, session_id, model_id: str):
+    """
+    Resolve (or create) the chat session, load its recent history and save
+    the user message
+
+    Commits once, closing the pre-model phase of the turn before the slow
+    Bedrock call. Returns (session_id, history); session_id is None when the
+    requested session does not belong to the user.
+    """
+    with connection.cursor() as cursor:
+        # Create new session if needed
+        if not session_id:
+            title = user_message[:50] + ('...' if len(user_message) > 50 else '')
+            share_hash = generate_share_hash()
+            cursor.execute(
+                "INSERT INTO chat_sessions (user_id, title, model_id, share_hash) VALUES (%s, %s, %s, %s)",
+                (user_id, title, model_id, share_hash)
+            )
+            session_id = cursor.lastrowid
+            history = []
+        else:
+            # Verify session belongs to user
+            cursor.execute(
+                "SELECT id FROM chat_sessions WHERE id = %s AND user_id = %s",
+                (session_id, user_id)
+            )
+            if not cursor.fetchone():
+                return None, []
+        
+            # Get the token-bounded tail of the conversation
+            token_budget = get_adapter(model_id).history_budget - estimate_tokens(user_message)
+            history = history_manager.load(cursor, session_id, token_budget)
+        
+        # Save user message
+        cursor.execute(
+            "INSERT INTO messages (session_id, role, content) VALUES (%s, %s, %s)",
+            (session_id, 'user', user_message)
+        )
+    connection.commit()
+    return session_id, history
+
+def save_chat_reply(connection, user_id: int, session_id: int, assistant_message: str,
+                    model_id: Optional[str] = None, usage: Optional[Dict] = None,
+                    is_overage: Optional[bool] = None):
+    """
+    Save the assistant message and queue its usage row for billing
+
+    The request itself was already counted by reserve_user_quota, so the
+    usage row is written behind by the usage writer, off the response path.
+    `usage` carries the token counts and latency reported by Bedrock and is
+    recorded on the usage row together with the model and session.
+    `is_overage` is the reservation's own flag (quota_info['is_overage']);
+    requests_used may already include later reservations by the time the
+    row is written.
+    """
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "INSERT INTO messages (session_id, role, content) VALUES (%s, %s, %s)",
+                (session_id, 'assistant', assistant_message)
+            )
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    record_api_usage(
+        user_id, 'chat', usage=usage, model_id=model_id,
+        session_id=session_id, count_request=False, is_overage=is_overage
+    )
+
+def abandon_chat_turn(user_id: int, error: Exception):
+    """
+    Roll back a failed turn's uncommitted writes and hand back its reserved request
+
+    The request-scoped connection is released with the error first, so the
+    quota release commits on a fresh connection and cannot commit half of
+    the turn along with it.
+    """
+    close_request_connection(error)
+    release_user_quota(user_id)
+
+# Longest a turn waits for web search results before going on without them
+SEARCH_LATENCY_BUDGET_MS = int(os.getenv('SEARCH_LATENCY_BUDGET_MS', 1500))
+search_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('SEARCH_WORKERS', 16)),
+    thread_name_prefix='web-search'
+)
+
+def fetch_search_context(user_message: str) -> str:
+    """Run a web search for the message and format the results"""
+    logger.info("Web search triggered", extra={'fields': {'query_chars': len(user_message)}})
+    search_results = perform_web_search(user_message)
+    return format_search_context(search_results) if search_results else ""
+
+def _timed_search_context(user_message: str):
+    started = time.monotonic()
+    return fetch_search_context(user_message), (time.monotonic() - started) * 1000
+
+def start_search_context(user_message: str):
+    """
+    Start the web search for a message in the background when it needs one,
+    so it overlaps the database work of the turn
+
+    Returns a handle for await_search_context, or None.
+    """
+    if not needs_web_search(user_message):
+        return None
+    deadline = time.monotonic() + SEARCH_LATENCY_BUDGET_MS / 1000
+    # The copied context keeps the search's spans in this request's trace
+    context = contextvars.copy_context()
+    return search_executor.submit(context.run, _timed_search_context, user_message), deadline
+
+def await_search_context(pending, timer: Optional[StageTimer] = None) -> str:
+    """
+    Wait for a started search until its latency budget runs out
+
+    A search that misses the budget keeps running and still fills the
+    search cache; this turn proceeds without search context.
+    """
+    if pending is None:
+        return ""
+    future, deadline = pending
+    try:
+        search_context, search_ms = future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FuturesTimeout:
+        logger.warning(f"Web search missed its {SEARCH_LATENCY_BUDGET_MS} ms budget; continuing without it")
+        return ""
+    except Exception as e:
+        logger.error(f"Web search error: {e}")
+        return ""
+    if timer is not None:
+        timer.record('search', search_ms)
+    return search_context
+
+def build_chat_messages(history: List[Dict], user_message: str, search_context: str = "") -> List[Dict]:
+    """Assemble the Bedrock message list from stored history and the new user message"""
+    messages = []
+    
+    # Add system message for better behavior (only for first message in conversation)
+    if not history:
+        system_message = (
+            "You are ZED, a friendly AI assistant. "
+            "Respond naturally in the user's language. "
+            "Be brief and direct - answer like a human in casual chat. "
+            "Never show thinking process or translate unless asked. "
+            "Example: User asks 'I love you mane ki?' → Just say 'আমি তোমাকে ভালোবাসি' - that's it!"
+        )
+        messages.append({
+            'role': 'user',
+            'content': system_message
+        })
+        messages.append({
+            'role': 'assistant',
+            'content': 'Got it! Short, natural answers only.'
+        })
+    
+    for msg in history:
+        messages.append({
+            'role': msg['role'],
+            'content': msg['content']
+        })
+    
+    # Add search context to user message if available
+    final_user_message = search_context + user_message if search_context else user_message
+    
+    messages.append({
+        'role': 'user',
+        'content': final_user_message
+    })
+    return messages
+
+def build_request_body(model_id: str, messages: List[Dict]) -> Dict:
+    """Prepare the Bedrock request body for the model's provider"""
+    return get_adapter(model_id).build_request(messages, CHAT_SYSTEM_PROMPT)
+
+def invoke_chat_model(model_id: str, request_body: Dict) -> Tuple[str, Dict]:
+    """
+    Call Bedrock with a prepared request body
+
+    Returns (assistant_text, usage), where usage holds input/output/total
+    tokens from the response body (or Bedrock's token-count headers) and the
+    model latency in milliseconds.
+    """
+    try:
+        log_payload(logger, 'Bedrock request', request_body, model_id=model_id)
+        
+        started = time.monotonic()
+        response = get_bedrock_router().invoke_model(
+            modelId=model_id,
+            body=json.dumps(request_body)
+        )
+        
+        response_body = json.loads(response['body'].read())
+        elapsed_ms = int((time.monotonic() - started) * 1000)
+        log_payload(logger, 'Bedrock response', response_body, model_id=model_id, latency_ms=elapsed_ms)
+        
+        adapter = get_adapter(model_id)
+        assistant_message = adapter.parse_response(response_body)
+        
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        usage = usage_from_headers(headers) or {}
+        usage.update(adapter.extract_usage(response_body) or {})
+        if not usage.get('latency_ms'):
+            usage['latency_ms'] = elapsed_ms
+        return assistant_message, usage
+            
+    except Exception as bedrock_error:
+        logger.exception("Bedrock API error (%s): %s", type(bedrock_error).__name__, bedrock_error)
+        raise bedrock_error
+
+def iter_stream_chunks(response: Dict):
+    """Yield decoded JSON chunks from an invoke_model_with_response_stream response"""
+    for event in response['body']:
+        if 'chunk' in event:
+            yield json.loads(event['chunk']['bytes'])
+        else:
+            # Modeled stream errors: throttlingException, modelStreamErrorException, ...
+            error_name, detail = next(iter(event.items()))
+            message = detail.get('message', detail) if isinstance(detail, dict) else detail
+            raise RuntimeError(f"Bedrock stream error ({error_name}): {message}")
+
+def chat_error(error: Exception) -> Tuple[int, Dict]:
+    """
+    Status and body for a failed chat turn: 429/503/504 marked retryable
+    when Bedrock is throttling or unavailable, 500 otherwise
+    """
+    status = error_status(error)
+    if status is None:
+        return 500, {'error': str(error)}
+    return status, {'error': 'The model is busy right now, please try again shortly', 'retryable': True}
+
+def chat_error_response(error: Exception):
+    status, body = chat_error(error)
+    response = jsonify(body)
+    if body.get('retryable'):
+        response.headers['Retry-After'] = str(BEDROCK_RETRY_AFTER)
+    return response, status
+
+def _ndjson(event: Dict) -> str:
+    return json.dumps(event, ensure_ascii=False, default=str) + '\n'
+
 @app.route('/api/chat', methods=['POST'])
 @login_required
 def chat():
     """Handle chat requests"""
     try:
-        # Check quota before processing
-        quota_check = check_user_quota(current_user.id)
-        if not quota_check.get('allowed', False):
+        data = request.get_json()
+        user_message = data.get('message', '').strip()
+        session_id = data.get('session_id')
+        model_id = data.get('model', MODEL_ID)
+        
+        if not user_message:
+            return jsonify({'error': 'Message is required'}), 400
+        
+        timer = StageTimer('chat')
+        
+        # Reserve this request against the quota before processing
+        with timer.stage('quota'):
+            quota_info = reserve_user_quota(current_user.id)
+        if not quota_info.get('allowed', False):
             return jsonify({
-                'error': quota_check.get('message', 'Quota exceeded'),
+                'error': quota_info.get('message', 'Quota exceeded'),
                 'quota_exceeded': True,
-                'quota_info': quota_check
+                'quota_info': quota_info
             }), 429
         
+        try:
+            # Search (if needed) runs while the history is loaded
+            pending_search = start_search_context(user_message)
+            
+            with timer.stage('history'):
+                with borrow_connection() as connection:
+                    session_id, history = prepare_chat_turn(
+                        connection, current_user.id, user_message, session_id, model_id
+                    )
+            if session_id is None:
+                release_user_quota(current_user.id)
+                return jsonify({'error': 'Invalid session'}), 403
+            
+            # Hand the connection back to the pool while the model generates
+            close_request_connection()
+            
+            with timer.stage('search_wait'):
+                search_context = await_search_context(pending_search, timer)
+            messages = build_chat_messages(history, user_message, search_context)
+            
+            with timer.stage('model'):
+                assistant_message, usage = invoke_chat_model(model_id, build_request_body(model_id, messages))
+            
+            with timer.stage('save'):
+                with borrow_connection() as connection:
+                    save_chat_reply(connection, current_user.id, session_id, assistant_message, model_id, usage,
+                                    quota_info['is_overage'])
+        except Exception as e:
+            abandon_chat_turn(current_user.id, e)
+            raise
+        
+        timer.log(model_id=model_id, search=pending_search is not None)
+        return jsonify({
+            'response': assistant_message,
+            'session_id': session_id,
+            'model': model_id,
+            'usage': usage,
+            'quota_info': quota_info
+        })
+            
+    except Exception as e:
+        logger.error(f"Chat error: {e}")
+        return chat_error_response(e)
+
+@app.route('/api/chat/stream', methods=['POST'])
+@login_required
+def chat_stream():
+    """
+    Handle chat requests, streaming the reply as newline-delimited JSON
+
+    Events: {"type": "start"}, then one {"type": "token", "text": ...} per
+    chunk, then {"type": "done"} with the full response and quota info, or
+    {"type": "error"} if the model call fails mid-stream.
+    """
+    try:
         data = request.get_json()
         user_message = data.get('message', '').strip()
         session_id = data.get('session_id')
@@ -342,224 +718,110 @@ def chat():
         if not user_message:
             return jsonify({'error': 'Message is required'}), 400
         
-        connection = get_db_connection()
+        timer = StageTimer('chat_stream')
+        
+        # Reserve this request against the quota before processing
+        user_id = current_user.id
+        with timer.stage('quota'):
+            quota_info = reserve_user_quota(user_id)
+        if not quota_info.get('allowed', False):
+            return jsonify({
+                'error': quota_info.get('message', 'Quota exceeded'),
+                'quota_exceeded': True,
+                'quota_info': quota_info
+            }), 429
+        
         try:
-            with connection.cursor() as cursor:
-                # Create new session if needed
-                if not session_id:
-                    title = user_message[:50] + ('...' if len(user_message) > 50 else '')
-                    share_hash = generate_share_hash()
-                    cursor.execute(
-                        "INSERT INTO chat_sessions (user_id, title, model_id, share_hash) VALUES (%s, %s, %s, %s)",
-                        (current_user.id, title, model_id, share_hash)
-                    )
-                    connection.commit()
-                    session_id = cursor.lastrowid
-                else:
-                    # Verify session belongs to user
-                    cursor.execute(
-                        "SELECT id FROM chat_sessions WHERE id = %s AND user_id = %s",
-                        (session_id, current_user.id)
-                    )
-                    if not cursor.fetchone():
-                        return jsonify({'error': 'Invalid session'}), 403
-                
-                # Get conversation history
-                cursor.execute(
-                    "SELECT role, content FROM messages WHERE session_id = %s ORDER BY created_at ASC",
-                    (session_id,)
-                )
-                history = cursor.fetchall()
-                
-                # Save user message
-                cursor.execute(
-                    "INSERT INTO messages (session_id, role, content) VALUES (%s, %s, %s)",
-                    (session_id, 'user', user_message)
-                )
-                connection.commit()
-                
-                # Check if web search is needed
-                search_context = ""
-                if needs_web_search(user_message):
-                    logger.info(f"Web search triggered for: {user_message}")
-                    search_results = perform_web_search(user_message)
-                    if search_results:
-                        search_context = format_search_context(search_results)
-                
-                # Prepare messages for Bedrock
-                messages = []
-                
-                # Add system message for better behavior (only for first message in conversation)
-                if not history:
-                    system_message = (
-                        "You are ZED, a friendly AI assistant. "
-                        "Respond naturally in the user's language. "
-                        "Be brief and direct - answer like a human in casual chat. "
-                        "Never show thinking process or translate unless asked. "
-                        "Example: User asks 'I love you mane ki?' → Just say 'আমি তোমাকে ভালোবাসি' - that's it!"
-                    )
-                    messages.append({
-                        'role': 'user',
-                        'content': system_message
-                    })
-                    messages.append({
-                        'role': 'assistant',
-                        'content': 'Got it! Short, natural answers only.'
-                    })
-                
-                for msg in history:
-                    messages.append({
-                        'role': msg['role'],
-                        'content': msg['content']
-                    })
-                
-                # Add search context to user message if available
-                final_user_message = search_context + user_message if search_context else user_message
-                
-                messages.append({
-                    'role': 'user',
-                    'content': final_user_message
-                })
-                
-                # Prepare request body based on model type
-                try:
-                    if 'anthropic.claude' in model_id:
-                        # Claude format (Anthropic models) with system prompt
-                        request_body = { 
-                            'anthropic_version': 'bedrock-2023-05-31',
-                            'max_tokens': 4096,
-                            'messages': messages,
-                            'temperature': 0.7,
-                            'top_p': 0.9,
-                            'system': (
-                                "You are ZED, a helpful AI assistant. "
-                                "CRITICAL: Jump straight to your answer. Never write any analysis like 'The user wants...', 'User is asking...', or 'I should...'. "
-                                "Do NOT write <reasoning> tags or show your thinking process. Start directly with the actual answer. "
-                                "Always respond in the same language as the user's question - never translate. "
-                                "If asked in Arabic, respond ONLY in Arabic. If asked in Bengali, respond ONLY in Bengali. "
-                                "Be brief and conversational unless detailed explanation is requested. "
-                                "Give the direct answer immediately without preamble or meta-commentary."
-                            )
-                        }
-                    elif 'amazon.nova' in model_id or 'meta.llama' in model_id or 'mistral.' in model_id or 'cohere.' in model_id or 'ai21.' in model_id or 'qwen.' in model_id or 'minimax.' in model_id or 'moonshot.' in model_id or 'deepseek.' in model_id:
-                        # Nova, Llama, Mistral, Cohere, and other models use inferenceConfig format
-                        request_body = {
-                            'messages': messages,
-                            'inferenceConfig': {
-                                'maxTokens': 4096,
-                                'temperature': 0.7,
-                                'topP': 0.9
-                            }
-                        }
-                    elif 'openai.gpt' in model_id or 'google.gemma' in model_id:
-                        # OpenAI and Google Gemma format - inject system prompt as first message
-                        system_prompt_messages = [
-                            {
-                                'role': 'user',
-                                'content': (
-                                    "You are ZED, a helpful AI assistant. "
-                                    "CRITICAL: Jump straight to your answer. Never write any analysis like 'The user wants...', 'User is asking...', or 'I should...'. "
-                                    "Do NOT write <reasoning> tags or show your thinking process. Start directly with the actual answer. "
-                                    "Always respond in the same language as the user's question - never translate. "
-                                    "If asked in Arabic, respond ONLY in Arabic. If asked in Bengali, respond ONLY in Bengali. "
-                                    "Be brief and conversational unless detailed explanation is requested. "
-                                    "Give the direct answer immediately without preamble or meta-commentary."
-                                )
-                            },
-                            {
-                                'role': 'assistant',
-                                'content': 'Understood. I will respond directly and concisely in the same language as the question.'
-                            }
-                        ] + messages
-                        
-                        request_body = {
-                            'messages': system_prompt_messages,
-                            'max_tokens': 4096,
-                            'temperature': 0.7,
-                            'top_p': 0.9
-                        }
-                    else:
-                        # Default format - try inferenceConfig
-                        request_body = {
-                            'messages': messages,
-                            'inferenceConfig': {
-                                'maxTokens': 4096,
-                                'temperature': 0.7,
-                                'topP': 0.9
-                            }
-                        }
-                    
-                    logger.info(f"Calling Bedrock - Model: {model_id}")
-                    logger.info(f"Request: {json.dumps(request_body, indent=2)}")
-                    
-                    response = bedrock_runtime.invoke_model(
-                        modelId=model_id,
-                        body=json.dumps(request_body)
+            # Search (if needed) runs while the history is loaded
+            pending_search = start_search_context(user_message)
+            
+            with timer.stage('history'):
+                with borrow_connection() as connection:
+                    session_id, history = prepare_chat_turn(
+                        connection, user_id, user_message, session_id, model_id
                     )
-                    
-                    response_body = json.loads(response['body'].read())
-                    logger.info(f"Response: {json.dumps(response_body, indent=2)}")
-                    
-                    # Parse response based on model type
-                    if 'anthropic.claude' in model_id:
-                        # Claude format response
-                        assistant_message = response_body['content'][0]['text']
-                    elif 'openai.gpt' in model_id or 'google.gemma' in model_id:
-                        # OpenAI/Gemma format response
-                        assistant_message = response_body['choices'][0]['message']['content']
-                    elif 'output' in response_body and 'message' in response_body['output']:
-                        # Nova, Llama, Mistral format response
-                        assistant_message = response_body['output']['message']['content'][0]['text']
-                    elif 'content' in response_body:
-                        # Alternative format
-                        if isinstance(response_body['content'], list):
-                            assistant_message = response_body['content'][0].get('text', str(response_body['content'][0]))
-                        else:
-                            assistant_message = response_body['content']
-                    else:
-                        # Fallback - try to extract any text content
-                        assistant_message = str(response_body)
-                        
-                except Exception as bedrock_error:
-                    logger.error(f"Bedrock API error: {str(bedrock_error)}")
-                    logger.error(f"Error type: {type(bedrock_error).__name__}")
-                    import traceback
-                    logger.error(f"Traceback: {traceback.format_exc()}")
-                    raise bedrock_error
-                
-                # Save assistant message
-                cursor.execute(
-                    "INSERT INTO messages (session_id, role, content) VALUES (%s, %s, %s)",
-                    (session_id, 'assistant', assistant_message)
-                )
-                connection.commit()
-                
-                # Log usage for billing
-                log_api_usage(current_user.id, 'chat')
-                
-                # Get updated quota info
-                quota_info = check_user_quota(current_user.id)
-                
-                return jsonify({
-                    'response': assistant_message,
-                    'session_id': session_id,
-                    'model': model_id,
-                    'quota_info': quota_info
-                })
-                
-        finally:
-            connection.close()
+            if session_id is None:
+                release_user_quota(user_id)
+                return jsonify({'error': 'Invalid session'}), 403
             
+            # Hand the connection back to the pool while the model generates
+            close_request_connection()
+            
+            with timer.stage('search_wait'):
+                search_context = await_search_context(pending_search, timer)
+            request_body = build_request_body(
+                model_id, build_chat_messages(history, user_message, search_context)
+            )
+        except Exception as e:
+            abandon_chat_turn(user_id, e)
+            raise
     except Exception as e:
         logger.error(f"Chat error: {e}")
-        return jsonify({'error': str(e)}), 500
+        return chat_error_response(e)
+    
+    def generate():
+        yield _ndjson({'type': 'start', 'session_id': session_id, 'model': model_id})
+        parts = []
+        usage = None
+        saved = False
+        try:
+            logger.info("Calling Bedrock (stream) - Model: %s", model_id)
+            started = time.monotonic()
+            response = get_bedrock_router().invoke_model_with_response_stream(
+                modelId=model_id,
+                body=json.dumps(request_body)
+            )
+            adapter = get_adapter(model_id)
+            for chunk in iter_stream_chunks(response):
+                text, chunk_usage = adapter.parse_stream_chunk(chunk)
+                if chunk_usage:
+                    usage = chunk_usage
+                if text:
+                    if not parts:
+                        timer.record('first_token', (time.monotonic() - started) * 1000)
+                    parts.append(text)
+                    yield _ndjson({'type': 'token', 'text': text})
+            timer.record('model', (time.monotonic() - started) * 1000)
+            
+            assistant_message = ''.join(parts)
+            usage = usage or {}
+            if not usage.get('latency_ms'):
+                usage['latency_ms'] = int((time.monotonic() - started) * 1000)
+            with timer.stage('save'):
+                with borrow_connection() as connection:
+                    save_chat_reply(connection, user_id, session_id, assistant_message, model_id, usage,
+                                    quota_info['is_overage'])
+            saved = True
+            timer.log(model_id=model_id, search=pending_search is not None)
+            
+            yield _ndjson({
+                'type': 'done',
+                'response': assistant_message,
+                'session_id': session_id,
+                'model': model_id,
+                'usage': usage,
+                'quota_info': quota_info
+            })
+        except Exception as e:
+            logger.error(f"Chat stream error: {e}")
+            _, body = chat_error(e)
+            yield _ndjson(dict(body, type='error'))
+        finally:
+            # Failed or abandoned by the client before the reply was saved
+            if not saved:
+                release_user_quota(user_id)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/api/sessions', methods=['GET'])
 @login_required
 def get_sessions():
     """Get user's chat sessions"""
-    connection = get_db_connection()
-    try:
+    with borrow_connection() as connection:
         with connection.cursor() as cursor:
             cursor.execute(
                 """SELECT id, share_hash, title, model_id, created_at, updated_at 
@@ -572,20 +834,17 @@ def get_sessions():
             sessions = cursor.fetchall()
             
             # Format dates
-            for session in sessions:
-                session['created_at'] = session['created_at'].isoformat() if session['created_at'] else None
-                session['updated_at'] = session['updated_at'].isoformat() if session['updated_at'] else None
+            for chat_session in sessions:
+                chat_session['created_at'] = chat_session['created_at'].isoformat() if chat_session['created_at'] else None
+                chat_session['updated_at'] = chat_session['updated_at'].isoformat() if chat_session['updated_at'] else None
             
             return jsonify(sessions)
-    finally:
-        connection.close()
 
 @app.route('/api/sessions/<int:session_id>', methods=['GET'])
 @login_required
 def get_session(session_id):
     """Get a specific session with messages"""
-    connection = get_db_connection()
-    try:
+    with borrow_connection() as connection:
         with connection.cursor() as cursor:
             # Verify session belongs to user
             cursor.execute(
@@ -599,7 +858,7 @@ def get_session(session_id):
             
             # Get messages
             cursor.execute(
-                "SELECT role, content, created_at FROM messages WHERE session_id = %s ORDER BY created_at ASC",
+                "SELECT role, content, created_at FROM messages WHERE session_id = %s ORDER BY id ASC",
                 (session_id,)
             )
             messages = cursor.fetchall()
@@ -613,15 +872,12 @@ def get_session(session_id):
                 'session': session,
                 'messages': messages
             })
-    finally:
-        connection.close()
 
 @app.route('/api/sessions/<int:session_id>', methods=['DELETE'])
 @login_required
 def delete_session(session_id):
     """Delete a chat session"""
-    connection = get_db_connection()
-    try:
+    with borrow_connection() as connection:
         with connection.cursor() as cursor:
             cursor.execute(
                 "DELETE FROM chat_sessions WHERE id = %s AND user_id = %s",
@@ -632,9 +888,8 @@ def delete_session(session_id):
             if cursor.rowcount == 0:
                 return jsonify({'error': 'Session not found'}), 404
             
+            history_manager.forget(session_id)
             return jsonify({'success': True})
-    finally:
-        connection.close()
 
 @app.route('/api/execute-code', methods=['POST'])
 @login_required
@@ -660,180 +915,151 @@ def execute_code():
         
         return jsonify(result)
         
+    except SandboxBusy as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         logger.error(f"Code execution error: {e}")
         return jsonify({'error': str(e)}), 500
 
-def execute_python_code(code: str, timeout: int) -> Dict:
-    """Execute Python code and capture output"""
+@app.route('/api/execute-code/stream', methods=['POST'])
+@login_required
+def execute_code_stream():
+    """Execute code, streaming its output as newline-delimited JSON events"""
     try:
-        # Create a temporary file for the code
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-            f.write(code)
-            temp_file = f.name
+        data = request.get_json()
+        code = data.get('code', '').strip()
+        language = data.get('language', 'python').lower()
+        
+        if not code:
+            return jsonify({'error': 'Code is required'}), 400
+        if language not in ('python', 'javascript'):
+            return jsonify({'error': f'Unsupported language: {language}'}), 400
         
+        timeout = 5  # seconds
+        events = stream_snippet(language, code, timeout)
+    except SandboxBusy as e:
+        return jsonify({'error': str(e)}), 503
+    except Exception as e:
+        logger.error(f"Code execution error: {e}")
+        return jsonify({'error': str(e)}), 500
+    
+    def generate():
         try:
-            # Execute with timeout
-            result = subprocess.run(
-                [sys.executable, temp_file],
-                capture_output=True,
-                text=True,
-                timeout=timeout
-            )
-            
-            output = result.stdout
-            error = result.stderr
-            
-            if result.returncode == 0:
-                return {
-                    'success': True,
-                    'output': output or 'Code executed successfully with no output',
-                    'error': None
-                }
-            else:
-                return {
-                    'success': False,
-                    'output': output,
-                    'error': error or 'Execution failed'
-                }
+            yield _ndjson({'type': 'start', 'language': language})
+            for event in events:
+                yield _ndjson(event)
         finally:
-            # Clean up temp file
-            os.unlink(temp_file)
-            
-    except subprocess.TimeoutExpired:
-        return {
-            'success': False,
-            'output': None,
-            'error': f'Execution timeout after {timeout} seconds'
-        }
-    except Exception as e:
-        return {
-            'success': False,
-            'output': None,
-            'error': str(e)
-        }
+            events.close()
+    
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # A client gone before the first line closes the response without ever
+    # starting generate(); the worker must go back to the pool regardless
+    response.call_on_close(events.close)
+    return response
+
+def execute_python_code(code: str, timeout: int) -> Dict:
+    """Execute Python code and capture output"""
+    return execute_snippet('python', code, timeout)
 
 def execute_javascript_code(code: str, timeout: int) -> Dict:
     """Execute JavaScript code using Node.js"""
-    try:
-        # Create a temporary file for the code
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.js', delete=False) as f:
-            f.write(code)
-            temp_file = f.name
-        
-        try:
-            # Check if Node.js is available
-            result = subprocess.run(
-                ['node', temp_file],
-                capture_output=True,
-                text=True,
-                timeout=timeout
-            )
-            
-            output = result.stdout
-            error = result.stderr
-            
-            if result.returncode == 0:
-                return {
-                    'success': True,
-                    'output': output or 'Code executed successfully with no output',
-                    'error': None
-                }
-            else:
-                return {
-                    'success': False,
-                    'output': output,
-                    'error': error or 'Execution failed'
-                }
-        finally:
-            # Clean up temp file
-            os.unlink(temp_file)
-            
-    except FileNotFoundError:
-        return {
-            'success': False,
-            'output': None,
-            'error': 'Node.js is not installed. JavaScript execution requires Node.js.'
-        }
-    except subprocess.TimeoutExpired:
-        return {
-            'success': False,
-            'output': None,
-            'error': f'Execution timeout after {timeout} seconds'
-        }
-    except Exception as e:
-        return {
-            'success': False,
-            'output': None,
-            'error': str(e)
-        }
+    return execute_snippet('javascript', code, timeout)
 
 @app.route('/api/models', methods=['GET'])
 def get_models():
     """Return available Bedrock models"""
-    models = [
-        # Claude Models
-        {'id': 'anthropic.claude-3-haiku-20240307-v1:0', 'name': 'Claude 3 Haiku (Default)', 'provider': 'Anthropic'},
-        
-        # Amazon Nova Models
-        {'id': 'amazon.nova-premier-v1:0', 'name': 'Nova Premier', 'provider': 'Amazon'},
-        {'id': 'amazon.nova-pro-v1:0', 'name': 'Nova Pro', 'provider': 'Amazon'},
-        {'id': 'amazon.nova-2-sonic-v1:0', 'name': 'Nova 2 Sonic', 'provider': 'Amazon'},
-        {'id': 'amazon.nova-2-lite-v1:0', 'name': 'Nova 2 Lite', 'provider': 'Amazon'},
-        {'id': 'amazon.nova-sonic-v1:0', 'name': 'Nova Sonic', 'provider': 'Amazon'},
-        {'id': 'amazon.nova-lite-v1:0', 'name': 'Nova Lite', 'provider': 'Amazon'},
-        {'id': 'amazon.nova-micro-v1:0', 'name': 'Nova Micro', 'provider': 'Amazon'},
-        
-        # Meta Llama Models
-        {'id': 'meta.llama4-scout-405b-v1:0', 'name': 'Llama 4 Scout 405B', 'provider': 'Meta'},
-        {'id': 'meta.llama4-maverick-v1:0', 'name': 'Llama 4 Maverick', 'provider': 'Meta'},
-        {'id': 'meta.llama3-3-70b-instruct-v1:0', 'name': 'Llama 3.3 70B Instruct', 'provider': 'Meta'},
-        {'id': 'meta.llama3-2-90b-instruct-v1:0', 'name': 'Llama 3.2 90B Instruct', 'provider': 'Meta'},
-        {'id': 'meta.llama3-1-70b-instruct-v1:0', 'name': 'Llama 3.1 70B Instruct', 'provider': 'Meta'},
-        
-        # Mistral Models
-        {'id': 'mistral.mistral-large-3-2503-v1:0', 'name': 'Mistral Large 3', 'provider': 'Mistral'},
-        {'id': 'mistral.magistral-large-2407-v1:0', 'name': 'Magistral Large 2407', 'provider': 'Mistral'},
-        {'id': 'mistral.ministral-3b-2410-v1:0', 'name': 'Ministral 3B 2410', 'provider': 'Mistral'},
-        {'id': 'mistral.mixtral-8x7b-instruct-v0:1', 'name': 'Mixtral 8x7B Instruct', 'provider': 'Mistral'},
-        
-        # DeepSeek Model
-        {'id': 'deepseek.deepseek-r1-distill-qwen-32b-v1:0', 'name': 'DeepSeek R1 Distill Qwen 32B', 'provider': 'DeepSeek'},
-        
-        # Cohere Models
-        {'id': 'cohere.command-r-plus-v1:0', 'name': 'Command R+', 'provider': 'Cohere'},
-        {'id': 'cohere.command-r-v1:0', 'name': 'Command R', 'provider': 'Cohere'},
-        
-        # OpenAI Models
-        {'id': 'openai.gpt-oss-120b-1:0', 'name': 'GPT OSS 120B', 'provider': 'OpenAI'},
-        {'id': 'openai.gpt-oss-20b-1:0', 'name': 'GPT OSS 20B', 'provider': 'OpenAI'},
-        
-        # AI21 Labs Models
-        {'id': 'ai21.jamba-2-ultra-v1:0', 'name': 'Jamba 2 Ultra', 'provider': 'AI21 Labs'},
-        {'id': 'ai21.jamba-2-large-v1:0', 'name': 'Jamba 2 Large', 'provider': 'AI21 Labs'},
-        
-        # Google Models
-        {'id': 'google.gemma-3-27b-it-v1:0', 'name': 'Gemma 3 27B IT', 'provider': 'Google'},
-        {'id': 'google.gemma-3-9b-it-v1:0', 'name': 'Gemma 3 9B IT', 'provider': 'Google'},
-        
-        # Qwen Models
-        {'id': 'qwen.qwen3-next-70b-instruct-v1:0', 'name': 'Qwen3 Next 70B Instruct', 'provider': 'Qwen'},
-        {'id': 'qwen.qwen2-5-32b-instruct-v1:0', 'name': 'Qwen 2.5 32B Instruct', 'provider': 'Qwen'},
-        {'id': 'qwen.qwq-32b-preview-v1:0', 'name': 'QwQ 32B Preview', 'provider': 'Qwen'},
-        
-        # MiniMax Model
-        {'id': 'minimax.minimax-m2-v1:0', 'name': 'MiniMax M2', 'provider': 'MiniMax'},
-        
-        # Moonshot Model
-        {'id': 'moonshot.moonshot-kimi-k2-v1:0', 'name': 'Moonshot Kimi K2', 'provider': 'Moonshot'}
-    ]
-    return jsonify(models)
+    return jsonify(get_supported_models())
 
 @app.route('/api/health', methods=['GET'])
 def health():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'service': 'ZED Chat'})
 
+# Pool, cache, queue and client stats, read when /metrics is scraped; the
+# running totals among them are exposed as counters
+metrics.register_stats(
+    'zed_db_pool', get_pool_stats, 'Database connection pool',
+    counters=('checkouts', 'created', 'discarded', 'waits', 'timeouts', 'ping_failures', 'wait_time_total')
+)
+metrics.register_stats(
+    'zed_cache', cache_stats, 'Named cache', label='cache',
+    counters=('hits', 'misses', 'evictions', 'expirations', 'errors')
+)
+metrics.register_stats(
+    'zed_search_client', lambda: get_search_client().stats(), 'Web search client',
+    counters=('searches', 'errors')
+)
+metrics.register_stats(
+    'zed_search_cache', search_cache.stats, 'Web search cache',
+    counters=('hits', 'misses', 'coalesced', 'errors', 'latency_saved_ms')
+)
+metrics.register_stats(
+    'zed_usage_writer', get_usage_writer_stats, 'Usage write-behind queue',
+    counters=('enqueued', 'written', 'batches', 'flush_errors', 'full_waits', 'rejected', 'dropped', 'replayed',
+              'dead_lettered')
+)
+metrics.register_stats(
+    'zed_webhook_pool', get_webhook_pool_stats, 'Webhook workers',
+    counters=('processed', 'retried', 'failed', 'claim_errors')
+)
+metrics.register_stats(
+    'zed_sandbox', sandbox_stats, 'Code execution pool', label='language',
+    counters=('runs', 'rejected', 'recycled', 'cold_starts', 'spawn_errors')
+)
+metrics.register_stats('zed_logging', logging_stats, 'Log writer queue', counters=('dropped',))
+metrics.register_stats(
+    'zed_tracing', tracing.tracing_stats, 'Request tracing',
+    counters=('traces', 'kept', 'discarded', 'exported', 'export_dropped', 'export_errors')
+)
+metrics.register_stats(
+    'zed_bedrock', bedrock_stats, 'Bedrock client',
+    counters=('calls', 'errors', 'retries', 'throttled', 'timeouts', 'failovers', 'exhausted')
+)
+metrics.register_stats(
+    'zed_bedrock_model', lambda: bedrock_stats()['models'], 'Bedrock calls', label='model',
+    counters=('calls', 'errors', 'retries', 'throttled')
+)
+metrics.register_stats(
+    'zed_bedrock_target', lambda: bedrock_stats()['targets'], 'Bedrock region', label='target',
+    counters=('calls', 'failovers')
+)
+metrics.register_stats(
+    'zed_lemonsqueezy', lambda: get_lemonsqueezy_client().stats()['endpoints'],
+    'LemonSqueezy API calls', label='endpoint', counters=('count', 'errors', 'short_circuited')
+)
+metrics.register_stats(
+    'zed_lemonsqueezy_circuit',
+    lambda: {'open': int(get_lemonsqueezy_client().stats()['circuit'] == 'open')},
+    'LemonSqueezy circuit breaker'
+)
+metrics.register_histogram_stats(
+    'zed_lemonsqueezy_request_duration_seconds', lambda: get_lemonsqueezy_client().stats()['endpoints'],
+    'LemonSqueezy API call latency by endpoint', label='endpoint'
+)
+
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Serve /metrics without a token; only for a listener that is not publicly reachable
+METRICS_PUBLIC = os.getenv('METRICS_PUBLIC', 'false').lower() == 'true'
+
+def metrics_authorized(authorization: Optional[str]) -> bool:
+    """Whether an Authorization header may read /metrics"""
+    if METRICS_TOKEN:
+        return hmac.compare_digest(authorization or '', f'Bearer {METRICS_TOKEN}')
+    return METRICS_PUBLIC
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text-format metrics, behind the METRICS_TOKEN bearer token"""
+    if not METRICS_TOKEN and not METRICS_PUBLIC:
+        return jsonify({'error': 'Not found'}), 404
+    if not metrics_authorized(request.headers.get('Authorization')):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 # ============================================================================
 # BILLING & SUBSCRIPTION ROUTES
 # ============================================================================
@@ -895,8 +1121,7 @@ def create_checkout():
 @login_required
 def customer_portal():
     """Get customer portal URL for subscription management"""
-    connection = get_db_connection()
-    try:
+    with borrow_connection() as connection:
         with connection.cursor() as cursor:
             cursor.execute("""
                 SELECT lemonsqueezy_customer_id 
@@ -924,8 +1149,6 @@ def customer_portal():
                     'success': False,
                     'error': 'Failed to get portal URL'
                 }), 500
-    finally:
-        connection.close()
 
 @app.route('/api/billing/usage', methods=['GET'])
 @login_required
@@ -965,35 +1188,35 @@ def update_billing_settings():
     """Update billing preferences"""
     data = request.get_json()
     
-    connection = get_db_connection()
-    try:
-        with connection.cursor() as cursor:
-            updates = []
-            params = []
+    with borrow_connection() as connection:
+        try:
+            with connection.cursor() as cursor:
+                updates = []
+                params = []
             
-            if 'overage_enabled' in data:
-                updates.append('overage_enabled = %s')
-                params.append(data['overage_enabled'])
+                if 'overage_enabled' in data:
+                    updates.append('overage_enabled = %s')
+                    params.append(data['overage_enabled'])
             
-            if 'auto_stop_at_limit' in data:
-                updates.append('auto_stop_at_limit = %s')
-                params.append(data['auto_stop_at_limit'])
+                if 'auto_stop_at_limit' in data:
+                    updates.append('auto_stop_at_limit = %s')
+                    params.append(data['auto_stop_at_limit'])
             
-            if updates:
-                params.append(current_user.id)
-                query = f"UPDATE users SET {', '.join(updates)} WHERE id = %s"
-                cursor.execute(query, params)
-                connection.commit()
+                if updates:
+                    params.append(current_user.id)
+                    query = f"UPDATE users SET {', '.join(updates)} WHERE id = %s"
+                    cursor.execute(query, params)
+                    connection.commit()
+                    invalidate_quota_cache(current_user.id)
+                    user_cache.delete(current_user.id)
                 
-                return jsonify({'success': True})
-            else:
-                return jsonify({'success': False, 'error': 'No valid fields to update'}), 400
-    except Exception as e:
-        connection.rollback()
-        logger.error(f"Settings update error: {e}")
-        return jsonify({'success': False, 'error': str(e)}), 500
-    finally:
-        connection.close()
+                    return jsonify({'success': True})
+                else:
+                    return jsonify({'success': False, 'error': 'No valid fields to update'}), 400
+        except Exception as e:
+            connection.rollback()
+            logger.error(f"Settings update error: {e}")
+            return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/api/webhooks/lemonsqueezy', methods=['POST'])
 def lemonsqueezy_webhook():
@@ -1009,14 +1232,22 @@ def lemonsqueezy_webhook():
     if not service.verify_webhook_signature(request.data, signature):
         return jsonify({'error': 'Invalid signature'}), 401
     
-    # Process the webhook
     event_data = request.get_json()
-    result = service.process_webhook_event(event_data)
+    if not WEBHOOK_ASYNC:
+        result = service.process_webhook_event(event_data)
+        if result['success']:
+            return jsonify({'success': True}), 200
+        else:
+            return jsonify(result), 400
     
-    if result['success']:
-        return jsonify({'success': True}), 200
-    else:
-        return jsonify(result), 400
+    # Store the event and acknowledge; the webhook workers apply it
+    result = service.enqueue_webhook_event(event_data, payload=request.get_data(as_text=True))
+    if not result['success']:
+        # Not stored: let LemonSqueezy redeliver it
+        return jsonify(result), 500
+    if not result['duplicate']:
+        get_webhook_pool().notify()
+    return jsonify({'success': True}), 200
 
 @app.route('/pricing')
 def pricing_page():
@@ -0,0 +1,508 @@
+"""
+ASGI serving mode for ZED AI
+
+Runs the chat pipeline on an asyncio event loop so a waiting chat turn costs
+a coroutine rather than a pinned worker thread. The blocking clients (boto3
+Bedrock, googleapiclient, LemonSqueezy over requests, PyMySQL) are called on
+bounded per-backend executors, so a slow search or billing API cannot starve
+database work. Session and billing routes run the existing Flask views on the
+executor for the backend they wait on; every other route goes to the Flask
+WSGI app unchanged.
+
+Serve with any ASGI server, e.g.:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 3000
+"""
+
+import asyncio
+import contextvars
+import functools
+import io
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from flask_login import current_user
+
+from app import (
+    app, MODEL_ID, reserve_user_quota, release_user_quota, prepare_chat_turn, save_chat_reply,
+    needs_web_search, fetch_search_context, build_chat_messages, build_request_body,
+    invoke_chat_model, iter_stream_chunks, chat_error, SEARCH_LATENCY_BUDGET_MS
+)
+from bedrock import BEDROCK_RETRY_AFTER, get_bedrock_router
+from database import DB_POOL_SIZE, borrow_connection
+from providers import get_adapter
+from timing import StageTimer
+from logs import set_request_id
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Executor sizes per backend. Threads only exist while a backend call is in
+# flight; coroutines waiting for a free thread cost no thread at all.
+EXECUTOR_SIZES = {
+    'db': int(os.getenv('ASYNC_DB_WORKERS', DB_POOL_SIZE)),
+    'bedrock': int(os.getenv('ASYNC_BEDROCK_WORKERS', 256)),
+    'search': int(os.getenv('ASYNC_SEARCH_WORKERS', 32)),
+    'billing': int(os.getenv('ASYNC_BILLING_WORKERS', 16)),
+    'wsgi': int(os.getenv('ASYNC_WSGI_WORKERS', 32)),
+}
+
+_executors = {}
+
+def get_executor(backend):
+    """Return the thread pool used for calls to `backend`"""
+    executor = _executors.get(backend)
+    if executor is None:
+        executor = _executors.setdefault(backend, ThreadPoolExecutor(
+            max_workers=EXECUTOR_SIZES[backend],
+            thread_name_prefix=f'asgi-{backend}'
+        ))
+    return executor
+
+async def run_blocking(backend, fn, *args, **kwargs):
+    """Run a blocking call on the executor for `backend` without blocking the loop"""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    call = functools.partial(ctx.run, fn, *args, **kwargs)
+    return await loop.run_in_executor(get_executor(backend), call)
+
+def shutdown_executors():
+    for executor in _executors.values():
+        executor.shutdown(wait=False)
+    _executors.clear()
+
+def _with_app_context(fn, *args, **kwargs):
+    # Gives borrow_connection() a request-scoped connection that is released
+    # when the context ends, exactly as in a Flask request
+    with app.app_context():
+        return fn(*args, **kwargs)
+
+# Routes served on a dedicated executor: (method, path regex, backend)
+ROUTE_BACKENDS = [
+    ('GET', re.compile(r'^/api/sessions$'), 'db'),
+    (None, re.compile(r'^/api/sessions/\d+$'), 'db'),
+    ('POST', re.compile(r'^/api/billing/checkout$'), 'billing'),
+    ('GET', re.compile(r'^/api/billing/portal$'), 'billing'),
+    (None, re.compile(r'^/api/billing/(usage|quota|settings)$'), 'db'),
+    ('POST', re.compile(r'^/api/webhooks/lemonsqueezy$'), 'db'),
+]
+
+
+# ============================================================================
+# WSGI BRIDGE
+# ============================================================================
+
+def build_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP scope and a fully read body"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': unquote(scope['path']),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for raw_name, raw_value in scope.get('headers', []):
+        name = raw_name.decode('latin-1').upper().replace('-', '_')
+        value = raw_value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+def _start_wsgi(environ):
+    """
+    Call the Flask WSGI app; returns (status, headers, body, chunks)
+
+    A response with a Content-Length is already in memory and comes back
+    whole as `body`; any other (a streamed response) comes back as the
+    `chunks` iterable, to be read chunk by chunk and then closed.
+    """
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [
+            (name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers
+        ]
+
+    result = app.wsgi_app(environ, start_response)
+    if any(name == b'content-length' for name, _ in response['headers']):
+        try:
+            return response['status'], response['headers'], b''.join(result), None
+        finally:
+            _close_wsgi(result)
+    return response['status'], response['headers'], None, result
+
+def _close_wsgi(result):
+    if hasattr(result, 'close'):
+        result.close()
+
+async def call_wsgi(scope, body, send, backend='wsgi'):
+    """
+    Serve a request with the Flask WSGI app on the given backend executor
+
+    Streamed responses are forwarded chunk by chunk as the view produces
+    them. Every call into the app runs in one context: a streamed view
+    re-enters its request context on each chunk, each time on whichever
+    executor thread is free.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_executor(backend)
+    ctx = contextvars.copy_context()
+    status, headers, payload, chunks = await loop.run_in_executor(
+        executor, ctx.run, _start_wsgi, build_environ(scope, body)
+    )
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    if chunks is None:
+        await send({'type': 'http.response.body', 'body': payload})
+        return
+
+    iterator = iter(chunks)
+    pending = None
+    try:
+        while True:
+            pending = executor.submit(ctx.run, next, iterator, None)
+            chunk = await asyncio.wrap_future(pending)
+            if chunk is None:
+                break
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if pending is None or pending.done():
+            await loop.run_in_executor(executor, ctx.run, _close_wsgi, chunks)
+        else:
+            # Cancelled (client gone) while the view was producing a chunk:
+            # close once it returns, since the context is still in use
+            pending.add_done_callback(lambda _: executor.submit(ctx.run, _close_wsgi, chunks))
+
+
+# ============================================================================
+# NATIVE CHAT PIPELINE
+# ============================================================================
+
+def _load_current_user(environ):
+    # Resolves the user from the Flask session / remember cookie
+    with app.request_context(environ):
+        user = current_user._get_current_object()
+        return user if user.is_authenticated else None
+
+def _prepare_turn(user_id, user_message, session_id, model_id):
+    with borrow_connection() as connection:
+        return prepare_chat_turn(connection, user_id, user_message, session_id, model_id)
+
+def _finish_turn(user_id, session_id, assistant_message, model_id, usage, is_overage):
+    with borrow_connection() as connection:
+        save_chat_reply(connection, user_id, session_id, assistant_message, model_id, usage, is_overage)
+
+def _open_stream(model_id, request_body):
+    logger.info("Calling Bedrock (stream) - Model: %s", model_id)
+    response = get_bedrock_router().invoke_model_with_response_stream(
+        modelId=model_id,
+        body=json.dumps(request_body)
+    )
+    return iter_stream_chunks(response)
+
+async def _send_json(send, status, payload):
+    headers = [(b'content-type', b'application/json')]
+    if payload.get('retryable'):
+        headers.append((b'retry-after', str(BEDROCK_RETRY_AFTER).encode('latin-1')))
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': headers,
+    })
+    await send({'type': 'http.response.body', 'body': app.json.dumps(payload).encode('utf-8')})
+
+async def _release(user_id):
+    await run_blocking('db', _with_app_context, release_user_quota, user_id)
+
+async def _timed(coro, timer, stage):
+    started = time.monotonic()
+    result = await coro
+    timer.record(stage, (time.monotonic() - started) * 1000)
+    return result
+
+async def _await_search(task, deadline):
+    """Wait for a started search until `deadline`; "" if it misses it"""
+    if task is None:
+        return ""
+    try:
+        # Shielded so a search that misses the budget still fills the cache
+        return await asyncio.wait_for(asyncio.shield(task), max(0.0, deadline - time.monotonic()))
+    except asyncio.TimeoutError:
+        logger.warning(f"Web search missed its {SEARCH_LATENCY_BUDGET_MS} ms budget; continuing without it")
+    except Exception as e:
+        logger.error(f"Web search error: {e}")
+    return ""
+
+async def _begin_turn(user, body, timer):
+    """
+    Run the pre-model phase of a chat turn
+
+    Returns (error_status, error_payload) on failure, otherwise
+    (None, (session_id, model_id, request_body, quota_info)). On success the
+    request holds a quota reservation the caller must release if the turn
+    is not saved.
+    """
+    data = json.loads(body)
+    user_message = data.get('message', '').strip()
+    session_id = data.get('session_id')
+    model_id = data.get('model', MODEL_ID)
+
+    if not user_message:
+        return 400, {'error': 'Message is required'}
+
+    quota_info = await _timed(
+        run_blocking('db', _with_app_context, reserve_user_quota, user.id), timer, 'quota'
+    )
+    if not quota_info.get('allowed', False):
+        return 429, {
+            'error': quota_info.get('message', 'Quota exceeded'),
+            'quota_exceeded': True,
+            'quota_info': quota_info
+        }
+
+    search = None
+    try:
+        # Search (if needed) runs while the history is loaded
+        if needs_web_search(user_message):
+            deadline = time.monotonic() + SEARCH_LATENCY_BUDGET_MS / 1000
+            search = asyncio.ensure_future(_timed(
+                run_blocking('search', fetch_search_context, user_message), timer, 'search'
+            ))
+
+        session_id, history = await _timed(run_blocking(
+            'db', _with_app_context, _prepare_turn, user.id, user_message, session_id, model_id
+        ), timer, 'history')
+        if session_id is None:
+            await _release(user.id)
+            return 403, {'error': 'Invalid session'}
+
+        search_context = await _timed(_await_search(search, deadline), timer, 'search_wait') if search else ""
+        request_body = build_request_body(
+            model_id, build_chat_messages(history, user_message, search_context)
+        )
+    except Exception:
+        await _release(user.id)
+        raise
+    return None, (session_id, model_id, request_body, quota_info, search is not None)
+
+async def chat(user, body, send):
+    """Async equivalent of app.chat()"""
+    timer = StageTimer('chat')
+    try:
+        status, result = await _begin_turn(user, body, timer)
+        if status is not None:
+            return await _send_json(send, status, result)
+        session_id, model_id, request_body, quota_info, searched = result
+    except Exception as e:
+        logger.error(f"Chat error: {e}")
+        return await _send_json(send, *chat_error(e))
+
+    try:
+        assistant_message, usage = await _timed(
+            run_blocking('bedrock', invoke_chat_model, model_id, request_body), timer, 'model'
+        )
+        await _timed(run_blocking(
+            'db', _with_app_context, _finish_turn, user.id, session_id, assistant_message, model_id, usage,
+            quota_info['is_overage']
+        ), timer, 'save')
+    except Exception as e:
+        logger.error(f"Chat error: {e}")
+        await _release(user.id)
+        return await _send_json(send, *chat_error(e))
+    timer.log(model_id=model_id, search=searched)
+    await _send_json(send, 200, {
+        'response': assistant_message,
+        'session_id': session_id,
+        'model': model_id,
+        'usage': usage,
+        'quota_info': quota_info
+    })
+
+async def chat_stream(user, body, send):
+    """Async equivalent of app.chat_stream()"""
+    timer = StageTimer('chat_stream')
+    try:
+        status, result = await _begin_turn(user, body, timer)
+        if status is not None:
+            return await _send_json(send, status, result)
+        session_id, model_id, request_body, quota_info, searched = result
+    except Exception as e:
+        logger.error(f"Chat error: {e}")
+        return await _send_json(send, *chat_error(e))
+
+    async def emit(event):
+        line = json.dumps(event, ensure_ascii=False, default=str) + '\n'
+        await send({'type': 'http.response.body', 'body': line.encode('utf-8'), 'more_body': True})
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'application/x-ndjson'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    await emit({'type': 'start', 'session_id': session_id, 'model': model_id})
+    parts = []
+    usage = None
+    saved = False
+    try:
+        adapter = get_adapter(model_id)
+        started = time.monotonic()
+        chunks = await run_blocking('bedrock', _open_stream, model_id, request_body)
+        while True:
+            chunk = await run_blocking('bedrock', next, chunks, None)
+            if chunk is None:
+                break
+            text, chunk_usage = adapter.parse_stream_chunk(chunk)
+            if chunk_usage:
+                usage = chunk_usage
+            if text:
+                if not parts:
+                    timer.record('first_token', (time.monotonic() - started) * 1000)
+                parts.append(text)
+                await emit({'type': 'token', 'text': text})
+        timer.record('model', (time.monotonic() - started) * 1000)
+
+        assistant_message = ''.join(parts)
+        usage = usage or {}
+        if not usage.get('latency_ms'):
+            usage['latency_ms'] = int((time.monotonic() - started) * 1000)
+        await _timed(run_blocking(
+            'db', _with_app_context, _finish_turn, user.id, session_id, assistant_message, model_id, usage,
+            quota_info['is_overage']
+        ), timer, 'save')
+        saved = True
+        timer.log(model_id=model_id, search=searched)
+        await emit({
+            'type': 'done',
+            'response': assistant_message,
+            'session_id': session_id,
+            'model': model_id,
+            'usage': usage,
+            'quota_info': quota_info
+        })
+    except Exception as e:
+        logger.error(f"Chat stream error: {e}")
+        _, error = chat_error(e)
+        await emit(dict(error, type='error'))
+    finally:
+        # Failed or cancelled before the reply was saved
+        if not saved:
+            await _release(user.id)
+    await send({'type': 'http.response.body', 'body': b''})
+
+NATIVE_ROUTES = {
+    ('POST', '/api/chat'): chat,
+    ('POST', '/api/chat/stream'): chat_stream,
+}
+
+
+# ============================================================================
+# ASGI ENTRY POINT
+# ============================================================================
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            shutdown_executors()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+def _metered_send(send, method, route):
+    """
+    Wrap `send` so the response start is recorded like Flask's after_request
+    does for bridged requests (native routes never reach those hooks)
+    """
+    started = time.perf_counter()
+
+    async def metered(message):
+        if message['type'] == 'http.response.start':
+            metrics.observe_request(method, route, message['status'], time.perf_counter() - started)
+        await send(message)
+    return metered
+
+async def application(scope, receive, send):
+    """ASGI application serving ZED AI"""
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    # Tag this request's log records, and hand the same ID to Flask views
+    headers = dict(scope.get('headers', []))
+    request_id = set_request_id(headers.get(b'x-request-id', b'').decode('latin-1'))
+    scope = dict(scope, headers=[(name, value) for name, value in scope.get('headers', [])
+                                 if name != b'x-request-id'] + [(b'x-request-id', request_id.encode('latin-1'))])
+
+    body = await _read_body(receive)
+    method = scope['method']
+    path = scope['path']
+
+    handler = NATIVE_ROUTES.get((method, path))
+    if handler is not None:
+        user = await run_blocking(
+            'db', _load_current_user, build_environ(scope, b'')
+        )
+        if user is not None:
+            root = tracing.start_trace(
+                f'{method} {path}', request_id=request_id,
+                traceparent=headers.get(b'traceparent', b'').decode('latin-1'),
+                **{'http.method': method, 'http.route': path}
+            )
+            try:
+                await handler(user, body, _metered_send(send, method, path))
+            except BaseException as e:
+                tracing.end_trace(root, e)
+                raise
+            tracing.end_trace(root)
+            return
+        # Let Flask-Login answer unauthenticated requests as usual
+        return await call_wsgi(scope, body, send)
+
+    for route_method, pattern, backend in ROUTE_BACKENDS:
+        if (route_method is None or route_method == method) and pattern.match(path):
+            return await call_wsgi(scope, body, send, backend)
+
+    await call_wsgi(scope, body, send)
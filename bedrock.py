@@ -0,0 +1,551 @@
+"""
+Bedrock client for ZED AI
+bedrock-runtime clients built for many concurrent callers: a connection
+pool sized to the worker count, standard-mode retries (jittered backoff
+under a throttling-aware retry quota), per-model read timeouts and TCP
+keepalive, with counts of the calls, retries and throttles they see
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+from dotenv import load_dotenv
+
+import tracing
+from providers import REGION_PREFIXES
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Bedrock client configuration
+BEDROCK_REGION = os.getenv('AWS_REGION', 'eu-north-1')
+# Empty uses the regional AWS endpoint; set to a local stub for testing
+BEDROCK_ENDPOINT_URL = os.getenv('BEDROCK_ENDPOINT_URL', '')
+# Pooled connections; defaults to the async Bedrock executor size so no
+# worker ever waits for a connection
+BEDROCK_POOL_SIZE = int(os.getenv('BEDROCK_POOL_SIZE') or os.getenv('ASYNC_BEDROCK_WORKERS') or 256)
+# 'standard' (jittered backoff, throttling-aware retry quota), 'adaptive'
+# (standard plus a client-side rate limiter, which holds throughput down long
+# after a burst of throttles; see bench_bedrock.py) or 'legacy'
+BEDROCK_RETRY_MODE = os.getenv('BEDROCK_RETRY_MODE', 'standard')
+# Attempts per call, the first one included
+BEDROCK_MAX_ATTEMPTS = int(os.getenv('BEDROCK_MAX_ATTEMPTS', 4))
+BEDROCK_CONNECT_TIMEOUT = float(os.getenv('BEDROCK_CONNECT_TIMEOUT', 5))
+# Seconds without a byte from Bedrock before a call fails (between stream
+# events when streaming)
+BEDROCK_READ_TIMEOUT = float(os.getenv('BEDROCK_READ_TIMEOUT', 60))
+# Per-model read timeouts, "model-id-prefix=seconds,..." matched against
+# the model ID without its cross-region prefix, longest prefix first
+BEDROCK_MODEL_TIMEOUTS = os.getenv('BEDROCK_MODEL_TIMEOUTS', '')
+BEDROCK_TCP_KEEPALIVE = os.getenv('BEDROCK_TCP_KEEPALIVE', 'true').lower() == 'true'
+# Retry-After (seconds) sent to users when Bedrock throttles after all retries
+BEDROCK_RETRY_AFTER = int(os.getenv('BEDROCK_RETRY_AFTER', 2))
+
+# Routing over several regions/accounts: a JSON list of targets (see
+# parse_targets), or just a comma-separated list of regions; AWS_REGION alone
+# when both are empty
+BEDROCK_TARGETS = os.getenv('BEDROCK_TARGETS', '')
+BEDROCK_REGIONS = os.getenv('BEDROCK_REGIONS', '')
+# Attempts per client when there are several targets (failover replaces retries)
+BEDROCK_FAILOVER_MAX_ATTEMPTS = int(os.getenv('BEDROCK_FAILOVER_MAX_ATTEMPTS', 2))
+# Seconds a throttled or failing target is avoided, doubling per consecutive failure (up to 8x)
+BEDROCK_THROTTLE_COOLDOWN = float(os.getenv('BEDROCK_THROTTLE_COOLDOWN', 5))
+# Look up each region's models and inference profiles (needs bedrock:List*)
+BEDROCK_DISCOVERY = os.getenv('BEDROCK_DISCOVERY', 'true').lower() == 'true'
+BEDROCK_DISCOVERY_INTERVAL = float(os.getenv('BEDROCK_DISCOVERY_INTERVAL', 3600))
+
+# Error codes Bedrock returns when the caller is sending too much
+THROTTLE_CODES = frozenset({'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException'})
+# Error codes worth retrying later, with the HTTP status shown to users
+RETRYABLE_STATUS = {
+    'ThrottlingException': 429,
+    'TooManyRequestsException': 429,
+    'ServiceQuotaExceededException': 429,
+    'ServiceUnavailableException': 503,
+    'ModelNotReadyException': 503,
+    'InternalServerException': 503,
+    'ModelTimeoutException': 504,
+}
+# Errors that send a routed call to the next target, and those that also
+# mean the model is not available to the target's region or account
+UNAVAILABLE_CODES = frozenset({'AccessDeniedException', 'ResourceNotFoundException'})
+FAILOVER_CODES = THROTTLE_CODES | UNAVAILABLE_CODES | {
+    'ServiceUnavailableException', 'ModelNotReadyException', 'InternalServerException'
+}
+# Cross-region inference profile prefixes and the regions that serve them
+PROFILE_REGION_PREFIXES = (('us-gov.', 'us-gov-'), ('us.', 'us-'), ('eu.', 'eu-'), ('apac.', 'ap-'), ('global.', ''))
+# Distinct model IDs counted separately in stats(); the rest share 'other'
+STATS_MAX_MODELS = 64
+
+
+def parse_model_timeouts(spec: str) -> Dict[str, float]:
+    """'prefix=seconds,...' to {prefix: seconds}"""
+    timeouts = {}
+    for item in spec.split(','):
+        prefix, _, seconds = item.strip().partition('=')
+        if prefix and seconds:
+            timeouts[prefix.strip()] = float(seconds)
+    return timeouts
+
+def error_status(error: Exception) -> Optional[int]:
+    """
+    HTTP status for a Bedrock failure the user should simply retry (429 when
+    throttled, 503 when unavailable, 504 on timeouts), or None
+    """
+    if isinstance(error, ClientError):
+        return RETRYABLE_STATUS.get(error.response.get('Error', {}).get('Code'))
+    if isinstance(error, (ReadTimeoutError, ConnectTimeoutError)):
+        return 504
+    return None
+
+
+class BedrockClientFactory:
+    """
+    Hands out bedrock-runtime clients, one per distinct read timeout
+
+    Clients are created lazily from one boto3 session (client creation is
+    not thread-safe on the shared default session) and share the counters
+    behind stats(). Each client has its own connection pool and, in the
+    default standard retry mode, its own retry quota; no client-side rate
+    limiter unless retry_mode='adaptive'.
+    """
+
+    def __init__(self, region=BEDROCK_REGION, endpoint_url=BEDROCK_ENDPOINT_URL or None,
+                 pool_size=BEDROCK_POOL_SIZE, retry_mode=BEDROCK_RETRY_MODE,
+                 max_attempts=BEDROCK_MAX_ATTEMPTS, connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+                 read_timeout=BEDROCK_READ_TIMEOUT, model_timeouts=None,
+                 tcp_keepalive=BEDROCK_TCP_KEEPALIVE, session=None, control_endpoint_url=None):
+        self.region = region
+        self.endpoint_url = endpoint_url
+        self.control_endpoint_url = control_endpoint_url
+        self.pool_size = pool_size
+        self.retry_mode = retry_mode
+        self.max_attempts = max_attempts
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        if model_timeouts is None:
+            model_timeouts = parse_model_timeouts(BEDROCK_MODEL_TIMEOUTS)
+        # Longest prefix wins
+        self.model_timeouts = sorted(model_timeouts.items(), key=lambda item: -len(item[0]))
+        self.tcp_keepalive = tcp_keepalive
+        self._session = session or boto3.session.Session(
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+        )
+        self._clients = {}  # read timeout -> client
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'errors': 0, 'retries': 0, 'throttled': 0, 'timeouts': 0}
+        self._models = {}
+
+    def read_timeout_for(self, model_id: Optional[str]) -> float:
+        if model_id:
+            base = model_id
+            for region_prefix in REGION_PREFIXES:
+                if base.startswith(region_prefix):
+                    base = base[len(region_prefix):]
+                    break
+            for prefix, seconds in self.model_timeouts:
+                if base.startswith(prefix):
+                    return seconds
+        return self.read_timeout
+
+    def client(self, model_id: Optional[str] = None):
+        """The client for `model_id` (its read timeout), created on first use"""
+        read_timeout = self.read_timeout_for(model_id)
+        client = self._clients.get(read_timeout)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(read_timeout)
+                if client is None:
+                    client = self._clients[read_timeout] = self._create(read_timeout)
+        return client
+
+    def _create(self, read_timeout):
+        config = Config(
+            region_name=self.region,
+            max_pool_connections=self.pool_size,
+            connect_timeout=self.connect_timeout,
+            read_timeout=read_timeout,
+            retries={'mode': self.retry_mode, 'total_max_attempts': self.max_attempts},
+            tcp_keepalive=self.tcp_keepalive,
+        )
+        client = self._session.client('bedrock-runtime', endpoint_url=self.endpoint_url, config=config)
+        events = client.meta.events
+        events.register('before-parameter-build.bedrock-runtime.*', self._before_call)
+        events.register('needs-retry.bedrock-runtime.*', self._on_attempt)
+        events.register('after-call.bedrock-runtime.*', self._after_call)
+        events.register('after-call-error.bedrock-runtime.*', self._after_call_error)
+        tracing.instrument_botocore(client)
+        logger.info("Bedrock client created (region %s, pool %d, %s retries x%d, read timeout %ss)",
+                    self.region, self.pool_size, self.retry_mode, self.max_attempts, read_timeout)
+        return client
+
+    def discover_models(self) -> set:
+        """Active on-demand foundation model IDs and inference profile IDs of this region"""
+        control = self._session.client(
+            'bedrock', region_name=self.region, endpoint_url=self.control_endpoint_url,
+            config=Config(connect_timeout=self.connect_timeout, read_timeout=30, retries={'mode': 'standard'})
+        )
+        models = {
+            model['modelId'] for model in control.list_foundation_models().get('modelSummaries', [])
+            if model.get('modelLifecycle', {}).get('status') == 'ACTIVE'
+            and 'ON_DEMAND' in model.get('inferenceTypesSupported', ['ON_DEMAND'])
+        }
+        for page in control.get_paginator('list_inference_profiles').paginate():
+            models.update(profile['inferenceProfileId'] for profile in page.get('inferenceProfileSummaries', []))
+        return models
+
+    def _model_stats(self, model_id):
+        # Caller holds self._lock
+        key = model_id or ''
+        if key not in self._models and len(self._models) >= STATS_MAX_MODELS:
+            key = 'other'
+        stats = self._models.get(key)
+        if stats is None:
+            stats = self._models[key] = {'calls': 0, 'errors': 0, 'retries': 0, 'throttled': 0}
+        return stats
+
+    def _count(self, model_id, **counts):
+        with self._lock:
+            model_stats = self._model_stats(model_id)
+            for name, amount in counts.items():
+                self._stats[name] += amount
+                if name in model_stats:
+                    model_stats[name] += amount
+
+    def _before_call(self, params, context, **kwargs):
+        context['bedrock_model_id'] = params.get('modelId')
+
+    def _on_attempt(self, response=None, caught_exception=None, request_dict=None, **kwargs):
+        # Runs after every attempt, before the retry handler decides
+        model_id = ((request_dict or {}).get('context') or {}).get('bedrock_model_id')
+        if response is not None:
+            if response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+                self._count(model_id, throttled=1)
+        elif isinstance(caught_exception, (ReadTimeoutError, ConnectTimeoutError)):
+            self._count(model_id, timeouts=1)
+
+    def _after_call(self, http_response, parsed, context, **kwargs):
+        self._count(
+            context.get('bedrock_model_id'), calls=1,
+            retries=parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0),
+            errors=int(http_response.status_code >= 400)
+        )
+
+    def _after_call_error(self, exception, context, **kwargs):
+        self._count(context.get('bedrock_model_id'), calls=1, errors=1)
+
+    def stats(self):
+        """Settings, call/error/retry/throttle/timeout counts and the same per model ID"""
+        with self._lock:
+            return dict(
+                self._stats,
+                pool_size=self.pool_size,
+                max_attempts=self.max_attempts,
+                clients=len(self._clients),
+                models={model: dict(stats) for model, stats in self._models.items()},
+            )
+
+
+class NoTargetAvailable(Exception):
+    """Raised when no configured region or account serves the requested model"""
+
+
+class BedrockTarget:
+    """
+    One region/account calls can be routed to, with its health: smoothed
+    latency of successful calls, error and throttle rates, calls in flight
+    and a cooldown after throttling
+    """
+
+    def __init__(self, name, factory, weight=1.0, models=None, max_in_flight=0):
+        self.name = name
+        self.factory = factory
+        self.region = factory.region
+        # Profile prefix of the region's group; us-gov- is matched before us-
+        self.profile_prefix = next((prefix for prefix, region_prefix in PROFILE_REGION_PREFIXES
+                                    if region_prefix and self.region.startswith(region_prefix)), None)
+        self.weight = weight
+        # Model and inference profile IDs served here; None until known (all
+        # allowed). A configured list is never replaced by discovery.
+        self.models = set(models) if models else None
+        self.static_models = bool(models)
+        self.unavailable = set()  # refused with AccessDenied/ResourceNotFound
+        self.max_in_flight = max_in_flight
+        self.latency_ms = None
+        self.error_rate = 0.0
+        self.throttle_rate = 0.0
+        self.in_flight = 0
+        self.throttle_streak = 0
+        self.cooldown_until = 0.0
+        self.calls = 0
+        self.failovers = 0
+
+    def serves(self, model_id: str) -> bool:
+        if model_id in self.unavailable:
+            return False
+        # Cross-region inference profiles only exist in their region group
+        for prefix, region_prefix in PROFILE_REGION_PREFIXES:
+            if model_id.startswith(prefix):
+                if region_prefix and prefix != self.profile_prefix:
+                    return False
+                break
+        return self.models is None or model_id in self.models
+
+    def score(self, default_latency_ms: float) -> float:
+        """Expected cost of one more call here; lower is better"""
+        latency = self.latency_ms if self.latency_ms is not None else default_latency_ms
+        return latency * (1 + self.in_flight) / self.weight * (1 + 4 * self.error_rate + 4 * self.throttle_rate)
+
+    def stats(self, now):
+        return {
+            'region': self.region,
+            'weight': self.weight,
+            'latency_ms': round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            'error_rate': round(self.error_rate, 4),
+            'throttle_rate': round(self.throttle_rate, 4),
+            'in_flight': self.in_flight,
+            'cooldown_s': round(max(0.0, self.cooldown_until - now), 1),
+            'calls': self.calls,
+            'failovers': self.failovers,
+            'models_known': len(self.models) if self.models is not None else None,
+        }
+
+
+class BedrockRouter:
+    """
+    Spreads Bedrock calls over several regions/accounts and fails over
+
+    Each call goes to the target serving the model with the lowest
+    latency x (1 + calls in flight) / weight, inflated by its error and
+    throttle rates; targets cooling down after a throttle, outage or
+    connect failure, or at their max_in_flight, are used only when nothing
+    else serves the model.
+    Throttling, unavailability and connect failures move the call to the
+    next target; streaming calls fail over only before the stream opens.
+    With a single target calls pass straight through.
+    """
+
+    def __init__(self, targets, throttle_cooldown=BEDROCK_THROTTLE_COOLDOWN, ewma_alpha=0.2):
+        if not targets:
+            raise ValueError("BedrockRouter needs at least one target")
+        self.targets = list(targets)
+        self.throttle_cooldown = throttle_cooldown
+        self.ewma_alpha = ewma_alpha
+        self._lock = threading.Lock()
+        self._failovers = 0
+        self._exhausted = 0
+
+    def client(self, model_id: Optional[str] = None):
+        """Client of the first target (for warm-up and single-region callers)"""
+        return self.targets[0].factory.client(model_id)
+
+    def invoke_model(self, modelId, **kwargs):
+        return self._call('invoke_model', modelId, kwargs)
+
+    def invoke_model_with_response_stream(self, modelId, **kwargs):
+        return self._call('invoke_model_with_response_stream', modelId, kwargs)
+
+    def converse(self, modelId, **kwargs):
+        return self._call('converse', modelId, kwargs)
+
+    def _choose(self, model_id, tried):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [t for t in self.targets if t not in tried and t.serves(model_id)]
+            if not candidates:
+                return None
+            known = [t.latency_ms for t in candidates if t.latency_ms is not None]
+            # Targets without samples look as fast as the fastest, so they get tried
+            default_latency = min(known) if known else 1.0
+            ready = [t for t in candidates if t.cooldown_until <= now
+                     and not (t.max_in_flight and t.in_flight >= t.max_in_flight)]
+            if ready:
+                target = min(ready, key=lambda t: (t.score(default_latency), random.random()))
+            else:
+                target = min(candidates, key=lambda t: t.cooldown_until)
+            target.in_flight += 1
+            target.calls += 1
+            return target
+
+    def _finish(self, target, elapsed_ms=None, failed=False, throttled=False, cool_down=False):
+        alpha = self.ewma_alpha
+        with self._lock:
+            target.in_flight -= 1
+            if elapsed_ms is not None:
+                target.latency_ms = elapsed_ms if target.latency_ms is None \
+                    else target.latency_ms + alpha * (elapsed_ms - target.latency_ms)
+            target.error_rate += alpha * (failed - target.error_rate)
+            target.throttle_rate += alpha * (throttled - target.throttle_rate)
+            if throttled or cool_down:
+                target.throttle_streak += 1
+                target.cooldown_until = time.monotonic() + \
+                    self.throttle_cooldown * min(2 ** (target.throttle_streak - 1), 8)
+            elif not failed:
+                target.throttle_streak = 0
+
+    def _call(self, operation, model_id, kwargs):
+        if len(self.targets) == 1:
+            return getattr(self.client(model_id), operation)(modelId=model_id, **kwargs)
+        tried = []
+        last_error = None
+        while True:
+            target = self._choose(model_id, tried)
+            if target is None:
+                break
+            if tried:
+                with self._lock:
+                    self._failovers += 1
+                    tried[-1].failovers += 1
+                logger.warning("Bedrock %s for %s failed over from %s to %s: %s",
+                               operation, model_id, tried[-1].name, target.name, last_error)
+            tried.append(target)
+            started = time.monotonic()
+            try:
+                result = getattr(target.factory.client(model_id), operation)(modelId=model_id, **kwargs)
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                self._finish(target, failed=True, throttled=code in THROTTLE_CODES,
+                             cool_down=code in FAILOVER_CODES and code not in UNAVAILABLE_CODES)
+                if code in UNAVAILABLE_CODES:
+                    with self._lock:
+                        target.unavailable.add(model_id)
+                elif code not in FAILOVER_CODES:
+                    raise
+                last_error = e
+                continue
+            except (EndpointConnectionError, ConnectTimeoutError) as e:
+                self._finish(target, failed=True, cool_down=True)
+                last_error = e
+                continue
+            except Exception:
+                self._finish(target, failed=True)
+                raise
+            self._finish(target, elapsed_ms=(time.monotonic() - started) * 1000)
+            return result
+        with self._lock:
+            self._exhausted += 1
+        if last_error is not None:
+            raise last_error
+        raise NoTargetAvailable(f"No configured Bedrock region serves {model_id}")
+
+    def discover(self):
+        """
+        Fill in each target's models from its region's foundation models
+        (active, on-demand) and inference profiles, as check_models.py lists
+        them; targets configured with a models list keep it
+        """
+        for target in self.targets:
+            if target.static_models:
+                continue
+            try:
+                models = target.factory.discover_models()
+            except Exception as e:
+                logger.warning("Bedrock model discovery failed for %s: %s", target.name, e)
+                continue
+            with self._lock:
+                target.models = models
+                target.unavailable.clear()
+            logger.info("Bedrock target %s serves %d models and profiles", target.name, len(models))
+
+    def start_discovery(self, interval=BEDROCK_DISCOVERY_INTERVAL):
+        """Discover now and every `interval` seconds in a background thread"""
+        def run():
+            while True:
+                self.discover()
+                time.sleep(interval)
+        threading.Thread(target=run, name='bedrock-discovery', daemon=True).start()
+
+    def stats(self):
+        """
+        Call/error/retry/throttle/timeout totals and per-model counts across
+        all targets, failover counts, and each target's health
+        """
+        now = time.monotonic()
+        totals = {'calls': 0, 'errors': 0, 'retries': 0, 'throttled': 0, 'timeouts': 0}
+        models = {}
+        for target in self.targets:
+            factory_stats = target.factory.stats()
+            for name in totals:
+                totals[name] += factory_stats[name]
+            for model, counts in factory_stats['models'].items():
+                merged = models.setdefault(model, dict.fromkeys(counts, 0))
+                for name, value in counts.items():
+                    merged[name] += value
+        with self._lock:
+            return dict(
+                totals,
+                failovers=self._failovers,
+                exhausted=self._exhausted,
+                models=models,
+                targets={target.name: target.stats(now) for target in self.targets},
+            )
+
+
+def parse_targets(spec: str = BEDROCK_TARGETS, regions: str = BEDROCK_REGIONS) -> List[Dict]:
+    """
+    Target settings from BEDROCK_TARGETS (a JSON list of {"region", "name",
+    "profile", "endpoint_url", "weight", "models", "max_in_flight"}), else
+    one per region in BEDROCK_REGIONS, else AWS_REGION alone
+    """
+    if spec:
+        targets = json.loads(spec)
+    else:
+        targets = [{'region': region.strip()} for region in (regions or BEDROCK_REGION).split(',') if region.strip()]
+    for target in targets:
+        target.setdefault('name', target['region'] if not target.get('profile')
+                          else f"{target['profile']}@{target['region']}")
+    return targets
+
+def build_router(targets: Optional[List[Dict]] = None, **factory_settings) -> BedrockRouter:
+    """
+    A router over `targets` (parse_targets() by default). With several
+    targets each client gives up after BEDROCK_FAILOVER_MAX_ATTEMPTS so a
+    throttled region hands the call on instead of backing off.
+    """
+    targets = parse_targets() if targets is None else targets
+    if len(targets) > 1:
+        factory_settings.setdefault('max_attempts', BEDROCK_FAILOVER_MAX_ATTEMPTS)
+    built = []
+    for target in targets:
+        session = boto3.session.Session(profile_name=target['profile']) if target.get('profile') else None
+        factory = BedrockClientFactory(
+            region=target['region'], endpoint_url=target.get('endpoint_url') or BEDROCK_ENDPOINT_URL or None,
+            session=session, control_endpoint_url=target.get('control_endpoint_url'), **factory_settings
+        )
+        built.append(BedrockTarget(target['name'], factory, weight=float(target.get('weight', 1.0)),
+                                   models=target.get('models'), max_in_flight=int(target.get('max_in_flight', 0))))
+    return BedrockRouter(built)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+def get_bedrock_router() -> BedrockRouter:
+    """Return the process-wide Bedrock router, built from the BEDROCK_* settings"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = build_router()
+                if BEDROCK_DISCOVERY and len(_router.targets) > 1:
+                    _router.start_discovery()
+    return _router
+
+def set_bedrock_router(router: Optional[BedrockRouter]):
+    """Replace the process-wide router (e.g. one over stub endpoints); None resets it"""
+    global _router
+    with _router_lock:
+        _router = router
+
+def bedrock_stats():
+    return get_bedrock_router().stats()
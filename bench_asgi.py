@@ -0,0 +1,207 @@
+"""
+Load test /api/chat against stubbed backends: the Flask app with one worker
+thread per in-flight request (as under a threaded WSGI server) against the
+ASGI application, at increasing numbers of concurrent chat turns.
+
+Bedrock is a bench_bedrock stub endpoint answering after --latency seconds;
+MySQL is a stub driver that answers every query after --db-latency seconds.
+Requests are driven in process, so the numbers are the app's own capacity
+without an HTTP server in front.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('WEBHOOK_ASYNC', 'false')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+
+import asgi
+import database
+from app import app
+from bedrock import build_router, set_bedrock_router
+from bench_bedrock import MODEL_ID, StubBedrock
+
+USER = {
+    'id': 1, 'username': 'bench', 'email': 'bench@example.com', 'monthly_quota': 10 ** 9,
+    'plan_name': 'Pro', 'overage_enabled': True, 'auto_stop_at_limit': False, 'requests_used': 0,
+    'current_period_start': None, 'current_period_end': None,
+}
+
+
+class StubCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 1
+        self.lastrowid = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, args=None):
+        time.sleep(self.connection.latency)
+        self.lastrowid = next(self.connection.ids)
+        self._rows = [dict(USER)] if 'FROM users' in query else []
+        self.rowcount = len(self._rows) if query.lstrip().upper().startswith('SELECT') else 1
+        return self.rowcount
+
+    def executemany(self, query, seq):
+        time.sleep(self.connection.latency)
+        return len(seq)
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return self._rows
+
+
+class StubConnection:
+    """Answers every query after `latency` seconds; users rows are USER"""
+
+    ids = itertools.count(1)
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def cursor(self):
+        return StubCursor(self)
+
+    def commit(self):
+        time.sleep(self.latency)
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+
+def session_cookie():
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(USER['id'])
+        session['_fresh'] = True
+    return f"session={client.get_cookie('session').value}".encode('latin-1')
+
+
+def chat_scope(cookie):
+    return {
+        'type': 'http', 'method': 'POST', 'path': '/api/chat', 'query_string': b'', 'http_version': '1.1',
+        'scheme': 'http', 'server': ('bench', 80), 'client': ('127.0.0.1', 0),
+        'headers': [(b'content-type', b'application/json'), (b'cookie', cookie)],
+    }
+
+
+BODY = app.json.dumps({'message': 'Hello there', 'model': MODEL_ID}).encode('utf-8')
+
+
+def wsgi_turn(scope):
+    """One chat turn through the Flask app; returns the status"""
+    status = {}
+
+    def start_response(line, headers, exc_info=None):
+        status['code'] = int(line.split(' ', 1)[0])
+
+    result = app.wsgi_app(asgi.build_environ(scope, BODY), start_response)
+    b''.join(result)
+    if hasattr(result, 'close'):
+        result.close()
+    return status['code']
+
+
+async def asgi_turn(scope):
+    """One chat turn through the ASGI application; returns the status"""
+    status = {}
+
+    async def receive():
+        return {'type': 'http.request', 'body': BODY, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+
+    await asgi.application(scope, receive, send)
+    return status['code']
+
+
+def load(turn, concurrency, turns):
+    """
+    `concurrency` clients each sending their next turn as soon as the last
+    one is answered, until `turns` are done; returns ([(status, seconds)],
+    elapsed seconds). Latency includes any wait for the server to pick the
+    turn up.
+    """
+    async def main():
+        remaining = iter(range(turns))
+        results = []
+
+        async def client():
+            for _ in remaining:
+                started = time.perf_counter()
+                status = await turn()
+                results.append((status, time.perf_counter() - started))
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return results, time.perf_counter() - started
+    return asyncio.run(main())
+
+
+def run_wsgi(scope, concurrency, turns, threads):
+    with ThreadPoolExecutor(threads) as server:
+        return load(lambda: asyncio.get_running_loop().run_in_executor(server, wsgi_turn, scope),
+                    concurrency, turns)
+
+
+def run_asgi(scope, concurrency, turns):
+    return load(lambda: asgi_turn(scope), concurrency, turns)
+
+
+def report(name, results, elapsed):
+    latencies = sorted(seconds for status, seconds in results if status == 200)
+    failed = len(results) - len(latencies)
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+    print(f"{name:>28}: {len(latencies) / elapsed:7.1f} turns/s  p50 {pick(0.5):7.0f} ms  "
+          f"p99 {pick(0.99):7.0f} ms  failed {failed}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test /api/chat on WSGI threads and on ASGI')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[32, 256, 1024],
+                        help='concurrent chat turns')
+    parser.add_argument('--turns', type=int, default=0, help='turns per run (default 4 x concurrency)')
+    parser.add_argument('--wsgi-threads', type=int, default=32, help='worker threads of the WSGI server')
+    parser.add_argument('--latency', type=float, default=0.5, help='stub Bedrock latency in seconds')
+    parser.add_argument('--db-latency', type=float, default=0.001, help='stub MySQL latency per query')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    stub = StubBedrock(args.latency, capacity=10 ** 6)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    set_bedrock_router(build_router([{'name': 'stub', 'region': 'us-east-1', 'models': [MODEL_ID],
+                                      'endpoint_url': f'http://127.0.0.1:{stub.server_port}'}],
+                                    pool_size=max(args.concurrency)))
+    database._pool = database.ConnectionPool(connect=lambda: StubConnection(args.db_latency), max_size=64)
+    scope = chat_scope(session_cookie())
+
+    print(f"Bedrock stub {args.latency * 1000:.0f} ms, MySQL stub {args.db_latency * 1000:.1f} ms per query, "
+          f"ASGI Bedrock executor {asgi.EXECUTOR_SIZES['bedrock']}")
+    for concurrency in args.concurrency:
+        turns = args.turns or concurrency * 4
+        print(f"\n{concurrency} concurrent turns, {turns} turns")
+        report(f'WSGI, {args.wsgi_threads} threads', *run_wsgi(scope, concurrency, turns, args.wsgi_threads))
+        report('ASGI', *run_asgi(scope, concurrency, turns))
+    stub.shutdown()
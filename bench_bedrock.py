@@ -0,0 +1,177 @@
+"""
+Benchmark Bedrock client settings against a local stub endpoint that
+answers InvokeModel after a fixed latency and throttles requests beyond
+its concurrency capacity: the botocore defaults (10 connections, legacy
+retries) against the BedrockClientFactory settings and adaptive retries.
+With --regions, route instead over several stubs of different speed and
+capacity, against sending everything to the first one.
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from botocore.exceptions import ClientError
+
+from bedrock import BedrockClientFactory, build_router, error_status
+
+# urllib3 warns for every connection dropped from a full pool
+logging.getLogger('urllib3.connectionpool').setLevel(logging.ERROR)
+
+MODEL_ID = 'amazon.nova-micro-v1:0'
+BODY = json.dumps({'messages': [{'role': 'user', 'content': [{'text': 'Hi'}]}]})
+
+
+class StubBedrock(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency, capacity, error=None):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.capacity = capacity
+        self.error = error  # (status, error type) every call fails with
+        self.requests = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.throttled = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, kept-alive
+    # connections would wait out the client's delayed ACK on every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def _reply(self, status, body, headers=()):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.error:
+            status, code = server.error
+            return self._reply(status, {'message': f'{code} from the stub'}, [('x-amzn-ErrorType', code)])
+        with server.lock:
+            throttle = server.in_flight >= server.capacity
+            if throttle:
+                server.throttled += 1
+            else:
+                server.in_flight += 1
+                server.peak = max(server.peak, server.in_flight)
+        if throttle:
+            return self._reply(429, {'message': 'Too many requests, please wait before trying again.'},
+                               [('x-amzn-ErrorType', 'ThrottlingException')])
+        try:
+            time.sleep(server.latency)
+            self._reply(200, {
+                'output': {'message': {'role': 'assistant', 'content': [{'text': 'Hello'}]}},
+                'usage': {'inputTokens': 5, 'outputTokens': 1, 'totalTokens': 6},
+            })
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+def run(client, calls, concurrency):
+    latencies, failures = [], {}
+
+    def call(_):
+        started = time.perf_counter()
+        try:
+            client.invoke_model(modelId=MODEL_ID, body=BODY)['body'].read()
+        except ClientError as e:
+            status = error_status(e) or 500
+            failures[status] = failures.get(status, 0) + 1
+            return
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(call, range(calls)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+    return {
+        'ok': len(latencies),
+        'failed': failures,
+        'throughput': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(pick(0.50), 1),
+        'p99_ms': round(pick(0.99), 1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare Bedrock client settings against a throttling stub')
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64, help='calling threads')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub model latency in seconds')
+    parser.add_argument('--capacity', type=int, default=48, help='concurrent calls the stub serves before throttling')
+    parser.add_argument('--regions', type=int, default=0, choices=[0, 2, 3], help='route over this many stub regions')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+
+    if args.regions:
+        # (latency, capacity) per stub region: fast but small, slower, slowest
+        profiles = [(args.latency, args.capacity), (args.latency * 2, args.capacity * 2), (args.latency * 4, args.capacity * 4)]
+        for routed in (False, True):
+            stubs = [StubBedrock(latency, capacity) for latency, capacity in profiles[:args.regions]]
+            for stub in stubs:
+                threading.Thread(target=stub.serve_forever, daemon=True).start()
+            targets = [{'name': f'stub-{i}', 'region': 'eu-north-1', 'endpoint_url': f'http://127.0.0.1:{stub.server_port}',
+                        'models': [MODEL_ID]} for i, stub in enumerate(stubs)]
+            router = build_router(targets if routed else targets[:1])
+            result = run(router, args.calls, args.concurrency)
+            stats = router.stats()
+            for stub in stubs:
+                stub.shutdown()
+            print(f"{'routed' if routed else 'first region only':>18}: {result['ok']} ok, failed {result['failed'] or 0}, "
+                  f"{result['throughput']}/s, p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms | "
+                  f"failovers {stats['failovers']}, stub throttles {sum(stub.throttled for stub in stubs)}")
+            if routed:
+                for name, target in stats['targets'].items():
+                    print(f"{name:>18}: {target['calls']} calls, latency {target['latency_ms']} ms, "
+                          f"throttle rate {target['throttle_rate']}, failovers {target['failovers']}")
+        raise SystemExit
+
+    settings = {
+        'botocore defaults': dict(pool_size=10, retry_mode='legacy', max_attempts=5, tcp_keepalive=False),
+        'factory settings': {},
+        'adaptive retries': dict(retry_mode='adaptive'),
+    }
+    for name, overrides in settings.items():
+        stub = StubBedrock(args.latency, args.capacity)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        factory = BedrockClientFactory(endpoint_url=f'http://127.0.0.1:{stub.server_port}', **overrides)
+        result = run(factory.client(MODEL_ID), args.calls, args.concurrency)
+        stats = factory.stats()
+        stub.shutdown()
+        print(f"{name:>18}: {result['ok']} ok, failed {result['failed'] or 0}, {result['throughput']}/s, "
+              f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms | stub {stub.connections} connections, "
+              f"peak {stub.peak} in flight, {stub.throttled} throttled | client retries {stats['retries']}, "
+              f"throttled {stats['throttled']}")
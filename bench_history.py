@@ -0,0 +1,194 @@
+"""
+Benchmark the history load of one chat turn as a session grows: the
+original full read of the session (ORDER BY created_at) against
+HistoryManager, with its tail cached in process or JSON-encoded as it would
+be in a shared cache.
+
+By default messages live in an in-memory table that answers the history
+queries; --mysql writes them to a throwaway user's session in the
+configured database (DB_* settings, run init_database first) and deletes
+the user, with its messages, at the end. Use a scratch database.
+"""
+
+import argparse
+import json
+import time
+import uuid
+from contextlib import nullcontext
+
+from cache import LRUCache
+from history import HistoryManager
+
+OLD_HISTORY_SQL = "SELECT role, content FROM messages WHERE session_id = %s ORDER BY created_at ASC"
+
+SESSION_ID = 1
+USER_TEXT = "Can you explain how the retry budget interacts with the regional failover we discussed? "
+ASSISTANT_TEXT = "The retry budget is spent per call, so a failover to the next region starts with the same budget. " * 4
+
+
+class MemoryMessages:
+    """In-memory messages table answering the history queries"""
+
+    def __init__(self):
+        self.session_id = SESSION_ID
+        self.rows = []
+        self._result = []
+
+    @property
+    def count(self):
+        return len(self.rows)
+
+    def add_many(self, messages):
+        for role, content in messages:
+            self.rows.append({'id': len(self.rows) + 1, 'role': role, 'content': content})
+
+    def connection(self):
+        return nullcontext(self)
+
+    def cursor(self):
+        return nullcontext(self)
+
+    def commit(self):
+        pass
+
+    def execute(self, query, args=None):
+        if 'ORDER BY id DESC LIMIT' in query:
+            result = self.rows[-args[1]:][::-1]
+        elif 'id > %s' in query:
+            result = self.rows[args[1]:]
+        elif 'ORDER BY created_at' in query:
+            result = self.rows
+        else:
+            raise ValueError(f'unexpected query: {query}')
+        self._result = [dict(row) for row in result]
+
+    def fetchall(self):
+        result, self._result = self._result, []
+        return result
+
+    def delete(self):
+        pass
+
+
+class MySQLMessages:
+    """A throwaway user and session in the configured database"""
+
+    def __init__(self):
+        name = f'bench-{uuid.uuid4().hex[:12]}'
+        self.count = 0
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO users (username, email, password_hash) VALUES (%s, %s, '-')",
+                               (name, f'{name}@bench.invalid'))
+                self.user_id = cursor.lastrowid
+                cursor.execute("""
+                    INSERT INTO chat_sessions (user_id, title, model_id, share_hash)
+                    VALUES (%s, 'bench', '', %s)
+                """, (self.user_id, uuid.uuid4().hex))
+                self.session_id = cursor.lastrowid
+            connection.commit()
+
+    def connection(self):
+        from database import borrow_connection
+        return borrow_connection()
+
+    def add_many(self, messages):
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.executemany("INSERT INTO messages (session_id, role, content) VALUES (%s, %s, %s)",
+                                   [(self.session_id, role, content) for role, content in messages])
+            connection.commit()
+        self.count += len(messages)
+
+    def delete(self):
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM users WHERE id = %s", (self.user_id,))
+            connection.commit()
+
+
+class CountingCursor:
+    """Passes queries through and counts the rows fetched"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.rows = 0
+
+    def execute(self, query, args=None):
+        return self._cursor.execute(query, args)
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self.rows += len(rows)
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self.rows += row is not None
+        return row
+
+
+class JSONStore(LRUCache):
+    """LRUCache holding values JSON-encoded, as RedisCache does"""
+
+    def get(self, key, default=None):
+        raw = super().get(key)
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        super().set(key, json.dumps(value), ttl)
+
+
+def old_load(cursor, session_id):
+    cursor.execute(OLD_HISTORY_SQL, (session_id,))
+    return cursor.fetchall()
+
+
+def run_turns(messages, loads, turns):
+    """
+    [(mean ms, mean rows read)] of each load over `turns` turns; every turn
+    adds a user message, runs each load, then adds the reply
+    """
+    totals = [[0.0, 0] for _ in loads]
+    for _ in range(turns):
+        messages.add_many([('user', USER_TEXT)])
+        with messages.connection() as connection:
+            for load, total in zip(loads, totals):
+                with connection.cursor() as cursor:
+                    counting = CountingCursor(cursor)
+                    started = time.perf_counter()
+                    load(counting, messages.session_id)
+                    total[0] += time.perf_counter() - started
+                    total[1] += counting.rows
+            connection.commit()
+        messages.add_many([('assistant', ASSISTANT_TEXT)])
+    return [(seconds / turns * 1000, rows / turns) for seconds, rows in totals]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare full-session and incremental history loads')
+    parser.add_argument('--messages', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='session length at each measurement')
+    parser.add_argument('--turns', type=int, default=50, help='turns timed per measurement')
+    parser.add_argument('--budget', type=int, default=8000, help='history token budget')
+    parser.add_argument('--mysql', action='store_true', help='use the configured database')
+    args = parser.parse_args()
+
+    messages = MySQLMessages() if args.mysql else MemoryMessages()
+    loads = {'full read': old_load}
+    for name, store in (('HistoryManager', LRUCache(16)), ('HistoryManager, JSON store', JSONStore(16))):
+        manager = HistoryManager(store=store)
+        loads[name] = lambda cursor, session_id, manager=manager: manager.load(cursor, session_id, args.budget)
+    try:
+        print(f"{'messages':>9}  " + '  '.join(f'{name:>27}' for name in loads))
+        for target in sorted(args.messages):
+            messages.add_many([
+                ('user', USER_TEXT) if i % 2 == 0 else ('assistant', ASSISTANT_TEXT)
+                for i in range(messages.count, target)
+            ])
+            # One untimed turn so the caches catch up with the bulk-loaded rows
+            run_turns(messages, list(loads.values()), 1)
+            cells = run_turns(messages, list(loads.values()), args.turns)
+            print(f"{target:>9}  " + '  '.join(f'{ms:>9.3f} ms {rows:>7.0f} rows' for ms, rows in cells))
+    finally:
+        messages.delete()
@@ -0,0 +1,87 @@
+"""
+Benchmark per-request logging cost on long chat sessions: pretty-printing
+every Bedrock request and response against logs.log_payload
+"""
+
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+import logs
+
+
+def session_body(turns, chars):
+    """A Bedrock request body carrying `turns` messages of `chars` characters"""
+    messages = [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': [{'type': 'text', 'text': 'x' * chars}]}
+        for i in range(turns)
+    ]
+    return {'anthropic_version': 'bedrock-2023-05-31', 'max_tokens': 4096, 'system': 'You are ZED.', 'messages': messages}
+
+
+def response_body(chars):
+    return {'content': [{'type': 'text', 'text': 'y' * chars}], 'usage': {'input_tokens': 1000, 'output_tokens': 300}}
+
+
+def measure(log_turn, requests):
+    """Microseconds per request spent in the calling thread"""
+    started = time.perf_counter()
+    for _ in range(requests):
+        log_turn()
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare pretty-printed payload logging with log_payload')
+    parser.add_argument('--turns', type=int, nargs='+', default=[10, 50, 200])
+    parser.add_argument('--chars', type=int, default=800, help='characters per message')
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    old_path = os.path.join(workdir, 'old.log')
+    new_path = os.path.join(workdir, 'new.log')
+
+    # The original setup: a synchronous text handler on the request thread
+    old_logger = logging.getLogger('bench.old')
+    old_logger.propagate = False
+    old_handler = logging.FileHandler(old_path)
+    old_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    old_logger.addHandler(old_handler)
+
+    logs.configure_logging(level='INFO', fmt='json', log_file=new_path)
+    new_logger = logging.getLogger('bench.new')
+
+    response = response_body(args.chars)
+
+    print(f"{args.requests} requests per case, {args.chars} chars per message")
+    print(f"{'turns':>6} {'level':>6} {'old us/req':>11} {'new us/req':>11} {'old bytes/req':>14} {'new bytes/req':>14}")
+    for turns in args.turns:
+        body = session_body(turns, args.chars)
+
+        def old_turn():
+            old_logger.info(f"Request: {json.dumps(body, indent=2)}")
+            old_logger.info(f"Response: {json.dumps(response, indent=2)}")
+
+        def new_turn():
+            logs.log_payload(new_logger, 'Bedrock request', body, model_id='bench')
+            logs.log_payload(new_logger, 'Bedrock response', response, model_id='bench', latency_ms=1000)
+
+        for level in (logging.INFO, logging.WARNING):
+            old_logger.setLevel(level)
+            new_logger.setLevel(level)
+            old_size, new_size = os.path.getsize(old_path), os.path.getsize(new_path)
+            old_us = measure(old_turn, args.requests)
+            new_us = measure(new_turn, args.requests)
+            # Let the writer thread catch up before measuring file growth
+            while logs.logging_stats()['queued']:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            old_bytes = (os.path.getsize(old_path) - old_size) / args.requests
+            new_bytes = (os.path.getsize(new_path) - new_size) / args.requests
+            print(f"{turns:>6} {logging.getLevelName(level):>6} {old_us:>11.1f} {new_us:>11.1f} "
+                  f"{old_bytes:>14.0f} {new_bytes:>14.0f}")
+    print(f"dropped records: {logs.logging_stats()['dropped']}")
@@ -0,0 +1,61 @@
+"""
+Benchmark /api/execute-code's execution backends: the warm sandbox pool
+against the original temp file and fresh interpreter per call. The
+limits themselves are covered by tests/test_sandbox.py.
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sandbox
+
+SNIPPETS = {
+    'python': "total = sum(i * i for i in range(1000))\nprint(total)",
+    'javascript': "let total = 0;\nfor (let i = 0; i < 1000; i++) total += i * i;\nconsole.log(total);",
+}
+
+
+def bench(run, code, count, concurrency):
+    """Run the snippet `count` times; returns (snippets/s, p50 ms, p99 ms, failures)"""
+    def one(_):
+        started = time.monotonic()
+        result = run(code)
+        ok = result['returncode'] == 0 and not result['timed_out']
+        return (time.monotonic() - started) * 1000, ok
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(count)))
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(ms for ms, _ in results)
+    failures = sum(1 for _, ok in results if not ok)
+    return count / elapsed, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)], failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the sandbox pool with a subprocess per call')
+    parser.add_argument('--language', choices=sorted(SNIPPETS), default='python')
+    parser.add_argument('--count', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--timeout', type=float, default=5)
+    args = parser.parse_args()
+
+    code = SNIPPETS[args.language]
+    pool = sandbox.get_sandbox_pool(args.language)
+    pool.start()
+    # Let the pool warm up and prime the page cache for both designs
+    for _ in range(pool.size):
+        pool.run(code, args.timeout)
+    sandbox.run_subprocess(args.language, code, args.timeout)
+
+    backends = [
+        ('subprocess per call', lambda c: sandbox.run_subprocess(args.language, c, args.timeout)),
+        ('sandbox pool', lambda c: pool.run(c, args.timeout)),
+    ]
+    print(f"{args.language}: {args.count} snippets, concurrency {args.concurrency}, pool size {pool.size}")
+    for name, run in backends:
+        rate, p50, p99, failures = bench(run, code, args.count, args.concurrency)
+        print(f"{name:>20}: {rate:7.1f} snippets/s  p50={p50:6.1f}ms  p99={p99:6.1f}ms  failures={failures}")
+    pool.shutdown()
@@ -0,0 +1,122 @@
+"""
+Benchmark per-search overhead against a local stub of the Custom Search
+JSON API: the original googleapiclient build() on every call against the
+long-lived SearchClient backends (googleapiclient with static discovery
+and a kept-alive connection per thread, and REST over a pooled session).
+"""
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from googleapiclient.discovery import build
+
+from search import CustomSearchBackend, RestSearchBackend, SearchClient, _parse_items
+
+API_KEY = 'stub-key'
+ENGINE_ID = 'stub-engine'
+
+
+class StubSearchServer(ThreadingHTTPServer):
+    """Answers every Custom Search query with `num` items after `latency` seconds"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(('127.0.0.1', 0), StubSearchHandler)
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        self.queries = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+
+class StubSearchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, kept-alive
+    # connections would wait out the client's delayed ACK on every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        query = params.get('q', [''])[0]
+        num = int(params.get('num', ['10'])[0])
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.queries.append(query)
+        time.sleep(self.server.latency)
+        payload = json.dumps({
+            'kind': 'customsearch#search',
+            'items': [{'title': f'{query} {i}', 'link': f'https://example.com/{i}', 'snippet': f'About {query}'}
+                      for i in range(num)],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def build_per_call(api_url):
+    """perform_web_search's original client: build() for every search"""
+    def search(query, num_results):
+        service = build('customsearch', 'v1', developerKey=API_KEY, client_options={'api_endpoint': api_url})
+        return _parse_items(service.cse().list(q=query, cx=ENGINE_ID, num=num_results).execute())
+    return search
+
+
+def run(search, searches, concurrency):
+    """Sorted per-search milliseconds"""
+    def one(i):
+        started = time.perf_counter()
+        search(f'query {i % 50}', 5)
+        return (time.perf_counter() - started) * 1000
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        return sorted(executor.map(one, range(searches)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare Custom Search client setups against a stub server')
+    parser.add_argument('--searches', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--latency', type=float, default=0.0, help='stub response latency in seconds')
+    args = parser.parse_args()
+
+    stub = StubSearchServer(args.latency)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    candidates = [
+        ('build() per call', build_per_call(stub.url)),
+        ('googleapiclient, long-lived', SearchClient(CustomSearchBackend(API_KEY, ENGINE_ID, api_url=stub.url)).search),
+        ('rest, pooled session', SearchClient(RestSearchBackend(API_KEY, ENGINE_ID, api_url=stub.url + '/customsearch/v1')).search),
+    ]
+    print(f"Stub latency {args.latency * 1000:.0f} ms, {args.searches} searches per run")
+    for concurrency in args.concurrency:
+        print(f"\n{concurrency} concurrent searches")
+        for name, search in candidates:
+            search('warm up', 5)
+            connections = stub.connections
+            started = time.perf_counter()
+            samples = run(search, args.searches, concurrency)
+            elapsed = time.perf_counter() - started
+            pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+            print(f"{name:>28}: mean {sum(samples) / len(samples):6.2f} ms  p50 {pick(0.5):6.2f} ms  "
+                  f"p99 {pick(0.99):6.2f} ms  {args.searches / elapsed:7.0f} searches/s  "
+                  f"new connections {stub.connections - connections}")
+    stub.shutdown()
@@ -0,0 +1,97 @@
+"""
+Compare search-intent classifiers on the labelled evaluation set
+(search_intent_eval.jsonl): precision, recall and search rate per language
+and overall, plus the cost of one call, for the original substring scan
+against the current classifier (or a SEARCH_INTENT_WEIGHTS file).
+"""
+
+import argparse
+import json
+import time
+
+from search import LexiconIntentClassifier, default_intent_terms, load_intent_classifier
+
+EVAL_SET = 'search_intent_eval.jsonl'
+
+# needs_web_search as it was before the intent classifier
+LEGACY_KEYWORDS = [
+    'latest', 'recent', 'current', 'today', 'now', 'news',
+    'what is happening', 'what happened', 'update on',
+    'weather', 'stock', 'price', 'score', 'result',
+    'search for', 'find', 'look up', 'who is', 'what is', 'whats', "what's", 'when is', 'where is', 'how to',
+    'define', 'definition', 'wiki', 'wikipedia', 'google', 'bing', 'yahoo'
+]
+
+
+def legacy_needs_web_search(message: str) -> bool:
+    message_lower = message.lower()
+    return any(keyword in message_lower for keyword in LEGACY_KEYWORDS)
+
+
+def load_examples(path=EVAL_SET):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(needs_search, examples):
+    """{'precision', 'recall', 'search_rate', 'tp', 'fp', 'fn', 'count'} over the examples"""
+    tp = fp = fn = searched = 0
+    for example in examples:
+        predicted = needs_search(example['text'])
+        searched += predicted
+        tp += predicted and example['search']
+        fp += predicted and not example['search']
+        fn += example['search'] and not predicted
+    return {
+        'count': len(examples),
+        'precision': tp / (tp + fp) if tp + fp else 1.0,
+        'recall': tp / (tp + fn) if tp + fn else 1.0,
+        'search_rate': searched / len(examples) if examples else 0.0,
+        'tp': tp, 'fp': fp, 'fn': fn,
+    }
+
+
+def cost_us(needs_search, examples, rounds):
+    """Mean microseconds per call over `rounds` passes of the examples"""
+    texts = [example['text'] for example in examples]
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            needs_search(text)
+    return (time.perf_counter() - started) / (rounds * len(texts)) * 1e6
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare search-intent classifiers on a labelled set')
+    parser.add_argument('--eval-set', default=EVAL_SET)
+    parser.add_argument('--weights', help='offline-fitted weights file instead of the built-in lexicon')
+    parser.add_argument('--rounds', type=int, default=200, help='passes over the set when timing')
+    parser.add_argument('--errors', action='store_true', help='list the messages the classifier gets wrong')
+    args = parser.parse_args()
+
+    examples = load_examples(args.eval_set)
+    classifier = load_intent_classifier(args.weights) if args.weights else LexiconIntentClassifier(default_intent_terms())
+    candidates = [
+        ('substring scan', legacy_needs_web_search),
+        (f'{classifier.name} classifier', classifier.needs_search),
+    ]
+    groups = [('all', examples)] + [
+        (language, [example for example in examples if example['lang'] == language])
+        for language in sorted({example['lang'] for example in examples})
+    ]
+    positives = sum(example['search'] for example in examples)
+    print(f"{len(examples)} messages, {positives} need a search")
+    for name, needs_search in candidates:
+        print(f"\n{name}: {cost_us(needs_search, examples, args.rounds):.1f} us per call")
+        for group, group_examples in groups:
+            result = evaluate(needs_search, group_examples)
+            print(f"  {group:>4} ({result['count']:>3}): precision {result['precision']:.2f}  "
+                  f"recall {result['recall']:.2f}  searches {result['search_rate']:.0%}  "
+                  f"false positives {result['fp']}  missed {result['fn']}")
+
+    if args.errors:
+        print()
+        for example in examples:
+            if classifier.needs_search(example['text']) != example['search']:
+                kind = 'missed' if example['search'] else 'false positive'
+                print(f"{kind:>15}: {example['text']} (score {classifier.score(example['text']):.1f})")
@@ -0,0 +1,122 @@
+"""
+Benchmark /api/billing/usage reads as a user's usage grows to millions of
+rows: UsageTracker.get_usage_stats (usage_rollups) against the original
+GROUP BY over usage_logs. Writes synthetic rows for a throwaway user in the
+configured database (DB_* settings, run init_database first) and deletes
+the user, with its rows, at the end. Use a scratch database.
+"""
+
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from database import borrow_connection
+from lemonsqueezy import UsageTracker
+from usage_writer import INSERT_USAGE_SQL, UNBILLED_PERIOD, UPSERT_ROLLUP_SQL, rollup_rows
+
+ACTIONS = ('chat', 'chat', 'chat', 'ask', 'summarize', 'explain')
+MODELS = ('amazon.nova-micro-v1:0', 'amazon.nova-lite-v1:0', 'anthropic.claude-3-haiku-20240307-v1:0')
+
+GROUP_BY_SQL = """
+    SELECT action_type, COUNT(*) as count, SUM(tokens_used) as tokens
+    FROM usage_logs
+    WHERE user_id = %s
+      AND billing_period_start = %s
+      AND billing_period_end = %s
+    GROUP BY action_type
+"""
+
+
+def create_user(unbilled):
+    """A throwaway user, with a current billing period unless `unbilled`"""
+    name = f'bench-{uuid.uuid4().hex[:12]}'
+    start = datetime.now().replace(microsecond=0) - timedelta(days=1)
+    period = (None, None) if unbilled else (start, start + timedelta(days=30))
+    with borrow_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO users (username, email, password_hash, current_period_start,
+                                   current_period_end, monthly_quota)
+                VALUES (%s, %s, '-', %s, %s, 100000000)
+            """, (name, f'{name}@bench.invalid') + period)
+            user_id = cursor.lastrowid
+        connection.commit()
+    return user_id, period[0] or UNBILLED_PERIOD, period[1] or UNBILLED_PERIOD
+
+
+def add_usage(user_id, period_start, period_end, count, batch_size):
+    """Write `count` synthetic usage rows and their rollups, as the usage writer does"""
+    now = datetime.now().replace(microsecond=0)
+    with borrow_connection() as connection:
+        for start in range(0, count, batch_size):
+            rows = []
+            for _ in range(min(batch_size, count - start)):
+                input_tokens, output_tokens = random.randint(50, 4000), random.randint(10, 1500)
+                rows.append((
+                    user_id, random.choice(ACTIONS), input_tokens + output_tokens, input_tokens,
+                    output_tokens, random.randint(200, 9000), random.choice(MODELS), None,
+                    now, period_start, period_end, False
+                ))
+            with connection.cursor() as cursor:
+                cursor.executemany(INSERT_USAGE_SQL, rows)
+                cursor.executemany(UPSERT_ROLLUP_SQL, rollup_rows(rows))
+            connection.commit()
+
+
+def timed(fn, repeat):
+    """Median milliseconds of `repeat` calls"""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def group_by(user_id, period_start, period_end):
+    with borrow_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(GROUP_BY_SQL, (user_id, period_start, period_end))
+            rows = cursor.fetchall()
+        connection.commit()
+    return rows
+
+
+def delete_user(user_id):
+    with borrow_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        connection.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare rollup and GROUP BY billing usage reads')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='usage rows of the user at each measurement')
+    parser.add_argument('--repeat', type=int, default=20, help='reads timed per measurement')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows per INSERT')
+    parser.add_argument('--unbilled', action='store_true', help='user without a billing period')
+    args = parser.parse_args()
+
+    user_id, period_start, period_end = create_user(args.unbilled)
+    try:
+        written = 0
+        print(f"{'rows':>10}  {'GROUP BY usage_logs':>20}  {'get_usage_stats':>16}")
+        for target in sorted(args.rows):
+            started = time.perf_counter()
+            add_usage(user_id, period_start, period_end, target - written, args.batch_size)
+            load_s = time.perf_counter() - started
+            written = target
+
+            stats = UsageTracker.get_usage_stats(user_id)
+            counted = sum(entry['count'] for entry in stats['breakdown'])
+            assert counted == written, f'rollups count {counted} of {written} rows'
+
+            scan_ms = timed(lambda: group_by(user_id, period_start, period_end), args.repeat)
+            rollup_ms = timed(lambda: UsageTracker.get_usage_stats(user_id), args.repeat)
+            print(f"{written:>10}  {scan_ms:>17.2f} ms  {rollup_ms:>13.2f} ms  (loaded in {load_s:.1f}s)")
+    finally:
+        delete_user(user_id)
@@ -0,0 +1,222 @@
+"""
+In-process caching for ZED AI
+Thread-safe, size-bounded LRU cache with optional per-entry TTLs, an
+optional Redis-backed equivalent and a registry of named caches
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Shared cache backend for named caches; empty keeps them in process
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', '')
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Size-bounded LRU cache with optional expiry
+
+    `ttl` is the default lifetime in seconds (None = no expiry); set() can
+    override it per entry. get/set/delete/clear form the whole storage
+    interface, so a shared backend (e.g. Redis) exposing the same methods can
+    be swapped in wherever a cache instance is accepted.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self._misses += 1
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at <= self._clock():
+                del self._data[key]
+                self._expirations += 1
+                self._misses += 1
+                return default
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key, value, ttl=_MISSING):
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires_at = self._clock() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, _MISSING) is not _MISSING
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Snapshot of hit/miss/eviction counters"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class RedisCache:
+    """
+    LRUCache-compatible cache stored in Redis, shared by every worker process
+
+    Values must be JSON-serializable. Redis evicts by its own maxmemory
+    policy, so max_size is informational only. Needs the optional `redis`
+    package.
+
+    While Redis is unreachable the cache degrades to always missing: get()
+    returns the default (so callers fall through to the database), set(),
+    delete() and clear() are dropped, len() is 0, and Redis is not tried
+    again for `retry_after` seconds so requests do not each wait out a
+    timeout.
+    """
+
+    def __init__(self, url, namespace, max_size=1024, ttl=None, retry_after=5.0, clock=time.monotonic):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("CACHE_REDIS_URL is set but the 'redis' package is not installed")
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._redis_errors = redis.RedisError
+        self._prefix = f"zed:{namespace}:"
+        self.max_size = max_size
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._clock = clock
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+
+    def _call(self, command, *args, **kwargs):
+        """Run one Redis command (a client method); _MISSING if Redis is down or the command failed"""
+        if self._down_until > self._clock():
+            return _MISSING
+        try:
+            return command(*args, **kwargs)
+        except self._redis_errors as e:
+            with self._lock:
+                self._errors += 1
+                self._down_until = self._clock() + self.retry_after
+            logger.warning(f"Redis cache {self._prefix[:-1]} unavailable, bypassing it for {self.retry_after}s: {e}")
+            return _MISSING
+
+    def get(self, key, default=None):
+        raw = self._call(self._client.get, self._prefix + str(key))
+        with self._lock:
+            if raw is None or raw is _MISSING:
+                self._misses += 1
+                return default
+            self._hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value, ttl=_MISSING):
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires = max(1, int(ttl * 1000)) if ttl is not None else None
+        self._call(self._client.set, self._prefix + str(key), json.dumps(value), px=expires)
+
+    def delete(self, key):
+        deleted = self._call(self._client.delete, self._prefix + str(key))
+        return deleted is not _MISSING and bool(deleted)
+
+    def _names(self):
+        # scan_iter fails while it is iterated, so the whole scan runs inside _call
+        return list(self._client.scan_iter(match=self._prefix + '*', count=500))
+
+    def clear(self):
+        names = self._call(self._names)
+        if names is _MISSING:
+            return
+        for start in range(0, len(names), 500):
+            if self._call(self._client.delete, *names[start:start + 500]) is _MISSING:
+                return
+
+    def __len__(self):
+        names = self._call(self._names)
+        return 0 if names is _MISSING else len(names)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'size': None,
+                'max_size': self.max_size,
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': None,
+                'expirations': None,
+                'errors': self._errors,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_cache(name, max_size=1024, ttl=None, shared=True):
+    """
+    Return the process-wide cache called `name`, creating it on first use
+
+    With CACHE_REDIS_URL set, caches created with shared=True live in Redis
+    so invalidations reach every worker; otherwise they are in-process LRUs.
+    """
+    cache = _caches.get(name)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(name)
+            if cache is None:
+                if shared and CACHE_REDIS_URL:
+                    cache = RedisCache(CACHE_REDIS_URL, name, max_size, ttl)
+                else:
+                    cache = LRUCache(max_size, ttl)
+                _caches[name] = cache
+    return cache
+
+def invalidate(name, key):
+    """Drop `key` from the named cache if that cache exists in this process"""
+    cache = _caches.get(name)
+    if cache is not None:
+        cache.delete(key)
+
+def cache_stats():
+    """Stats of every named cache"""
+    return {name: cache.stats() for name, cache in list(_caches.items())}
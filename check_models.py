@@ -1,6 +1,7 @@
 import boto3
 import os
 from dotenv import load_dotenv
+from providers import resolve_adapter
 
 load_dotenv()
 
@@ -40,8 +41,10 @@ try:
         print(f'\n{provider}:')
         print('-' * 50)
         for model in provider_models:
+            adapter = resolve_adapter(model['id'])
             print(f'  • {model["name"]}')
             print(f'    ID: {model["id"]}')
+            print(f'    Adapter: {adapter.name if adapter else "not supported by ZED"}')
             print()
             
 except Exception as e:
@@ -1,16 +1,52 @@
 import pymysql
 import os
 import secrets
+import threading
+import time
+import logging
+from collections import deque
+from contextlib import contextmanager
 from dotenv import load_dotenv
+from flask import g, has_app_context
+from pymysql.constants.SERVER_STATUS import SERVER_STATUS_IN_TRANS
+
+import tracing
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Connection pool configuration
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 5))
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', 300))
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', 3600))
+DB_POOL_PING_INTERVAL = float(os.getenv('DB_POOL_PING_INTERVAL', 30))
+
 def generate_share_hash():
     """Generate a secure random hash for chat sharing"""
     return secrets.token_urlsafe(24)  # Generates 32 character URL-safe string
 
-def get_db_connection():
-    """Create and return a database connection"""
+class TracedCursor(pymysql.cursors.DictCursor):
+    """DictCursor that records each statement as a span of the current trace"""
+
+    def execute(self, query, args=None):
+        if not tracing.recording():
+            return super().execute(query, args)
+        with tracing.span('db.query', **{'db.system': 'mysql', 'db.statement': tracing.normalize_sql(query)}) as span:
+            rows = super().execute(query, args)
+            span.set(rows=rows)
+            return rows
+
+    def executemany(self, query, args):
+        if not tracing.recording():
+            return super().executemany(query, args)
+        with tracing.span('db.query', **{'db.system': 'mysql', 'db.statement': tracing.normalize_sql(query),
+                                         'batch': len(args) if hasattr(args, '__len__') else None}):
+            return super().executemany(query, args)
+
+def create_raw_connection():
+    """Open a new, unpooled database connection"""
     return pymysql.connect(
         host=os.getenv('DB_HOST', '127.0.0.1'),
         port=int(os.getenv('DB_PORT', 3307)),
@@ -18,10 +54,335 @@ def get_db_connection():
         password=os.getenv('DB_PASSWORD', ''),
         database=os.getenv('DB_NAME', 'zed'),
         charset='utf8mb4',
-        cursorclass=pymysql.cursors.DictCursor,
+        cursorclass=TracedCursor,
         autocommit=False
     )
 
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available in time"""
+
+
+class PooledConnection:
+    """
+    Proxy around a driver connection that hands it back to its pool on close()
+
+    Everything else (cursor, commit, rollback, ...) is delegated to the
+    underlying connection, so existing code that calls close() in a finally
+    block keeps working unchanged.
+    """
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get('_raw')
+        if raw is None:
+            raise pymysql.err.InterfaceError("Connection has been returned to the pool")
+        return getattr(raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._raw is None
+
+    def close(self):
+        """Return the connection to the pool (idempotent)"""
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool._release(raw, self._created_at)
+
+    def invalidate(self):
+        """Close the underlying connection instead of returning it to the pool"""
+        raw, self._raw = self._raw, None
+        if raw is not None:
+            self._pool._release(raw, self._created_at, discard=True)
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of database connections
+
+    - At most `max_size` connections exist at once; callers wait up to
+      `timeout` seconds for one to be released before PoolTimeout is raised.
+    - Connections idle for longer than `ping_interval` are pinged on checkout
+      and replaced if the server has gone away.
+    - Connections idle for longer than `max_idle` or older than
+      `max_lifetime` are closed instead of reused.
+    - Open transactions are rolled back when a connection is released.
+
+    `connect` is any zero-argument callable returning a DB-API connection
+    with ping()/rollback()/close(), which makes the pool usable with a fake
+    driver.
+    """
+
+    def __init__(self, connect=create_raw_connection, max_size=DB_POOL_SIZE,
+                 timeout=DB_POOL_TIMEOUT, max_idle=DB_POOL_MAX_IDLE,
+                 max_lifetime=DB_POOL_MAX_LIFETIME, ping_interval=DB_POOL_PING_INTERVAL):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping_interval = ping_interval
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = deque()  # (raw, created_at, released_at), most recently used on the right
+        self._size = 0
+        self._in_use = 0
+        self._pid = os.getpid()
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'ping_failures': 0,
+            'wait_time_total': 0.0,
+        }
+
+    def _check_pid(self):
+        # Connections must not be shared with a forked child; start afresh.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle.clear()
+            self._size = 0
+            self._in_use = 0
+
+    def _expired(self, created_at, released_at, now):
+        if self.max_lifetime and now - created_at > self.max_lifetime:
+            return True
+        return bool(self.max_idle) and now - released_at > self.max_idle
+
+    def _close_quietly(self, raw):
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None):
+        """Check out a connection, waiting up to `timeout` seconds"""
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        waited = False
+        wait_started = None
+
+        while True:
+            candidate = None
+            create = False
+            stale = []
+            with self._cond:
+                self._check_pid()
+                while True:
+                    now = time.monotonic()
+                    while self._idle:
+                        raw, created_at, released_at = self._idle.pop()
+                        if self._expired(created_at, released_at, now):
+                            stale.append(raw)
+                            self._size -= 1
+                            self._stats['discarded'] += 1
+                            continue
+                        candidate = (raw, created_at, released_at)
+                        break
+                    if candidate is None and self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                    if candidate is not None or create:
+                        self._in_use += 1
+                        self._stats['checkouts'] += 1
+                        break
+
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        if wait_started is not None:
+                            self._stats['wait_time_total'] += now - wait_started
+                        raise PoolTimeout(
+                            f"Timed out after {timeout}s waiting for a database connection "
+                            f"({self._in_use} in use, max {self.max_size})"
+                        )
+                    if not waited:
+                        waited = True
+                        wait_started = now
+                        self._stats['waits'] += 1
+                    self._cond.wait(remaining)
+
+                if wait_started is not None:
+                    self._stats['wait_time_total'] += time.monotonic() - wait_started
+                    wait_started = None
+
+            for raw in stale:
+                self._close_quietly(raw)
+
+            if create:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    self._forget_slot()
+                    raise
+                with self._cond:
+                    self._stats['created'] += 1
+                return PooledConnection(self, raw, time.monotonic())
+
+            raw, created_at, released_at = candidate
+            if self.ping_interval is not None and time.monotonic() - released_at >= self.ping_interval:
+                try:
+                    raw.ping(reconnect=False)
+                except Exception as e:
+                    logger.warning(f"Discarding dead pooled connection: {e}")
+                    self._close_quietly(raw)
+                    with self._cond:
+                        self._stats['ping_failures'] += 1
+                        self._stats['discarded'] += 1
+                    self._forget_slot()
+                    continue
+            return PooledConnection(self, raw, created_at)
+
+    def _forget_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _release(self, raw, created_at, discard=False):
+        # Skip the ROLLBACK round trip when the server reports no open transaction
+        if not discard and getattr(raw, 'server_status', SERVER_STATUS_IN_TRANS) & SERVER_STATUS_IN_TRANS:
+            try:
+                raw.rollback()
+            except Exception:
+                discard = True
+
+        now = time.monotonic()
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if discard or (self.max_lifetime and now - created_at > self.max_lifetime):
+                self._size -= 1
+                self._stats['discarded'] += 1
+            else:
+                self._idle.append((raw, created_at, now))
+                raw = None
+            self._cond.notify()
+
+        if raw is not None:
+            self._close_quietly(raw)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """Context manager yielding a pooled connection, rolled back on error"""
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except Exception:
+                conn.invalidate()
+            raise
+        finally:
+            conn.close()
+
+    def stats(self):
+        """Snapshot of pool metrics"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+            })
+        return stats
+
+    def close_all(self):
+        """Close every idle connection; checked-out ones close on release"""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._stats['discarded'] += len(idle)
+        for raw, _, _ in idle:
+            self._close_quietly(raw)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+def get_db_connection():
+    """Check out a pooled database connection; close() returns it to the pool"""
+    with tracing.span('db.acquire'):
+        return get_pool().acquire()
+
+def db_connection(timeout=None):
+    """Context manager form of get_db_connection()"""
+    return get_pool().connection(timeout)
+
+def get_pool_stats():
+    """Return metrics for the process-wide connection pool"""
+    return get_pool().stats()
+
+def get_request_connection():
+    """
+    Return the connection bound to the current Flask app context
+
+    The first call checks a connection out of the pool; later calls in the
+    same request reuse it. It is released by close_request_connection(),
+    which app.py registers as a teardown handler.
+    """
+    if 'db_connection' not in g:
+        g.db_connection = get_db_connection()
+    return g.db_connection
+
+def close_request_connection(exc=None):
+    """Release the request-scoped connection, rolling back on error"""
+    connection = g.pop('db_connection', None)
+    if connection is None:
+        return
+    if exc is not None:
+        try:
+            connection.rollback()
+        except Exception:
+            connection.invalidate()
+            return
+    connection.close()
+
+@contextmanager
+def borrow_connection():
+    """
+    Yield the request-scoped connection inside a Flask app context,
+    otherwise a pooled connection that is released on exit
+
+    Callers must not close the yielded connection; transaction control
+    (commit/rollback) stays with them.
+    """
+    if has_app_context():
+        yield get_request_connection()
+        return
+    connection = get_db_connection()
+    try:
+        yield connection
+    finally:
+        connection.close()
+
 def init_database():
     """Initialize database tables"""
     connection = get_db_connection()
@@ -65,6 +426,8 @@ def init_database():
                     share_hash VARCHAR(40) UNIQUE NOT NULL,
                     title VARCHAR(255) NOT NULL,
                     model_id VARCHAR(100) NOT NULL,
+                    summary TEXT NULL,
+                    summary_message_id INT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
@@ -83,7 +446,7 @@ def init_database():
                     content TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (session_id) REFERENCES chat_sessions(id) ON DELETE CASCADE,
-                    INDEX idx_session_id (session_id),
+                    INDEX idx_session_id_id (session_id, id),
                     INDEX idx_created_at (created_at)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """)
@@ -95,6 +458,11 @@ def init_database():
                     user_id INT NOT NULL,
                     action_type ENUM('summarize', 'ask', 'explain', 'autofill', 'chat') NOT NULL,
                     tokens_used INT DEFAULT 0,
+                    input_tokens INT DEFAULT 0,
+                    output_tokens INT DEFAULT 0,
+                    latency_ms INT NULL,
+                    model_id VARCHAR(100) NULL,
+                    session_id INT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     billing_period_start TIMESTAMP NOT NULL,
                     billing_period_end TIMESTAMP NOT NULL,
@@ -102,7 +470,32 @@ def init_database():
                     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE,
                     INDEX idx_user_id (user_id),
                     INDEX idx_created_at (created_at),
-                    INDEX idx_billing_period (billing_period_start, billing_period_end)
+                    INDEX idx_billing_period (billing_period_start, billing_period_end),
+                    INDEX idx_user_model (user_id, model_id),
+                    INDEX idx_session_id (session_id)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """)
+            
+            # Per user, billing period, action and model totals of usage_logs,
+            # kept current on every write so the billing dashboard never
+            # scans raw usage rows (model_id '' = no model)
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS usage_rollups (
+                    user_id INT NOT NULL,
+                    billing_period_start TIMESTAMP NOT NULL,
+                    billing_period_end TIMESTAMP NOT NULL,
+                    action_type ENUM('summarize', 'ask', 'explain', 'autofill', 'chat') NOT NULL,
+                    model_id VARCHAR(100) NOT NULL DEFAULT '',
+                    requests INT NOT NULL DEFAULT 0,
+                    overage_requests INT NOT NULL DEFAULT 0,
+                    tokens_used BIGINT NOT NULL DEFAULT 0,
+                    input_tokens BIGINT NOT NULL DEFAULT 0,
+                    output_tokens BIGINT NOT NULL DEFAULT 0,
+                    latency_ms BIGINT NOT NULL DEFAULT 0,
+                    timed_output_tokens BIGINT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, billing_period_start, billing_period_end, action_type, model_id),
+                    FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """)
             
@@ -116,11 +509,18 @@ def init_database():
                     lemonsqueezy_event_id VARCHAR(255) UNIQUE NOT NULL,
                     payload JSON NOT NULL,
                     processed BOOLEAN DEFAULT FALSE,
+                    attempts INT NOT NULL DEFAULT 0,
+                    next_attempt_at TIMESTAMP NULL,
+                    last_error TEXT NULL,
+                    failed BOOLEAN NOT NULL DEFAULT FALSE,
+                    locked_by VARCHAR(100) NULL,
+                    locked_at TIMESTAMP NULL,
+                    processed_at TIMESTAMP NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE SET NULL,
-                    INDEX idx_subscription_id (subscription_id),
+                    INDEX idx_subscription_id (subscription_id, processed, failed),
                     INDEX idx_event_type (event_type),
-                    INDEX idx_processed (processed)
+                    INDEX idx_processed (processed, failed, next_attempt_at)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
             """)
             
@@ -0,0 +1,192 @@
+"""
+Conversation history for ZED AI
+Caches the recent tail of each chat session, reads only new messages on each
+turn and trims the tail to a per-model token budget
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from cache import LRUCache
+from database import borrow_connection
+
+logger = logging.getLogger(__name__)
+
+# Sessions kept in the in-process cache
+HISTORY_CACHE_SESSIONS = int(os.getenv('HISTORY_CACHE_SESSIONS', 2000))
+# Most recent messages kept per session (the upper bound of any window)
+MAX_HISTORY_LENGTH = int(os.getenv('MAX_HISTORY_LENGTH', 50))
+# Messages that must fall out of the tail before they are summarized
+HISTORY_SUMMARY_BATCH = int(os.getenv('HISTORY_SUMMARY_BATCH', 10))
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate: ~4 UTF-8 bytes per token plus per-message overhead
+
+    Counting bytes rather than characters keeps the estimate conservative for
+    Bengali and Arabic text, where one character is two or three bytes.
+    """
+    return len(text.encode('utf-8')) // 4 + 4
+
+
+def _session_tail(last_id, messages, summary=None, summary_id=0, pending=()) -> Dict:
+    """
+    Cached state of one session; replaced, never mutated in place
+
+    A plain dict of JSON types, so any cache with the LRUCache interface can
+    hold it, cache.RedisCache included.
+    """
+    return {
+        'last_id': last_id,          # highest message id seen
+        'messages': list(messages),  # [{'id', 'role', 'content', 'tokens'}, ...]
+        'summary': summary,          # running summary of older turns
+        'summary_id': summary_id,    # last message id folded into the summary
+        'pending': list(pending),    # dropped messages not yet summarized
+    }
+
+
+class HistoryManager:
+    """
+    Token-bounded conversation history with incremental loading
+
+    The first turn of a session in this process reads only the newest
+    `max_messages` rows; later turns read just the rows added since (another
+    worker's included) with an indexed `id > last_id` range scan on
+    (session_id, id). The cached tail is then trimmed to the caller's token
+    budget.
+
+    If a `summarizer(previous_summary, messages) -> str` is given, messages
+    that fall off the cached tail are folded into a running summary stored on
+    chat_sessions. Summaries are built in a background thread so a turn never
+    waits on them.
+
+    `store` defaults to an in-process LRU. Cached tails are plain dicts, so a
+    shared cache (get_cache with CACHE_REDIS_URL) can be passed instead.
+    """
+
+    def __init__(self, max_messages=MAX_HISTORY_LENGTH, store=None,
+                 summarizer: Optional[Callable[[Optional[str], List[Dict]], str]] = None,
+                 summary_batch=HISTORY_SUMMARY_BATCH):
+        self.max_messages = max_messages
+        self.store = store if store is not None else LRUCache(HISTORY_CACHE_SESSIONS)
+        self.summarizer = summarizer
+        self.summary_batch = summary_batch
+        self._summary_lock = threading.Lock()
+        self._summarizing = set()
+        self._summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-summary') if summarizer else None
+
+    def _rows(self, rows):
+        return [
+            {'id': row['id'], 'role': row['role'], 'content': row['content'], 'tokens': estimate_tokens(row['content'])}
+            for row in rows
+        ]
+
+    def _refresh(self, cursor, session_id) -> Dict:
+        tail = self.store.get(session_id)
+        if tail is None:
+            cursor.execute(
+                "SELECT id, role, content FROM messages WHERE session_id = %s ORDER BY id DESC LIMIT %s",
+                (session_id, self.max_messages)
+            )
+            rows = self._rows(reversed(cursor.fetchall()))
+            summary, summary_id = None, 0
+            if self.summarizer:
+                cursor.execute(
+                    "SELECT summary, summary_message_id FROM chat_sessions WHERE id = %s",
+                    (session_id,)
+                )
+                session = cursor.fetchone() or {}
+                summary, summary_id = session.get('summary'), session.get('summary_message_id') or 0
+            last_id = rows[-1]['id'] if rows else 0
+            tail = _session_tail(last_id, rows, summary, summary_id)
+            self.store.set(session_id, tail)
+            return tail
+
+        cursor.execute(
+            "SELECT id, role, content FROM messages WHERE session_id = %s AND id > %s ORDER BY id ASC",
+            (session_id, tail['last_id'])
+        )
+        rows = self._rows(cursor.fetchall())
+        if not rows:
+            return tail
+
+        messages = tail['messages'] + rows
+        overflow = len(messages) - self.max_messages
+        pending = tail['pending']
+        if overflow > 0:
+            if self.summarizer:
+                pending = pending + messages[:overflow]
+            messages = messages[overflow:]
+        tail = _session_tail(rows[-1]['id'], messages, tail['summary'], tail['summary_id'], pending)
+        self.store.set(session_id, tail)
+
+        if self.summarizer and len(pending) >= self.summary_batch:
+            self._schedule_summary(session_id, tail)
+        return tail
+
+    def load(self, cursor, session_id: int, token_budget: int) -> List[Dict]:
+        """
+        Return the session's history as [{'role', 'content'}, ...], oldest
+        first, trimmed so its estimated size fits `token_budget`
+        """
+        tail = self._refresh(cursor, session_id)
+        messages, summary = tail['messages'], tail['summary']
+
+        start = len(messages)
+        used = 0
+        if summary:
+            used = estimate_tokens(summary) + 8
+        while start > 0 and used + messages[start - 1]['tokens'] <= token_budget:
+            start -= 1
+            used += messages[start]['tokens']
+        # Windows must open with a user turn
+        while start < len(messages) and messages[start]['role'] != 'user':
+            start += 1
+
+        window = []
+        if summary:
+            window.append({'role': 'user', 'content': f"Summary of our earlier conversation:\n{summary}"})
+            window.append({'role': 'assistant', 'content': 'Got it.'})
+        window.extend({'role': m['role'], 'content': m['content']} for m in messages[start:])
+        return window
+
+    def forget(self, session_id: int):
+        """Drop a session from the cache (e.g. after it is deleted)"""
+        self.store.delete(session_id)
+
+    def _schedule_summary(self, session_id, tail):
+        with self._summary_lock:
+            if session_id in self._summarizing:
+                return
+            self._summarizing.add(session_id)
+        self._summary_executor.submit(self._summarize, session_id, tail)
+
+    def _summarize(self, session_id, tail):
+        try:
+            summary = self.summarizer(tail['summary'], [
+                {'role': m['role'], 'content': m['content']} for m in tail['pending']
+            ])
+            summary_id = tail['pending'][-1]['id']
+            with borrow_connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "UPDATE chat_sessions SET summary = %s, summary_message_id = %s WHERE id = %s",
+                        (summary, summary_id, session_id)
+                    )
+                connection.commit()
+
+            current = self.store.get(session_id)
+            if current is not None:
+                pending = [m for m in current['pending'] if m['id'] > summary_id]
+                self.store.set(session_id, _session_tail(
+                    current['last_id'], current['messages'], summary, summary_id, pending
+                ))
+        except Exception as e:
+            logger.error(f"History summary error for session {session_id}: {e}")
+        finally:
+            with self._summary_lock:
+                self._summarizing.discard(session_id)
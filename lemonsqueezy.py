@@ -4,13 +4,26 @@ Handles subscriptions, webhooks, and usage-based billing
 """
 
 import os
+import random
 import requests
 import hashlib
 import hmac
 import json
-from datetime import datetime, timedelta
+import threading
+import time
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
-from database import get_db_connection
+from requests.adapters import HTTPAdapter
+from cache import get_cache, invalidate
+from database import borrow_connection
+import tracing
+from providers import estimate_cost
+from usage_writer import (
+    USAGE_WRITE_BEHIND, ROLLUP_COLUMNS, ROLLUP_ON_DUPLICATE, UNBILLED_PERIOD, get_usage_writer
+)
 
 load_dotenv()
 
@@ -26,19 +39,344 @@ PRO_PLAN_INCLUDED_REQUESTS = int(os.getenv('PRO_PLAN_INCLUDED_REQUESTS', '2000')
 OVERAGE_RATE_PER_REQUEST = float(os.getenv('OVERAGE_RATE_PER_REQUEST', '0.01'))
 FREE_PLAN_MONTHLY_LIMIT = int(os.getenv('FREE_PLAN_MONTHLY_LIMIT', '50'))
 
-# LemonSqueezy API Base URL
-LEMONSQUEEZY_API_URL = "https://api.lemonsqueezy.com/v1"
+# Quota plan cache (quota, plan name and overage flags per user). Admission is
+# always decided by the database; the cache only shapes quota responses.
+QUOTA_CACHE_SIZE = int(os.getenv('QUOTA_CACHE_SIZE', '10000'))
+QUOTA_CACHE_TTL = float(os.getenv('QUOTA_CACHE_TTL', '300'))
+
+_quota_plans = get_cache('quota_plans', QUOTA_CACHE_SIZE, QUOTA_CACHE_TTL)
+
+# LemonSqueezy lookup caches. Entries are served as they are while fresh,
+# then served stale while one background refresh runs, until they expire.
+# Signed portal URLs expire PORTAL_URL_EXPIRY_MARGIN seconds before the
+# expiry in their signature and are fresh for the first half of that time.
+PORTAL_CACHE_SIZE = int(os.getenv('PORTAL_CACHE_SIZE', '10000'))
+PORTAL_URL_EXPIRY_MARGIN = int(os.getenv('PORTAL_URL_EXPIRY_MARGIN', '300'))
+PORTAL_URL_DEFAULT_TTL = int(os.getenv('PORTAL_URL_DEFAULT_TTL', '3600'))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv('SUBSCRIPTION_CACHE_SIZE', '10000'))
+SUBSCRIPTION_CACHE_FRESH = int(os.getenv('SUBSCRIPTION_CACHE_FRESH', '60'))
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', '3600'))
+LEMONSQUEEZY_REFRESH_WORKERS = int(os.getenv('LEMONSQUEEZY_REFRESH_WORKERS', '2'))
+
+# LemonSqueezy API Base URL (override to point at a local stub server)
+LEMONSQUEEZY_API_URL = os.getenv('LEMONSQUEEZY_API_URL', "https://api.lemonsqueezy.com/v1")
+
+# LemonSqueezy HTTP client configuration
+LEMONSQUEEZY_TIMEOUT = float(os.getenv('LEMONSQUEEZY_TIMEOUT', 10))
+LEMONSQUEEZY_CONNECT_TIMEOUT = float(os.getenv('LEMONSQUEEZY_CONNECT_TIMEOUT', 3))
+LEMONSQUEEZY_POOL_SIZE = int(os.getenv('LEMONSQUEEZY_POOL_SIZE', 16))
+LEMONSQUEEZY_MAX_RETRIES = int(os.getenv('LEMONSQUEEZY_MAX_RETRIES', 3))
+LEMONSQUEEZY_RETRY_BASE_MS = int(os.getenv('LEMONSQUEEZY_RETRY_BASE_MS', 200))
+LEMONSQUEEZY_RETRY_MAX_MS = int(os.getenv('LEMONSQUEEZY_RETRY_MAX_MS', 5000))
+# Consecutive failed calls that open the circuit, and how long it stays open
+LEMONSQUEEZY_BREAKER_THRESHOLD = int(os.getenv('LEMONSQUEEZY_BREAKER_THRESHOLD', 5))
+LEMONSQUEEZY_BREAKER_COOLDOWN = float(os.getenv('LEMONSQUEEZY_BREAKER_COOLDOWN', 30))
+
+# Upper bounds (ms) of the per-endpoint latency histogram buckets
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """Raised instead of calling LemonSqueezy while the circuit is open"""
+
+
+class LemonSqueezyClient:
+    """
+    Shared LemonSqueezy API client
+
+    One keep-alive requests.Session with a bounded connection pool and
+    (connect, read) timeouts on every call. 429 and 5xx responses (and, for
+    idempotent methods, connection errors) are retried with capped,
+    jittered exponential backoff, honouring Retry-After. After
+    `breaker_threshold` consecutive failed calls the circuit opens and calls
+    fail fast with CircuitOpenError for `breaker_cooldown` seconds; then one
+    trial call decides whether it closes again. Latency is recorded per
+    endpoint label in a histogram (see stats()).
+    """
+
+    def __init__(self, api_key=None, base_url=None, timeout=LEMONSQUEEZY_TIMEOUT,
+                 connect_timeout=LEMONSQUEEZY_CONNECT_TIMEOUT, pool_size=LEMONSQUEEZY_POOL_SIZE,
+                 max_retries=LEMONSQUEEZY_MAX_RETRIES, retry_base_ms=LEMONSQUEEZY_RETRY_BASE_MS,
+                 retry_max_ms=LEMONSQUEEZY_RETRY_MAX_MS, breaker_threshold=LEMONSQUEEZY_BREAKER_THRESHOLD,
+                 breaker_cooldown=LEMONSQUEEZY_BREAKER_COOLDOWN):
+        self.base_url = (base_url or LEMONSQUEEZY_API_URL).rstrip('/')
+        self.timeout = (connect_timeout, timeout)
+        self.max_retries = max_retries
+        self.retry_base_ms = retry_base_ms
+        self.retry_max_ms = retry_max_ms
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Accept': 'application/vnd.api+json',
+            'Content-Type': 'application/vnd.api+json',
+            'Authorization': f'Bearer {api_key or LEMONSQUEEZY_API_KEY}'
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._short_circuited = 0
+        self._endpoints = {}
+
+    def request(self, method, path, endpoint=None, **kwargs):
+        """
+        Call `path` (relative to the API base URL) and return the response
+
+        `endpoint` labels the call in the latency stats (defaults to the
+        method and path). Raises requests' exceptions, including HTTPError
+        for error statuses left after retries, and CircuitOpenError.
+        """
+        method = method.upper()
+        endpoint = endpoint or f"{method} {path}"
+        self._before_call(endpoint)
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        kwargs.setdefault('timeout', self.timeout)
+
+        attempt = 0
+        started = time.monotonic()
+        while True:
+            attempt += 1
+            try:
+                with tracing.span('lemonsqueezy', endpoint=endpoint, attempt=attempt) as span:
+                    response = self.session.request(method, url, **kwargs)
+                    span.set(**{'http.status_code': response.status_code})
+                    if response.status_code >= 500 or response.status_code == 429:
+                        span.end(f'HTTP {response.status_code}')
+            except requests.exceptions.RequestException as e:
+                # Connect failures never reached the server; anything else may have
+                retryable = (isinstance(e, (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError))
+                             and (method in IDEMPOTENT_METHODS or isinstance(e, requests.exceptions.ConnectTimeout)))
+                if retryable and attempt <= self.max_retries:
+                    time.sleep(self._retry_delay(attempt))
+                    continue
+                self._after_call(endpoint, started, ok=False)
+                raise
+
+            if response.status_code in RETRY_STATUSES and attempt <= self.max_retries \
+                    and (method in IDEMPOTENT_METHODS or response.status_code in (429, 503)):
+                time.sleep(self._retry_delay(attempt, response.headers.get('Retry-After')))
+                continue
+
+            # Client errors are the caller's problem, not LemonSqueezy being down
+            self._after_call(endpoint, started, ok=response.status_code < 500 and response.status_code != 429)
+            response.raise_for_status()
+            return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def _retry_delay(self, attempt, retry_after=None):
+        """Seconds before the next attempt: Retry-After if given, else jittered backoff"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.retry_max_ms / 1000)
+            except ValueError:
+                pass
+        delay = min(self.retry_max_ms, self.retry_base_ms * 2 ** (attempt - 1)) / 1000
+        return delay * random.uniform(0.5, 1.0)
+
+    def _before_call(self, endpoint):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at >= self.breaker_cooldown and not self._trial_running:
+                # Half-open: let this call through as the trial
+                self._trial_running = True
+                return
+            self._short_circuited += 1
+            self._endpoint_stats(endpoint)['short_circuited'] += 1
+        raise CircuitOpenError(f"LemonSqueezy circuit open, not calling {endpoint}")
+
+    def _after_call(self, endpoint, started, ok):
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            stats = self._endpoint_stats(endpoint)
+            stats['count'] += 1
+            stats['sum_ms'] += elapsed_ms
+            stats['buckets'][bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            self._trial_running = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            stats['errors'] += 1
+            self._failures += 1
+            # A failed trial reopens the circuit for another cooldown
+            opening = self._opened_at is None and self._failures >= self.breaker_threshold
+            if opening or self._opened_at is not None:
+                self._opened_at = time.monotonic()
+            failures = self._failures
+        if opening:
+            print(f"LemonSqueezy circuit open after {failures} failed calls ({endpoint})")
+
+    def _endpoint_stats(self, endpoint):
+        stats = self._endpoints.get(endpoint)
+        if stats is None:
+            stats = self._endpoints[endpoint] = {
+                'count': 0, 'errors': 0, 'short_circuited': 0, 'sum_ms': 0.0,
+                'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1),
+            }
+        return stats
+
+    def stats(self):
+        """
+        Circuit state and, per endpoint, call/error counts and a cumulative
+        latency histogram keyed by bucket upper bound in ms ('+Inf' last)
+        """
+        with self._lock:
+            endpoints = {}
+            for endpoint, stats in self._endpoints.items():
+                histogram, total = {}, 0
+                for bound, count in zip(LATENCY_BUCKETS_MS + ('+Inf',), stats['buckets']):
+                    total += count
+                    histogram[str(bound)] = total
+                endpoints[endpoint] = {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'short_circuited': stats['short_circuited'],
+                    'avg_ms': round(stats['sum_ms'] / stats['count'], 2) if stats['count'] else 0.0,
+                    'histogram': histogram,
+                }
+            return {
+                'circuit': 'closed' if self._opened_at is None else 'open',
+                'consecutive_failures': self._failures,
+                'short_circuited': self._short_circuited,
+                'endpoints': endpoints,
+            }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_lemonsqueezy_client() -> LemonSqueezyClient:
+    """Return the process-wide LemonSqueezy client, built from the LEMONSQUEEZY_* settings"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = LemonSqueezyClient()
+    return _client
+
+def set_lemonsqueezy_client(client):
+    """Swap the process-wide client, e.g. for one pointed at a stub; None rebuilds from settings"""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+def portal_url_lifetimes(portal_url):
+    """(fresh, ttl) in seconds for a signed portal URL, from its `expires` parameter"""
+    try:
+        expires = int(parse_qs(urlparse(portal_url).query)['expires'][0])
+        ttl = expires - time.time() - PORTAL_URL_EXPIRY_MARGIN
+    except (KeyError, ValueError):
+        ttl = PORTAL_URL_DEFAULT_TTL
+    return ttl / 2, ttl
+
+def subscription_lifetimes(subscription):
+    """(fresh, ttl) in seconds for subscription details"""
+    return SUBSCRIPTION_CACHE_FRESH, SUBSCRIPTION_CACHE_TTL
+
+
+class StaleWhileRevalidateCache:
+    """
+    Cache of LemonSqueezy lookups that never waits on a refresh it can avoid
+
+    get(key, fetch, lifetimes) returns the cached value; once it is past its
+    fresh period the value is still returned while `fetch()` runs once in the
+    background to replace it. Only a miss (nothing cached, or past its ttl)
+    waits on `fetch()`. `lifetimes(value)` gives (fresh, ttl) in seconds.
+    fetch() returning None (a failed lookup) is not cached and leaves any
+    stale value in place. Entries are JSON-serializable dicts, so `store` may
+    be a shared RedisCache.
+    """
+
+    def __init__(self, store, executor):
+        self.store = store
+        self.executor = executor
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch, lifetimes):
+        entry = self.store.get(key)
+        if entry is None:
+            return self._refresh(key, fetch, lifetimes)
+        if entry['fresh_until'] <= time.time():
+            self._refresh_in_background(key, fetch, lifetimes)
+        return entry['value']
+
+    def put(self, key, value, lifetimes):
+        fresh, ttl = lifetimes(value)
+        if ttl > 0:
+            self.store.set(key, {'value': value, 'fresh_until': time.time() + fresh}, ttl=ttl)
+        else:
+            self.store.delete(key)
+
+    def delete(self, key):
+        self.store.delete(key)
+
+    def _refresh(self, key, fetch, lifetimes):
+        value = fetch()
+        if value is not None:
+            self.put(key, value, lifetimes)
+        return value
+
+    def _refresh_in_background(self, key, fetch, lifetimes):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self._refresh(key, fetch, lifetimes)
+            except Exception as e:
+                print(f"Error refreshing cached LemonSqueezy lookup {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        try:
+            self.executor.submit(run)
+        except RuntimeError:
+            # Executor shut down (interpreter exiting); keep serving the stale value
+            with self._lock:
+                self._refreshing.discard(key)
+
+
+_refresh_executor = ThreadPoolExecutor(
+    max_workers=LEMONSQUEEZY_REFRESH_WORKERS, thread_name_prefix='lemonsqueezy-refresh'
+)
+_portal_urls = StaleWhileRevalidateCache(
+    get_cache('lemonsqueezy_portal_urls', PORTAL_CACHE_SIZE), _refresh_executor
+)
+_subscriptions = StaleWhileRevalidateCache(
+    get_cache('lemonsqueezy_subscriptions', SUBSCRIPTION_CACHE_SIZE), _refresh_executor
+)
+
 
 class LemonSqueezyService:
     """Service for handling LemonSqueezy operations"""
     
-    def __init__(self):
-        self.api_key = LEMONSQUEEZY_API_KEY
-        self.headers = {
-            'Accept': 'application/vnd.api+json',
-            'Content-Type': 'application/vnd.api+json',
-            'Authorization': f'Bearer {self.api_key}'
-        }
+    def __init__(self, client=None):
+        self._client = client
+    
+    @property
+    def client(self):
+        return self._client or get_lemonsqueezy_client()
     
     def create_checkout(self, user_id, email, custom_data=None):
         """
@@ -52,8 +390,6 @@ class LemonSqueezyService:
         Returns:
             dict: Checkout URL and session data
         """
-        url = f"{LEMONSQUEEZY_API_URL}/checkouts"
-        
         checkout_data = {
             "data": {
                 "type": "checkouts",
@@ -84,8 +420,7 @@ class LemonSqueezyService:
         }
         
         try:
-            response = requests.post(url, json=checkout_data, headers=self.headers)
-            response.raise_for_status()
+            response = self.client.post('/checkouts', json=checkout_data, endpoint='POST /checkouts')
             data = response.json()
             
             checkout_url = data['data']['attributes']['url']
@@ -101,12 +436,15 @@ class LemonSqueezyService:
             }
     
     def get_subscription(self, subscription_id):
+        """Get subscription details, cached and refreshed from LemonSqueezy"""
+        return _subscriptions.get(
+            str(subscription_id), lambda: self._fetch_subscription(subscription_id), subscription_lifetimes
+        )
+    
+    def _fetch_subscription(self, subscription_id):
         """Get subscription details from LemonSqueezy"""
-        url = f"{LEMONSQUEEZY_API_URL}/subscriptions/{subscription_id}"
-        
         try:
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
+            response = self.client.get(f'/subscriptions/{subscription_id}', endpoint='GET /subscriptions/{id}')
             return response.json()
         except requests.exceptions.RequestException as e:
             print(f"Error fetching subscription: {e}")
@@ -114,22 +452,23 @@ class LemonSqueezyService:
     
     def cancel_subscription(self, subscription_id):
         """Cancel a subscription"""
-        url = f"{LEMONSQUEEZY_API_URL}/subscriptions/{subscription_id}"
-        
         try:
-            response = requests.delete(url, headers=self.headers)
-            response.raise_for_status()
+            self.client.delete(f'/subscriptions/{subscription_id}', endpoint='DELETE /subscriptions/{id}')
+            _subscriptions.delete(str(subscription_id))
             return {'success': True}
         except requests.exceptions.RequestException as e:
             return {'success': False, 'error': str(e)}
     
     def get_customer_portal_url(self, customer_id):
-        """Get customer portal URL for subscription management"""
-        url = f"{LEMONSQUEEZY_API_URL}/customers/{customer_id}"
-        
+        """Get customer portal URL for subscription management, cached until its signature expires"""
+        return _portal_urls.get(
+            str(customer_id), lambda: self._fetch_customer_portal_url(customer_id), portal_url_lifetimes
+        )
+    
+    def _fetch_customer_portal_url(self, customer_id):
+        """Get customer portal URL from LemonSqueezy"""
         try:
-            response = requests.get(url, headers=self.headers)
-            response.raise_for_status()
+            response = self.client.get(f'/customers/{customer_id}', endpoint='GET /customers/{id}')
             data = response.json()
             return data['data']['attributes']['urls']['customer_portal']
         except requests.exceptions.RequestException as e:
@@ -148,8 +487,8 @@ class LemonSqueezyService:
     
     def process_webhook_event(self, event_data):
         """
-        Process LemonSqueezy webhook events
-        
+        Store and process a LemonSqueezy webhook event synchronously
+
         Event types:
         - subscription_created
         - subscription_updated
@@ -161,106 +500,164 @@ class LemonSqueezyService:
         - subscription_payment_success
         - subscription_payment_failed
         """
-        event_type = event_data.get('meta', {}).get('event_name')
-        # LemonSqueezy sends `webhook_id` (not `event_id`). Use it as our event identifier.
-        event_id = event_data.get('meta', {}).get('event_id') or event_data.get('meta', {}).get('webhook_id')
+        result = self.enqueue_webhook_event(event_data)
+        if not result['success']:
+            return result
+        return self.process_stored_event(result['id'])
+    
+    def enqueue_webhook_event(self, event_data, payload=None):
+        """
+        Durably store a verified webhook event in subscription_events
+
+        Redeliveries of an event (same lemonsqueezy_event_id) are ignored,
+        so each event is applied at most once. Returns the row id and whether
+        the event was a duplicate. Any other failure to store the row (a bad
+        value, a NULL in a NOT NULL column) is an error, not a duplicate.
+        """
+        meta = event_data.get('meta', {})
         subscription_data = event_data.get('data', {})
         attributes = subscription_data.get('attributes', {})
+        if payload is None:
+            payload = json.dumps(event_data)
+        # LemonSqueezy sends `webhook_id` (not `event_id`). Use it as our event identifier,
+        # falling back to a digest of the payload so the column is never NULL
+        event_id = (meta.get('event_id') or meta.get('webhook_id')
+                    or hashlib.sha256(payload.encode('utf-8')).hexdigest())
+        # Events of one subscription are processed in order; invoices carry
+        # the subscription in their attributes
+        subscription_id = str(attributes.get('subscription_id') or subscription_data.get('id') or '')
         
-        # Extract user_id from multiple possible locations
+        with borrow_connection() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    # A redelivery hits the unique lemonsqueezy_event_id and
+                    # leaves the row unchanged (0 rows affected); either way
+                    # LAST_INSERT_ID() is the event's row id
+                    cursor.execute("""
+                        INSERT INTO subscription_events 
+                        (event_type, subscription_id, lemonsqueezy_event_id, payload, processed)
+                        VALUES (%s, %s, %s, %s, FALSE)
+                        ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
+                    """, (meta.get('event_name'), subscription_id, event_id, payload))
+                    duplicate = cursor.rowcount != 1
+                    row_id = cursor.lastrowid
+                connection.commit()
+                return {'success': True, 'id': row_id, 'event_id': event_id, 'duplicate': duplicate}
+            except Exception as e:
+                connection.rollback()
+                print(f"Error storing webhook: {e}")
+                return {'success': False, 'error': str(e)}
+    
+    def process_stored_event(self, event_row_id):
+        """
+        Apply one stored subscription_events row
+
+        The row is locked for the transaction and skipped if already
+        processed, so concurrent or repeated processing applies it once.
+        """
         user_id = None
+        with borrow_connection() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT payload, processed FROM subscription_events
+                        WHERE id = %s FOR UPDATE
+                    """, (event_row_id,))
+                    row = cursor.fetchone()
+                    if row is None or row['processed']:
+                        connection.commit()
+                        return {'success': True, 'duplicate': True}
+                    
+                    event_data = json.loads(row['payload'])
+                    attributes = event_data.get('data', {}).get('attributes', {})
+                    user_id = self._find_webhook_user(cursor, event_data)
+                    if not user_id:
+                        connection.rollback()
+                        error_msg = f"Could not find user_id. Email: {attributes.get('user_email')}, Customer ID: {attributes.get('customer_id')}"
+                        print(error_msg)
+                        return {'success': False, 'error': 'Missing user_id'}
+                    
+                    self._apply_webhook_event(
+                        cursor, user_id, event_data.get('meta', {}).get('event_name'), attributes
+                    )
+                    
+                    # Mark event as processed
+                    cursor.execute("""
+                        UPDATE subscription_events 
+                        SET user_id = %s, processed = TRUE, processed_at = %s,
+                            last_error = NULL, locked_by = NULL, locked_at = NULL
+                        WHERE id = %s
+                    """, (user_id, datetime.now(), event_row_id))
+                
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                print(f"Error processing webhook: {e}")
+                return {'success': False, 'error': str(e)}
         
-        # Try 1: From custom_data in attributes
-        custom_data = attributes.get('custom_data', {})
-        if custom_data and isinstance(custom_data, dict):
-            user_id = custom_data.get('user_id')
-        
-        # Try 2: From meta custom_data
-        if not user_id:
-            meta_custom = event_data.get('meta', {}).get('custom_data', {})
-            if meta_custom and isinstance(meta_custom, dict):
-                user_id = meta_custom.get('user_id')
-        
-        # Try 3: Find user by email
-        if not user_id:
-            user_email = attributes.get('user_email') or attributes.get('customer_email')
-            if user_email:
-                connection = get_db_connection()
-                try:
-                    with connection.cursor() as cursor:
-                        cursor.execute("SELECT id FROM users WHERE email = %s", (user_email,))
-                        user_data = cursor.fetchone()
-                        if user_data:
-                            user_id = user_data['id']
-                finally:
-                    connection.close()
-        
-        # Try 4: Find user by lemonsqueezy_customer_id
-        if not user_id:
-            customer_id = attributes.get('customer_id')
-            if customer_id:
-                connection = get_db_connection()
-                try:
-                    with connection.cursor() as cursor:
-                        cursor.execute("SELECT id FROM users WHERE lemonsqueezy_customer_id = %s", (customer_id,))
-                        user_data = cursor.fetchone()
-                        if user_data:
-                            user_id = user_data['id']
-                finally:
-                    connection.close()
+        invalidate_quota_cache(user_id)
+        invalidate('users', int(user_id))
+        self._update_lookup_caches(event_data)
+        return {'success': True, 'user_id': user_id}
+    
+    def _update_lookup_caches(self, event_data):
+        """
+        Drop cached details of the event's subscription and store the signed
+        portal URL the event carries (or drop the cached one)
+        """
+        data = event_data.get('data', {})
+        attributes = data.get('attributes', {})
+        subscription_id = attributes.get('subscription_id') or (
+            data.get('id') if data.get('type') == 'subscriptions' else None
+        )
+        if subscription_id:
+            _subscriptions.delete(str(subscription_id))
         
-        if not user_id:
-            error_msg = f"Could not find user_id. Email: {attributes.get('user_email')}, Customer ID: {attributes.get('customer_id')}"
-            print(error_msg)
-            return {'success': False, 'error': 'Missing user_id'}
+        customer_id = attributes.get('customer_id')
+        if customer_id:
+            portal_url = (attributes.get('urls') or {}).get('customer_portal')
+            if portal_url:
+                _portal_urls.put(str(customer_id), portal_url, portal_url_lifetimes)
+            else:
+                _portal_urls.delete(str(customer_id))
+    
+    def _find_webhook_user(self, cursor, event_data):
+        """
+        Resolve the user of an event: custom_data user_id (attributes, then
+        meta) first, else one query matching email or LemonSqueezy customer id
+        """
+        attributes = event_data.get('data', {}).get('attributes', {})
+        for custom_data in (attributes.get('custom_data'), event_data.get('meta', {}).get('custom_data')):
+            if custom_data and isinstance(custom_data, dict) and custom_data.get('user_id'):
+                return custom_data['user_id']
         
-        connection = get_db_connection()
-        try:
-            with connection.cursor() as cursor:
-                # Log the webhook event
-                # Ensure lemonsqueezy_event_id is not NULL to satisfy DB constraint
-                cursor.execute("""
-                    INSERT INTO subscription_events 
-                    (user_id, event_type, subscription_id, lemonsqueezy_event_id, payload, processed)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
-                    user_id,
-                    event_type,
-                    subscription_data.get('id'),
-                    event_id,
-                    json.dumps(event_data),
-                    False
-                ))
-                
-                # Process based on event type
-                if event_type == 'subscription_created':
-                    self._handle_subscription_created(cursor, user_id, attributes)
-                elif event_type == 'subscription_updated':
-                    self._handle_subscription_updated(cursor, user_id, attributes)
-                elif event_type in ['subscription_cancelled', 'subscription_expired']:
-                    self._handle_subscription_cancelled(cursor, user_id, attributes)
-                elif event_type == 'subscription_resumed':
-                    self._handle_subscription_resumed(cursor, user_id, attributes)
-                elif event_type == 'subscription_payment_success':
-                    self._handle_payment_success(cursor, user_id, attributes)
-                elif event_type == 'subscription_payment_failed':
-                    self._handle_payment_failed(cursor, user_id, attributes)
-                
-                # Mark event as processed
-                cursor.execute("""
-                    UPDATE subscription_events 
-                    SET processed = TRUE 
-                    WHERE lemonsqueezy_event_id = %s
-                """, (event_id,))
-                
-            connection.commit()
-            return {'success': True}
-        except Exception as e:
-            connection.rollback()
-            print(f"Error processing webhook: {e}")
-            return {'success': False, 'error': str(e)}
-        finally:
-            connection.close()
+        user_email = attributes.get('user_email') or attributes.get('customer_email')
+        customer_id = attributes.get('customer_id')
+        if not user_email and not customer_id:
+            return None
+        cursor.execute("""
+            SELECT id FROM users
+            WHERE email = %s OR lemonsqueezy_customer_id = %s
+            ORDER BY email = %s DESC
+            LIMIT 1
+        """, (user_email, customer_id, user_email))
+        user_data = cursor.fetchone()
+        return user_data['id'] if user_data else None
+    
+    def _apply_webhook_event(self, cursor, user_id, event_type, attributes):
+        """Process based on event type"""
+        if event_type == 'subscription_created':
+            self._handle_subscription_created(cursor, user_id, attributes)
+        elif event_type == 'subscription_updated':
+            self._handle_subscription_updated(cursor, user_id, attributes)
+        elif event_type in ['subscription_cancelled', 'subscription_expired']:
+            self._handle_subscription_cancelled(cursor, user_id, attributes)
+        elif event_type == 'subscription_resumed':
+            self._handle_subscription_resumed(cursor, user_id, attributes)
+        elif event_type == 'subscription_payment_success':
+            self._handle_payment_success(cursor, user_id, attributes)
+        elif event_type == 'subscription_payment_failed':
+            self._handle_payment_failed(cursor, user_id, attributes)
     
     def _handle_subscription_created(self, cursor, user_id, attributes):
         """Handle new subscription creation"""
@@ -375,6 +772,16 @@ class LemonSqueezyService:
         """, (user_id,))
 
 
+def _token_counts(usage, tokens_used=1):
+    """(tokens_used, input_tokens, output_tokens) for a model usage dict"""
+    input_tokens = usage.get('input_tokens') or 0
+    output_tokens = usage.get('output_tokens') or 0
+    if usage.get('total_tokens') is not None:
+        tokens_used = usage['total_tokens']
+    elif input_tokens or output_tokens:
+        tokens_used = input_tokens + output_tokens
+    return tokens_used, input_tokens, output_tokens
+
 class UsageTracker:
     """Track and manage user API usage"""
     
@@ -393,8 +800,7 @@ class UsageTracker:
                 'plan': str
             }
         """
-        connection = get_db_connection()
-        try:
+        with borrow_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute("""
                     SELECT subscription_status, monthly_quota, requests_used, 
@@ -443,66 +849,179 @@ class UsageTracker:
                     'is_overage': is_overage,
                     'plan': user['plan_name']
                 }
-        finally:
-            connection.close()
     
     @staticmethod
-    def log_usage(user_id, action_type, tokens_used=1):
-        """Log API usage and increment counter"""
-        connection = get_db_connection()
-        try:
-            with connection.cursor() as cursor:
-                # Get user's billing period
-                cursor.execute("""
-                    SELECT current_period_start, current_period_end, 
-                           monthly_quota, requests_used
-                    FROM users WHERE id = %s
-                """, (user_id,))
-                
-                user = cursor.fetchone()
-                
-                if not user:
-                    return {'success': False, 'error': 'User not found'}
-                
-                # Determine if this is overage
-                is_overage = user['requests_used'] >= user['monthly_quota']
-                
-                # Log the usage
-                cursor.execute("""
-                    INSERT INTO usage_logs 
-                    (user_id, action_type, tokens_used, billing_period_start, 
-                     billing_period_end, is_overage)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, (
-                    user_id,
-                    action_type,
-                    tokens_used,
-                    user['current_period_start'] or datetime.now(),
-                    user['current_period_end'] or datetime.now() + timedelta(days=30),
-                    is_overage
-                ))
-                
-                # Increment user's request counter
-                cursor.execute("""
-                    UPDATE users 
-                    SET requests_used = requests_used + 1
-                    WHERE id = %s
-                """, (user_id,))
+    def _cached_plan(cursor, user_id):
+        plan = _quota_plans.get(user_id)
+        if plan is None:
+            cursor.execute("""
+                SELECT monthly_quota, plan_name, overage_enabled, auto_stop_at_limit
+                FROM users WHERE id = %s
+            """, (user_id,))
+            plan = cursor.fetchone()
+            if plan:
+                _quota_plans.set(user_id, plan)
+        return plan
+    
+    @staticmethod
+    def reserve_quota(user_id):
+        """
+        Atomically reserve one request against the user's quota
+        
+        The admission rule of check_quota runs inside a single conditional
+        UPDATE, so concurrent requests at the quota boundary cannot both be
+        admitted. The new counter value comes back through LAST_INSERT_ID(),
+        so the remaining quota needs no second read. Only a denied request
+        falls back to check_quota for its message.
+        
+        Returns the same dict as check_quota, computed after the reservation.
+        A reserved request that is not served must be handed back with
+        release_quota.
+        """
+        for _ in range(2):
+            with borrow_connection() as connection:
+                try:
+                    with connection.cursor() as cursor:
+                        cursor.execute("""
+                            UPDATE users 
+                            SET requests_used = LAST_INSERT_ID(requests_used + 1)
+                            WHERE id = %s
+                              AND (requests_used < monthly_quota
+                                   OR (overage_enabled AND NOT auto_stop_at_limit))
+                        """, (user_id,))
+                        reserved = cursor.rowcount == 1
+                        used = cursor.lastrowid
+                        plan = UsageTracker._cached_plan(cursor, user_id) if reserved else None
+                    connection.commit()
+                except Exception:
+                    connection.rollback()
+                    raise
+            
+            if reserved and plan:
+                quota = plan['monthly_quota']
+                return {
+                    'allowed': True,
+                    'remaining': max(0, quota - used),
+                    'quota': quota,
+                    'used': used,
+                    'is_overage': used > quota,
+                    'plan': plan['plan_name']
+                }
+            
+            # Denied: report why from a fresh read. If the row changed in
+            # between (quota reset, overage enabled) try the reservation again.
+            invalidate_quota_cache(user_id)
+            result = UsageTracker.check_quota(user_id)
+            if not result.get('allowed', False):
+                return result
+        
+        result['allowed'] = False
+        result['message'] = 'Quota is being updated. Please try again.'
+        return result
+    
+    @staticmethod
+    def release_quota(user_id):
+        """Hand back a request reserved with reserve_quota that was not served"""
+        with borrow_connection() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute("""
+                        UPDATE users 
+                        SET requests_used = requests_used - 1
+                        WHERE id = %s AND requests_used > 0
+                    """, (user_id,))
+                connection.commit()
+            except Exception as e:
+                connection.rollback()
+                print(f"Error releasing quota: {e}")
+    
+    @staticmethod
+    def log_usage(user_id, action_type, tokens_used=1, commit=True,
+                  usage=None, model_id=None, session_id=None, count_request=True,
+                  is_overage=None):
+        """
+        Log API usage and increment counter
+
+        `usage` is the token/latency dict reported for a model call; when
+        given, its total_tokens replaces tokens_used and its input/output
+        counts and latency are stored on the row with model_id and session_id.
+        
+        Pass count_request=False when the request was already counted by
+        reserve_quota; only the usage row is written then, and is_overage
+        should be the reservation's flag, since requests_used may include
+        later reservations by now. Without it the flag is read from the
+        counter when the row is written.
+
+        With commit=False the writes join the caller's open transaction on the
+        request-scoped connection and errors propagate, so the caller can
+        commit or roll back its whole unit of work at once.
+        """
+        with borrow_connection() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    usage = usage or {}
+                    tokens_used, input_tokens, output_tokens = _token_counts(usage, tokens_used)
+                    
+                    if is_overage is not None:
+                        overage_sql, overage_args = '%s', (bool(is_overage),)
+                    elif count_request:
+                        overage_sql, overage_args = 'requests_used >= monthly_quota', ()
+                    else:
+                        # A reserved request is already included in requests_used
+                        overage_sql, overage_args = 'requests_used > monthly_quota', ()
+                    
+                    # Log the usage against the user's billing period in a single statement
+                    cursor.execute(f"""
+                        INSERT INTO usage_logs 
+                        (user_id, action_type, tokens_used, input_tokens, output_tokens,
+                         latency_ms, model_id, session_id, billing_period_start, 
+                         billing_period_end, is_overage)
+                        SELECT id, %s, %s, %s, %s, %s, %s, %s,
+                               COALESCE(current_period_start, %s),
+                               COALESCE(current_period_end, %s),
+                               {overage_sql}
+                        FROM users WHERE id = %s
+                    """, (action_type, tokens_used, input_tokens, output_tokens,
+                          usage.get('latency_ms'), model_id, session_id,
+                          UNBILLED_PERIOD, UNBILLED_PERIOD) + overage_args + (user_id,))
+                    
+                    if cursor.rowcount == 0:
+                        return {'success': False, 'error': 'User not found'}
+                    
+                    # Fold the new row into its usage rollup
+                    cursor.execute(f"""
+                        INSERT INTO usage_rollups {ROLLUP_COLUMNS}
+                        SELECT user_id, billing_period_start, billing_period_end,
+                               action_type, COALESCE(model_id, ''), 1, is_overage,
+                               tokens_used, input_tokens, output_tokens,
+                               COALESCE(latency_ms, 0),
+                               IF(latency_ms IS NULL, 0, output_tokens)
+                        FROM usage_logs WHERE id = %s
+                        {ROLLUP_ON_DUPLICATE}
+                    """, (cursor.lastrowid,))
+                    
+                    # Increment user's request counter
+                    if count_request:
+                        cursor.execute("""
+                            UPDATE users 
+                            SET requests_used = requests_used + 1
+                            WHERE id = %s
+                        """, (user_id,))
                 
-            connection.commit()
-            return {'success': True}
-        except Exception as e:
-            connection.rollback()
-            print(f"Error logging usage: {e}")
-            return {'success': False, 'error': str(e)}
-        finally:
-            connection.close()
+                if commit:
+                    connection.commit()
+                return {'success': True}
+            except Exception as e:
+                if not commit:
+                    raise
+                connection.rollback()
+                print(f"Error logging usage: {e}")
+                return {'success': False, 'error': str(e)}
     
     @staticmethod
     def get_usage_stats(user_id):
         """Get detailed usage statistics for current billing period"""
-        connection = get_db_connection()
-        try:
+        with borrow_connection() as connection:
             with connection.cursor() as cursor:
                 # Get user info
                 cursor.execute("""
@@ -517,17 +1036,47 @@ class UsageTracker:
                 if not user:
                     return None
                 
-                # Get usage breakdown
+                # Usage totals for the period from the rollup: one row per
+                # action type and model, a primary key range read. Users
+                # without a period were logged under UNBILLED_PERIOD.
                 cursor.execute("""
-                    SELECT action_type, COUNT(*) as count, SUM(tokens_used) as tokens
-                    FROM usage_logs
+                    SELECT action_type, model_id, requests, tokens_used,
+                           input_tokens, output_tokens, latency_ms, timed_output_tokens
+                    FROM usage_rollups
                     WHERE user_id = %s 
                       AND billing_period_start = %s
                       AND billing_period_end = %s
-                    GROUP BY action_type
-                """, (user_id, user['current_period_start'], user['current_period_end']))
+                """, (user_id, user['current_period_start'] or UNBILLED_PERIOD,
+                      user['current_period_end'] or UNBILLED_PERIOD))
+                
+                rollups = cursor.fetchall()
                 
-                breakdown = cursor.fetchall()
+                # Usage breakdown by action type
+                by_action = {}
+                for row in rollups:
+                    entry = by_action.setdefault(row['action_type'], {
+                        'action_type': row['action_type'], 'count': 0, 'tokens': 0
+                    })
+                    entry['count'] += int(row['requests'])
+                    entry['tokens'] += int(row['tokens_used'])
+                breakdown = list(by_action.values())
+                
+                # Per-model token, latency and cost breakdown
+                by_model = {}
+                for row in rollups:
+                    if not row['model_id']:
+                        continue
+                    entry = by_model.setdefault(row['model_id'], {
+                        'model_id': row['model_id'], 'requests': 0, 'input_tokens': 0,
+                        'output_tokens': 0, 'tokens': 0, 'latency_ms': 0, 'timed_output_tokens': 0
+                    })
+                    entry['requests'] += int(row['requests'])
+                    entry['input_tokens'] += int(row['input_tokens'])
+                    entry['output_tokens'] += int(row['output_tokens'])
+                    entry['tokens'] += int(row['tokens_used'])
+                    entry['latency_ms'] += int(row['latency_ms'])
+                    entry['timed_output_tokens'] += int(row['timed_output_tokens'])
+                models = [UsageTracker._model_usage(row) for row in by_model.values()]
                 
                 # Calculate overage
                 overage_requests = max(0, user['requests_used'] - user['monthly_quota'])
@@ -546,19 +1095,39 @@ class UsageTracker:
                     'period_start': user['current_period_start'],
                     'period_end': user['current_period_end'],
                     'breakdown': breakdown,
+                    'models': models,
+                    'model_cost': round(sum(m['cost'] or 0 for m in models), 4),
                     'overage_enabled': user['overage_enabled'],
                     'auto_stop_at_limit': user['auto_stop_at_limit']
                 }
-        finally:
-            connection.close()
+    
+    @staticmethod
+    def _model_usage(row):
+        """Shape one per-model usage aggregate for the usage API"""
+        requests_count = int(row['requests'])
+        input_tokens = int(row['input_tokens'] or 0)
+        output_tokens = int(row['output_tokens'] or 0)
+        latency_ms = int(row['latency_ms'] or 0)
+        timed_output_tokens = int(row['timed_output_tokens'] or 0)
+        cost = estimate_cost(row['model_id'], input_tokens, output_tokens)
+        return {
+            'model_id': row['model_id'],
+            'requests': requests_count,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': int(row['tokens'] or 0),
+            'avg_input_tokens': round(input_tokens / requests_count, 1) if requests_count else 0,
+            'avg_latency_ms': round(latency_ms / requests_count) if requests_count else 0,
+            'tokens_per_second': round(timed_output_tokens / (latency_ms / 1000), 2) if latency_ms else None,
+            'cost': round(cost, 4) if cost is not None else None
+        }
     
     @staticmethod
     def should_show_warning(user_id):
         """Check if overage warning should be shown"""
         threshold = float(os.getenv('OVERAGE_WARNING_THRESHOLD', '0.8'))
         
-        connection = get_db_connection()
-        try:
+        with borrow_connection() as connection:
             with connection.cursor() as cursor:
                 cursor.execute("""
                     SELECT monthly_quota, requests_used
@@ -572,8 +1141,6 @@ class UsageTracker:
                 
                 usage_percentage = user['requests_used'] / user['monthly_quota']
                 return usage_percentage >= threshold
-        finally:
-            connection.close()
 
 
 # Helper functions for easy import
@@ -586,9 +1153,54 @@ def check_user_quota(user_id):
     """Quick function to check quota"""
     return UsageTracker.check_quota(user_id)
 
-def log_api_usage(user_id, action_type):
+def reserve_user_quota(user_id):
+    """Quick function to reserve one request against the quota"""
+    return UsageTracker.reserve_quota(user_id)
+
+def release_user_quota(user_id):
+    """Quick function to hand back an unused reservation"""
+    return UsageTracker.release_quota(user_id)
+
+def invalidate_quota_cache(user_id):
+    """Drop the cached quota plan after the user's subscription or settings change"""
+    _quota_plans.delete(int(user_id))
+
+def log_api_usage(user_id, action_type, commit=True, usage=None, model_id=None,
+                  session_id=None, count_request=True, is_overage=None):
     """Quick function to log usage"""
-    return UsageTracker.log_usage(user_id, action_type)
+    return UsageTracker.log_usage(
+        user_id, action_type, commit=commit, usage=usage, model_id=model_id,
+        session_id=session_id, count_request=count_request, is_overage=is_overage
+    )
+
+def record_api_usage(user_id, action_type, usage=None, model_id=None,
+                     session_id=None, count_request=True, is_overage=None):
+    """
+    Log usage off the response path through the write-behind writer
+
+    Falls back to a synchronous log_usage when write-behind is disabled or
+    the writer's queue stays full.
+    """
+    if USAGE_WRITE_BEHIND:
+        tokens_used, input_tokens, output_tokens = _token_counts(usage or {})
+        queued = get_usage_writer().submit({
+            'user_id': user_id,
+            'action_type': action_type,
+            'tokens_used': tokens_used,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'latency_ms': (usage or {}).get('latency_ms'),
+            'model_id': model_id,
+            'session_id': session_id,
+            'count_request': count_request,
+            'is_overage': is_overage
+        })
+        if queued:
+            return {'success': True, 'queued': True}
+    return UsageTracker.log_usage(
+        user_id, action_type, usage=usage, model_id=model_id,
+        session_id=session_id, count_request=count_request, is_overage=is_overage
+    )
 
 def get_user_usage_stats(user_id):
     """Quick function to get stats"""
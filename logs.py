@@ -0,0 +1,208 @@
+"""
+Logging for ZED AI
+JSON-lines (or text) log records tagged with the current request ID, written
+by a background thread so log I/O never blocks a request, and cheap
+summaries of Bedrock payloads instead of pretty-printed copies
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+from datetime import datetime, timezone
+
+# Logging configuration
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'json' (one JSON object per line) or 'text'
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Empty logs to stderr
+LOG_FILE = os.getenv('LOG_FILE', '')
+# Records waiting for the writer thread beyond this are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+# Full payload copies: logged at DEBUG for this fraction of calls, cut to
+# LOG_PAYLOAD_MAX_CHARS, with message text replaced by its length
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0.01))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv('LOG_PAYLOAD_MAX_CHARS', 2000))
+LOG_REDACT_CONTENT = os.getenv('LOG_REDACT_CONTENT', 'true').lower() == 'true'
+
+# Payload keys whose string values are user or model text
+CONTENT_KEYS = frozenset({'content', 'text', 'prompt', 'inputText', 'system', 'outputText', 'completion', 'generation'})
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+_request_id = contextvars.ContextVar('request_id', default='-')
+# Caller-supplied request IDs are only trusted in this shape
+_REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+def set_request_id(request_id=None) -> str:
+    """Tag log records of the current context with `request_id` (a new one if None or malformed)"""
+    if not request_id or not _REQUEST_ID_PATTERN.fullmatch(request_id):
+        request_id = new_request_id()
+    _request_id.set(request_id)
+    return request_id
+
+def get_request_id() -> str:
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request ID to every record as `request_id`"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record: ts, level, logger, request_id, msg, any
+    fields passed as extra={'fields': {...}} and the exception, if any
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'msg': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The classic text format with the request ID and any extra fields as key=value pairs"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full instead of raising"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_queue_handler = None
+
+def configure_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, log_file=LOG_FILE, queue_size=LOG_QUEUE_SIZE):
+    """
+    Route all logging through a bounded queue to a writer thread
+
+    The root logger gets a single non-blocking queue handler; record
+    encoding and file or stderr I/O happen on the listener thread. Safe to
+    call more than once (later calls are ignored).
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    target = logging.FileHandler(log_file, encoding='utf-8') if log_file else logging.StreamHandler(sys.stderr)
+    target.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _queue_handler.addFilter(RequestIdFilter())
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(_queue_handler.queue, target, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+def logging_stats():
+    """Records waiting for the writer thread and records dropped because the queue was full"""
+    if _queue_handler is None:
+        return {'queued': 0, 'dropped': 0}
+    return {'queued': _queue_handler.queue.qsize(), 'dropped': _queue_handler.dropped}
+
+
+def payload_summary(payload) -> dict:
+    """
+    Shape of a request or response body from its top-level keys only:
+    list lengths, string lengths and scalar values. Cost does not grow
+    with the conversation.
+    """
+    summary = {}
+    if not isinstance(payload, dict):
+        return summary
+    for key, value in payload.items():
+        if isinstance(value, (list, dict)):
+            summary[f'{key}_len'] = len(value)
+        elif isinstance(value, str):
+            summary[f'{key}_chars'] = len(value)
+        elif isinstance(value, (int, float, bool)) or value is None:
+            summary[key] = value
+    return summary
+
+def redact(value):
+    """Copy of a payload with message text replaced by its length"""
+    if isinstance(value, dict):
+        return {
+            key: f'<{len(item)} chars>' if key in CONTENT_KEYS and isinstance(item, str) else redact(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+class _PayloadText:
+    """Serializes a payload only if the record is actually formatted"""
+
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        payload = redact(self.payload) if LOG_REDACT_CONTENT else self.payload
+        text = json.dumps(payload, ensure_ascii=False, separators=(',', ':'), default=str)
+        if len(text) > LOG_PAYLOAD_MAX_CHARS:
+            text = f"{text[:LOG_PAYLOAD_MAX_CHARS]}...[{len(text) - LOG_PAYLOAD_MAX_CHARS} more chars]"
+        return text
+
+
+def log_payload(log, label, payload, **fields):
+    """
+    Log a Bedrock payload cheaply: its summary at INFO, and for a sampled
+    fraction of calls a redacted, truncated copy at DEBUG
+    """
+    if log.isEnabledFor(logging.INFO):
+        log.info(label, extra={'fields': dict(fields, **payload_summary(payload))})
+    if log.isEnabledFor(logging.DEBUG) and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        log.debug('%s payload: %s', label, _PayloadText(payload), extra={'fields': fields})
@@ -0,0 +1,266 @@
+"""
+Metrics for ZED AI
+In-process counters and histograms for requests and chat pipeline stages,
+plus the stats() snapshots of the pools, caches and clients, rendered in
+the Prometheus text exposition format for /metrics
+"""
+
+import logging
+import math
+import os
+import re
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Distinct model labels kept; model IDs come from requests, so any beyond
+# this are recorded as 'other' to bound the number of series
+METRICS_MAX_MODELS = int(os.getenv('METRICS_MAX_MODELS', 32))
+
+_INVALID_NAME_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: Dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class Counter:
+    """Monotonic counter with a fixed set of label names"""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name + '_total', dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """Histogram over fixed buckets with a fixed set of label names"""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        for key, values in series:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), values):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le=_format_value(bound)), cumulative
+            yield self.name + '_count', labels, cumulative
+            yield self.name + '_sum', labels, values[-1]
+
+
+class Registry:
+    """
+    Named metrics plus collectors called at scrape time
+
+    A collector returns (name, type, help, samples) tuples, samples being
+    (sample name, labels, value). A failing collector is logged and skipped
+    so one broken stats() call cannot take /metrics down.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector: Callable[[], Iterable[Tuple]]):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        families = [(m.name, m.type, m.documentation, m.samples()) for m in metrics]
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as e:
+                logger.warning("Metrics collector %s failed: %s", getattr(collector, '__name__', collector), e)
+        lines = []
+        for name, metric_type, documentation, samples in families:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for sample_name, labels, value in samples:
+                lines.append(f'{sample_name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.counter(
+    'zed_http_requests', 'HTTP requests by method, route and status', ('method', 'route', 'status')
+)
+http_request_duration = REGISTRY.histogram(
+    'zed_http_request_duration_seconds',
+    'Time to produce the response (first byte for streamed responses) by method and route',
+    ('method', 'route')
+)
+stage_duration = REGISTRY.histogram(
+    'zed_stage_duration_seconds', 'Duration of each chat pipeline stage by pipeline, stage and model',
+    ('pipeline', 'stage', 'model')
+)
+pipeline_duration = REGISTRY.histogram(
+    'zed_pipeline_duration_seconds', 'Total duration of a chat pipeline run by pipeline and model',
+    ('pipeline', 'model')
+)
+
+
+def observe_request(method: str, route: str, status: int, seconds: float):
+    """Count one HTTP request and record how long its response took"""
+    http_requests.inc(method=method, route=route, status=status)
+    http_request_duration.observe(seconds, method=method, route=route)
+
+_models = set()
+
+def _model_label(model: Optional[str]) -> str:
+    if not model:
+        return ''
+    if model not in _models:
+        if len(_models) >= METRICS_MAX_MODELS:
+            return 'other'
+        _models.add(model)
+    return model
+
+def observe_stages(pipeline: str, stages, total_ms: float, model: Optional[str] = None):
+    """Record a StageTimer's stages (name, ms) and total"""
+    model = _model_label(model)
+    for stage, ms in stages:
+        stage_duration.observe(ms / 1000, pipeline=pipeline, stage=stage, model=model)
+    pipeline_duration.observe(total_ms / 1000, pipeline=pipeline, model=model)
+
+
+def _metric_name(*parts) -> str:
+    return _INVALID_NAME_CHARS.sub('_', '_'.join(str(part) for part in parts if part))
+
+def _stats_family(prefix: str, key: str, documentation: str, counter: bool, samples) -> Tuple:
+    if not counter:
+        name = _metric_name(prefix, key)
+        return name, 'gauge', f'{documentation}: {key}', [(name, labels, value) for labels, value in samples]
+    name = _metric_name(prefix, key[:-len('_total')] if key.endswith('_total') else key)
+    return name, 'counter', f'{documentation}: {key}', [(name + '_total', labels, value) for labels, value in samples]
+
+def register_stats(prefix: str, stats_fn: Callable[[], Dict], documentation: str, label: Optional[str] = None,
+                   counters: Iterable[str] = ()):
+    """
+    Expose a stats() snapshot as gauges named <prefix>_<key>
+
+    Keys in `counters` are running totals (hits, calls, runs) and are
+    exposed as counters named <prefix>_<key>_total instead, so rate()
+    applies to them. With `label`, stats_fn returns {label value: stats
+    dict} (e.g. one entry per cache or language) and each series carries
+    that label. Non-numeric values are skipped.
+    """
+    counters = frozenset(counters)
+
+    def collect():
+        snapshot = stats_fn()
+        groups = snapshot.items() if label else [(None, snapshot)]
+        series = {}
+        for group, stats in groups:
+            for key, value in stats.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    series.setdefault(key, []).append(({label: group} if label else {}, value))
+        return [_stats_family(prefix, key, documentation, key in counters, samples)
+                for key, samples in series.items()]
+
+    collect.__name__ = f'{prefix}_collector'
+    REGISTRY.register_collector(collect)
+
+def register_histogram_stats(name: str, stats_fn: Callable[[], Dict], documentation: str,
+                             label: str, scale: float = 0.001):
+    """
+    Expose pre-aggregated histograms as a histogram family
+
+    stats_fn returns {label value: {'count', 'avg_ms' or 'sum', 'histogram':
+    {upper bound: cumulative count, ..., '+Inf': count}}}; bounds are scaled
+    by `scale` (ms to seconds by default).
+    """
+    def collect():
+        samples = []
+        for group, stats in stats_fn().items():
+            labels = {label: group}
+            for bound, count in stats['histogram'].items():
+                le = '+Inf' if bound == '+Inf' else _format_value(float(bound) * scale)
+                samples.append((name + '_bucket', dict(labels, le=le), count))
+            total = stats.get('sum', stats.get('avg_ms', 0) * stats['count'])
+            samples.append((name + '_count', labels, stats['count']))
+            samples.append((name + '_sum', labels, total * scale))
+        return [(name, 'histogram', documentation, samples)]
+
+    collect.__name__ = f'{name}_collector'
+    REGISTRY.register_collector(collect)
+
+def render() -> str:
+    return REGISTRY.render()
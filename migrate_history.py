@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Migration script for incremental conversation history
+
+Adds the (session_id, id) index used for ordered history range reads and the
+running-summary columns on chat_sessions.
+"""
+
+import pymysql
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+DB_NAME = os.getenv('DB_NAME', 'zed')
+
+def migrate():
+    """Add the composite history index and summary columns"""
+    conn = pymysql.connect(
+        host=os.getenv('DB_HOST', '127.0.0.1'),
+        port=int(os.getenv('DB_PORT', 3307)),
+        user=os.getenv('DB_USER', 'root'),
+        password=os.getenv('DB_PASSWORD', ''),
+        database=DB_NAME,
+        charset='utf8mb4'
+    )
+    
+    try:
+        with conn.cursor() as cursor:
+            # Composite index for ORDER BY id range reads per session
+            cursor.execute("""
+                SELECT COUNT(*) as count
+                FROM INFORMATION_SCHEMA.STATISTICS
+                WHERE TABLE_SCHEMA = %s
+                AND TABLE_NAME = 'messages'
+                AND INDEX_NAME = 'idx_session_id_id'
+            """, (DB_NAME,))
+            result = cursor.fetchone()
+            
+            if result[0] == 0:
+                print("Adding index on messages (session_id, id)...")
+                cursor.execute("""
+                    ALTER TABLE messages 
+                    ADD INDEX idx_session_id_id (session_id, id)
+                """)
+                conn.commit()
+                print("✓ Index added")
+            else:
+                print("✓ Index already exists")
+            
+            # The composite index also serves the session_id foreign key
+            cursor.execute("""
+                SELECT COUNT(*) as count
+                FROM INFORMATION_SCHEMA.STATISTICS
+                WHERE TABLE_SCHEMA = %s
+                AND TABLE_NAME = 'messages'
+                AND INDEX_NAME = 'idx_session_id'
+            """, (DB_NAME,))
+            result = cursor.fetchone()
+            
+            if result[0] > 0:
+                print("\nDropping redundant index idx_session_id...")
+                cursor.execute("ALTER TABLE messages DROP INDEX idx_session_id")
+                conn.commit()
+                print("✓ Index dropped")
+            
+            # Running summary columns
+            cursor.execute("""
+                SELECT COUNT(*) as count 
+                FROM INFORMATION_SCHEMA.COLUMNS 
+                WHERE TABLE_SCHEMA = %s 
+                AND TABLE_NAME = 'chat_sessions' 
+                AND COLUMN_NAME = 'summary'
+            """, (DB_NAME,))
+            result = cursor.fetchone()
+            
+            if result[0] == 0:
+                print("\nAdding summary columns to chat_sessions...")
+                cursor.execute("""
+                    ALTER TABLE chat_sessions 
+                    ADD COLUMN summary TEXT NULL AFTER model_id,
+                    ADD COLUMN summary_message_id INT NULL AFTER summary
+                """)
+                conn.commit()
+                print("✓ Columns added")
+            else:
+                print("✓ Summary columns already exist")
+            
+        print("\n✅ Migration completed successfully!")
+        
+    except Exception as e:
+        print(f"\n❌ Error: {e}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    migrate()
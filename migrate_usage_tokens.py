@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Migration script for per-request token accounting
+
+Adds input/output token counts, model latency, model_id and session_id to
+usage_logs, plus the indexes used by the per-model usage breakdown.
+"""
+
+import pymysql
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+DB_NAME = os.getenv('DB_NAME', 'zed')
+
+def migrate():
+    """Add token accounting columns and indexes to usage_logs"""
+    conn = pymysql.connect(
+        host=os.getenv('DB_HOST', '127.0.0.1'),
+        port=int(os.getenv('DB_PORT', 3307)),
+        user=os.getenv('DB_USER', 'root'),
+        password=os.getenv('DB_PASSWORD', ''),
+        database=DB_NAME,
+        charset='utf8mb4'
+    )
+    
+    try:
+        with conn.cursor() as cursor:
+            # Token accounting columns
+            cursor.execute("""
+                SELECT COUNT(*) as count 
+                FROM INFORMATION_SCHEMA.COLUMNS 
+                WHERE TABLE_SCHEMA = %s 
+                AND TABLE_NAME = 'usage_logs' 
+                AND COLUMN_NAME = 'input_tokens'
+            """, (DB_NAME,))
+            result = cursor.fetchone()
+            
+            if result[0] == 0:
+                print("Adding token accounting columns to usage_logs...")
+                cursor.execute("""
+                    ALTER TABLE usage_logs 
+                    ADD COLUMN input_tokens INT DEFAULT 0 AFTER tokens_used,
+                    ADD COLUMN output_tokens INT DEFAULT 0 AFTER input_tokens,
+                    ADD COLUMN latency_ms INT NULL AFTER output_tokens,
+                    ADD COLUMN model_id VARCHAR(100) NULL AFTER latency_ms,
+                    ADD COLUMN session_id INT NULL AFTER model_id
+                """)
+                conn.commit()
+                print("✓ Columns added")
+            else:
+                print("✓ Token accounting columns already exist")
+            
+            # Indexes for per-model and per-session breakdowns
+            for index_name, columns in (('idx_user_model', 'user_id, model_id'),
+                                        ('idx_session_id', 'session_id')):
+                cursor.execute("""
+                    SELECT COUNT(*) as count
+                    FROM INFORMATION_SCHEMA.STATISTICS
+                    WHERE TABLE_SCHEMA = %s
+                    AND TABLE_NAME = 'usage_logs'
+                    AND INDEX_NAME = %s
+                """, (DB_NAME, index_name))
+                result = cursor.fetchone()
+                
+                if result[0] == 0:
+                    print(f"\nAdding index {index_name} on usage_logs ({columns})...")
+                    cursor.execute(f"ALTER TABLE usage_logs ADD INDEX {index_name} ({columns})")
+                    conn.commit()
+                    print("✓ Index added")
+                else:
+                    print(f"✓ Index {index_name} already exists")
+            
+        print("\n✅ Migration completed successfully!")
+        
+    except Exception as e:
+        print(f"\n❌ Error: {e}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    migrate()
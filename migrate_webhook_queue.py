@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Migration script for background webhook processing
+
+Adds retry, claim and dead-letter columns to subscription_events and widens
+its indexes for the webhook workers' queue queries.
+"""
+
+import pymysql
+from dotenv import load_dotenv
+import os
+
+load_dotenv()
+
+DB_NAME = os.getenv('DB_NAME', 'zed')
+
+def migrate():
+    """Add webhook queue columns and indexes to subscription_events"""
+    conn = pymysql.connect(
+        host=os.getenv('DB_HOST', '127.0.0.1'),
+        port=int(os.getenv('DB_PORT', 3307)),
+        user=os.getenv('DB_USER', 'root'),
+        password=os.getenv('DB_PASSWORD', ''),
+        database=DB_NAME,
+        charset='utf8mb4'
+    )
+    
+    try:
+        with conn.cursor() as cursor:
+            # Queue columns
+            cursor.execute("""
+                SELECT COUNT(*) as count 
+                FROM INFORMATION_SCHEMA.COLUMNS 
+                WHERE TABLE_SCHEMA = %s 
+                AND TABLE_NAME = 'subscription_events' 
+                AND COLUMN_NAME = 'attempts'
+            """, (DB_NAME,))
+            result = cursor.fetchone()
+            
+            if result[0] == 0:
+                print("Adding queue columns to subscription_events...")
+                cursor.execute("""
+                    ALTER TABLE subscription_events 
+                    ADD COLUMN attempts INT NOT NULL DEFAULT 0 AFTER processed,
+                    ADD COLUMN next_attempt_at TIMESTAMP NULL AFTER attempts,
+                    ADD COLUMN last_error TEXT NULL AFTER next_attempt_at,
+                    ADD COLUMN failed BOOLEAN NOT NULL DEFAULT FALSE AFTER last_error,
+                    ADD COLUMN locked_by VARCHAR(100) NULL AFTER failed,
+                    ADD COLUMN locked_at TIMESTAMP NULL AFTER locked_by,
+                    ADD COLUMN processed_at TIMESTAMP NULL AFTER locked_at
+                """)
+                conn.commit()
+                print("✓ Columns added")
+            else:
+                print("✓ Queue columns already exist")
+            
+            # Indexes for the pending-event and per-subscription ordering queries
+            for index_name, columns in (('idx_processed', 'processed, failed, next_attempt_at'),
+                                        ('idx_subscription_id', 'subscription_id, processed, failed')):
+                cursor.execute("""
+                    SELECT COUNT(*) as count
+                    FROM INFORMATION_SCHEMA.STATISTICS
+                    WHERE TABLE_SCHEMA = %s
+                    AND TABLE_NAME = 'subscription_events'
+                    AND INDEX_NAME = %s
+                    AND COLUMN_NAME = 'failed'
+                """, (DB_NAME, index_name))
+                result = cursor.fetchone()
+                
+                if result[0] == 0:
+                    print(f"\nRebuilding index {index_name} on subscription_events ({columns})...")
+                    cursor.execute(f"""
+                        ALTER TABLE subscription_events
+                        DROP INDEX {index_name},
+                        ADD INDEX {index_name} ({columns})
+                    """)
+                    conn.commit()
+                    print("✓ Index rebuilt")
+                else:
+                    print(f"✓ Index {index_name} already up to date")
+            
+        print("\n✅ Migration completed successfully!")
+        
+    except Exception as e:
+        print(f"\n❌ Error: {e}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    migrate()
@@ -0,0 +1,375 @@
+"""
+Bedrock provider adapters for ZED AI
+Builds request bodies and parses responses, stream chunks and token usage
+for each model family, resolved once per model_id from a prefix registry
+"""
+
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+# Inference defaults shared by every provider
+MAX_TOKENS = 4096
+TEMPERATURE = 0.7
+TOP_P = 0.9
+
+# Token budget for conversation history, overridable for every model at once
+HISTORY_TOKEN_BUDGET = os.getenv('HISTORY_TOKEN_BUDGET')
+
+# Cross-region inference profile prefixes, e.g. "us.anthropic.claude-..."
+REGION_PREFIXES = ('us.', 'eu.', 'apac.', 'us-gov.', 'global.')
+
+
+class ProviderResponseError(ValueError):
+    """Raised when a model response does not match its provider's format"""
+
+
+class ProviderAdapter:
+    """
+    Base adapter for one Bedrock request/response format
+
+    Subclasses implement build_request(), parse_response(), stream_text()
+    and extract_usage(); all of them are pure functions of their input, so
+    they can be tested offline against recorded payloads.
+    """
+
+    name = 'base'
+    prefixes: Tuple[str, ...] = ()
+    # Estimated tokens of history sent per turn
+    context_budget = 8000
+
+    @property
+    def history_budget(self) -> int:
+        return int(HISTORY_TOKEN_BUDGET) if HISTORY_TOKEN_BUDGET else self.context_budget
+
+    def build_request(self, messages: List[Dict], system_prompt: Optional[str] = None) -> Dict:
+        raise NotImplementedError
+
+    def parse_response(self, body: Dict) -> str:
+        raise NotImplementedError
+
+    def stream_text(self, chunk: Dict) -> str:
+        """Return the text delta carried by one decoded stream chunk"""
+        raise NotImplementedError
+
+    def extract_usage(self, body: Dict) -> Optional[Dict]:
+        """Return {'input_tokens', 'output_tokens', 'total_tokens'} or None"""
+        return None
+
+    def parse_stream_chunk(self, chunk: Dict):
+        """
+        Decode one chunk of a response stream
+
+        Returns (text, usage): the text delta (possibly empty) and, once
+        Bedrock reports its invocation metrics, a dict of token counts and
+        latency; otherwise None.
+        """
+        usage = None
+        metrics = chunk.get('amazon-bedrock-invocationMetrics')
+        if metrics:
+            usage = _usage(metrics.get('inputTokenCount'), metrics.get('outputTokenCount')) or {}
+            usage['latency_ms'] = metrics.get('invocationLatency')
+            usage['first_byte_latency_ms'] = metrics.get('firstByteLatency')
+        return self.stream_text(chunk), usage
+
+
+def _usage(input_tokens, output_tokens, total_tokens=None) -> Optional[Dict]:
+    if input_tokens is None and output_tokens is None:
+        return None
+    input_tokens = input_tokens or 0
+    output_tokens = output_tokens or 0
+    return {
+        'input_tokens': input_tokens,
+        'output_tokens': output_tokens,
+        'total_tokens': total_tokens if total_tokens is not None else input_tokens + output_tokens
+    }
+
+def usage_from_headers(headers: Dict) -> Optional[Dict]:
+    """
+    Token counts and latency from the x-amzn-bedrock-* headers that
+    invoke_model returns for every model family
+    """
+    def header(name):
+        value = headers.get(name)
+        return int(value) if value not in (None, '') else None
+
+    usage = _usage(header('x-amzn-bedrock-input-token-count'), header('x-amzn-bedrock-output-token-count'))
+    latency = header('x-amzn-bedrock-invocation-latency')
+    if usage is None and latency is None:
+        return None
+    usage = usage or {}
+    usage['latency_ms'] = latency
+    return usage
+
+
+class AnthropicAdapter(ProviderAdapter):
+    """Anthropic Claude messages API; the system prompt is a top-level field"""
+
+    name = 'anthropic'
+    prefixes = ('anthropic.claude',)
+    context_budget = 16000
+
+    def build_request(self, messages, system_prompt=None):
+        body = {
+            'anthropic_version': 'bedrock-2023-05-31',
+            'max_tokens': MAX_TOKENS,
+            'messages': messages,
+            'temperature': TEMPERATURE,
+            'top_p': TOP_P
+        }
+        if system_prompt:
+            body['system'] = system_prompt
+        return body
+
+    def parse_response(self, body):
+        try:
+            return body['content'][0]['text']
+        except (KeyError, IndexError, TypeError):
+            raise ProviderResponseError("Unrecognized Claude response format")
+
+    def stream_text(self, chunk):
+        # Text arrives in content_block_delta events
+        if chunk.get('type') == 'content_block_delta':
+            return chunk.get('delta', {}).get('text', '')
+        return ''
+
+    def extract_usage(self, body):
+        usage = body.get('usage') or {}
+        return _usage(usage.get('input_tokens'), usage.get('output_tokens'))
+
+
+class InferenceConfigAdapter(ProviderAdapter):
+    """
+    Nova, Llama, Mistral, Cohere and other models using the inferenceConfig
+    format; also the fallback for unregistered model ids
+    """
+
+    name = 'inference-config'
+    prefixes = (
+        'amazon.nova', 'meta.llama', 'mistral.', 'cohere.', 'ai21.',
+        'qwen.', 'minimax.', 'moonshot.', 'deepseek.'
+    )
+
+    def build_request(self, messages, system_prompt=None):
+        return {
+            'messages': messages,
+            'inferenceConfig': {
+                'maxTokens': MAX_TOKENS,
+                'temperature': TEMPERATURE,
+                'topP': TOP_P
+            }
+        }
+
+    def parse_response(self, body):
+        try:
+            output = body.get('output')
+            if isinstance(output, dict) and 'message' in output:
+                return output['message']['content'][0]['text']
+            if 'content' in body:
+                # Alternative format
+                content = body['content']
+                if isinstance(content, list):
+                    if content and isinstance(content[0], dict) and 'text' in content[0]:
+                        return content[0]['text']
+                elif isinstance(content, str):
+                    return content
+            if body.get('choices'):
+                return body['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError, AttributeError):
+            pass
+        raise ProviderResponseError("Unrecognized inferenceConfig response format")
+
+    def stream_text(self, chunk):
+        if 'contentBlockDelta' in chunk:
+            return chunk['contentBlockDelta'].get('delta', {}).get('text', '')
+        if 'generation' in chunk:
+            # Native Llama stream
+            return chunk['generation'] or ''
+        if chunk.get('outputs'):
+            # Native Mistral stream
+            return chunk['outputs'][0].get('text', '')
+        if chunk.get('choices'):
+            return (chunk['choices'][0].get('delta') or {}).get('content') or ''
+        return ''
+
+    def extract_usage(self, body):
+        usage = body.get('usage') or {}
+        if 'inputTokens' in usage or 'outputTokens' in usage:
+            return _usage(usage.get('inputTokens'), usage.get('outputTokens'), usage.get('totalTokens'))
+        return _usage(usage.get('prompt_tokens'), usage.get('completion_tokens'), usage.get('total_tokens'))
+
+
+class ChatCompletionsAdapter(ProviderAdapter):
+    """
+    OpenAI and Google Gemma chat completions format; the system prompt is
+    injected as the first user/assistant exchange
+    """
+
+    name = 'chat-completions'
+    prefixes = ('openai.gpt', 'google.gemma')
+
+    def build_request(self, messages, system_prompt=None):
+        if system_prompt:
+            messages = [
+                {
+                    'role': 'user',
+                    'content': system_prompt
+                },
+                {
+                    'role': 'assistant',
+                    'content': 'Understood. I will respond directly and concisely in the same language as the question.'
+                }
+            ] + messages
+        return {
+            'messages': messages,
+            'max_tokens': MAX_TOKENS,
+            'temperature': TEMPERATURE,
+            'top_p': TOP_P
+        }
+
+    def parse_response(self, body):
+        try:
+            return body['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError):
+            raise ProviderResponseError("Unrecognized chat completions response format")
+
+    def stream_text(self, chunk):
+        choices = chunk.get('choices') or [{}]
+        return (choices[0].get('delta') or {}).get('content') or ''
+
+    def extract_usage(self, body):
+        usage = body.get('usage') or {}
+        return _usage(usage.get('prompt_tokens'), usage.get('completion_tokens'), usage.get('total_tokens'))
+
+
+DEFAULT_ADAPTER = InferenceConfigAdapter()
+
+_registry: Dict[str, ProviderAdapter] = {}
+
+def register_adapter(adapter: ProviderAdapter):
+    """Register an adapter under each of its model-id prefixes"""
+    for prefix in adapter.prefixes:
+        _registry[prefix] = adapter
+    resolve_adapter.cache_clear()
+    return adapter
+
+def _base_model_id(model_id: str) -> str:
+    for region_prefix in REGION_PREFIXES:
+        if model_id.startswith(region_prefix):
+            return model_id[len(region_prefix):]
+    return model_id
+
+@lru_cache(maxsize=1024)
+def resolve_adapter(model_id: str) -> Optional[ProviderAdapter]:
+    """Return the registered adapter with the longest matching prefix, or None"""
+    base_id = _base_model_id(model_id)
+    best = None
+    for prefix, adapter in _registry.items():
+        if base_id.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return _registry[best] if best else None
+
+def get_adapter(model_id: str) -> ProviderAdapter:
+    """Return the adapter for model_id, falling back to the inferenceConfig format"""
+    return resolve_adapter(model_id) or DEFAULT_ADAPTER
+
+for _adapter in (AnthropicAdapter(), DEFAULT_ADAPTER, ChatCompletionsAdapter()):
+    register_adapter(_adapter)
+
+
+# Models offered in the chat UI
+MODELS = [
+    # Claude Models
+    {'id': 'anthropic.claude-3-haiku-20240307-v1:0', 'name': 'Claude 3 Haiku (Default)', 'provider': 'Anthropic'},
+
+    # Amazon Nova Models
+    {'id': 'amazon.nova-premier-v1:0', 'name': 'Nova Premier', 'provider': 'Amazon'},
+    {'id': 'amazon.nova-pro-v1:0', 'name': 'Nova Pro', 'provider': 'Amazon'},
+    {'id': 'amazon.nova-2-sonic-v1:0', 'name': 'Nova 2 Sonic', 'provider': 'Amazon'},
+    {'id': 'amazon.nova-2-lite-v1:0', 'name': 'Nova 2 Lite', 'provider': 'Amazon'},
+    {'id': 'amazon.nova-sonic-v1:0', 'name': 'Nova Sonic', 'provider': 'Amazon'},
+    {'id': 'amazon.nova-lite-v1:0', 'name': 'Nova Lite', 'provider': 'Amazon'},
+    {'id': 'amazon.nova-micro-v1:0', 'name': 'Nova Micro', 'provider': 'Amazon'},
+
+    # Meta Llama Models
+    {'id': 'meta.llama4-scout-405b-v1:0', 'name': 'Llama 4 Scout 405B', 'provider': 'Meta'},
+    {'id': 'meta.llama4-maverick-v1:0', 'name': 'Llama 4 Maverick', 'provider': 'Meta'},
+    {'id': 'meta.llama3-3-70b-instruct-v1:0', 'name': 'Llama 3.3 70B Instruct', 'provider': 'Meta'},
+    {'id': 'meta.llama3-2-90b-instruct-v1:0', 'name': 'Llama 3.2 90B Instruct', 'provider': 'Meta'},
+    {'id': 'meta.llama3-1-70b-instruct-v1:0', 'name': 'Llama 3.1 70B Instruct', 'provider': 'Meta'},
+
+    # Mistral Models
+    {'id': 'mistral.mistral-large-3-2503-v1:0', 'name': 'Mistral Large 3', 'provider': 'Mistral'},
+    {'id': 'mistral.magistral-large-2407-v1:0', 'name': 'Magistral Large 2407', 'provider': 'Mistral'},
+    {'id': 'mistral.ministral-3b-2410-v1:0', 'name': 'Ministral 3B 2410', 'provider': 'Mistral'},
+    {'id': 'mistral.mixtral-8x7b-instruct-v0:1', 'name': 'Mixtral 8x7B Instruct', 'provider': 'Mistral'},
+
+    # DeepSeek Model
+    {'id': 'deepseek.deepseek-r1-distill-qwen-32b-v1:0', 'name': 'DeepSeek R1 Distill Qwen 32B', 'provider': 'DeepSeek'},
+
+    # Cohere Models
+    {'id': 'cohere.command-r-plus-v1:0', 'name': 'Command R+', 'provider': 'Cohere'},
+    {'id': 'cohere.command-r-v1:0', 'name': 'Command R', 'provider': 'Cohere'},
+
+    # OpenAI Models
+    {'id': 'openai.gpt-oss-120b-1:0', 'name': 'GPT OSS 120B', 'provider': 'OpenAI'},
+    {'id': 'openai.gpt-oss-20b-1:0', 'name': 'GPT OSS 20B', 'provider': 'OpenAI'},
+
+    # AI21 Labs Models
+    {'id': 'ai21.jamba-2-ultra-v1:0', 'name': 'Jamba 2 Ultra', 'provider': 'AI21 Labs'},
+    {'id': 'ai21.jamba-2-large-v1:0', 'name': 'Jamba 2 Large', 'provider': 'AI21 Labs'},
+
+    # Google Models
+    {'id': 'google.gemma-3-27b-it-v1:0', 'name': 'Gemma 3 27B IT', 'provider': 'Google'},
+    {'id': 'google.gemma-3-9b-it-v1:0', 'name': 'Gemma 3 9B IT', 'provider': 'Google'},
+
+    # Qwen Models
+    {'id': 'qwen.qwen3-next-70b-instruct-v1:0', 'name': 'Qwen3 Next 70B Instruct', 'provider': 'Qwen'},
+    {'id': 'qwen.qwen2-5-32b-instruct-v1:0', 'name': 'Qwen 2.5 32B Instruct', 'provider': 'Qwen'},
+    {'id': 'qwen.qwq-32b-preview-v1:0', 'name': 'QwQ 32B Preview', 'provider': 'Qwen'},
+
+    # MiniMax Model
+    {'id': 'minimax.minimax-m2-v1:0', 'name': 'MiniMax M2', 'provider': 'MiniMax'},
+
+    # Moonshot Model
+    {'id': 'moonshot.moonshot-kimi-k2-v1:0', 'name': 'Moonshot Kimi K2', 'provider': 'Moonshot'}
+]
+
+# On-demand list prices in USD per 1K (input, output) tokens, matched by the
+# longest model-id prefix like the adapter registry. Models without an entry
+# report token counts but no cost.
+MODEL_PRICING = {
+    'anthropic.claude-3-haiku': (0.00025, 0.00125),
+    'amazon.nova-premier': (0.0025, 0.0125),
+    'amazon.nova-pro': (0.0008, 0.0032),
+    'amazon.nova-lite': (0.00006, 0.00024),
+    'amazon.nova-micro': (0.000035, 0.00014),
+    'meta.llama3-3-70b': (0.00072, 0.00072),
+    'meta.llama3-2-90b': (0.00072, 0.00072),
+    'meta.llama3-1-70b': (0.00072, 0.00072),
+    'mistral.mixtral-8x7b': (0.00045, 0.0007),
+    'cohere.command-r-plus': (0.003, 0.015),
+    'cohere.command-r': (0.0005, 0.0015),
+    'openai.gpt-oss-120b': (0.00015, 0.0006),
+    'openai.gpt-oss-20b': (0.00007, 0.0003),
+}
+
+def get_model_pricing(model_id: str) -> Optional[Tuple[float, float]]:
+    """Return (input, output) USD per 1K tokens for model_id, or None"""
+    base_id = _base_model_id(model_id or '')
+    best = None
+    for prefix in MODEL_PRICING:
+        if base_id.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return MODEL_PRICING[best] if best else None
+
+def estimate_cost(model_id: str, input_tokens: int, output_tokens: int) -> Optional[float]:
+    """Estimated Bedrock cost in USD of the given token counts, or None if unpriced"""
+    pricing = get_model_pricing(model_id)
+    if pricing is None:
+        return None
+    return (input_tokens or 0) / 1000 * pricing[0] + (output_tokens or 0) / 1000 * pricing[1]
+
+def get_supported_models() -> List[Dict]:
+    """Return the catalogue entries that have a registered adapter"""
+    return [model for model in MODELS if resolve_adapter(model['id']) is not None]
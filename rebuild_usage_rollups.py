@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""Backfill / rebuild usage_rollups from raw usage_logs
+
+Creates the rollup table if needed and recomputes it a few users at a time,
+each batch in its own transaction, so the billing dashboard keeps serving
+while it runs. Writes that arrive during a rebuild wait for the batch of
+their user and are then counted exactly once.
+
+Usage logged before UNBILLED_PERIOD existed, for users without a billing
+period, carries the time of the request as its period. The rebuild moves
+every row whose period start is none of the user's subscription periods
+(the current one, or one set by a processed subscription event) to
+UNBILLED_PERIOD first, so they land in the rollup the dashboard reads.
+
+Usage:
+    python rebuild_usage_rollups.py               # all users
+    python rebuild_usage_rollups.py --user 42     # a single user
+"""
+
+import argparse
+import json
+import pymysql
+from dotenv import load_dotenv
+import os
+
+from datetime import datetime
+
+from usage_writer import UNBILLED_PERIOD
+
+load_dotenv()
+
+DB_NAME = os.getenv('DB_NAME', 'zed')
+
+CREATE_ROLLUPS_SQL = """
+    CREATE TABLE IF NOT EXISTS usage_rollups (
+        user_id INT NOT NULL,
+        billing_period_start TIMESTAMP NOT NULL,
+        billing_period_end TIMESTAMP NOT NULL,
+        action_type ENUM('summarize', 'ask', 'explain', 'autofill', 'chat') NOT NULL,
+        model_id VARCHAR(100) NOT NULL DEFAULT '',
+        requests INT NOT NULL DEFAULT 0,
+        overage_requests INT NOT NULL DEFAULT 0,
+        tokens_used BIGINT NOT NULL DEFAULT 0,
+        input_tokens BIGINT NOT NULL DEFAULT 0,
+        output_tokens BIGINT NOT NULL DEFAULT 0,
+        latency_ms BIGINT NOT NULL DEFAULT 0,
+        timed_output_tokens BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, billing_period_start, billing_period_end, action_type, model_id),
+        FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+"""
+
+# Webhook events that set users.current_period_start (from renews_at)
+PERIOD_EVENTS = ('subscription_created', 'subscription_updated', 'subscription_payment_success')
+
+def _event_period_start(payload):
+    """Period start a subscription event set, parsed like the webhook handlers do"""
+    if isinstance(payload, (bytes, str)):
+        payload = json.loads(payload)
+    value = payload.get('data', {}).get('attributes', {}).get('renews_at')
+    try:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+    except (TypeError, ValueError):
+        return None
+
+def subscription_period_starts(cursor, user_ids):
+    """Start of every billing period each user has been on, by user id"""
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    starts = {user_id: set() for user_id in user_ids}
+    cursor.execute(f"""
+        SELECT id, current_period_start FROM users
+        WHERE id IN ({placeholders}) AND current_period_start IS NOT NULL
+    """, user_ids)
+    for row in cursor.fetchall():
+        starts[row['id']].add(row['current_period_start'])
+    cursor.execute(f"""
+        SELECT user_id, payload FROM subscription_events
+        WHERE user_id IN ({placeholders}) AND processed = TRUE
+          AND event_type IN ({', '.join(['%s'] * len(PERIOD_EVENTS))})
+    """, list(user_ids) + list(PERIOD_EVENTS))
+    for row in cursor.fetchall():
+        start = _event_period_start(row['payload'])
+        if start is not None:
+            starts[row['user_id']].add(start)
+    return starts
+
+def move_fallback_usage(cursor, user_ids):
+    """
+    Move usage logged under a made-up period (no subscription period of the
+    user starts there) to UNBILLED_PERIOD; returns the rows moved
+    """
+    starts = subscription_period_starts(cursor, user_ids)
+    placeholders = ', '.join(['%s'] * len(user_ids))
+    cursor.execute(f"""
+        SELECT DISTINCT user_id, billing_period_start, billing_period_end FROM usage_logs
+        WHERE user_id IN ({placeholders}) AND billing_period_start <> %s
+    """, list(user_ids) + [UNBILLED_PERIOD])
+    fallback = [(UNBILLED_PERIOD, UNBILLED_PERIOD, row['user_id'],
+                 row['billing_period_start'], row['billing_period_end'])
+                for row in cursor.fetchall()
+                if row['billing_period_start'] not in starts[row['user_id']]]
+    if not fallback:
+        return 0
+    cursor.executemany("""
+        UPDATE usage_logs
+        SET billing_period_start = %s, billing_period_end = %s
+        WHERE user_id = %s AND billing_period_start = %s AND billing_period_end = %s
+    """, fallback)
+    return cursor.rowcount
+
+def rebuild(user_id=None, batch_size=100):
+    """Recompute usage_rollups for one user or for everyone"""
+    conn = pymysql.connect(
+        host=os.getenv('DB_HOST', '127.0.0.1'),
+        port=int(os.getenv('DB_PORT', 3307)),
+        user=os.getenv('DB_USER', 'root'),
+        password=os.getenv('DB_PASSWORD', ''),
+        database=DB_NAME,
+        charset='utf8mb4',
+        cursorclass=pymysql.cursors.DictCursor
+    )
+
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(CREATE_ROLLUPS_SQL)
+            conn.commit()
+            print("✓ usage_rollups table ready")
+
+            if user_id is not None:
+                user_ids = [user_id]
+            else:
+                cursor.execute("SELECT DISTINCT user_id FROM usage_logs ORDER BY user_id")
+                user_ids = [row['user_id'] for row in cursor.fetchall()]
+            conn.commit()
+
+            print(f"\nRebuilding rollups for {len(user_ids)} user(s)...")
+            rows = 0
+            for start in range(0, len(user_ids), batch_size):
+                batch = user_ids[start:start + batch_size]
+                placeholders = ', '.join(['%s'] * len(batch))
+                move_fallback_usage(cursor, batch)
+                cursor.execute(f"DELETE FROM usage_rollups WHERE user_id IN ({placeholders})", batch)
+                cursor.execute(f"""
+                    INSERT INTO usage_rollups
+                    (user_id, billing_period_start, billing_period_end, action_type, model_id,
+                     requests, overage_requests, tokens_used, input_tokens, output_tokens,
+                     latency_ms, timed_output_tokens)
+                    SELECT user_id, billing_period_start, billing_period_end,
+                           action_type, COALESCE(model_id, ''),
+                           COUNT(*), SUM(is_overage), SUM(tokens_used),
+                           SUM(input_tokens), SUM(output_tokens),
+                           SUM(COALESCE(latency_ms, 0)),
+                           SUM(IF(latency_ms IS NULL, 0, output_tokens))
+                    FROM usage_logs
+                    WHERE user_id IN ({placeholders})
+                    GROUP BY user_id, billing_period_start, billing_period_end,
+                             action_type, COALESCE(model_id, '')
+                """, batch)
+                rows += cursor.rowcount
+                conn.commit()
+                print(f"  {min(start + batch_size, len(user_ids))}/{len(user_ids)} users")
+
+            if user_id is None:
+                # Rollups of users whose raw usage is gone
+                cursor.execute("""
+                    DELETE FROM usage_rollups
+                    WHERE user_id NOT IN (SELECT DISTINCT user_id FROM usage_logs)
+                """)
+                conn.commit()
+
+            print(f"✓ {rows} rollup rows written")
+
+        print("\n✅ Rollup rebuild completed successfully!")
+
+    except Exception as e:
+        print(f"\n❌ Error: {e}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild usage_rollups from usage_logs')
+    parser.add_argument('--user', type=int, help='only rebuild this user id')
+    parser.add_argument('--batch-size', type=int, default=100, help='users per transaction')
+    args = parser.parse_args()
+    rebuild(args.user, args.batch_size)
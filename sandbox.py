@@ -0,0 +1,898 @@
+"""
+Code execution sandbox for ZED AI
+Runs user snippets for /api/execute-code in pools of pre-started worker
+processes per language instead of a fresh interpreter per call, under
+CPU, memory, output and process limits, streaming output as it is printed
+"""
+
+import codecs
+import json
+import logging
+import os
+import resource
+import select
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Sandbox pool configuration
+SANDBOX_POOL = os.getenv('SANDBOX_POOL', 'true').lower() == 'true'
+SANDBOX_PYTHON_WORKERS = int(os.getenv('SANDBOX_PYTHON_WORKERS', 4))
+SANDBOX_NODE_WORKERS = int(os.getenv('SANDBOX_NODE_WORKERS', 4))
+# Snippets a Python worker runs before it is replaced (Node workers run one)
+SANDBOX_MAX_RUNS = int(os.getenv('SANDBOX_MAX_RUNS', 200))
+# Callers waiting for a free worker beyond this are turned away, and no
+# caller waits longer than SANDBOX_QUEUE_TIMEOUT seconds
+SANDBOX_MAX_WAITING = int(os.getenv('SANDBOX_MAX_WAITING', 32))
+SANDBOX_QUEUE_TIMEOUT = float(os.getenv('SANDBOX_QUEUE_TIMEOUT', 10))
+
+# Resource limits of each snippet
+SANDBOX_CPU_SECONDS = int(os.getenv('SANDBOX_CPU_SECONDS', 5))
+SANDBOX_MEMORY_MB = int(os.getenv('SANDBOX_MEMORY_MB', 256))
+SANDBOX_MAX_OUTPUT = int(os.getenv('SANDBOX_MAX_OUTPUT', 64 * 1024))
+# Processes (and threads) a snippet may start on top of those its user
+# already runs when the worker starts, enforced with RLIMIT_NPROC; 0 leaves
+# it unset. The kernel does not apply the limit to root.
+SANDBOX_MAX_PROCS = int(os.getenv('SANDBOX_MAX_PROCS', 32))
+
+NODE_BINARY = os.getenv('NODE_BINARY', 'node')
+
+_FRAME_HEADER = struct.Struct('>I')
+TRUNCATION_MARKER = '\n[output truncated at {limit} bytes]\n'
+
+
+class SandboxBusy(Exception):
+    """Raised when no worker becomes free in time or too many callers are waiting"""
+
+
+class _EventStream:
+    """
+    Iterator over a generator of events that runs `on_close` once, when the
+    events run out or fail or the stream is closed. Unlike a generator's
+    own finally block, this also happens when it is closed before its first
+    event.
+    """
+
+    def __init__(self, events: Iterator[Dict], on_close):
+        self._events = events
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict:
+        try:
+            return next(self._events)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            self._events.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                on_close()
+
+
+# Python worker: a fork server. It reads length-prefixed JSON jobs on stdin
+# and forks a child per snippet (no interpreter startup, no state shared
+# between snippets) that applies the limits and runs the code. Output read
+# from the child's pipes is forwarded as it arrives in 'output' frames on
+# stdout, up to max_output bytes, followed by one 'exit' frame with the
+# status and the child's wall time, CPU time and peak RSS. As a child
+# subreaper it inherits anything the snippet leaves behind, even processes
+# that left its session, and kills it after every snippet.
+PYTHON_RUNNER = r'''
+import codecs, ctypes, json, os, resource, select, signal, struct, sys, time, traceback
+
+HEADER = struct.Struct('>I')
+PR_SET_CHILD_SUBREAPER = 36
+proto_in = os.fdopen(os.dup(0), 'rb')
+proto_out = os.fdopen(os.dup(1), 'wb')
+null = os.open(os.devnull, os.O_RDWR)
+os.dup2(null, 0)
+os.dup2(null, 1)
+try:
+    ctypes.CDLL(None, use_errno=True).prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0)
+except Exception:
+    pass
+
+def read_frame():
+    header = proto_in.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    return json.loads(proto_in.read(HEADER.unpack(header)[0]))
+
+def write_frame(message):
+    data = json.dumps(message).encode('utf-8')
+    proto_out.write(HEADER.pack(len(data)) + data)
+    proto_out.flush()
+
+def limit(name, value):
+    if value:
+        resource.setrlimit(name, (value, value))
+
+def child(job, out_w, err_w):
+    os.setsid()
+    proto_in.close()
+    proto_out.close()
+    os.dup2(out_w, 1)
+    os.dup2(err_w, 2)
+    limit(resource.RLIMIT_CPU, job['cpu_seconds'])
+    limit(resource.RLIMIT_AS, job['memory_bytes'])
+    limit(resource.RLIMIT_FSIZE, job['max_output'])
+    limit(resource.RLIMIT_NPROC, job['max_procs'])
+    sys.stdout = os.fdopen(1, 'w', encoding='utf-8', errors='replace')
+    sys.stderr = os.fdopen(2, 'w', encoding='utf-8', errors='replace')
+    status = 0
+    try:
+        exec(compile(job['code'], '<snippet>', 'exec'), {'__name__': '__main__', '__builtins__': __builtins__})
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            status = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except BaseException as e:
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        status = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    except Exception:
+        pass
+    os._exit(status)
+
+def children():
+    pid = os.getpid()
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        pass
+    found = []
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open(f'/proc/{name}/stat') as f:
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        found.append(int(name))
+            except (OSError, ValueError, IndexError):
+                pass
+    return found
+
+def sweep():
+    # Orphans of the snippet are reparented here; kill until none are left
+    while True:
+        pids = children()
+        if not pids:
+            return
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+def run(job):
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    started = time.monotonic()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(out_r)
+            os.close(err_r)
+            child(job, out_w, err_w)
+        finally:
+            os._exit(1)
+    os.close(out_w)
+    os.close(err_w)
+
+    deadline = started + job['timeout']
+    names = {out_r: 'stdout', err_r: 'stderr'}
+    decoders = {fd: codecs.getincrementaldecoder('utf-8')('replace') for fd in names}
+    size = 0
+    timed_out = truncated = False
+    pending = [out_r, err_r]
+    while pending and not truncated:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            timed_out = True
+            break
+        ready, _, _ = select.select(pending, [], [], remaining)
+        for fd in ready:
+            data = os.read(fd, 65536)
+            if not data:
+                pending.remove(fd)
+                continue
+            room = job['max_output'] - size
+            if len(data) > room:
+                data = data[:room]
+                truncated = True
+            size += len(data)
+            text = decoders[fd].decode(data)
+            if text:
+                write_frame({'type': 'output', 'stream': names[fd], 'text': text})
+            if truncated:
+                break
+    for fd, decoder in decoders.items():
+        text = decoder.decode(b'', final=True)
+        if text:
+            write_frame({'type': 'output', 'stream': names[fd], 'text': text})
+
+    while True:
+        if timed_out or truncated:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            _, status, usage = os.wait4(pid, 0)
+            break
+        waited, status, usage = os.wait4(pid, os.WNOHANG)
+        if waited:
+            break
+        if time.monotonic() >= deadline:
+            timed_out = True
+        else:
+            time.sleep(0.002)
+    wall_ms = (time.monotonic() - started) * 1000
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    sweep()
+    os.close(out_r)
+    os.close(err_r)
+    write_frame({
+        'type': 'exit',
+        'returncode': os.waitstatus_to_exitcode(status),
+        'timed_out': timed_out,
+        'truncated': truncated,
+        'wall_ms': round(wall_ms, 1),
+        'cpu_ms': round((usage.ru_utime + usage.ru_stime) * 1000, 1),
+        'max_rss_kb': usage.ru_maxrss,
+    })
+
+write_frame({'ready': True})
+while True:
+    job = read_frame()
+    if job is None:
+        break
+    run(job)
+'''
+
+# Node worker: started ahead of time, it waits for one snippet on stdin and
+# runs it as a CommonJS module body. Node cannot fork a warm copy of itself,
+# so each worker runs a single snippet and is replaced in the background.
+NODE_RUNNER = r'''
+const chunks = [];
+process.stdin.on('data', chunk => chunks.push(chunk));
+process.stdin.on('end', () => {
+  const code = Buffer.concat(chunks).toString('utf8');
+  const mod = { exports: {} };
+  let fn;
+  try {
+    fn = require('vm').compileFunction(code, ['require', 'module', 'exports', '__filename', '__dirname'], { filename: 'snippet.js' });
+  } catch (e) {
+    console.error(e.stack || String(e));
+    process.exitCode = 1;
+    return;
+  }
+  fn(require, mod, mod.exports, 'snippet.js', process.cwd());
+});
+'''
+
+
+def user_tasks(uid: Optional[int] = None) -> int:
+    """Processes and threads running as `uid` (this user by default), as RLIMIT_NPROC counts them"""
+    uid = str(os.getuid() if uid is None else uid)
+    total = 0
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/status') as f:
+                status = f.read()
+        except OSError:
+            continue
+        real_uid, threads = None, 1
+        for line in status.splitlines():
+            if line.startswith('Uid:'):
+                real_uid = line.split()[1]
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+        if real_uid == uid:
+            total += threads
+    return total
+
+
+def _nproc_limit() -> int:
+    """RLIMIT_NPROC leaving a snippet SANDBOX_MAX_PROCS tasks, or 0 for none"""
+    if not SANDBOX_MAX_PROCS:
+        return 0
+    return user_tasks() + SANDBOX_MAX_PROCS
+
+
+def _worker_limits(cpu=False, nproc=0):
+    """preexec_fn applying the output and (optionally) CPU and process limits to a worker"""
+    def apply():
+        os.setsid()
+        resource.setrlimit(resource.RLIMIT_FSIZE, (SANDBOX_MAX_OUTPUT, SANDBOX_MAX_OUTPUT))
+        if cpu and SANDBOX_CPU_SECONDS:
+            resource.setrlimit(resource.RLIMIT_CPU, (SANDBOX_CPU_SECONDS, SANDBOX_CPU_SECONDS + 1))
+        if nproc:
+            resource.setrlimit(resource.RLIMIT_NPROC, (nproc, nproc))
+    return apply
+
+
+def _stream_output(streams, deadline, max_output, state):
+    """
+    Yield 'output' events from a process's stdout and stderr until EOF, the
+    deadline or max_output bytes in total; sets state['timed_out'] and
+    state['truncated']
+    """
+    names = {streams[0].fileno(): 'stdout', streams[1].fileno(): 'stderr'}
+    decoders = {fd: codecs.getincrementaldecoder('utf-8')('replace') for fd in names}
+    pending = list(names)
+    size = 0
+    while pending and not state['truncated']:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            state['timed_out'] = True
+            break
+        ready, _, _ = select.select(pending, [], [], remaining)
+        for fd in ready:
+            data = os.read(fd, 65536)
+            if not data:
+                pending.remove(fd)
+                continue
+            room = max_output - size
+            if len(data) > room:
+                data = data[:room]
+                state['truncated'] = True
+            size += len(data)
+            text = decoders[fd].decode(data)
+            if text:
+                yield {'type': 'output', 'stream': names[fd], 'text': text}
+            if state['truncated']:
+                break
+    for fd, decoder in decoders.items():
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield {'type': 'output', 'stream': names[fd], 'text': text}
+
+
+class SandboxWorker:
+    """A pre-started process that runs snippets of one language"""
+
+    language = None
+    max_runs = 1
+
+    def __init__(self):
+        self.runs = 0
+        self.healthy = True
+        self.proc = None
+
+    def stream(self, code: str, timeout: float) -> Iterator[Dict]:
+        """
+        Run one snippet, yielding {'type': 'output', 'stream', 'text'} events
+        as output arrives and finally an 'exit' event (returncode,
+        timed_out, truncated, wall_ms, cpu_ms, max_rss_kb). A worker left
+        mid-snippet is marked unhealthy.
+        """
+        raise NotImplementedError
+
+    def run(self, code: str, timeout: float) -> Dict:
+        """Run one snippet; returns the exit event with the collected stdout and stderr"""
+        return collect(self.stream(code, timeout))
+
+    def reusable(self) -> bool:
+        return self.healthy and self.runs < self.max_runs and self.proc.poll() is None
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        for stream in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            if stream is not None:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        try:
+            self.proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            pass
+
+
+class PythonWorker(SandboxWorker):
+    """Fork server running each snippet in a fresh child (see PYTHON_RUNNER)"""
+
+    language = 'python'
+
+    def __init__(self, max_runs=SANDBOX_MAX_RUNS, startup_timeout=10):
+        super().__init__()
+        self.max_runs = max_runs
+        # CPU, memory and process limits are applied to each child, not the
+        # fork server; the process limit is counted from the tasks its user
+        # runs now, since RLIMIT_NPROC is per user rather than per process tree
+        self.nproc = _nproc_limit()
+        self.proc = subprocess.Popen(
+            [sys.executable, '-I', '-c', PYTHON_RUNNER],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            preexec_fn=_worker_limits(), close_fds=True
+        )
+        if not self._read_frame(time.monotonic() + startup_timeout).get('ready'):
+            self.close()
+            raise RuntimeError('Python sandbox worker failed to start')
+
+    def stream(self, code, timeout):
+        self.runs += 1
+        job = {
+            'code': code,
+            'timeout': timeout,
+            'cpu_seconds': SANDBOX_CPU_SECONDS,
+            'memory_bytes': SANDBOX_MEMORY_MB * 1024 * 1024,
+            'max_output': SANDBOX_MAX_OUTPUT,
+            'max_procs': self.nproc,
+        }
+        finished = False
+        try:
+            data = json.dumps(job).encode('utf-8')
+            self.proc.stdin.write(_FRAME_HEADER.pack(len(data)) + data)
+            self.proc.stdin.flush()
+            # The fork server enforces the timeout; allow it time to report
+            deadline = time.monotonic() + timeout + 2
+            while True:
+                event = self._read_frame(deadline)
+                if event['type'] == 'exit':
+                    finished = True
+                    if event['timed_out']:
+                        # Recycle after any timeout rather than trust the worker's state
+                        self.healthy = False
+                    yield event
+                    return
+                yield event
+        finally:
+            if not finished:
+                self.healthy = False
+
+    def _read_frame(self, deadline):
+        header = self._read_exactly(_FRAME_HEADER.size, deadline)
+        return json.loads(self._read_exactly(_FRAME_HEADER.unpack(header)[0], deadline))
+
+    def _read_exactly(self, count, deadline):
+        fd = self.proc.stdout.fileno()
+        data = b''
+        while len(data) < count:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                self.healthy = False
+                raise TimeoutError('Python sandbox worker did not answer in time')
+            chunk = os.read(fd, count - len(data))
+            if not chunk:
+                self.healthy = False
+                raise RuntimeError('Python sandbox worker exited')
+            data += chunk
+        return data
+
+
+class NodeWorker(SandboxWorker):
+    """Pre-started Node.js process waiting for a single snippet (see NODE_RUNNER)"""
+
+    language = 'javascript'
+
+    def __init__(self):
+        super().__init__()
+        # V8 reserves far more address space than it uses, so memory is
+        # bounded by the heap size instead of RLIMIT_AS
+        self.proc = subprocess.Popen(
+            [NODE_BINARY, f'--max-old-space-size={SANDBOX_MEMORY_MB}', '-e', NODE_RUNNER],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            preexec_fn=_worker_limits(cpu=True, nproc=_nproc_limit()), close_fds=True
+        )
+        self._status = self._usage = None
+
+    def stream(self, code, timeout):
+        self.runs += 1
+        self.healthy = False
+        started = time.monotonic()
+        deadline = started + timeout
+        try:
+            self.proc.stdin.write(code.encode('utf-8'))
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        state = {'timed_out': False, 'truncated': False}
+        completed = False
+        try:
+            yield from _stream_output(
+                (self.proc.stdout, self.proc.stderr), deadline, SANDBOX_MAX_OUTPUT, state
+            )
+            completed = True
+        finally:
+            if not completed:
+                # The consumer stopped early
+                self._wait(deadline, kill=True)
+        status, usage = self._wait(deadline, kill=state['timed_out'] or state['truncated'])
+        if status is None:
+            state['timed_out'] = True
+            status, usage = self._wait(deadline, kill=True)
+        yield {
+            'type': 'exit',
+            'returncode': os.waitstatus_to_exitcode(status),
+            'timed_out': state['timed_out'],
+            'truncated': state['truncated'],
+            'wall_ms': round((time.monotonic() - started) * 1000, 1),
+            'cpu_ms': round((usage.ru_utime + usage.ru_stime) * 1000, 1),
+            'max_rss_kb': usage.ru_maxrss,
+        }
+
+    def _wait(self, deadline, kill):
+        """Reap the process (killing it first if asked) by the deadline; (None, None) if still running"""
+        if self.proc.returncode is not None:
+            return self._status, self._usage
+        if kill:
+            self.close_group()
+        while True:
+            pid, status, usage = os.wait4(self.proc.pid, 0 if kill else os.WNOHANG)
+            if pid:
+                # Reaped here, so tell Popen not to wait for it again
+                self.proc.returncode = os.waitstatus_to_exitcode(status)
+                self._status, self._usage = status, usage
+                return status, usage
+            if time.monotonic() >= deadline:
+                return None, None
+            time.sleep(0.002)
+
+    def close_group(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+WORKER_TYPES = {
+    PythonWorker.language: PythonWorker,
+    NodeWorker.language: NodeWorker,
+}
+
+
+class SandboxPool:
+    """
+    Bounded pool of pre-started workers for one language
+
+    At most `size` snippets run at once; up to `max_waiting` callers queue
+    for a free worker for at most `queue_timeout` seconds, anyone else gets
+    SandboxBusy. Workers that reach their run limit, time out or break are
+    closed and replaced in the background, so the next caller finds a warm
+    one. If no worker is ready and the pool is short of workers (e.g. a
+    replacement failed to start) the caller starts one itself.
+    """
+
+    def __init__(self, worker_factory, size, max_waiting=SANDBOX_MAX_WAITING,
+                 queue_timeout=SANDBOX_QUEUE_TIMEOUT):
+        self.worker_factory = worker_factory
+        self.size = size
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self._cond = threading.Condition()
+        self._spawner = None
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = deque()
+        self._busy = 0
+        self._spawning = 0
+        self._waiting = 0
+        self._runs = 0
+        self._rejected = 0
+        self._recycled = 0
+        self._spawn_errors = 0
+        self._cold_starts = 0
+        self._total_ms = 0.0
+        # Inherited worker processes belong to the parent; never touch them
+        self._spawner = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sandbox-spawn')
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def start(self):
+        """Start the workers in the background"""
+        with self._cond:
+            self._check_fork()
+            missing = self.size - len(self._idle) - self._busy - self._spawning
+            self._spawning += missing
+        for _ in range(missing):
+            self._spawner.submit(self._spawn)
+
+    def _spawn(self):
+        try:
+            worker = self.worker_factory()
+        except Exception as e:
+            logger.error(f"Sandbox worker start error: {e}")
+            with self._cond:
+                self._spawning -= 1
+                self._spawn_errors += 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._spawning -= 1
+            self._idle.append(worker)
+            self._cond.notify()
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            self._check_fork()
+            if self._waiting >= self.max_waiting:
+                self._rejected += 1
+                raise SandboxBusy('Too many code executions queued, try again shortly')
+            self._waiting += 1
+            try:
+                while not self._idle:
+                    if len(self._idle) + self._busy + self._spawning < self.size:
+                        # Short of workers and none on the way: start one here
+                        self._busy += 1
+                        self._cold_starts += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._rejected += 1
+                        raise SandboxBusy('No code execution worker became free in time')
+                    self._cond.wait(remaining)
+                else:
+                    self._busy += 1
+                    return self._idle.popleft()
+            finally:
+                self._waiting -= 1
+        try:
+            return self.worker_factory()
+        except Exception:
+            with self._cond:
+                self._busy -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, worker):
+        reusable = worker.reusable()
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._busy -= 1
+            if reusable:
+                self._idle.append(worker)
+                self._cond.notify()
+                return
+            self._recycled += 1
+            self._spawning += 1
+        worker.close()
+        self._spawner.submit(self._spawn)
+
+    def stream(self, code: str, timeout: float) -> Iterator[Dict]:
+        """
+        Take a worker for the snippet and return its event stream (see
+        SandboxWorker.stream); the worker goes back to the pool when the
+        stream ends or is closed, also when it is closed unread. Raises
+        SandboxBusy when the pool is saturated, before any event is produced.
+        """
+        worker = self._acquire()
+        started = time.monotonic()
+
+        def events():
+            try:
+                yield from worker.stream(code, timeout)
+            except BaseException:
+                worker.healthy = False
+                raise
+
+        def finish():
+            self._release(worker)
+            with self._cond:
+                self._runs += 1
+                self._total_ms += (time.monotonic() - started) * 1000
+
+        return _EventStream(events(), finish)
+
+    def run(self, code: str, timeout: float) -> Dict:
+        """Run a snippet on a pooled worker; returns the exit event with stdout and stderr"""
+        return collect(self.stream(code, timeout))
+
+    def shutdown(self):
+        """Close idle workers and stop replacing them"""
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            idle, self._idle = list(self._idle), deque()
+        self._spawner.shutdown(wait=False, cancel_futures=True)
+        for worker in idle:
+            worker.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'idle': len(self._idle),
+                'busy': self._busy,
+                'waiting': self._waiting,
+                'runs': self._runs,
+                'rejected': self._rejected,
+                'recycled': self._recycled,
+                'cold_starts': self._cold_starts,
+                'spawn_errors': self._spawn_errors,
+                'avg_ms': round(self._total_ms / self._runs, 2) if self._runs else 0.0,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_sandbox_pool(language: str) -> SandboxPool:
+    """Return the process-wide worker pool for `language` ('python' or 'javascript')"""
+    pool = _pools.get(language)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(language)
+            if pool is None:
+                size = SANDBOX_PYTHON_WORKERS if language == 'python' else SANDBOX_NODE_WORKERS
+                pool = SandboxPool(WORKER_TYPES[language], size)
+                _pools[language] = pool
+    return pool
+
+def sandbox_stats():
+    """Stats of every sandbox pool"""
+    return {language: pool.stats() for language, pool in list(_pools.items())}
+
+
+def collect(events: Iterator[Dict]) -> Dict:
+    """Drain a snippet's event stream into its exit event plus the joined stdout and stderr"""
+    output = {'stdout': [], 'stderr': []}
+    result = None
+    for event in events:
+        if event['type'] == 'output':
+            output[event['stream']].append(event['text'])
+        else:
+            result = event
+    return dict(result, stdout=''.join(output['stdout']), stderr=''.join(output['stderr']))
+
+
+def run_subprocess(language: str, code: str, timeout: float) -> Dict:
+    """Run a snippet the original way: a temp file and a fresh interpreter per call"""
+    suffix, command = ('.py', [sys.executable]) if language == 'python' else ('.js', [NODE_BINARY])
+    with tempfile.NamedTemporaryFile(mode='w', suffix=suffix, delete=False) as f:
+        f.write(code)
+        temp_file = f.name
+    started = time.monotonic()
+    result = {'type': 'exit', 'timed_out': False, 'truncated': False, 'cpu_ms': None, 'max_rss_kb': None}
+    try:
+        completed = subprocess.run(command + [temp_file], capture_output=True, text=True, timeout=timeout)
+        result.update(returncode=completed.returncode, stdout=completed.stdout, stderr=completed.stderr)
+    except subprocess.TimeoutExpired:
+        result.update(returncode=None, stdout='', stderr='', timed_out=True)
+    finally:
+        os.unlink(temp_file)
+    result['wall_ms'] = round((time.monotonic() - started) * 1000, 1)
+    return result
+
+
+def _outcome(result: Dict, timeout: float) -> Dict:
+    """success, error and resource usage of a finished snippet (its exit event)"""
+    if result['truncated']:
+        success, error = False, f'Output limit of {SANDBOX_MAX_OUTPUT} bytes exceeded'
+    elif result['timed_out']:
+        success, error = False, f'Execution timeout after {timeout} seconds'
+    elif result['returncode'] == 0:
+        success, error = True, None
+    elif result['returncode'] == -signal.SIGXCPU:
+        success, error = False, f'CPU time limit of {SANDBOX_CPU_SECONDS} seconds exceeded'
+    else:
+        success, error = False, 'Execution failed'
+    return {
+        'success': success,
+        'error': error,
+        'returncode': result['returncode'],
+        'resources': {
+            'wall_ms': result['wall_ms'],
+            'cpu_ms': result['cpu_ms'],
+            'max_rss_kb': result['max_rss_kb'],
+        },
+    }
+
+
+def _snippet_events(language: str, code: str, timeout: float) -> Iterator[Dict]:
+    if SANDBOX_POOL:
+        return get_sandbox_pool(language).stream(code, timeout)
+    result = run_subprocess(language, code, timeout)
+    events = [{'type': 'output', 'stream': name, 'text': result.pop(name)}
+              for name in ('stdout', 'stderr') if result[name]]
+    return iter(events + [result])
+
+
+def _start_error(language: str, e: Exception) -> str:
+    if isinstance(e, FileNotFoundError) and language == 'javascript':
+        return 'Node.js is not installed. JavaScript execution requires Node.js.'
+    return str(e)
+
+
+def execute_snippet(language: str, code: str, timeout: float) -> Dict:
+    """
+    Run a snippet and shape the result for /api/execute-code (success,
+    output, error, returncode, resources). Output cut at the limit ends with
+    a truncation marker. Raises SandboxBusy when the pool is saturated.
+    """
+    try:
+        result = collect(_snippet_events(language, code, timeout))
+    except SandboxBusy:
+        raise
+    except Exception as e:
+        return {'success': False, 'output': None, 'error': _start_error(language, e)}
+
+    response = _outcome(result, timeout)
+    output = result['stdout']
+    if result['truncated']:
+        output += TRUNCATION_MARKER.format(limit=SANDBOX_MAX_OUTPUT)
+    if response['success']:
+        output = output or 'Code executed successfully with no output'
+    elif response['error'] == 'Execution failed' or result['returncode'] == -signal.SIGXCPU:
+        # The snippet's own error output says more than a generic message
+        response['error'] = result['stderr'] or response['error']
+    elif result['stderr']:
+        output += result['stderr']
+    response['output'] = output
+    return response
+
+
+def stream_snippet(language: str, code: str, timeout: float) -> Iterator[Dict]:
+    """
+    Run a snippet as /api/execute-code/stream events: 'output' (stream,
+    text) as the snippet prints, 'truncated' (limit) if output was cut at
+    the limit, then 'done' (success, error, returncode, resources) or
+    'error'. Raises SandboxBusy up front when the pool is saturated. The
+    pooled worker is returned when the stream ends or is closed, read or not.
+    """
+    try:
+        events = _snippet_events(language, code, timeout)
+    except SandboxBusy:
+        raise
+    except Exception as e:
+        error = _start_error(language, e)
+
+        def failed():
+            yield {'type': 'error', 'error': error}
+
+        return failed()
+
+    def generate():
+        try:
+            for event in events:
+                if event['type'] == 'output':
+                    yield event
+                    continue
+                if event['truncated']:
+                    yield {'type': 'truncated', 'limit': SANDBOX_MAX_OUTPUT}
+                yield dict(_outcome(event, timeout), type='done')
+        except Exception as e:
+            yield {'type': 'error', 'error': str(e)}
+
+    return _EventStream(generate(), getattr(events, 'close', None))
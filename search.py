@@ -0,0 +1,464 @@
+"""
+Web search for ZED AI
+A long-lived Google Custom Search client with pluggable backends, a cache
+of results by normalized query with per-class TTLs and collapsing of
+concurrent identical searches into a single call, and the classifier that
+decides whether a message needs a search at all
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from typing import Callable, Dict, List, Optional
+
+import httplib2
+import requests
+from dotenv import load_dotenv
+from googleapiclient.discovery import build
+from requests.adapters import HTTPAdapter
+
+from cache import get_cache
+import tracing
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Custom Search client configuration
+GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+GOOGLE_SEARCH_ENGINE_ID = os.getenv('GOOGLE_SEARCH_ENGINE_ID')
+# 'googleapiclient' or 'rest'
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'googleapiclient')
+# Endpoint override, e.g. a local stub server; empty uses Google's
+SEARCH_API_URL = os.getenv('SEARCH_API_URL', '')
+SEARCH_TIMEOUT = float(os.getenv('SEARCH_TIMEOUT', 5))
+SEARCH_CONNECT_TIMEOUT = float(os.getenv('SEARCH_CONNECT_TIMEOUT', 2))
+SEARCH_POOL_SIZE = int(os.getenv('SEARCH_POOL_SIZE', 32))
+
+DEFAULT_REST_URL = 'https://customsearch.googleapis.com/customsearch/v1'
+
+# Search cache configuration
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', 5000))
+# How long a caller waits for an identical in-flight search before searching itself
+SEARCH_INFLIGHT_WAIT = float(os.getenv('SEARCH_INFLIGHT_WAIT', 10))
+
+# Result lifetime per query class, in seconds
+SEARCH_TTLS = {
+    'price': int(os.getenv('SEARCH_TTL_PRICE', 120)),
+    'news': int(os.getenv('SEARCH_TTL_NEWS', 300)),
+    'weather': int(os.getenv('SEARCH_TTL_WEATHER', 600)),
+    'general': int(os.getenv('SEARCH_TTL_GENERAL', 3600)),
+    'definition': int(os.getenv('SEARCH_TTL_DEFINITION', 7 * 24 * 3600)),
+}
+
+# Checked in order; the first class with a matching word wins
+QUERY_CLASSES = [
+    ('price', re.compile(r'\b(price|prices|stock|stocks|share price|exchange rate|rate|score|scores|result|results|crypto|bitcoin)\b')),
+    ('weather', re.compile(r'\b(weather|forecast|temperature|rain|humidity)\b')),
+    ('news', re.compile(r'\b(latest|recent|current|today|tonight|now|news|breaking|happening|happened|update on)\b')),
+    ('definition', re.compile(r'\b(define|definition|meaning|what is|what are|who is|who was|wiki|wikipedia)\b')),
+]
+
+STOPWORDS = frozenset({
+    'a', 'an', 'the', 'is', 'are', 'was', 'were', 'be', 'of', 'in', 'on', 'at',
+    'to', 'for', 'and', 'or', 'me', 'my', 'please', 'tell', 'about', 'can',
+    'you', 'i', 'do', 'does', 'what', 'whats', 'who', 'how', 'search', 'find',
+    'look', 'up', 'google',
+})
+
+
+def _parse_items(result: Dict) -> List[Dict]:
+    return [
+        {
+            'title': item.get('title', ''),
+            'link': item.get('link', ''),
+            'snippet': item.get('snippet', '')
+        }
+        for item in result.get('items', [])
+    ]
+
+
+class SearchBackend:
+    """Interface of a search backend: search(query, num_results) -> results"""
+
+    name = 'base'
+
+    def search(self, query: str, num_results: int) -> List[Dict]:
+        raise NotImplementedError
+
+
+class CustomSearchBackend(SearchBackend):
+    """
+    googleapiclient Custom Search service built from the bundled (static)
+    discovery document, so no discovery fetch happens. httplib2 connections
+    are not thread-safe, so each thread builds its service once and keeps
+    its keep-alive connection for later searches.
+    """
+
+    name = 'googleapiclient'
+
+    def __init__(self, api_key, engine_id, api_url=SEARCH_API_URL, timeout=SEARCH_TIMEOUT):
+        self.api_key = api_key
+        self.engine_id = engine_id
+        self.api_url = api_url
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _service(self):
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = build(
+                'customsearch', 'v1',
+                developerKey=self.api_key,
+                http=httplib2.Http(timeout=self.timeout),
+                static_discovery=True,
+                cache_discovery=False,
+                client_options={'api_endpoint': self.api_url} if self.api_url else None
+            )
+            self._local.service = service
+        return service
+
+    def search(self, query, num_results):
+        result = self._service().cse().list(q=query, cx=self.engine_id, num=num_results).execute()
+        return _parse_items(result)
+
+
+class RestSearchBackend(SearchBackend):
+    """Custom Search JSON API over a pooled, keep-alive requests.Session"""
+
+    name = 'rest'
+
+    def __init__(self, api_key, engine_id, api_url=None, timeout=SEARCH_TIMEOUT,
+                 connect_timeout=SEARCH_CONNECT_TIMEOUT, pool_size=SEARCH_POOL_SIZE):
+        self.api_key = api_key
+        self.engine_id = engine_id
+        self.api_url = api_url or DEFAULT_REST_URL
+        self.timeout = (connect_timeout, timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def search(self, query, num_results):
+        response = self.session.get(
+            self.api_url,
+            params={'key': self.api_key, 'cx': self.engine_id, 'q': query, 'num': num_results},
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        return _parse_items(response.json())
+
+
+BACKENDS = {
+    CustomSearchBackend.name: CustomSearchBackend,
+    RestSearchBackend.name: RestSearchBackend,
+}
+
+
+class SearchClient:
+    """Thread-safe front for one search backend, with call timing"""
+
+    def __init__(self, backend: SearchBackend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._searches = 0
+        self._errors = 0
+        self._total_ms = 0.0
+
+    def search(self, query: str, num_results: int = 5) -> List[Dict]:
+        started = time.monotonic()
+        try:
+            with tracing.span('search', backend=self.backend.name, num_results=num_results) as span:
+                results = self.backend.search(query, num_results)
+                span.set(results=len(results))
+        except Exception:
+            with self._lock:
+                self._errors += 1
+            raise
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            self._searches += 1
+            self._total_ms += elapsed_ms
+        logger.info("Found %d search results (%.0f ms)", len(results), elapsed_ms)
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': self.backend.name,
+                'searches': self._searches,
+                'errors': self._errors,
+                'avg_ms': round(self._total_ms / self._searches, 2) if self._searches else 0.0,
+            }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_search_client() -> SearchClient:
+    """Return the process-wide search client, built from the SEARCH_* settings"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                backend = BACKENDS[SEARCH_BACKEND](
+                    GOOGLE_API_KEY, GOOGLE_SEARCH_ENGINE_ID, api_url=SEARCH_API_URL or None
+                )
+                _client = SearchClient(backend)
+    return _client
+
+def set_search_backend(backend: Optional[SearchBackend]):
+    """Swap the process-wide backend, e.g. for a stub; None rebuilds from settings"""
+    global _client
+    with _client_lock:
+        _client = SearchClient(backend) if backend is not None else None
+
+
+def normalize_query(query: str) -> str:
+    """
+    Canonical form of a search query for cache keys: Unicode-normalized,
+    lowercased, punctuation stripped, whitespace collapsed and stopwords
+    removed (unless nothing else is left)
+    """
+    text = unicodedata.normalize('NFKC', query).casefold()
+    text = ''.join(' ' if unicodedata.category(ch)[0] in 'PS' else ch for ch in text)
+    words = text.split()
+    kept = [word for word in words if word not in STOPWORDS]
+    return ' '.join(kept or words)
+
+
+def classify_query(query: str) -> str:
+    """Return the query class that decides how long its results stay fresh"""
+    text = query.casefold()
+    for name, pattern in QUERY_CLASSES:
+        if pattern.search(text):
+            return name
+    return 'general'
+
+
+class _InFlight:
+    __slots__ = ('done', 'results', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class SearchCache:
+    """
+    Cache in front of a search function
+
+    get_or_search(query, num_results, search) returns cached results for the
+    normalized query, or calls `search(query, num_results)` once for all
+    concurrent callers asking the same thing. Failed searches are not
+    cached. `store` is any LRUCache-compatible cache.
+    """
+
+    def __init__(self, store=None, ttls=None, inflight_wait=SEARCH_INFLIGHT_WAIT):
+        self.store = store if store is not None else get_cache('search', SEARCH_CACHE_SIZE)
+        self.ttls = dict(SEARCH_TTLS, **(ttls or {}))
+        self.inflight_wait = inflight_wait
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._hits = 0
+        self._misses = 0
+        self._coalesced = 0
+        self._errors = 0
+        self._fetch_ms = 0.0
+        self._saved_ms = 0.0
+
+    def get_or_search(self, query: str, num_results: int,
+                      search: Callable[[str, int], List[Dict]]) -> List[Dict]:
+        key = f"{num_results}:{normalize_query(query)}"
+        entry = self.store.get(key)
+        if entry is not None:
+            with self._lock:
+                self._hits += 1
+                self._saved_ms += entry['fetch_ms']
+            return entry['results']
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _InFlight()
+                self._misses += 1
+            else:
+                self._coalesced += 1
+
+        if not leader:
+            if flight.done.wait(self.inflight_wait) and flight.error is None:
+                return flight.results
+            # The leader failed or is stuck; search independently
+            return search(query, num_results)
+
+        started = time.monotonic()
+        try:
+            results = search(query, num_results)
+        except Exception as e:
+            flight.error = e
+            with self._lock:
+                self._errors += 1
+            raise
+        else:
+            fetch_ms = (time.monotonic() - started) * 1000
+            flight.results = results
+            self.store.set(key, {'results': results, 'fetch_ms': fetch_ms},
+                           ttl=self.ttls[classify_query(query)])
+            with self._lock:
+                self._fetch_ms += fetch_ms
+            return results
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def stats(self):
+        """Hit ratio, coalesced searches and upstream latency saved"""
+        with self._lock:
+            lookups = self._hits + self._misses + self._coalesced
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'coalesced': self._coalesced,
+                'errors': self._errors,
+                'hit_rate': round((self._hits + self._coalesced) / lookups, 4) if lookups else 0.0,
+                'avg_fetch_ms': round(self._fetch_ms / self._misses, 2) if self._misses else 0.0,
+                'latency_saved_ms': round(self._saved_ms, 2),
+            }
+
+
+# ----------------------------------------------------------------------
+# Search intent
+# ----------------------------------------------------------------------
+
+# Path of an offline-fitted weights file ({"threshold": t, "terms": {term: weight}});
+# empty uses the built-in lexicon
+SEARCH_INTENT_WEIGHTS = os.getenv('SEARCH_INTENT_WEIGHTS', '')
+SEARCH_INTENT_THRESHOLD = float(os.getenv('SEARCH_INTENT_THRESHOLD', 1.0))
+
+# Term weights per language. A message needs a search when the weights of
+# the distinct terms it contains add up to the threshold: freshness and
+# explicit search requests fire alone, question words only together with
+# another cue, and task words (code, translation, writing) hold a search back.
+INTENT_TERMS = {
+    'en': {
+        'latest': 1.0, 'recent': 1.0, 'recently': 1.0, 'today': 1.0, "today's": 1.0,
+        'tonight': 1.0, 'yesterday': 1.0, 'this week': 1.0, 'news': 1.0, 'headlines': 1.0,
+        'breaking': 1.0, 'weather': 1.0, 'forecast': 1.0, 'stock': 1.0, 'stocks': 1.0,
+        'share price': 1.0, 'price of': 1.0, 'prices': 1.0, 'exchange rate': 1.0,
+        'score': 1.0, 'scores': 1.0, 'who won': 1.0, 'what happened': 1.0,
+        'what is happening': 1.0, "what's happening": 1.0, 'update on': 1.0,
+        'search for': 1.0, 'search the web': 1.0, 'look up': 1.0, 'google': 1.0,
+        'bing': 1.0, 'yahoo': 1.0, 'wikipedia': 1.0, 'wiki': 1.0,
+        'now': 0.5, 'current': 0.5, 'currently': 0.5, 'price': 0.5, 'result': 0.5,
+        'results': 0.5, 'find': 0.5, 'who is': 0.5, 'when is': 0.5, 'where is': 0.5,
+        'what is': 0.5, "what's": 0.5, 'whats': 0.5, 'define': 0.5, 'definition': 0.5,
+        'code': -1.0, 'function': -1.0, 'python': -1.0, 'javascript': -1.0, 'sql': -1.0,
+        'regex': -1.0, 'debug': -1.0, 'translate': -1.0, 'rewrite': -1.0, 'poem': -1.0,
+        'essay': -1.0, 'story': -1.0, 'explain': -0.5, 'summarize': -0.5,
+    },
+    'bn': {
+        'আজ': 1.0, 'আজকে': 1.0, 'আজকের': 1.0, 'গতকাল': 1.0, 'সর্বশেষ': 1.0,
+        'সাম্প্রতিক': 1.0, 'খবর': 1.0, 'সংবাদ': 1.0, 'আবহাওয়া': 1.0, 'দাম': 1.0,
+        'মূল্য': 1.0, 'স্কোর': 1.0, 'ফলাফল': 1.0, 'খুঁজুন': 1.0, 'সার্চ': 1.0,
+        'এখন': 0.5, 'বর্তমান': 0.5, 'বর্তমানে': 0.5, 'কে': 0.5, 'কোথায়': 0.5, 'কখন': 0.5,
+        'কোড': -1.0, 'অনুবাদ': -1.0, 'কবিতা': -1.0, 'রচনা': -1.0, 'গল্প': -1.0,
+    },
+    'ar': {
+        'اليوم': 1.0, 'أمس': 1.0, 'أخبار': 1.0, 'الأخبار': 1.0, 'أحدث': 1.0, 'آخر': 1.0,
+        'عاجل': 1.0, 'طقس': 1.0, 'الطقس': 1.0, 'سعر': 1.0, 'أسعار': 1.0, 'الأسعار': 1.0,
+        'نتيجة': 1.0, 'نتائج': 1.0, 'ابحث': 1.0, 'بحث عن': 1.0,
+        'الآن': 0.5, 'حاليا': 0.5, 'من هو': 0.5, 'من هي': 0.5, 'ما هو': 0.5, 'ما هي': 0.5,
+        'أين': 0.5, 'متى': 0.5,
+        'كود': -1.0, 'برمجة': -1.0, 'ترجم': -1.0, 'ترجمة': -1.0, 'قصيدة': -1.0, 'قصة': -1.0,
+    },
+}
+
+# Characters that continue a word: \w plus the Bengali block, whose vowel
+# signs \w does not cover. Arabic diacritics and tatweel are stripped before
+# matching.
+_WORD_CHARS = '\\w\u0980-\u09ff'
+_ARABIC_MARKS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u0640]')
+
+
+def _normalize_message(text: str) -> str:
+    text = unicodedata.normalize('NFC', text).casefold().replace('\u2019', "'")
+    return ' '.join(_ARABIC_MARKS.sub('', text).split())
+
+
+class SearchIntentClassifier:
+    """Interface of a search-intent classifier: needs_search(message) -> bool"""
+
+    name = 'base'
+
+    def needs_search(self, message: str) -> bool:
+        raise NotImplementedError
+
+
+class LexiconIntentClassifier(SearchIntentClassifier):
+    """
+    Weighted term lexicon matched in one pass by a single compiled regex
+
+    Terms match whole words only ("know" does not contain "now"), longest
+    alternative first so "what is happening" wins over "what is". Each
+    distinct term counts once towards the score.
+    """
+
+    name = 'lexicon'
+
+    def __init__(self, terms: Dict[str, float], threshold: float = SEARCH_INTENT_THRESHOLD):
+        self.weights = {_normalize_message(term): weight for term, weight in terms.items()}
+        self.threshold = threshold
+        alternatives = sorted(self.weights, key=len, reverse=True)
+        self.pattern = re.compile(
+            rf"(?<![{_WORD_CHARS}])(?:{'|'.join(map(re.escape, alternatives))})(?![{_WORD_CHARS}])"
+        )
+
+    def score(self, message: str) -> float:
+        matched = set(self.pattern.findall(_normalize_message(message)))
+        return sum(self.weights[term] for term in matched)
+
+    def needs_search(self, message):
+        return self.score(message) >= self.threshold
+
+
+def default_intent_terms() -> Dict[str, float]:
+    """The built-in lexicon of every language, merged"""
+    terms = {}
+    for language_terms in INTENT_TERMS.values():
+        terms.update(language_terms)
+    return terms
+
+
+def load_intent_classifier(path: str) -> LexiconIntentClassifier:
+    """Build a classifier from an offline-fitted weights file"""
+    with open(path, encoding='utf-8') as f:
+        model = json.load(f)
+    return LexiconIntentClassifier(model['terms'], model.get('threshold', SEARCH_INTENT_THRESHOLD))
+
+
+_intent_classifier = None
+
+def get_intent_classifier() -> SearchIntentClassifier:
+    """Return the process-wide search-intent classifier"""
+    global _intent_classifier
+    if _intent_classifier is None:
+        with _client_lock:
+            if _intent_classifier is None:
+                if SEARCH_INTENT_WEIGHTS:
+                    _intent_classifier = load_intent_classifier(SEARCH_INTENT_WEIGHTS)
+                else:
+                    _intent_classifier = LexiconIntentClassifier(default_intent_terms())
+    return _intent_classifier
+
+def set_intent_classifier(classifier: Optional[SearchIntentClassifier]):
+    """Swap the process-wide classifier; None rebuilds it from settings"""
+    global _intent_classifier
+    with _client_lock:
+        _intent_classifier = classifier
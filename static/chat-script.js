@@ -301,7 +301,7 @@ async function handleSendMessage() {
     const loadingElement = showLoading();
     
     try {
-        const response = await fetch('/api/chat', {
+        const response = await fetch('/api/chat/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -317,23 +317,71 @@ async function handleSendMessage() {
             throw new Error('Request failed');
         }
         
-        const data = await response.json();
+        // Read newline-delimited JSON events and render tokens as they arrive
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let replyText = '';
+        let replyElement = null;
+        let renderPending = false;
+        let newSession = false;
         
-        // Remove loading
-        loadingElement.remove();
+        const renderReply = () => {
+            renderPending = false;
+            replyElement.querySelector('.message-content').innerHTML = formatMessage(replyText);
+            scrollToBottom();
+        };
         
-        // Add AI response
-        addMessage(data.response, 'assistant');
+        const handleEvent = (event) => {
+            if (event.type === 'start') {
+                if (!currentSessionId) {
+                    currentSessionId = event.session_id;
+                    newSession = true;
+                }
+            } else if (event.type === 'token') {
+                replyText += event.text;
+                if (!replyElement) {
+                    loadingElement.remove();
+                    replyElement = addMessage('', 'assistant');
+                }
+                if (!renderPending) {
+                    renderPending = true;
+                    requestAnimationFrame(renderReply);
+                }
+            } else if (event.type === 'done') {
+                replyText = event.response;
+                if (!replyElement) {
+                    loadingElement.remove();
+                    replyElement = addMessage('', 'assistant');
+                }
+                renderReply();
+            } else if (event.type === 'error') {
+                throw new Error(event.error || 'Request failed');
+            }
+        };
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (line.trim()) handleEvent(JSON.parse(line));
+            }
+        }
+        if (buffer.trim()) handleEvent(JSON.parse(buffer));
         
-        // Update session ID
-        if (!currentSessionId) {
-            currentSessionId = data.session_id;
+        // Update session list for a new session
+        if (newSession) {
             await loadSessions();
         }
         
     } catch (error) {
         console.error('Error:', error);
-        loadingElement.remove();
+        if (loadingElement.isConnected) {
+            loadingElement.remove();
+        }
         showError('Sorry, something went wrong. Please try again.');
     } finally {
         isLoading = false;
@@ -360,6 +408,7 @@ function addMessage(content, role) {
     
     messages.appendChild(messageDiv);
     scrollToBottom();
+    return messageDiv;
 }
 
 // Format message
@@ -475,7 +524,7 @@ async function executeCode(code, language) {
             <circle cx="12" cy="12" r="10"></circle>
         </svg> Running...`;
         
-        const response = await fetch('/api/execute-code', {
+        const response = await fetch('/api/execute-code/stream', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -490,39 +539,77 @@ async function executeCode(code, language) {
             throw new Error('Execution failed');
         }
         
-        const result = await response.json();
-        
-        // Create output message
+        // Create output message and insert it after the code block
         const outputDiv = document.createElement('div');
         outputDiv.className = 'code-output';
-        
-        if (result.success) {
-            outputDiv.innerHTML = `
-                <div class="output-header success">
-                    <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
-                        <polyline points="20 6 9 17 4 12"></polyline>
-                    </svg>
-                    Execution Successful
-                </div>
-                <pre class="output-content">${escapeHtml(result.output)}</pre>
-            `;
-        } else {
-            outputDiv.innerHTML = `
-                <div class="output-header error">
-                    <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
-                        <circle cx="12" cy="12" r="10"></circle>
-                        <line x1="12" y1="8" x2="12" y2="12"></line>
-                        <line x1="12" y1="16" x2="12.01" y2="16"></line>
-                    </svg>
-                    Execution Failed
-                </div>
-                <pre class="output-content error">${escapeHtml(result.error)}</pre>
-            `;
-        }
-        
-        // Insert output after the code block
+        outputDiv.innerHTML = `
+            <div class="output-header">Running...</div>
+            <pre class="output-content"></pre>
+        `;
         const codeBlock = btn.closest('.code-block');
         codeBlock.parentNode.insertBefore(outputDiv, codeBlock.nextSibling);
+        const header = outputDiv.querySelector('.output-header');
+        const outputPre = outputDiv.querySelector('.output-content');
+        
+        // Read newline-delimited JSON events and show output as it is printed
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let hasOutput = false;
+        
+        const handleEvent = (event) => {
+            if (event.type === 'output') {
+                hasOutput = true;
+                outputPre.textContent += event.text;
+            } else if (event.type === 'truncated') {
+                outputPre.textContent += `\n[output truncated at ${event.limit} bytes]\n`;
+            } else if (event.type === 'done') {
+                const seconds = (event.resources.wall_ms / 1000).toFixed(2);
+                if (event.success) {
+                    header.className = 'output-header success';
+                    header.innerHTML = `
+                        <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+                            <polyline points="20 6 9 17 4 12"></polyline>
+                        </svg>
+                        Execution Successful (${seconds}s)
+                    `;
+                    if (!hasOutput) {
+                        outputPre.textContent = 'Code executed successfully with no output';
+                    }
+                } else {
+                    header.className = 'output-header error';
+                    header.innerHTML = `
+                        <svg width="14" height="14" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2">
+                            <circle cx="12" cy="12" r="10"></circle>
+                            <line x1="12" y1="8" x2="12" y2="12"></line>
+                            <line x1="12" y1="16" x2="12.01" y2="16"></line>
+                        </svg>
+                        Execution Failed (${seconds}s)
+                    `;
+                    if (event.error !== 'Execution failed' || !hasOutput) {
+                        outputPre.textContent += (hasOutput ? '\n' : '') + event.error;
+                    }
+                    outputPre.classList.add('error');
+                }
+            } else if (event.type === 'error') {
+                header.className = 'output-header error';
+                header.textContent = 'Execution Failed';
+                outputPre.classList.add('error');
+                outputPre.textContent += event.error;
+            }
+        };
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const lines = buffer.split('\n');
+            buffer = lines.pop();
+            for (const line of lines) {
+                if (line.trim()) handleEvent(JSON.parse(line));
+            }
+        }
+        if (buffer.trim()) handleEvent(JSON.parse(buffer));
         
         btn.innerHTML = originalHTML;
         btn.disabled = false;
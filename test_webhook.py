@@ -1,9 +1,58 @@
+import argparse
+import hashlib
+import hmac
 import json
-from lemonsqueezy import LemonSqueezyService
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from lemonsqueezy import LemonSqueezyService, LEMONSQUEEZY_WEBHOOK_SECRET
+
+
+def replay(payload, url, count, concurrency, unique):
+    """POST signed copies of the payload to the webhook endpoint and report throughput"""
+    session = requests.Session()
+
+    def send(i):
+        event = json.loads(json.dumps(payload))
+        if unique:
+            event['meta']['webhook_id'] = str(uuid.uuid4())
+        body = json.dumps(event).encode('utf-8')
+        signature = hmac.new(LEMONSQUEEZY_WEBHOOK_SECRET.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        started = time.monotonic()
+        response = session.post(url, data=body, timeout=30, headers={
+            'Content-Type': 'application/json',
+            'X-Signature': signature,
+        })
+        return response.status_code, (time.monotonic() - started) * 1000
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(count)))
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(ms for _, ms in results)
+    print(f"{count} webhooks in {elapsed:.2f}s ({count / elapsed:.0f}/s)")
+    print(f"status: {dict(Counter(status for status, _ in results))}")
+    print(f"latency p50={latencies[len(latencies) // 2]:.1f}ms p99={latencies[int(len(latencies) * 0.99)]:.1f}ms")
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Process or replay sample_webhook.json')
+    parser.add_argument('--url', help='replay against this webhook endpoint instead of processing in-process')
+    parser.add_argument('--count', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--unique', action='store_true', help='give every copy its own webhook_id')
+    args = parser.parse_args()
+
     with open("sample_webhook.json", "r") as f:
         payload = json.load(f)
-    svc = LemonSqueezyService()
-    result = svc.process_webhook_event(payload)
-    print(result)
\ No newline at end of file
+    if args.url:
+        replay(payload, args.url, args.count, args.concurrency, args.unique)
+    else:
+        svc = LemonSqueezyService()
+        result = svc.process_webhook_event(payload)
+        print(result)
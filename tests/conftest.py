@@ -0,0 +1,36 @@
+import os
+import sys
+
+# The modules live at the repository root, next to app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# No background webhook workers polling a database that is not there
+os.environ.setdefault('WEBHOOK_ASYNC', 'false')
+
+import pytest
+
+from fakes import FakeDriver
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """Route database.get_pool() to a pool over a FakeDriver; returns the driver"""
+    import database
+    driver = FakeDriver()
+    monkeypatch.setattr(database, '_pool', database.ConnectionPool(connect=driver, max_size=4, timeout=1))
+    return driver
+
+
+@pytest.fixture
+def client(fake_db):
+    """Flask test client logged in as user 1"""
+    import app
+    import lemonsqueezy
+    app.user_cache.clear()
+    lemonsqueezy.invalidate_quota_cache(1)
+    app.app.config['TESTING'] = True
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+    return client
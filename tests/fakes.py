@@ -0,0 +1,136 @@
+"""
+In-memory stand-ins for the PyMySQL driver
+
+FakeConnection records every statement (and COMMIT / ROLLBACK) and answers
+queries from a list of (substring, rows) responses, where rows is a list of
+dicts, a row count, a (row count, lastrowid) pair, or a callable taking the
+statement's args and returning one of those (or raising). ConnectionPool
+accepts FakeDriver as its `connect` callable.
+"""
+
+import re
+import threading
+
+
+def _normalize(query):
+    return re.sub(r'\s+', ' ', query).strip()
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = 0
+        self.lastrowid = None
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, args=None):
+        return self.connection._execute(self, _normalize(query), args)
+
+    def executemany(self, query, seq):
+        total = 0
+        for args in seq:
+            total += self.connection._execute(self, _normalize(query), args)
+        self.rowcount = total
+        return total
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, responses=(), fail_ping=False):
+        self.responses = list(responses)
+        self.statements = []  # (normalized query, args)
+        self.commits = 0
+        self.rollbacks = 0
+        self.pings = 0
+        self.fail_ping = fail_ping
+        self.closed = False
+        self.lastrowid = 0
+        self.server_status = 0
+
+    def cursor(self):
+        if self.closed:
+            raise RuntimeError('cursor() on a closed connection')
+        return FakeCursor(self)
+
+    def _execute(self, cursor, query, args):
+        self.statements.append((query, args))
+        self.lastrowid += 1
+        cursor.lastrowid = self.lastrowid
+        for pattern, result in self.responses:
+            if pattern in query:
+                rows = result(args) if callable(result) else result
+                if isinstance(rows, tuple):
+                    cursor._rows, (cursor.rowcount, cursor.lastrowid) = [], rows
+                elif isinstance(rows, int):
+                    cursor._rows, cursor.rowcount = [], rows
+                else:
+                    cursor._rows, cursor.rowcount = [dict(row) for row in rows], len(rows)
+                return cursor.rowcount
+        cursor._rows, cursor.rowcount = [], 1
+        return 1
+
+    def executed(self, pattern):
+        """Args of every recorded statement containing `pattern`"""
+        return [args for query, args in self.statements if pattern in query]
+
+    def committed(self, pattern):
+        """Args of statements containing `pattern` whose transaction was committed"""
+        committed, pending = [], []
+        for query, args in self.statements:
+            if query == 'COMMIT':
+                committed.extend(pending)
+                pending = []
+            elif query == 'ROLLBACK':
+                pending = []
+            elif pattern in query:
+                pending.append(args)
+        return committed
+
+    def commit(self):
+        self.commits += 1
+        self.statements.append(('COMMIT', None))
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.statements.append(('ROLLBACK', None))
+
+    def ping(self, reconnect=False):
+        self.pings += 1
+        if self.fail_ping:
+            raise ConnectionError('server has gone away')
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDriver:
+    """Zero-argument connect callable handing out FakeConnections"""
+
+    def __init__(self, responses=()):
+        self.responses = responses
+        self.connections = []
+        self.fail = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        if self.fail:
+            raise ConnectionError("Can't connect to MySQL server")
+        connection = FakeConnection(self.responses)
+        with self._lock:
+            self.connections.append(connection)
+        return connection
@@ -0,0 +1,61 @@
+"""Bridged Flask routes served through the ASGI application"""
+
+import asyncio
+import time
+
+import asgi
+
+USER = {'id': 1, 'username': 'ada', 'email': 'ada@example.com'}
+
+SLOW_SNIPPET = "import time\nprint('first', flush=True)\ntime.sleep(1)\nprint('second')"
+
+
+def serve(scope, body=b''):
+    """Run one request through asgi.application; returns [(seconds since start, message)]"""
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append((time.monotonic() - started, message))
+
+    started = time.monotonic()
+    asyncio.run(asgi.application(scope, receive, send))
+    return messages
+
+
+def http_scope(method, path, headers=()):
+    return {'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+            'headers': list(headers), 'http_version': '1.1', 'scheme': 'http',
+            'server': ('testserver', 80), 'client': ('127.0.0.1', 5000)}
+
+
+def test_plain_response_is_sent_in_one_body_message(fake_db):
+    messages = serve(http_scope('GET', '/api/health'))
+    assert messages[0][1]['status'] == 200
+    bodies = [message for _, message in messages if message['type'] == 'http.response.body']
+    assert len(bodies) == 1
+    assert b'healthy' in bodies[0]['body']
+    assert not bodies[0].get('more_body')
+
+
+def test_streamed_response_is_forwarded_as_it_is_produced(client, fake_db):
+    fake_db.responses = [('FROM users WHERE id', [USER])]
+    cookie = client.get_cookie('session')
+    messages = serve(
+        http_scope('POST', '/api/execute-code/stream', [
+            (b'content-type', b'application/json'),
+            (b'cookie', f'session={cookie.value}'.encode('latin-1')),
+        ]),
+        asgi.app.json.dumps({'code': SLOW_SNIPPET, 'language': 'python'}).encode('utf-8')
+    )
+
+    assert messages[0][1]['status'] == 200
+    chunks = [(at, message) for at, message in messages if message['type'] == 'http.response.body']
+    first_output = next(at for at, message in chunks if b'first' in message['body'])
+    assert chunks[-1][0] >= 1.0
+    assert first_output < chunks[-1][0] - 0.5
+    assert all(message['more_body'] for _, message in chunks[:-1])
+    assert chunks[-1][1]['body'] == b'' and not chunks[-1][1].get('more_body')
+    assert b'"done"' in b''.join(message['body'] for _, message in chunks)
@@ -0,0 +1,111 @@
+"""BedrockRouter over local stub endpoints: failover, region groups, unavailable models"""
+
+import os
+import socket
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+
+from bedrock import NoTargetAvailable, build_router
+from bench_bedrock import BODY, MODEL_ID, StubBedrock
+
+ACCESS_DENIED = (403, 'AccessDeniedException')
+
+
+@pytest.fixture
+def stubs():
+    started = []
+
+    def start(error=None):
+        stub = StubBedrock(latency=0, capacity=100, error=error)
+        threading.Thread(target=stub.serve_forever, daemon=True).start()
+        started.append(stub)
+        return stub
+
+    yield start
+    for stub in started:
+        stub.shutdown()
+        stub.server_close()
+
+
+def dead_endpoint():
+    """URL of a local port nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f'http://127.0.0.1:{port}'
+
+
+def target(name, endpoint, region='eu-north-1', **settings):
+    url = endpoint if isinstance(endpoint, str) else f'http://127.0.0.1:{endpoint.server_port}'
+    return dict({'name': name, 'region': region, 'endpoint_url': url}, **settings)
+
+
+def invoke(router, model_id=MODEL_ID):
+    return router.invoke_model(modelId=model_id, body=BODY)['body'].read()
+
+
+def test_call_fails_over_from_a_dead_endpoint_and_avoids_it_while_cooling_down(stubs):
+    live = stubs()
+    router = build_router([target('dead', dead_endpoint(), weight=100), target('live', live)], max_attempts=1)
+
+    for _ in range(3):
+        assert b'Hello' in invoke(router)
+
+    stats = router.stats()
+    assert live.requests == 3
+    assert stats['failovers'] == 1
+    assert stats['targets']['dead']['calls'] == 1
+    assert stats['targets']['dead']['cooldown_s'] > 0
+
+
+def test_cross_region_profiles_stay_in_their_region_group(stubs):
+    regions = {'eu': 'eu-north-1', 'us': 'us-east-1', 'gov': 'us-gov-west-1', 'apac': 'ap-northeast-1'}
+    servers = {name: stubs() for name in regions}
+    router = build_router([target(name, servers[name], region) for name, region in regions.items()], max_attempts=1)
+
+    for prefix, expected in (('eu.', 'eu'), ('us.', 'us'), ('us-gov.', 'gov'), ('apac.', 'apac')):
+        before = {name: server.requests for name, server in servers.items()}
+        for _ in range(4):
+            invoke(router, prefix + MODEL_ID)
+        served = {name for name, server in servers.items() if server.requests > before[name]}
+        assert served == {expected}, prefix
+
+    assert {t.name for t in router.targets if t.serves('global.' + MODEL_ID)} == set(regions)
+
+
+def test_access_denied_marks_the_model_unavailable_on_that_target(stubs):
+    denied, live = stubs(error=ACCESS_DENIED), stubs()
+    router = build_router([target('denied', denied, weight=100), target('live', live)], max_attempts=1)
+
+    for _ in range(3):
+        assert b'Hello' in invoke(router)
+
+    assert denied.requests == 1
+    assert live.requests == 3
+    denied_target = router.targets[0]
+    assert MODEL_ID in denied_target.unavailable
+    assert denied_target.serves('amazon.nova-lite-v1:0')
+    # Unavailability is not throttling: no cooldown for the target's other models
+    assert router.stats()['targets']['denied']['cooldown_s'] == 0
+
+
+def test_no_target_available(stubs):
+    first, second = stubs(error=ACCESS_DENIED), stubs(error=ACCESS_DENIED)
+    router = build_router([target('first', first, models=[MODEL_ID]),
+                           target('second', second, models=[MODEL_ID])], max_attempts=1)
+
+    with pytest.raises(NoTargetAvailable):
+        invoke(router, 'amazon.titan-text-lite-v1')
+    with pytest.raises(ClientError) as denied:
+        invoke(router)
+    assert denied.value.response['Error']['Code'] == 'AccessDeniedException'
+    # Both targets now refuse the model, so no request is sent at all
+    with pytest.raises(NoTargetAvailable):
+        invoke(router)
+    assert (first.requests, second.requests) == (1, 1)
+    assert router.stats()['exhausted'] == 3
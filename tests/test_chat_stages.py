@@ -0,0 +1,78 @@
+"""A chat turn overlaps web search with its database work and logs its stage timings"""
+
+import logging
+import time
+
+import pytest
+
+import app
+
+USER = {'id': 1, 'username': 'ada', 'email': 'ada@example.com', 'monthly_quota': 50,
+        'plan_name': 'Free', 'overage_enabled': True, 'auto_stop_at_limit': False}
+SEARCH_MESSAGE = 'What is the latest news today?'
+RESULTS = [{'title': 'Election results announced', 'link': 'https://example.com/news', 'snippet': 'Counting ended'}]
+
+
+def slow_first(seconds, result=1):
+    """Response that takes `seconds` the first time: the user message written during the history stage"""
+    calls = []
+
+    def respond(args):
+        if not calls:
+            time.sleep(seconds)
+        calls.append(args)
+        return result
+    return respond
+
+
+@pytest.fixture
+def turn(client, fake_db, monkeypatch):
+    """Post one chat turn; returns (response, seconds, messages sent to the model)"""
+    sent = []
+    monkeypatch.setattr(app, 'invoke_chat_model',
+                        lambda model_id, body: (sent.append(body['messages']) or 'Here is the news', {}))
+    monkeypatch.setattr(app, 'record_api_usage', lambda *args, **kwargs: None)
+    fake_db.responses = [('FROM users WHERE id', [USER]), ('INSERT INTO messages', slow_first(0.2))]
+
+    def post(message=SEARCH_MESSAGE):
+        started = time.monotonic()
+        response = client.post('/api/chat', json={'message': message})
+        return response, time.monotonic() - started, sent[-1] if sent else None
+    return post
+
+
+def test_search_runs_while_the_turn_writes_to_the_database(turn, monkeypatch):
+    monkeypatch.setattr(app, 'perform_web_search', lambda query: time.sleep(0.2) or RESULTS)
+
+    response, seconds, messages = turn()
+
+    assert response.status_code == 200
+    assert 'Election results announced' in messages[-1]['content']
+    assert messages[-1]['content'].endswith(SEARCH_MESSAGE)
+    # 0.2 s of history work and 0.2 s of search overlap instead of adding up
+    assert seconds < 0.35
+
+
+def test_turn_goes_on_without_a_search_that_misses_its_budget(turn, monkeypatch):
+    monkeypatch.setattr(app, 'SEARCH_LATENCY_BUDGET_MS', 300)
+    monkeypatch.setattr(app, 'perform_web_search', lambda query: time.sleep(1) or RESULTS)
+
+    response, seconds, messages = turn()
+
+    assert response.status_code == 200
+    assert messages[-1]['content'] == SEARCH_MESSAGE
+    assert seconds < 0.6
+
+
+def test_stage_timings_are_logged(turn, monkeypatch, caplog):
+    monkeypatch.setattr(app, 'perform_web_search', lambda query: RESULTS)
+    with caplog.at_level(logging.INFO, logger='timing'):
+        response, _, _ = turn()
+    assert response.status_code == 200
+
+    record = next(record for record in caplog.records if record.getMessage() == 'chat timings')
+    assert {'quota_ms', 'history_ms', 'search_ms', 'search_wait_ms', 'model_ms', 'save_ms',
+            'total_ms'} <= set(record.fields)
+    assert record.fields['search'] is True
+    assert record.fields['history_ms'] >= 200
+    assert record.fields['total_ms'] >= record.fields['history_ms']
@@ -0,0 +1,28 @@
+"""A chat turn that fails partway commits none of its writes"""
+
+import pytest
+
+USER = {'id': 1, 'username': 'ada', 'email': 'ada@example.com', 'monthly_quota': 50,
+        'plan_name': 'Free', 'overage_enabled': True, 'auto_stop_at_limit': False}
+
+
+def fail(args):
+    raise RuntimeError('lost connection during INSERT')
+
+
+@pytest.mark.parametrize('path', ['/api/chat', '/api/chat/stream'])
+def test_failed_turn_is_rolled_back_before_the_quota_release(client, fake_db, path):
+    fake_db.responses = [
+        ('FROM users WHERE id', [USER]),
+        ('INSERT INTO messages', fail),
+    ]
+
+    response = client.post(path, json={'message': 'Hello there'})
+
+    assert response.status_code == 500
+    statements = [statement for connection in fake_db.connections for statement in connection.statements]
+    assert any('requests_used = LAST_INSERT_ID' in query for query, _ in statements)
+    assert any('requests_used = requests_used - 1' in query for query, _ in statements)
+    for connection in fake_db.connections:
+        assert connection.committed('INSERT INTO chat_sessions') == []
+    assert sum(len(connection.committed('requests_used = requests_used - 1')) for connection in fake_db.connections) == 1
@@ -0,0 +1,165 @@
+"""ConnectionPool against the fake driver (and, opted in, a real MySQL)"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymysql
+import pytest
+from pymysql.constants.SERVER_STATUS import SERVER_STATUS_IN_TRANS
+
+from database import ConnectionPool, PoolTimeout, create_raw_connection
+
+from fakes import FakeDriver
+
+
+def make_pool(**settings):
+    driver = FakeDriver()
+    settings.setdefault('max_size', 2)
+    settings.setdefault('timeout', 1)
+    return driver, ConnectionPool(connect=driver, **settings)
+
+
+def test_released_connections_are_reused():
+    driver, pool = make_pool()
+    for _ in range(3):
+        with pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+    assert len(driver.connections) == 1
+    stats = pool.stats()
+    assert (stats['checkouts'], stats['created'], stats['in_use'], stats['idle']) == (3, 1, 0, 1)
+
+
+def test_checkout_waits_for_a_release_and_times_out_when_none_comes():
+    driver, pool = make_pool(max_size=2)
+    first, second = pool.acquire(), pool.acquire()
+
+    with pytest.raises(PoolTimeout):
+        pool.acquire(timeout=0.05)
+
+    threading.Timer(0.05, first.close).start()
+    third = pool.acquire(timeout=1)
+    assert third._raw is driver.connections[0]
+    stats = pool.stats()
+    assert (stats['waits'], stats['timeouts'], stats['size']) == (2, 1, 2)
+    assert stats['wait_time_total'] > 0
+    second.close()
+    third.close()
+
+
+def test_pool_never_exceeds_max_size_under_contention():
+    driver, pool = make_pool(max_size=4, timeout=5)
+    peak, lock, in_use = [0], threading.Lock(), [0]
+
+    def work(_):
+        with pool.connection():
+            with lock:
+                in_use[0] += 1
+                peak[0] = max(peak[0], in_use[0])
+            time.sleep(0.001)
+            with lock:
+                in_use[0] -= 1
+
+    with ThreadPoolExecutor(16) as executor:
+        list(executor.map(work, range(400)))
+    stats = pool.stats()
+    assert peak[0] <= 4
+    assert len(driver.connections) <= 4
+    assert (stats['checkouts'], stats['in_use'], stats['timeouts']) == (400, 0, 0)
+
+
+def test_dead_connection_is_replaced_on_checkout():
+    driver, pool = make_pool(ping_interval=0)
+    pool.acquire().close()
+    driver.connections[0].fail_ping = True
+
+    connection = pool.acquire()
+
+    assert connection._raw is driver.connections[1]
+    assert driver.connections[0].closed
+    stats = pool.stats()
+    assert (stats['ping_failures'], stats['discarded'], stats['size']) == (1, 1, 1)
+    connection.close()
+
+
+def test_recently_used_connection_is_not_pinged():
+    driver, pool = make_pool(ping_interval=30)
+    pool.acquire().close()
+    pool.acquire().close()
+    assert driver.connections[0].pings == 0
+
+
+def test_idle_and_old_connections_are_recycled():
+    driver, pool = make_pool(max_idle=0.05, max_lifetime=None)
+    pool.acquire().close()
+    time.sleep(0.1)
+    pool.acquire().close()
+    assert len(driver.connections) == 2 and driver.connections[0].closed
+
+    driver, pool = make_pool(max_idle=None, max_lifetime=0.05)
+    connection = pool.acquire()
+    time.sleep(0.1)
+    connection.close()
+    assert driver.connections[0].closed
+    assert pool.stats()['idle'] == 0
+
+
+def test_release_rolls_back_only_open_transactions():
+    driver, pool = make_pool()
+    connection = pool.acquire()
+    connection.close()
+    assert driver.connections[0].rollbacks == 0
+
+    connection = pool.acquire()
+    driver.connections[0].server_status = SERVER_STATUS_IN_TRANS
+    connection.close()
+    assert driver.connections[0].rollbacks == 1
+
+
+def test_connection_context_discards_a_connection_that_cannot_roll_back():
+    driver, pool = make_pool()
+
+    def broken_rollback():
+        raise pymysql.err.OperationalError(2013, 'Lost connection to MySQL server during query')
+
+    with pytest.raises(RuntimeError):
+        with pool.connection() as connection:
+            connection._raw.rollback = broken_rollback
+            raise RuntimeError('query failed')
+
+    assert driver.connections[0].closed
+    assert (pool.stats()['discarded'], pool.stats()['size']) == (1, 0)
+
+
+def test_failed_connect_frees_its_slot():
+    driver, pool = make_pool(max_size=1)
+    driver.fail = True
+    with pytest.raises(ConnectionError):
+        pool.acquire()
+    driver.fail = False
+    pool.acquire(timeout=0.05).close()
+    assert pool.stats()['size'] == 1
+
+
+def test_returned_connection_cannot_be_used():
+    _, pool = make_pool()
+    connection = pool.acquire()
+    connection.close()
+    connection.close()
+    with pytest.raises(pymysql.err.InterfaceError):
+        connection.cursor()
+
+
+@pytest.mark.skipif(os.getenv('TEST_MYSQL', 'false').lower() != 'true',
+                    reason='set TEST_MYSQL=true and DB_* to run against a MySQL test database')
+def test_pool_against_mysql():
+    pool = ConnectionPool(connect=create_raw_connection, max_size=2, ping_interval=0)
+    for _ in range(3):
+        with pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT CONNECTION_ID() AS id")
+                assert cursor.fetchone()['id']
+    assert pool.stats()['created'] == 1
+    pool.close_all()
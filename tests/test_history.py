@@ -0,0 +1,67 @@
+"""Cached history tails are JSON-serializable and read only new rows"""
+
+import json
+
+from cache import LRUCache
+from history import HistoryManager
+
+from fakes import FakeConnection
+
+
+class JSONStore(LRUCache):
+    """Round-trips every value through JSON, as RedisCache does"""
+
+    def get(self, key, default=None):
+        raw = super().get(key)
+        return default if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        super().set(key, json.dumps(value), ttl)
+
+
+class Messages:
+    def __init__(self):
+        self.rows = []
+
+    def add(self, role, content):
+        self.rows.append({'id': len(self.rows) + 1, 'role': role, 'content': content})
+
+    def tail(self, args):
+        session_id, limit = args
+        return self.rows[-limit:][::-1]
+
+    def since(self, args):
+        session_id, last_id = args
+        return [row for row in self.rows if row['id'] > last_id]
+
+
+def conversation(messages, turns):
+    for i in range(turns):
+        messages.add('user', f'question {i}')
+        messages.add('assistant', f'answer {i}')
+
+
+def test_json_store_gives_the_same_windows_and_reads_only_new_rows():
+    messages = Messages()
+    conversation(messages, 40)
+    connection = FakeConnection([
+        ('ORDER BY id DESC LIMIT', messages.tail),
+        ('id > %s', messages.since),
+    ])
+    in_process, shared = HistoryManager(max_messages=20), HistoryManager(max_messages=20, store=JSONStore())
+
+    for turn in range(5):
+        messages.add('user', f'follow-up {turn}')
+        with connection.cursor() as cursor:
+            window = in_process.load(cursor, 1, token_budget=60)
+            assert shared.load(cursor, 1, token_budget=60) == window
+        assert window[0]['role'] == 'user'
+        assert window[-1]['content'] == f'follow-up {turn}'
+        messages.add('assistant', f'reply {turn}')
+
+    assert len(connection.executed('ORDER BY id DESC LIMIT')) == 2
+    # Each later turn asks only for the reply and follow-up added since the last one
+    assert connection.executed('id > %s')[-1] == (1, messages.rows[-4]['id'])
+    cached = json.loads(shared.store._data[1][0])
+    assert len(cached['messages']) == 20
+    assert cached['last_id'] == messages.rows[-2]['id']
@@ -0,0 +1,127 @@
+"""Prometheus exposition of the metrics registry and the /metrics gate"""
+
+import logging
+import os
+
+import pytest
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+
+import app
+import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    return registry
+
+
+def lines(registry):
+    return registry.render().splitlines()
+
+
+def test_histogram_buckets_are_cumulative_and_inclusive(registry):
+    histogram = registry.histogram('latency_seconds', 'Latency', ('route',), buckets=(0.01, 0.05))
+    for value in (0.01, 0.02, 0.05, 3.0):
+        histogram.observe(value, route='/api/chat')
+
+    assert lines(registry) == [
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        # A value equal to a bound counts in that bucket
+        'latency_seconds_bucket{route="/api/chat",le="0.01"} 1',
+        'latency_seconds_bucket{route="/api/chat",le="0.05"} 3',
+        'latency_seconds_bucket{route="/api/chat",le="+Inf"} 4',
+        'latency_seconds_count{route="/api/chat"} 4',
+        'latency_seconds_sum{route="/api/chat"} 3.08',
+    ]
+
+
+def test_counter_samples_and_label_escaping(registry):
+    counter = registry.counter('requests', 'Requests', ('route', 'status'))
+    counter.inc(route='/a "quoted"\\path\nnext', status=200)
+    counter.inc(2, route='/a "quoted"\\path\nnext', status=200)
+
+    assert lines(registry)[1:] == [
+        '# TYPE requests counter',
+        'requests_total{route="/a \\"quoted\\"\\\\path\\nnext",status="200"} 3',
+    ]
+
+
+def test_a_failing_collector_is_skipped(registry, caplog):
+    def broken():
+        raise RuntimeError('stats unavailable')
+
+    registry.counter('requests', 'Requests').inc()
+    registry.register_collector(broken)
+    metrics.register_stats('zed_pool', lambda: {'in_use': 2}, 'Pool')
+
+    with caplog.at_level(logging.WARNING, logger='metrics'):
+        rendered = lines(registry)
+
+    assert 'requests_total 1' in rendered
+    assert 'zed_pool_in_use 2' in rendered
+    assert 'stats unavailable' in caplog.text
+
+
+def test_stats_totals_are_counters_and_the_rest_gauges(registry):
+    metrics.register_stats(
+        'zed_cache', lambda: {'users': {'size': 3, 'hits': 7, 'hit_rate': 0.7, 'backend': 'lru'}},
+        'Named cache', label='cache', counters=('hits',)
+    )
+    metrics.register_stats('zed_db_pool', lambda: {'wait_time_total': 1.5, 'up': True}, 'Pool',
+                           counters=('wait_time_total',))
+
+    assert lines(registry) == [
+        '# HELP zed_cache_size Named cache: size',
+        '# TYPE zed_cache_size gauge',
+        'zed_cache_size{cache="users"} 3',
+        '# HELP zed_cache_hits Named cache: hits',
+        '# TYPE zed_cache_hits counter',
+        'zed_cache_hits_total{cache="users"} 7',
+        '# HELP zed_cache_hit_rate Named cache: hit_rate',
+        '# TYPE zed_cache_hit_rate gauge',
+        'zed_cache_hit_rate{cache="users"} 0.7',
+        '# HELP zed_db_pool_wait_time Pool: wait_time_total',
+        '# TYPE zed_db_pool_wait_time counter',
+        'zed_db_pool_wait_time_total 1.5',
+    ]
+
+
+@pytest.fixture
+def scrape(monkeypatch):
+    def get(token='', public=False, authorization=None):
+        monkeypatch.setattr(app, 'METRICS_TOKEN', token)
+        monkeypatch.setattr(app, 'METRICS_PUBLIC', public)
+        headers = {'Authorization': authorization} if authorization else {}
+        return app.app.test_client().get('/metrics', headers=headers)
+    return get
+
+
+def test_metrics_are_hidden_without_a_token(scrape):
+    assert scrape().status_code == 404
+    assert scrape(authorization='Bearer anything').status_code == 404
+
+
+def test_metrics_need_the_bearer_token(scrape):
+    assert scrape(token='s3cret').status_code == 401
+    assert scrape(token='s3cret', authorization='Bearer wrong').status_code == 401
+    assert scrape(token='s3cret', public=True).status_code == 401
+
+    response = scrape(token='s3cret', authorization='Bearer s3cret')
+    assert response.status_code == 200
+    assert response.content_type == metrics.CONTENT_TYPE
+
+
+def test_public_metrics_render_the_app_registry(scrape):
+    response = scrape(public=True)
+    assert response.status_code == 200
+    body = response.get_data(as_text=True)
+    assert '# TYPE zed_bedrock_calls counter' in body
+    assert 'zed_bedrock_calls_total ' in body
+    assert '# TYPE zed_db_pool_checkouts counter' in body
+    assert '# TYPE zed_db_pool_in_use gauge' in body
+    assert '# TYPE zed_http_request_duration_seconds histogram' in body
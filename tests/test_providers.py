@@ -0,0 +1,91 @@
+"""Provider adapters against Bedrock payloads in each model family's format"""
+
+import glob
+import json
+import os
+
+import pytest
+
+import providers
+from providers import ProviderResponseError, get_adapter, get_supported_models, resolve_adapter, usage_from_headers
+
+PAYLOADS = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'payloads', '*.json')))
+MESSAGES = [{'role': 'user', 'content': 'What is the capital of France?'}]
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+@pytest.fixture(params=PAYLOADS, ids=lambda path: os.path.basename(path)[:-5])
+def recorded(request):
+    return load(request.param)
+
+
+def test_model_id_resolves_to_its_adapter(recorded):
+    assert get_adapter(recorded['model_id']).name == recorded['adapter']
+
+
+def test_response_text_and_usage(recorded):
+    adapter = get_adapter(recorded['model_id'])
+    assert adapter.parse_response(recorded['response']) == recorded['text']
+    assert adapter.extract_usage(recorded['response']) == recorded['usage']
+
+
+def test_stream_text_and_usage(recorded):
+    adapter = get_adapter(recorded['model_id'])
+    text, usage = '', None
+    for chunk in recorded['stream']:
+        delta, chunk_usage = adapter.parse_stream_chunk(chunk)
+        text += delta
+        usage = chunk_usage or usage
+    assert text == recorded['text']
+    assert usage == recorded['stream_usage']
+
+
+def test_unrecognized_response_raises(recorded):
+    with pytest.raises(ProviderResponseError):
+        get_adapter(recorded['model_id']).parse_response({'error': 'unexpected'})
+
+
+@pytest.mark.parametrize('body', [
+    {'output': {'message': {}}},
+    {'output': {'message': {'content': []}}},
+    {'output': {'message': {'content': [{'image': {}}]}}},
+    {'output': {'message': None}},
+    {'choices': [{}]},
+    {'choices': [{'message': None}]},
+    [],
+])
+def test_truncated_inference_config_responses_raise_provider_errors(body):
+    with pytest.raises(ProviderResponseError):
+        get_adapter('amazon.nova-micro-v1:0').parse_response(body)
+
+
+def test_request_bodies_carry_the_system_prompt_where_the_format_has_one():
+    claude = get_adapter('anthropic.claude-3-haiku-20240307-v1:0').build_request(MESSAGES, 'Be brief.')
+    assert claude['system'] == 'Be brief.' and claude['messages'] == MESSAGES
+    assert claude['anthropic_version'] == 'bedrock-2023-05-31'
+
+    gpt = get_adapter('openai.gpt-oss-20b-1:0').build_request(MESSAGES, 'Be brief.')
+    assert [m['role'] for m in gpt['messages']] == ['user', 'assistant', 'user']
+    assert gpt['messages'][0]['content'] == 'Be brief.'
+    assert get_adapter('openai.gpt-oss-20b-1:0').build_request(MESSAGES)['messages'] == MESSAGES
+
+    nova = get_adapter('amazon.nova-micro-v1:0').build_request(MESSAGES, 'Be brief.')
+    assert nova['messages'] == MESSAGES and nova['inferenceConfig']['maxTokens'] == providers.MAX_TOKENS
+
+
+def test_unregistered_models_fall_back_to_the_inference_config_format():
+    assert resolve_adapter('writer.palmyra-x5-v1:0') is None
+    assert get_adapter('writer.palmyra-x5-v1:0') is providers.DEFAULT_ADAPTER
+    assert all(resolve_adapter(model['id']) for model in get_supported_models())
+
+
+def test_usage_from_invoke_model_headers():
+    headers = {'x-amzn-bedrock-input-token-count': '41', 'x-amzn-bedrock-output-token-count': '19',
+               'x-amzn-bedrock-invocation-latency': '612'}
+    assert usage_from_headers(headers) == {'input_tokens': 41, 'output_tokens': 19, 'total_tokens': 60,
+                                           'latency_ms': 612}
+    assert usage_from_headers({}) is None
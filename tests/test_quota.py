@@ -0,0 +1,138 @@
+"""Concurrent quota reservations never admit more requests than the quota"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import database
+import lemonsqueezy
+from lemonsqueezy import UsageTracker
+
+from fakes import FakeDriver
+
+PARALLEL = 64
+QUOTA = 20
+
+
+class UsersRow:
+    """One users row; the reservation UPDATE is applied atomically, as MySQL does"""
+
+    def __init__(self, quota, overage_enabled=False, auto_stop_at_limit=False):
+        self.row = {'id': 1, 'subscription_status': 'free', 'plan_name': 'Free', 'monthly_quota': quota,
+                    'requests_used': 0, 'overage_enabled': overage_enabled,
+                    'auto_stop_at_limit': auto_stop_at_limit}
+        self.lock = threading.Lock()
+
+    def reserve(self, args):
+        with self.lock:
+            row = self.row
+            if row['requests_used'] < row['monthly_quota'] or (row['overage_enabled'] and not row['auto_stop_at_limit']):
+                row['requests_used'] += 1
+                return 1, row['requests_used']
+            return 0, 0
+
+    def release(self, args):
+        with self.lock:
+            if self.row['requests_used'] > 0:
+                self.row['requests_used'] -= 1
+                return 1
+            return 0
+
+    def select(self, args):
+        with self.lock:
+            return [dict(self.row)]
+
+
+@pytest.fixture
+def users(monkeypatch):
+    table = UsersRow(QUOTA)
+    driver = FakeDriver([
+        ('requests_used = LAST_INSERT_ID(requests_used + 1)', table.reserve),
+        ('requests_used = requests_used - 1', table.release),
+        ('FROM users WHERE id', table.select),
+    ])
+    monkeypatch.setattr(database, '_pool', database.ConnectionPool(connect=driver, max_size=16, timeout=5))
+    lemonsqueezy.invalidate_quota_cache(1)
+    table.driver = driver
+    return table
+
+
+def reserve_in_parallel(count):
+    barrier = threading.Barrier(count)
+
+    def reserve(_):
+        barrier.wait()
+        return UsageTracker.reserve_quota(1)
+
+    with ThreadPoolExecutor(count) as executor:
+        return list(executor.map(reserve, range(count)))
+
+
+def test_parallel_reservations_admit_exactly_the_quota(users):
+    results = reserve_in_parallel(PARALLEL)
+
+    allowed = [result for result in results if result['allowed']]
+    assert len(allowed) == QUOTA
+    assert users.row['requests_used'] == QUOTA
+    assert sorted(result['used'] for result in allowed) == list(range(1, QUOTA + 1))
+    assert all(result['remaining'] == QUOTA - result['used'] for result in allowed)
+    assert all('exceeded' in result['message'] for result in results if not result['allowed'])
+
+
+def test_overage_admits_everyone_and_reports_it(users):
+    users.row['overage_enabled'] = True
+    results = reserve_in_parallel(PARALLEL)
+    assert all(result['allowed'] for result in results)
+    assert sum(result['is_overage'] for result in results) == PARALLEL - QUOTA
+
+
+def test_released_reservation_is_available_again(users):
+    users.row['requests_used'] = QUOTA - 1
+    assert UsageTracker.reserve_quota(1)['allowed']
+    assert not UsageTracker.reserve_quota(1)['allowed']
+    UsageTracker.release_quota(1)
+    assert UsageTracker.reserve_quota(1)['allowed']
+
+
+def test_admitted_reservation_is_one_statement_once_the_plan_is_cached(users):
+    UsageTracker.reserve_quota(1)
+    statements = sum(len(connection.statements) for connection in users.driver.connections)
+    UsageTracker.reserve_quota(1)
+    after = sum(len(connection.statements) for connection in users.driver.connections)
+    # The conditional UPDATE and its COMMIT
+    assert after - statements == 2
+
+
+@pytest.mark.skipif(os.getenv('TEST_MYSQL', 'false').lower() != 'true',
+                    reason='set TEST_MYSQL=true and DB_* to run against a MySQL test database')
+def test_parallel_reservations_against_mysql():
+    database.init_database()
+    with database.db_connection() as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO users (username, email, password_hash, monthly_quota, requests_used,
+                                   overage_enabled, auto_stop_at_limit)
+                VALUES ('quota-test', 'quota-test@example.invalid', '-', %s, 0, FALSE, FALSE)
+            """, (QUOTA,))
+            user_id = cursor.lastrowid
+        connection.commit()
+    try:
+        barrier = threading.Barrier(PARALLEL)
+
+        def reserve(_):
+            barrier.wait()
+            return UsageTracker.reserve_quota(user_id)['allowed']
+
+        with ThreadPoolExecutor(PARALLEL) as executor:
+            assert sum(executor.map(reserve, range(PARALLEL))) == QUOTA
+        with database.db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT requests_used FROM users WHERE id = %s", (user_id,))
+                assert cursor.fetchone()['requests_used'] == QUOTA
+    finally:
+        with database.db_connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM users WHERE id = %s", (user_id,))
+            connection.commit()
@@ -0,0 +1,173 @@
+"""Hostile snippets must stay inside the sandbox's limits, and every stream must hand its worker back"""
+
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+import sandbox
+
+TIMEOUT = 2
+
+FORK_LOOP = """import os, time
+while True:
+    try:
+        pid = os.fork()
+    except OSError:
+        continue
+    if pid == 0:
+        os.setsid()
+        time.sleep(60)
+        os._exit(0)
+    print(pid, flush=True)
+"""
+
+FORK_UNTIL_REFUSED = """import os, time
+forked = 0
+while True:
+    try:
+        pid = os.fork()
+    except OSError:
+        break
+    if pid == 0:
+        time.sleep(60)
+        os._exit(0)
+    forked += 1
+print(forked)
+"""
+
+
+def _alive(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except OSError:
+        return False
+
+
+@pytest.fixture(scope='module')
+def python_pool():
+    pool = sandbox.SandboxPool(sandbox.PythonWorker, 1)
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+@pytest.fixture(scope='module')
+def node_pool():
+    if not shutil.which(sandbox.NODE_BINARY):
+        pytest.skip('Node.js is not installed')
+    pool = sandbox.SandboxPool(sandbox.NodeWorker, 1)
+    pool.start()
+    yield pool
+    pool.shutdown()
+
+
+def test_python_output_is_truncated_at_the_limit(python_pool):
+    result = python_pool.run("while True:\n    print('x' * 1000)", TIMEOUT)
+    assert result['truncated']
+    assert len(result['stdout']) <= sandbox.SANDBOX_MAX_OUTPUT
+
+
+def test_python_memory_is_capped(python_pool):
+    result = python_pool.run("blocks = []\nwhile True:\n    blocks.append(' ' * 10**6)", TIMEOUT)
+    assert result['returncode'] != 0
+    assert 'MemoryError' in result['stderr']
+
+
+def test_python_cpu_spin_is_stopped(python_pool):
+    result = python_pool.run("while True:\n    pass", TIMEOUT)
+    assert result['timed_out'] or result['returncode'] != 0
+
+
+def test_python_fork_loop_leaves_no_survivors(python_pool):
+    result = python_pool.run(FORK_LOOP, TIMEOUT)
+    pids = [int(word) for word in result['stdout'].split() if word.isdigit()]
+    time.sleep(0.2)
+    assert pids
+    assert not [pid for pid in pids if _alive(pid)]
+
+
+def test_python_process_limit_is_set(python_pool):
+    result = python_pool.run("import resource\nprint(resource.getrlimit(resource.RLIMIT_NPROC)[0])", TIMEOUT)
+    limit = int(result['stdout'])
+    assert limit != -1
+    assert limit - sandbox.SANDBOX_MAX_PROCS <= sandbox.user_tasks()
+
+
+@pytest.mark.skipif(os.geteuid() == 0, reason='RLIMIT_NPROC does not apply to root')
+def test_python_fork_loop_is_refused_at_the_process_limit(python_pool):
+    result = python_pool.run(FORK_UNTIL_REFUSED, TIMEOUT)
+    assert 0 < int(result['stdout']) <= sandbox.SANDBOX_MAX_PROCS
+
+
+def test_python_pool_recovers_after_hostile_snippets(python_pool):
+    result = python_pool.run("print(sum(range(10)))", TIMEOUT)
+    assert result['returncode'] == 0
+    assert result['stdout'] == '45\n'
+
+
+def test_node_output_is_truncated_at_the_limit(node_pool):
+    # Node buffers console output behind a busy loop, so this can also end by timeout
+    result = node_pool.run("while (true) console.log('x'.repeat(1000));", TIMEOUT)
+    assert result['truncated'] or result['timed_out']
+    assert len(result['stdout']) <= sandbox.SANDBOX_MAX_OUTPUT
+
+
+def test_node_memory_is_capped(node_pool):
+    result = node_pool.run("const blocks = []; while (true) blocks.push(new Array(1e6).fill(1));", TIMEOUT)
+    assert result['returncode'] != 0
+
+
+def test_node_cpu_spin_is_stopped(node_pool):
+    result = node_pool.run("while (true) {}", TIMEOUT)
+    assert result['timed_out'] or result['returncode'] != 0
+
+
+def test_node_process_limit_is_set(node_pool):
+    code = ("const limits = require('fs').readFileSync('/proc/self/limits', 'utf8');"
+            "console.log(limits.split('\\n').find(line => line.startsWith('Max processes')));")
+    result = node_pool.run(code, TIMEOUT)
+    soft = result['stdout'].split()[2]
+    assert soft != 'unlimited'
+    assert int(soft) - sandbox.SANDBOX_MAX_PROCS <= sandbox.user_tasks()
+
+
+def test_stream_reports_a_start_error_as_an_event(monkeypatch):
+    monkeypatch.setattr(sandbox, 'SANDBOX_POOL', False)
+    monkeypatch.setattr(sandbox, 'NODE_BINARY', '/nonexistent/node')
+    events = sandbox.stream_snippet('javascript', 'console.log(1)', TIMEOUT)
+    assert [event['type'] for event in events] == ['error']
+    events.close()
+
+
+@pytest.fixture
+def small_pool(monkeypatch):
+    pool = sandbox.SandboxPool(sandbox.PythonWorker, 1, queue_timeout=1)
+    pool.start()
+    monkeypatch.setattr(sandbox, 'get_sandbox_pool', lambda language: pool)
+    yield pool
+    pool.shutdown()
+
+
+def test_stream_closed_unread_returns_its_worker(small_pool):
+    small_pool.stream('print(1)', TIMEOUT).close()
+    assert small_pool.stats()['busy'] == 0
+    sandbox.stream_snippet('python', 'print(1)', TIMEOUT).close()
+    assert small_pool.stats()['busy'] == 0
+    assert small_pool.run('print(2)', TIMEOUT)['stdout'] == '2\n'
+
+
+def test_stream_route_returns_the_worker_when_the_client_leaves_early(client, fake_db, small_pool):
+    fake_db.responses = [('FROM users WHERE id', [{'id': 1, 'username': 'ada', 'email': 'ada@example.com'}])]
+    for _ in range(3):
+        response = client.post('/api/execute-code/stream', json={'code': 'print(1)'}, buffered=False)
+        assert response.status_code == 200
+        response.close()
+        assert small_pool.stats()['busy'] == 0
+
+    response = client.post('/api/execute-code/stream', json={'code': 'print(3)'})
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [line['type'] for line in lines] == ['start', 'output', 'done']
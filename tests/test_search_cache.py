@@ -0,0 +1,100 @@
+"""SearchCache: normalized keys, per-class TTLs and single-flight, with a stubbed search"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cache import LRUCache
+from search import SEARCH_TTLS, SearchCache, classify_query, normalize_query
+
+RESULTS = [{'title': 'Bitcoin', 'link': 'https://example.com/btc', 'snippet': '...'}]
+
+
+class StubSearch:
+    def __init__(self, delay=0.0, fail=0):
+        self.calls = []
+        self.delay = delay
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def __call__(self, query, num_results):
+        with self.lock:
+            self.calls.append((query, num_results))
+            fail = self.fail > 0
+            self.fail -= fail
+        time.sleep(self.delay)
+        if fail:
+            raise ConnectionError('search backend unreachable')
+        return RESULTS
+
+
+@pytest.fixture
+def clock():
+    now = [0.0]
+    return now
+
+
+@pytest.fixture
+def cache(clock):
+    return SearchCache(store=LRUCache(100, clock=lambda: clock[0]))
+
+
+def test_phrasings_of_one_query_share_a_key():
+    assert normalize_query('What is the PRICE of Bitcoin?') == 'price bitcoin'
+    assert normalize_query('  price   of   bitcoin!!') == 'price bitcoin'
+    assert normalize_query('ｐｒｉｃｅ of bitcoin') == 'price bitcoin'
+    # A query made only of stopwords keeps them
+    assert normalize_query('Who is?') == 'who is'
+
+
+@pytest.mark.parametrize('query, query_class', [
+    ('bitcoin price', 'price'), ('weather in Dhaka', 'weather'), ('latest news on the election', 'news'),
+    ('what is photosynthesis', 'definition'), ('best hiking trails in Sylhet', 'general'),
+])
+def test_query_classes(query, query_class):
+    assert classify_query(query) == query_class
+
+
+def test_results_expire_by_query_class(cache, clock):
+    search = StubSearch()
+    cache.get_or_search('bitcoin price', 5, search)
+    cache.get_or_search('define entropy', 5, search)
+
+    clock[0] = SEARCH_TTLS['price'] + 1
+    cache.get_or_search('What is the bitcoin price?', 5, search)
+    cache.get_or_search('define: entropy', 5, search)
+    assert [query for query, _ in search.calls] == ['bitcoin price', 'define entropy', 'What is the bitcoin price?']
+
+    assert cache.get_or_search('bitcoin price', 10, search) == RESULTS
+    assert search.calls[-1] == ('bitcoin price', 10)
+
+
+def test_concurrent_identical_queries_make_one_call(cache):
+    search = StubSearch(delay=0.1)
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda _: cache.get_or_search('Bitcoin price', 5, search), range(8)))
+    assert results == [RESULTS] * 8
+    assert len(search.calls) == 1
+    stats = cache.stats()
+    assert (stats['misses'], stats['coalesced'], stats['hits']) == (1, 7, 0)
+
+
+def test_failed_searches_are_not_cached(cache):
+    search = StubSearch(fail=1)
+    with pytest.raises(ConnectionError):
+        cache.get_or_search('bitcoin price', 5, search)
+    assert cache.get_or_search('bitcoin price', 5, search) == RESULTS
+    assert len(search.calls) == 2
+    assert cache.stats()['errors'] == 1
+
+
+def test_stats_report_hit_ratio_and_latency_saved(cache):
+    search = StubSearch(delay=0.02)
+    for _ in range(4):
+        cache.get_or_search('bitcoin price', 5, search)
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (3, 1, 0.75)
+    assert stats['avg_fetch_ms'] >= 20
+    assert stats['latency_saved_ms'] == pytest.approx(3 * stats['avg_fetch_ms'], rel=0.01)
@@ -0,0 +1,68 @@
+"""Long-lived search backends against a local Custom Search stub server"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import search
+from bench_search import API_KEY, ENGINE_ID, StubSearchServer
+from search import CustomSearchBackend, RestSearchBackend, SearchClient, get_search_client, set_search_backend
+
+
+@pytest.fixture
+def stub():
+    server = StubSearchServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def backends(url, **settings):
+    return [CustomSearchBackend(API_KEY, ENGINE_ID, api_url=url, **settings),
+            RestSearchBackend(API_KEY, ENGINE_ID, api_url=url + '/customsearch/v1', **settings)]
+
+
+def test_backends_parse_results_and_keep_their_connection(stub):
+    for backend in backends(stub.url):
+        client = SearchClient(backend)
+        before = stub.connections
+        for _ in range(5):
+            results = client.search('dhaka weather', 3)
+        assert results == [{'title': f'dhaka weather {i}', 'link': f'https://example.com/{i}',
+                            'snippet': 'About dhaka weather'} for i in range(3)]
+        assert stub.connections - before == 1, backend.name
+        assert client.stats()['searches'] == 5
+
+
+def test_googleapiclient_backend_gives_each_thread_its_own_connection(stub):
+    client = SearchClient(CustomSearchBackend(API_KEY, ENGINE_ID, api_url=stub.url))
+    barrier = threading.Barrier(4)
+
+    def searches(_):
+        barrier.wait()
+        return [client.search('query', 1) for _ in range(10)]
+
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(searches, range(4)))
+    assert stub.requests == 40
+    assert stub.connections == 4
+
+
+def test_timeouts_are_counted_as_errors(stub):
+    stub.latency = 0.5
+    for backend in backends(stub.url, timeout=0.05):
+        client = SearchClient(backend)
+        with pytest.raises(Exception):
+            client.search('slow query', 1)
+        assert client.stats()['errors'] == 1, backend.name
+
+
+def test_process_wide_backend_can_be_swapped_for_a_stub(stub, monkeypatch):
+    monkeypatch.setattr(search, '_client', None)
+    set_search_backend(RestSearchBackend(API_KEY, ENGINE_ID, api_url=stub.url + '/customsearch/v1'))
+    assert get_search_client().backend.name == 'rest'
+    assert get_search_client().search('swapped', 1)[0]['title'] == 'swapped 0'
+    set_search_backend(None)
+    assert search._client is None
@@ -0,0 +1,69 @@
+"""The search-intent classifier against the labelled evaluation set"""
+
+import json
+import os
+
+import pytest
+
+from bench_search_intent import evaluate, legacy_needs_web_search, load_examples
+from search import LexiconIntentClassifier, default_intent_terms, load_intent_classifier
+
+EVAL_SET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'search_intent_eval.jsonl')
+
+
+@pytest.fixture(scope='module')
+def examples():
+    return load_examples(EVAL_SET)
+
+
+@pytest.fixture(scope='module')
+def classifier():
+    return LexiconIntentClassifier(default_intent_terms())
+
+
+def test_eval_set_is_balanced_across_languages(examples):
+    for language in ('en', 'bn', 'ar'):
+        labels = [example['search'] for example in examples if example['lang'] == language]
+        assert True in labels and False in labels
+
+
+def test_classifier_precision_and_recall(classifier, examples):
+    result = evaluate(classifier.needs_search, examples)
+    assert result['precision'] >= 0.95
+    assert result['recall'] >= 0.8
+
+
+@pytest.mark.parametrize('language', ['bn', 'ar'])
+def test_classifier_recall_outside_english(classifier, examples, language):
+    result = evaluate(classifier.needs_search, [example for example in examples if example['lang'] == language])
+    assert result['recall'] >= 0.8
+    assert result['fp'] == 0
+
+
+def test_classifier_searches_less_and_better_than_the_substring_scan(classifier, examples):
+    legacy = evaluate(legacy_needs_web_search, examples)
+    current = evaluate(classifier.needs_search, examples)
+    assert current['precision'] > legacy['precision']
+    assert current['recall'] > legacy['recall']
+    assert current['fp'] < legacy['fp']
+
+
+@pytest.mark.parametrize('message', [
+    'I know the answer, just check my reasoning',
+    'Acknowledge this message and wait for my next one',
+    'Snowden or Assange, who would you side with in a debate?',
+])
+def test_terms_match_whole_words_only(classifier, message):
+    assert classifier.score(message) == 0
+
+
+def test_arabic_diacritics_are_ignored(classifier):
+    assert classifier.score('مَا هِيَ أَخْبَارُ اليَوْمِ؟') == classifier.score('ما هي أخبار اليوم؟')
+
+
+def test_weights_file_replaces_the_lexicon(tmp_path):
+    path = tmp_path / 'weights.json'
+    path.write_text(json.dumps({'threshold': 2.0, 'terms': {'weather': 1.0, 'today': 1.0}}))
+    classifier = load_intent_classifier(str(path))
+    assert not classifier.needs_search('weather in Dhaka')
+    assert classifier.needs_search('weather in Dhaka today')
@@ -0,0 +1,98 @@
+"""Bedrock token counts and latency reach usage_logs and the usage API"""
+
+import io
+import json
+import os
+import threading
+
+import pytest
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+
+import app
+import lemonsqueezy
+from bedrock import build_router, set_bedrock_router
+from bench_bedrock import MODEL_ID, StubBedrock
+from lemonsqueezy import UsageTracker
+from providers import estimate_cost
+
+USER = {'id': 1, 'username': 'ada', 'email': 'ada@example.com', 'monthly_quota': 50,
+        'plan_name': 'Free', 'overage_enabled': True, 'auto_stop_at_limit': False,
+        'current_period_start': None, 'current_period_end': None}
+
+
+@pytest.fixture
+def stub_bedrock():
+    stub = StubBedrock(latency=0.02, capacity=10)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    set_bedrock_router(build_router([{'name': 'stub', 'region': 'us-east-1', 'models': [MODEL_ID],
+                                      'endpoint_url': f'http://127.0.0.1:{stub.server_port}'}]))
+    yield stub
+    set_bedrock_router(None)
+    stub.shutdown()
+    stub.server_close()
+
+
+def test_chat_turn_records_tokens_latency_model_and_session(client, fake_db, stub_bedrock, monkeypatch):
+    monkeypatch.setattr(lemonsqueezy, 'USAGE_WRITE_BEHIND', False)
+    fake_db.responses = [('FROM users WHERE id', [USER])]
+
+    response = client.post('/api/chat', json={'message': 'Hello there', 'model': MODEL_ID})
+
+    assert response.status_code == 200
+    session_id = response.get_json()['session_id']
+    rows = [args for connection in fake_db.connections for args in connection.committed('INSERT INTO usage_logs')]
+    assert len(rows) == 1
+    action, tokens, input_tokens, output_tokens, latency_ms, model_id, row_session = rows[0][:7]
+    # The stub reports 5 input and 1 output token in the response body
+    assert (action, tokens, input_tokens, output_tokens) == ('chat', 6, 5, 1)
+    assert latency_ms >= 20
+    assert (model_id, row_session) == (MODEL_ID, session_id)
+
+
+@pytest.mark.parametrize('used, overage', [(50, False), (51, True)])
+def test_chat_turn_records_the_overage_flag_of_its_reservation(client, fake_db, stub_bedrock, monkeypatch,
+                                                               used, overage):
+    monkeypatch.setattr(lemonsqueezy, 'USAGE_WRITE_BEHIND', False)
+    # The reservation brings requests_used to `used` of a quota of 50
+    fake_db.responses = [('LAST_INSERT_ID(requests_used + 1)', (1, used)), ('FROM users WHERE id', [USER])]
+
+    response = client.post('/api/chat', json={'message': 'Hello there', 'model': MODEL_ID})
+
+    assert response.status_code == 200
+    assert response.get_json()['quota_info']['is_overage'] is overage
+    rows = [args for connection in fake_db.connections for args in connection.committed('INSERT INTO usage_logs')]
+    # The flag is a parameter, not read back from the counter when the row is written
+    assert rows[0][-2:] == (overage, USER['id'])
+
+
+class HeaderOnlyRouter:
+    """invoke_model answering with token counts in the headers only"""
+
+    def invoke_model(self, modelId, body):
+        return {
+            'body': io.BytesIO(json.dumps({'output': {'message': {'content': [{'text': 'Hi'}]}}}).encode()),
+            'ResponseMetadata': {'HTTPHeaders': {
+                'x-amzn-bedrock-input-token-count': '12', 'x-amzn-bedrock-output-token-count': '3',
+                'x-amzn-bedrock-invocation-latency': '410',
+            }},
+        }
+
+
+def test_token_counts_fall_back_to_bedrock_headers(monkeypatch):
+    monkeypatch.setattr(app, 'get_bedrock_router', HeaderOnlyRouter)
+    text, usage = app.invoke_chat_model(MODEL_ID, {'messages': []})
+    assert text == 'Hi'
+    assert usage == {'input_tokens': 12, 'output_tokens': 3, 'total_tokens': 15, 'latency_ms': 410}
+
+
+def test_model_usage_reports_throughput_and_cost():
+    row = {'model_id': MODEL_ID, 'requests': 4, 'input_tokens': 4000, 'output_tokens': 1000,
+           'tokens': 5000, 'latency_ms': 2000, 'timed_output_tokens': 800}
+    usage = UsageTracker._model_usage(row)
+    assert usage['avg_latency_ms'] == 500
+    # Only output tokens of rows with a measured latency count towards throughput
+    assert usage['tokens_per_second'] == 400.0
+    assert usage['cost'] == round(estimate_cost(MODEL_ID, 4000, 1000), 4) > 0
+    assert UsageTracker._model_usage(dict(row, model_id='writer.palmyra-x5-v1:0'))['cost'] is None
@@ -0,0 +1,226 @@
+"""Request traces: span nesting, head and tail sampling, traceparent and SQL normalization"""
+
+import os
+import threading
+import time
+
+import pytest
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+
+import app
+import tracing
+from bedrock import build_router, set_bedrock_router
+from bench_bedrock import MODEL_ID, StubBedrock
+from search import SearchBackend, set_search_backend
+
+USER = {'id': 1, 'username': 'ada', 'email': 'ada@example.com', 'monthly_quota': 50,
+        'plan_name': 'Free', 'overage_enabled': True, 'auto_stop_at_limit': False,
+        'current_period_start': None, 'current_period_end': None}
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+@pytest.fixture
+def exporter(monkeypatch):
+    monkeypatch.setattr(tracing, 'TRACE_SAMPLE_RATE', 0.0)
+    monkeypatch.setattr(tracing, 'TRACE_TAIL_SLOW_MS', 0)
+    monkeypatch.setattr(tracing, 'TRACE_TAIL_ERRORS', False)
+    monkeypatch.setattr(tracing, 'TAIL_SAMPLING', False)
+    exporter = tracing.InMemoryExporter()
+    tracing.set_exporter(exporter)
+    yield exporter
+    tracing.set_exporter(None)
+
+
+def finished(exporter):
+    assert tracing.flush()
+    return exporter.traces
+
+
+def tail_sampling(monkeypatch, slow_ms=50, errors=True):
+    monkeypatch.setattr(tracing, 'TRACE_TAIL_SLOW_MS', slow_ms)
+    monkeypatch.setattr(tracing, 'TRACE_TAIL_ERRORS', errors)
+    monkeypatch.setattr(tracing, 'TAIL_SAMPLING', True)
+
+
+class StubSearch(SearchBackend):
+    name = 'stub'
+
+    def search(self, query, num_results):
+        return [{'title': 'Result', 'link': 'https://example.com', 'snippet': query}]
+
+
+@pytest.fixture
+def stub_backends(monkeypatch):
+    stub = StubBedrock(latency=0.01, capacity=10)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    set_bedrock_router(build_router([{'name': 'stub', 'region': 'us-east-1', 'models': [MODEL_ID],
+                                      'endpoint_url': f'http://127.0.0.1:{stub.server_port}'}]))
+    set_search_backend(StubSearch())
+    monkeypatch.setattr(app, 'GOOGLE_API_KEY', 'stub')
+    monkeypatch.setattr(app, 'GOOGLE_SEARCH_ENGINE_ID', 'stub')
+    monkeypatch.setattr(app, 'record_api_usage', lambda *args, **kwargs: None)
+    yield
+    set_search_backend(None)
+    set_bedrock_router(None)
+    stub.shutdown()
+    stub.server_close()
+
+
+def test_chat_request_nests_db_search_and_bedrock_spans_under_its_root(client, fake_db, exporter,
+                                                                        stub_backends):
+    fake_db.responses = [('FROM users WHERE id', [USER])]
+
+    response = client.post('/api/chat', json={'message': 'What is the latest news on tracing today?',
+                                              'model': MODEL_ID},
+                           headers={'traceparent': f'00-{TRACE_ID}-{PARENT_ID}-01'})
+
+    assert response.status_code == 200
+    [spans] = finished(exporter)
+    by_id = {span['span_id']: span for span in spans}
+    [root] = [span for span in spans if span['parent_id'] == PARENT_ID]
+    assert root['name'] == 'POST /api/chat'
+    assert root['attributes']['http.status_code'] == 200
+    assert {span['trace_id'] for span in spans} == {TRACE_ID}
+    names = {span['name'] for span in spans}
+    assert {'db.acquire', 'search', 'bedrock-runtime.InvokeModel'} <= names
+    for span in spans:
+        if span is not root:
+            # Every span hangs off the request's root, and ends inside it
+            assert span['parent_id'] in by_id
+            assert root['start_ns'] <= span['start_ns'] <= span['end_ns'] <= root['end_ns']
+    [bedrock] = [span for span in spans if span['name'] == 'bedrock-runtime.InvokeModel']
+    assert bedrock['attributes']['model_id'] == MODEL_ID
+    assert bedrock['attributes']['http.status_code'] == 200
+
+
+def test_traced_cursor_records_normalized_statements(exporter, monkeypatch):
+    import pymysql
+    from database import TracedCursor
+    monkeypatch.setattr(pymysql.cursors.DictCursor, 'execute', lambda self, query, args=None: 3)
+    monkeypatch.setattr(tracing, 'TRACE_SAMPLE_RATE', 1.0)
+
+    root = tracing.start_trace('GET /api/sessions')
+    with tracing.span('history'):
+        TracedCursor(None).execute("SELECT * FROM messages WHERE session_id = %s AND id > 10", (7,))
+    tracing.end_trace(root)
+
+    [spans] = finished(exporter)
+    query, history, _ = spans
+    assert query['name'] == 'db.query'
+    assert query['parent_id'] == history['span_id']
+    assert history['parent_id'] == root.span_id
+    assert query['attributes']['db.statement'] == 'SELECT * FROM messages WHERE session_id = ? AND id > ?'
+    assert query['attributes']['rows'] == 3
+
+
+def test_head_sampling(exporter, monkeypatch):
+    assert tracing.start_trace('GET /') is tracing.NOOP_SPAN
+    assert not tracing.recording()
+
+    monkeypatch.setattr(tracing, 'TRACE_SAMPLE_RATE', 1.0)
+    root = tracing.start_trace('GET /')
+    tracing.end_trace(root)
+    assert [[span['name'] for span in spans] for spans in finished(exporter)] == [['GET /']]
+
+
+def test_a_sampled_traceparent_is_honored_at_a_zero_sample_rate(exporter):
+    root = tracing.start_trace('GET /', traceparent=f'00-{TRACE_ID}-{PARENT_ID}-01')
+    tracing.end_trace(root)
+    assert finished(exporter)[0][0]['trace_id'] == TRACE_ID
+
+
+def test_tail_sampling_keeps_slow_and_failed_requests_only(exporter, monkeypatch):
+    tail_sampling(monkeypatch, slow_ms=50)
+
+    fast = tracing.start_trace('GET /fast')
+    with tracing.span('db.query'):
+        pass
+    tracing.end_trace(fast)
+
+    slow = tracing.start_trace('GET /slow')
+    time.sleep(0.06)
+    tracing.end_trace(slow)
+
+    failed = tracing.start_trace('GET /failed')
+    with pytest.raises(ValueError):
+        with tracing.span('search'):
+            raise ValueError('backend down')
+    tracing.end_trace(failed)
+
+    kept = {spans[-1]['name']: spans for spans in finished(exporter)}
+    assert set(kept) == {'GET /slow', 'GET /failed'}
+    assert kept['GET /failed'][0]['error'] == 'ValueError: backend down'
+
+
+def test_failed_requests_are_dropped_without_error_tail_sampling(exporter, monkeypatch):
+    tail_sampling(monkeypatch, slow_ms=1000, errors=False)
+    root = tracing.start_trace('GET /failed')
+    tracing.end_trace(root, 'HTTP 500')
+    assert finished(exporter) == []
+
+
+def test_traceparent_continues_the_callers_trace(exporter, monkeypatch):
+    tail_sampling(monkeypatch)
+    root = tracing.start_trace('GET /', traceparent=f'00-{TRACE_ID}-{PARENT_ID}-00')
+    assert (root.trace.trace_id, root.parent_id, root.trace.sampled) == (TRACE_ID, PARENT_ID, False)
+    with tracing.span('lemonsqueezy') as child:
+        # Unsampled so far: downstream services must not keep it on our account
+        assert tracing.traceparent() == f'00-{TRACE_ID}-{child.span_id}-00'
+    tracing.end_trace(root)
+    assert tracing.traceparent() is None
+
+    root = tracing.start_trace('GET /', traceparent='00-not-a-trace-01')
+    assert root.trace.trace_id != TRACE_ID and root.parent_id is None
+    tracing.end_trace(root)
+
+
+def test_spans_ending_after_their_trace_are_dropped(exporter, monkeypatch):
+    monkeypatch.setattr(tracing, 'TRACE_SAMPLE_RATE', 1.0)
+    root = tracing.start_trace('POST /api/chat')
+    late = tracing.start_span('search')
+    tracing.end_trace(root)
+    late.end()
+
+    assert [[span['name'] for span in spans] for spans in finished(exporter)] == [['POST /api/chat']]
+    assert root.trace.dropped_spans == 1
+
+
+@pytest.mark.parametrize('sql, shape', [
+    ("SELECT * FROM users WHERE id = 42", "SELECT * FROM users WHERE id = ?"),
+    ("SELECT * FROM users WHERE email = 'o\\'brien@x' OR name = \"it's\"",
+     "SELECT * FROM users WHERE email = ? OR name = ?"),
+    ("UPDATE users SET price = 9.99 WHERE id IN (%s, %s, %s)", "UPDATE users SET price = ? WHERE id IN (?)"),
+    ("SELECT id\n  FROM   messages\n\tWHERE session_id = %s", "SELECT id FROM messages WHERE session_id = ?"),
+    (b"DELETE FROM sessions WHERE token = 'x'", "DELETE FROM sessions WHERE token = ?"),
+    ("SELECT * FROM t2 WHERE v1 = 3", "SELECT * FROM t2 WHERE v1 = ?"),
+])
+def test_normalize_sql(sql, shape):
+    assert tracing.normalize_sql(sql) == shape
+
+
+def test_normalize_sql_is_cut_at_the_limit():
+    sql = 'SELECT ' + ', '.join(f'column_{i}' for i in range(200)) + ' FROM wide'
+    assert len(tracing.normalize_sql(sql)) == tracing.SQL_MAX_CHARS
+
+
+def test_counters_are_exact_under_concurrency(exporter, monkeypatch):
+    tail_sampling(monkeypatch, slow_ms=10000)
+    before = tracing.tracing_stats()
+
+    def requests():
+        for _ in range(500):
+            tracing.end_trace(tracing.start_trace('GET /'))
+
+    threads = [threading.Thread(target=requests) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = tracing.tracing_stats()
+    assert stats['traces'] - before['traces'] == 4000
+    assert stats['discarded'] - before['discarded'] == 4000
+    assert (stats['exported'], stats['export_dropped'], stats['export_errors']) == (0, 0, 0)
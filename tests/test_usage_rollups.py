@@ -0,0 +1,112 @@
+"""Usage of users without a billing period lands in, and is read from, one rollup key"""
+
+import json
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+import pytest
+
+import lemonsqueezy
+from lemonsqueezy import UsageTracker
+from rebuild_usage_rollups import move_fallback_usage
+from usage_writer import UNBILLED_PERIOD, UsageWriter
+
+from fakes import FakeConnection
+
+FREE_USER = {
+    'id': 7, 'subscription_status': 'free', 'plan_name': 'Free', 'monthly_quota': 50,
+    'requests_used': 3, 'current_period_start': None, 'current_period_end': None,
+    'overage_enabled': True, 'auto_stop_at_limit': False,
+}
+
+
+class RollupTable:
+    """usage_rollups keyed like its primary key, fed by the upserts the code sends"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def upsert(self, args):
+        key, totals = args[:5], args[5:]
+        row = self.rows.setdefault(key, [0] * len(totals))
+        for i, value in enumerate(totals):
+            row[i] += value
+        return 1
+
+    def select(self, args):
+        user_id, start, end = args
+        names = ('requests', 'overage_requests', 'tokens_used', 'input_tokens',
+                 'output_tokens', 'latency_ms', 'timed_output_tokens')
+        return [dict(zip(names, totals), action_type=key[3], model_id=key[4])
+                for key, totals in self.rows.items() if key[:3] == (user_id, start, end)]
+
+
+@pytest.fixture
+def database(monkeypatch):
+    table = RollupTable()
+    connection = FakeConnection([
+        ('FROM users WHERE id', [FREE_USER]),
+        ('INSERT INTO usage_rollups', table.upsert),
+        ('FROM usage_rollups', table.select),
+    ])
+    monkeypatch.setattr(lemonsqueezy, 'borrow_connection', lambda: nullcontext(connection))
+    return connection, table
+
+
+def test_write_behind_usage_of_unbilled_users_shares_one_period(database):
+    connection, table = database
+    writer = UsageWriter(connection_factory=lambda: nullcontext(connection), flush_interval_ms=10)
+    try:
+        for created_at in ('2026-01-05 10:00:00', '2026-03-20 18:30:00'):
+            assert writer.submit({'user_id': 7, 'action_type': 'chat', 'tokens_used': 30,
+                                  'input_tokens': 20, 'output_tokens': 10, 'model_id': 'amazon.nova-micro-v1:0',
+                                  'created_at': created_at})
+            assert writer.flush()
+    finally:
+        writer.shutdown()
+
+    periods = {(args[9], args[10]) for args in connection.executed('INSERT INTO usage_logs')}
+    assert periods == {(UNBILLED_PERIOD, UNBILLED_PERIOD)}
+    assert list(table.rows) == [(7, UNBILLED_PERIOD, UNBILLED_PERIOD, 'chat', 'amazon.nova-micro-v1:0')]
+
+
+def test_synchronous_log_usage_falls_back_to_the_unbilled_period(database):
+    connection, _ = database
+    assert UsageTracker.log_usage(7, 'chat', usage={'input_tokens': 5, 'output_tokens': 2})['success']
+    args = connection.executed('INSERT INTO usage_logs')[0]
+    assert args[-3:] == (UNBILLED_PERIOD, UNBILLED_PERIOD, 7)
+
+
+def test_usage_stats_of_unbilled_users_read_their_rollup(database):
+    connection, table = database
+    table.upsert((7, UNBILLED_PERIOD, UNBILLED_PERIOD, 'chat', 'amazon.nova-micro-v1:0', 3, 0, 90, 60, 30, 900, 30))
+    table.upsert((7, UNBILLED_PERIOD, UNBILLED_PERIOD, 'ask', '', 1, 0, 1, 0, 0, 0, 0))
+
+    stats = UsageTracker.get_usage_stats(7)
+
+    assert connection.executed('FROM usage_rollups') == [(7, UNBILLED_PERIOD, UNBILLED_PERIOD)]
+    assert {entry['action_type']: entry['count'] for entry in stats['breakdown']} == {'chat': 3, 'ask': 1}
+    assert [model['requests'] for model in stats['models']] == [3]
+
+
+def test_rebuild_moves_only_usage_outside_the_users_subscription_periods():
+    current = datetime(2026, 3, 1, 9, 0, 0)
+    renewed = datetime(2026, 2, 1, 9, 0, 0)   # earlier real period, known from its event
+    made_up = datetime(2026, 1, 12, 14, 3, 27)  # request time of a legacy free-tier row
+    month = timedelta(days=30)
+    event = {'data': {'attributes': {'renews_at': '2026-02-01T09:00:00.000000Z'}}}
+    connection = FakeConnection([
+        ('FROM users WHERE id IN', [{'id': 7, 'current_period_start': current}]),
+        ('FROM subscription_events', [{'user_id': 7, 'payload': json.dumps(event)}]),
+        ('SELECT DISTINCT user_id, billing_period_start', [
+            {'user_id': 7, 'billing_period_start': start, 'billing_period_end': start + month}
+            for start in (current, renewed, made_up)
+        ]),
+        ('UPDATE usage_logs', 4),
+    ])
+
+    with connection.cursor() as cursor:
+        assert move_fallback_usage(cursor, [7]) == 4
+
+    assert connection.executed('UPDATE usage_logs') == [
+        (UNBILLED_PERIOD, UNBILLED_PERIOD, 7, made_up, made_up + month)]
@@ -0,0 +1,205 @@
+"""UsageWriter batching, backpressure, retries, dead-lettering and spool replay against a fake cursor"""
+
+import glob
+import json
+import os
+import threading
+from contextlib import nullcontext
+
+import pymysql
+
+from usage_writer import UsageWriter, _pid_alive
+
+from fakes import FakeConnection
+
+USERS = {
+    1: {'id': 1, 'current_period_start': None, 'current_period_end': None, 'requests_used': 10, 'monthly_quota': 50},
+    2: {'id': 2, 'current_period_start': None, 'current_period_end': None, 'requests_used': 50, 'monthly_quota': 50},
+}
+
+
+def users(args):
+    return [USERS[user_id] for user_id in args if user_id in USERS]
+
+
+def event(user_id, **fields):
+    return dict({'user_id': user_id, 'action_type': 'chat', 'tokens_used': 30, 'input_tokens': 20,
+                 'output_tokens': 10, 'latency_ms': 300, 'model_id': 'amazon.nova-micro-v1:0',
+                 'session_id': 9}, **fields)
+
+
+def make_writer(connection, **settings):
+    settings.setdefault('flush_interval_ms', 20)
+    return UsageWriter(connection_factory=lambda: nullcontext(connection), **settings)
+
+
+def test_queued_events_are_written_in_one_transaction_with_aggregated_counters():
+    connection = FakeConnection([('FROM users WHERE id IN', users)])
+    writer = make_writer(connection, flush_interval_ms=100, batch_size=1000)
+    try:
+        for _ in range(30):
+            assert writer.submit(event(1))
+        for _ in range(20):
+            assert writer.submit(event(2, count_request=False))
+        assert writer.submit(event(404))
+        assert writer.flush()
+    finally:
+        writer.shutdown()
+
+    assert len(connection.executed('FROM users WHERE id IN')) == 1
+    inserted = connection.committed('INSERT INTO usage_logs')
+    assert len(inserted) == 50
+    assert connection.committed('requests_used = requests_used + %s') == [(30, 1)]
+    assert connection.commits == 1
+    # User 2 is at its quota; its reserved requests are not overage, unreserved ones would be
+    assert {row[0]: row[-1] for row in inserted} == {1: False, 2: False}
+    stats = writer.stats()
+    assert (stats['enqueued'], stats['written'], stats['dropped'], stats['batches'], stats['depth']) == (51, 50, 1, 1, 0)
+
+
+def test_reserved_events_keep_the_overage_flag_of_their_reservation():
+    # Later reservations took user 1 past its quota before the flush
+    connection = FakeConnection([('FROM users WHERE id IN',
+                                  [dict(USERS[1], requests_used=70)])])
+    writer = make_writer(connection, flush_interval_ms=100, batch_size=1000)
+    try:
+        assert writer.submit(event(1, count_request=False, is_overage=False))
+        assert writer.submit(event(1, count_request=False, is_overage=True))
+        assert writer.flush()
+    finally:
+        writer.shutdown()
+
+    assert [row[-1] for row in connection.committed('INSERT INTO usage_logs')] == [False, True]
+    assert connection.committed('INSERT INTO usage_rollups')[0][5:7] == (2, 1)
+
+
+def test_full_queue_pushes_back_on_producers():
+    connection = FakeConnection([('FROM users WHERE id IN', users)])
+    gate = threading.Event()
+
+    def blocked():
+        gate.wait(5)
+        return nullcontext(connection)
+
+    writer = UsageWriter(connection_factory=blocked, max_queue=5, batch_size=1,
+                         flush_interval_ms=10, put_timeout_ms=20)
+    try:
+        results = [writer.submit(event(1)) for _ in range(8)]
+        assert results[:5] == [True] * 5
+        assert results[5:] == [False] * 3
+        stats = writer.stats()
+        assert (stats['depth'], stats['rejected'], stats['full_waits']) == (5, 3, 3)
+        gate.set()
+        assert writer.flush()
+    finally:
+        gate.set()
+        writer.shutdown()
+    assert writer.stats()['written'] == 5
+
+
+def test_batches_are_retried_after_a_database_error():
+    connection = FakeConnection([('FROM users WHERE id IN', users)])
+    failures = [ConnectionError("Can't connect to MySQL server")]
+
+    def flaky():
+        if failures:
+            raise failures.pop()
+        return nullcontext(connection)
+
+    writer = UsageWriter(connection_factory=flaky, flush_interval_ms=10)
+    try:
+        writer.submit(event(1))
+        assert writer.flush()
+    finally:
+        writer.shutdown()
+    stats = writer.stats()
+    assert (stats['flush_errors'], stats['written']) == (1, 1)
+
+
+def test_a_batch_failing_on_its_data_is_dead_lettered_and_the_queue_moves_on(tmp_path):
+    def insert(args):
+        if args[6] == 'bad-model':
+            raise pymysql.err.DataError(1406, "Data too long for column 'model_id' at row 1")
+        return 1
+
+    connection = FakeConnection([('FROM users WHERE id IN', users), ('INSERT INTO usage_logs', insert)])
+    dead_letter = tmp_path / 'usage_dead_letter.jsonl'
+    writer = make_writer(connection, flush_interval_ms=10, batch_size=1000, max_batch_attempts=3,
+                         dead_letter_path=str(dead_letter))
+    try:
+        with writer._cond:
+            # One batch holding the bad event between two good ones
+            for model_id in ('good', 'bad-model', 'good'):
+                assert writer.submit(event(1, model_id=model_id))
+        assert writer.flush()
+        assert writer.submit(event(1))
+        assert writer.flush()
+    finally:
+        writer.shutdown()
+
+    assert [args[6] for args in connection.committed('INSERT INTO usage_logs')] == \
+        ['good', 'good', 'amazon.nova-micro-v1:0']
+    [parked] = [json.loads(line) for line in dead_letter.read_text().splitlines()]
+    assert (parked['user_id'], parked['model_id']) == (1, 'bad-model')
+    assert 'Data too long' in parked['error']
+    stats = writer.stats()
+    assert (stats['flush_errors'], stats['dead_lettered'], stats['written'], stats['dropped']) == (3, 1, 3, 0)
+
+
+def test_an_unreachable_database_is_retried_without_dead_lettering(tmp_path):
+    connection = FakeConnection([('FROM users WHERE id IN', users)])
+    failures = [pymysql.err.OperationalError(2003, "Can't connect to MySQL server")] * 4
+
+    def down_for_a_while():
+        if failures:
+            raise failures.pop()
+        return nullcontext(connection)
+
+    dead_letter = tmp_path / 'usage_dead_letter.jsonl'
+    writer = UsageWriter(connection_factory=down_for_a_while, flush_interval_ms=10, max_batch_attempts=2,
+                         dead_letter_path=str(dead_letter))
+    try:
+        writer.submit(event(1))
+        assert writer.flush()
+    finally:
+        writer.shutdown()
+
+    assert not dead_letter.exists()
+    stats = writer.stats()
+    assert (stats['flush_errors'], stats['dead_lettered'], stats['written']) == (4, 0, 1)
+
+
+def dead_pid():
+    pid = 4_000_000
+    while _pid_alive(pid):
+        pid += 1
+    return pid
+
+
+def test_spooled_events_of_a_dead_process_are_replayed(tmp_path):
+    spool = str(tmp_path / 'usage.spool')
+
+    def down():
+        raise ConnectionError("Can't connect to MySQL server")
+
+    crashed = UsageWriter(connection_factory=down, flush_interval_ms=10, spool_path=spool)
+    for user_id in (1, 1, 2):
+        crashed.submit(event(user_id))
+    crashed.shutdown(timeout=1)
+    segments = glob.glob(spool + '.*')
+    assert segments
+    # Hand the spool to a process id that is no longer running
+    for path in segments:
+        os.replace(path, path.replace(f'.{os.getpid()}', f'.{dead_pid()}', 1))
+
+    connection = FakeConnection([('FROM users WHERE id IN', users)])
+    writer = make_writer(connection, spool_path=spool)
+    try:
+        writer.submit(event(2))
+        assert writer.flush()
+    finally:
+        writer.shutdown()
+
+    assert writer.stats()['replayed'] == 3
+    assert len(connection.committed('INSERT INTO usage_logs')) == 4
+    assert glob.glob(spool + '.*') == []
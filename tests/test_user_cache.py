@@ -0,0 +1,133 @@
+"""Cached users and quota plans follow webhook changes and survive a Redis outage"""
+
+import fnmatch
+import json
+
+import app
+import lemonsqueezy
+from cache import RedisCache
+from lemonsqueezy import PRO_PLAN_INCLUDED_REQUESTS, LemonSqueezyService, UsageTracker
+
+IDENTITY_SQL = 'SELECT id, username, email FROM users'
+
+SUBSCRIPTION_CREATED = {
+    'meta': {'event_name': 'subscription_created', 'custom_data': {'user_id': 1}},
+    'data': {'type': 'subscriptions', 'id': '77', 'attributes': {
+        'subscription_id': 77, 'customer_id': 88, 'status': 'active',
+        'created_at': '2026-10-01T00:00:00.000000Z', 'renews_at': '2026-11-01T00:00:00.000000Z',
+    }},
+}
+
+
+class Users:
+    """The users row of user 1, updated by the statements that change it"""
+
+    def __init__(self):
+        self.row = {'id': 1, 'username': 'ada', 'email': 'ada@example.com', 'subscription_status': 'free',
+                    'plan_name': 'Free', 'monthly_quota': 50, 'requests_used': 0,
+                    'overage_enabled': False, 'auto_stop_at_limit': True}
+
+    def select(self, args):
+        return [dict(self.row)]
+
+    def reserve(self, args):
+        self.row['requests_used'] += 1
+        return 1, self.row['requests_used']
+
+    def upgrade(self, args):
+        self.row.update(subscription_status='pro', plan_name='Pro', monthly_quota=args[5], requests_used=0)
+        return 1
+
+
+def identity_lookups(fake_db):
+    return sum(len(connection.executed(IDENTITY_SQL)) for connection in fake_db.connections)
+
+
+def test_webhook_plan_change_is_visible_on_the_next_request(client, fake_db):
+    users = Users()
+    fake_db.responses = [
+        ('FROM subscription_events WHERE id', [{'payload': json.dumps(SUBSCRIPTION_CREATED), 'processed': False}]),
+        ("plan_name = 'Pro'", users.upgrade),
+        ('LAST_INSERT_ID(requests_used + 1)', users.reserve),
+        ('FROM users WHERE id', users.select),
+    ]
+    lemonsqueezy.invalidate_quota_cache(1)
+
+    assert client.get('/api/billing/quota').get_json()['plan'] == 'Free'
+    assert client.get('/api/billing/quota').status_code == 200
+    assert identity_lookups(fake_db) == 1
+    assert UsageTracker.reserve_quota(1)['plan'] == 'Free'
+    assert UsageTracker.reserve_quota(1)['quota'] == 50
+
+    assert LemonSqueezyService().process_stored_event(5) == {'success': True, 'user_id': 1}
+
+    assert app.user_cache.get(1) is None
+    reservation = UsageTracker.reserve_quota(1)
+    assert (reservation['plan'], reservation['quota'], reservation['used']) == ('Pro', PRO_PLAN_INCLUDED_REQUESTS, 1)
+    assert client.get('/api/billing/quota').get_json()['plan'] == 'Pro'
+    assert identity_lookups(fake_db) == 2
+
+
+def test_requests_fall_through_to_the_database_while_redis_is_down(client, fake_db, monkeypatch):
+    users = Users()
+    fake_db.responses = [('FROM users WHERE id', users.select)]
+    now = [0.0]
+    down = RedisCache('redis://127.0.0.1:1/0', 'users', ttl=60, retry_after=5.0, clock=lambda: now[0])
+    monkeypatch.setattr(app, 'user_cache', down)
+
+    for _ in range(3):
+        response = client.get('/api/billing/quota')
+        assert response.status_code == 200
+        assert response.get_json()['plan'] == 'Free'
+
+    assert identity_lookups(fake_db) == 3
+    stats = down.stats()
+    # Refused once, then bypassed until retry_after has passed
+    assert (stats['errors'], stats['hits'], stats['misses']) == (1, 0, 3)
+    assert down.delete(1) is False
+    now[0] = 6.0
+    assert down.get(1) is None
+    assert down.stats()['errors'] == 2
+
+
+def test_clear_and_len_degrade_while_redis_is_down():
+    now = [0.0]
+    down = RedisCache('redis://127.0.0.1:1/0', 'users', retry_after=5.0, clock=lambda: now[0])
+
+    down.clear()
+    assert len(down) == 0
+    # The failed scan counts as the outage; neither call waits on Redis again
+    assert down.stats()['errors'] == 1
+
+
+class StubRedis:
+    """The few redis.Redis commands RedisCache uses, over a dict"""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, name):
+        return self.data.get(name)
+
+    def set(self, name, value, px=None):
+        self.data[name] = value.encode()
+
+    def delete(self, *names):
+        return sum(self.data.pop(name, None) is not None for name in names)
+
+    def scan_iter(self, match, count):
+        yield from [name for name in list(self.data) if fnmatch.fnmatchcase(name, match)]
+
+
+def test_clear_and_len_cover_only_the_cache_namespace():
+    users = RedisCache('redis://127.0.0.1:1/0', 'users')
+    plans = RedisCache('redis://127.0.0.1:1/0', 'quota_plans')
+    users._client = plans._client = StubRedis()
+    for user_id in range(3):
+        users.set(user_id, {'id': user_id})
+    plans.set(1, {'plan_name': 'Pro'})
+
+    assert (len(users), len(plans)) == (3, 1)
+    users.clear()
+    assert (len(users), len(plans)) == (0, 1)
+    assert plans.get(1) == {'plan_name': 'Pro'}
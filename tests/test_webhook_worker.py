@@ -0,0 +1,234 @@
+"""Webhook queue: deduplicated storage, per-subscription ordering, retries and claims"""
+
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+import pymysql
+
+import webhook_worker
+from lemonsqueezy import LemonSqueezyService
+from webhook_worker import WebhookWorkerPool
+
+from fakes import FakeConnection
+
+
+class EventsTable:
+    """subscription_events rows answering the queue's statements through FakeConnection responses"""
+
+    def __init__(self):
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def add(self, subscription_id, **columns):
+        row_id = len(self.rows) + 1
+        self.rows[row_id] = dict({
+            'id': row_id, 'subscription_id': subscription_id, 'event_id': f'evt-{row_id}',
+            'event_type': 'subscription_updated', 'processed': False, 'failed': False, 'attempts': 0,
+            'next_attempt_at': None, 'locked_by': None, 'locked_at': None, 'last_error': None,
+        }, **columns)
+        return row_id
+
+    def responses(self):
+        return [
+            ('INSERT IGNORE INTO subscription_events', lambda args: self.insert(args, ignore=True)),
+            ('INSERT INTO subscription_events', self.insert),
+            ('SELECT e.id FROM subscription_events e', self.claimable),
+            ('SET locked_by = %s, locked_at = %s', self.lock_row),
+            ('SELECT attempts FROM subscription_events', lambda args: [{'attempts': self.rows[args[0]]['attempts']}]),
+            ('SET attempts = %s, last_error = %s', self.schedule),
+        ]
+
+    def connection(self):
+        return FakeConnection(self.responses())
+
+    def insert(self, args, ignore=False):
+        event_type, subscription_id, event_id, payload = args
+        with self.lock:
+            for row in self.rows.values():
+                if row['event_id'] == event_id:
+                    return 0, row['id']
+            if event_type is None:
+                if ignore:
+                    # INSERT IGNORE turns the error into a warning and stores nothing
+                    return 0, 0
+                raise pymysql.IntegrityError(1048, "Column 'event_type' cannot be null")
+            return 1, self.add(subscription_id, event_id=event_id, event_type=event_type)
+
+    def claimable(self, args):
+        now, stale, limit = args
+        with self.lock:
+            pending = [row for row in self.rows.values() if not row['processed'] and not row['failed']]
+            due = [
+                row for row in pending
+                if (row['next_attempt_at'] is None or row['next_attempt_at'] <= now)
+                and (row['locked_at'] is None or row['locked_at'] < stale)
+                and not any(other['subscription_id'] == row['subscription_id'] and other['id'] < row['id']
+                            for other in pending)
+            ]
+            return [{'id': row['id']} for row in sorted(due, key=lambda row: row['id'])[:limit]]
+
+    def lock_row(self, args):
+        worker_id, now, row_id, stale = args
+        with self.lock:
+            row = self.rows[row_id]
+            if row['processed'] or (row['locked_at'] is not None and row['locked_at'] >= stale):
+                return 0
+            row.update(locked_by=worker_id, locked_at=now)
+            return 1
+
+    def schedule(self, args):
+        attempts, error, failed, next_attempt_at, row_id = args
+        with self.lock:
+            self.rows[row_id].update(attempts=attempts, last_error=error, failed=failed,
+                                     next_attempt_at=next_attempt_at, locked_by=None, locked_at=None)
+        return 1
+
+    def process(self, row_id):
+        with self.lock:
+            self.rows[row_id].update(processed=True, locked_by=None, locked_at=None)
+
+
+class FakeService:
+    """process_stored_event that applies events, or fails those listed in `failing`"""
+
+    def __init__(self, table, failing=()):
+        self.table = table
+        self.failing = set(failing)
+        self.applied = []
+
+    def process_stored_event(self, row_id):
+        if row_id in self.failing:
+            return {'success': False, 'error': 'Missing user_id'}
+        self.applied.append(row_id)
+        self.table.process(row_id)
+        return {'success': True}
+
+
+def make_pool(table, service, **settings):
+    settings.setdefault('workers', 1)
+    return WebhookWorkerPool(service=service, connection_factory=lambda: nullcontext(table.connection()),
+                             **settings)
+
+
+def webhook(event_id, event_name='subscription_updated'):
+    return {'meta': {'event_name': event_name, 'webhook_id': event_id},
+            'data': {'id': 'sub-1', 'attributes': {'user_email': 'ada@example.com'}}}
+
+
+def test_a_redelivered_event_is_stored_once(fake_db):
+    table = EventsTable()
+    fake_db.responses = table.responses()
+    service = LemonSqueezyService()
+
+    first = service.enqueue_webhook_event(webhook('wh-1'))
+    again = service.enqueue_webhook_event(webhook('wh-1'))
+
+    assert (first['success'], first['duplicate']) == (True, False)
+    assert (again['success'], again['duplicate'], again['id']) == (True, True, first['id'])
+    assert len(table.rows) == 1
+
+
+def test_an_event_that_cannot_be_stored_is_an_error_not_a_duplicate(fake_db):
+    table = EventsTable()
+    fake_db.responses = table.responses()
+
+    result = LemonSqueezyService().enqueue_webhook_event(webhook('wh-2', event_name=None))
+
+    assert result['success'] is False
+    assert 'cannot be null' in result['error']
+    assert table.rows == {}
+
+
+def test_later_events_of_a_subscription_wait_for_earlier_ones():
+    table = EventsTable()
+    first, second, other = table.add('sub-a'), table.add('sub-a'), table.add('sub-b')
+    service = FakeService(table, failing={first})
+    pool = make_pool(table, service)
+
+    assert pool._claim() == [first, other]
+    for row_id in (first, other):
+        pool._process(row_id)
+    # The first event failed and waits for its retry; the second stays behind it
+    table.rows[first]['next_attempt_at'] = None
+    assert pool._claim() == [first]
+
+    service.failing.clear()
+    pool._process(first)
+    assert pool._claim() == [second]
+    pool._process(second)
+    assert service.applied == [other, first, second]
+
+
+def test_a_failed_event_no_longer_blocks_its_subscription():
+    table = EventsTable()
+    first, second = table.add('sub-a', failed=True), table.add('sub-a')
+    assert make_pool(table, FakeService(table))._claim() == [second]
+    assert not table.rows[first]['locked_by']
+
+
+def test_failures_back_off_and_end_in_failed(monkeypatch):
+    monkeypatch.setattr(webhook_worker.random, 'uniform', lambda low, high: 1.0)
+    table = EventsTable()
+    row_id = table.add('sub-a')
+    pool = make_pool(table, FakeService(table, failing={row_id}), max_attempts=5)
+    row = table.rows[row_id]
+
+    delays = []
+    for attempt in range(1, 6):
+        assert pool._claim() == [row_id]
+        before = datetime.now()
+        pool._process(row_id)
+        assert (row['attempts'], row['last_error'], row['locked_by']) == (attempt, 'Missing user_id', None)
+        delays.append((row['next_attempt_at'] - before).total_seconds())
+        if attempt < 5:
+            assert not row['failed']
+            # Not due before its backoff runs out
+            assert pool._claim() == []
+            row['next_attempt_at'] = None
+
+    base = webhook_worker.WEBHOOK_RETRY_BASE_MS / 1000
+    assert [round(delay / base) for delay in delays[:4]] == [1, 2, 4, 8]
+    assert row['failed']
+    row['next_attempt_at'] = None
+    assert pool._claim() == []
+    stats = pool.stats()
+    assert (stats['retried'], stats['failed'], stats['processed']) == (4, 1, 0)
+
+
+def test_retry_delay_is_capped():
+    assert webhook_worker.retry_delay(20, base_ms=1000, max_ms=30000) <= 30
+
+
+def test_stale_claims_expire():
+    table = EventsTable()
+    now = datetime.now()
+    abandoned = table.add('sub-a', locked_by='crashed:1', locked_at=now - timedelta(seconds=400))
+    held = table.add('sub-b', locked_by='busy:2', locked_at=now - timedelta(seconds=10))
+    pool = make_pool(table, FakeService(table), claim_timeout=300)
+
+    assert pool._claim() == [abandoned]
+    assert table.rows[abandoned]['locked_by'] == pool._worker_id
+    assert table.rows[held]['locked_by'] == 'busy:2'
+
+
+def test_worker_threads_apply_each_subscription_in_order():
+    table = EventsTable()
+    rows = [table.add(subscription) for subscription in ('a', 'b', 'a', 'c', 'b', 'a', 'c', 'a')]
+    service = FakeService(table)
+    pool = make_pool(table, service, workers=3, poll_interval_ms=10, batch_size=2)
+    pool.start()
+    try:
+        pool.notify()
+        deadline = time.monotonic() + 5
+        while len(service.applied) < len(rows) and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        pool.shutdown()
+
+    assert sorted(service.applied) == rows
+    for subscription in 'abc':
+        ids = [row_id for row_id in service.applied if table.rows[row_id]['subscription_id'] == subscription]
+        assert ids == sorted(ids)
+    assert pool.stats()['processed'] == len(rows)
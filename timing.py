@@ -0,0 +1,56 @@
+"""
+Request stage timing for ZED AI
+Records how long each stage of a request takes, logs the breakdown and
+feeds the stage histograms served on /metrics
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimer:
+    """
+    Wall-clock durations of the named stages of one request
+
+    Stages may overlap (e.g. a background search running during history
+    loading); each is recorded with its own duration and the total is the
+    time since the timer was created.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.monotonic()
+        self.stages = []  # (stage, milliseconds) in completion order
+
+    @contextmanager
+    def stage(self, stage: str):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.monotonic() - started) * 1000)
+
+    def record(self, stage: str, ms: float):
+        self.stages.append((stage, ms))
+
+    def total_ms(self) -> float:
+        return (time.monotonic() - self.started) * 1000
+
+    def log(self, **fields):
+        """
+        Record every stage and the total in the metrics histograms (labelled
+        with the `model_id` field, if any) and log them with any extra fields
+        """
+        total_ms = self.total_ms()
+        metrics.observe_stages(self.name, self.stages, total_ms, fields.get('model_id'))
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        timings = {f"{stage}_ms": round(ms) for stage, ms in self.stages}
+        timings['total_ms'] = round(total_ms)
+        timings.update(fields)
+        logger.info("%s timings", self.name, extra={'fields': timings})
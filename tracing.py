@@ -0,0 +1,503 @@
+"""
+Request tracing for ZED AI
+Nested spans for a request's DB queries, Bedrock calls, web searches and
+LemonSqueezy requests, sampled at the head (a fraction of all requests)
+and at the tail (slow or failed requests), and handed to a pluggable
+exporter (in-memory, JSON lines or OTLP/HTTP) by a background thread
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Tracing configuration
+# 'none' (tracing off), 'memory', 'jsonl' or 'otlp'
+TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'none')
+TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.getenv('TRACE_OTLP_ENDPOINT', 'http://127.0.0.1:4318/v1/traces')
+TRACE_SERVICE_NAME = os.getenv('TRACE_SERVICE_NAME', 'zed-ai')
+# Head sampling: fraction of requests traced regardless of outcome (a
+# sampled W3C traceparent from the caller is always honored)
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0.01))
+# Tail sampling: every request records its spans and is kept if it took at
+# least TRACE_TAIL_SLOW_MS (0 disables) or failed; the rest are discarded
+TRACE_TAIL_SLOW_MS = float(os.getenv('TRACE_TAIL_SLOW_MS', 2000))
+TRACE_TAIL_ERRORS = os.getenv('TRACE_TAIL_ERRORS', 'true').lower() == 'true'
+# Spans kept per trace, and finished traces waiting for the exporter
+TRACE_MAX_SPANS = int(os.getenv('TRACE_MAX_SPANS', 256))
+TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', 1000))
+
+TAIL_SAMPLING = TRACE_TAIL_SLOW_MS > 0 or TRACE_TAIL_ERRORS
+
+_TRACEPARENT = re.compile(r'00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})')
+_SQL_STRINGS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_SQL_NUMBERS = re.compile(r'\b\d+(?:\.\d+)?\b')
+_SQL_IN_LISTS = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))+\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+SQL_MAX_CHARS = 500
+
+
+def _new_id(bits: int) -> str:
+    return f'{random.getrandbits(bits):0{bits // 4}x}'
+
+def normalize_sql(sql) -> str:
+    """
+    Statement shape for span names and grouping: literals and placeholder
+    lists collapsed to ?, whitespace squeezed, cut to SQL_MAX_CHARS
+    """
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8', 'replace')
+    sql = _SQL_STRINGS.sub('?', sql)
+    sql = _SQL_NUMBERS.sub('?', sql)
+    sql = _SQL_IN_LISTS.sub('(?)', sql.replace('%s', '?'))
+    sql = _WHITESPACE.sub(' ', sql).strip()
+    return sql[:SQL_MAX_CHARS]
+
+
+class Trace:
+    """Spans of one request and whether they are kept"""
+
+    __slots__ = ('trace_id', 'request_id', 'sampled', 'spans', 'dropped_spans', 'finished')
+
+    def __init__(self, trace_id, request_id, sampled):
+        self.trace_id = trace_id
+        self.request_id = request_id
+        self.sampled = sampled
+        self.spans = []
+        self.dropped_spans = 0
+        self.finished = False
+
+
+class Span:
+    """One timed operation; ended exactly once"""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'start_ns', 'end_ns', 'error')
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = error if isinstance(error, str) else f'{type(error).__name__}: {error}'
+        trace = self.trace
+        # Spans outliving their trace (e.g. a search that missed its budget) are not exported
+        if trace.finished or len(trace.spans) >= TRACE_MAX_SPANS:
+            trace.dropped_spans += 1
+        else:
+            trace.spans.append(self)
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def to_dict(self) -> Dict:
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': round(self.duration_ms, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class _NoopSpan:
+    """Stands in for a span when the request is not being traced"""
+
+    __slots__ = ()
+    span_id = None
+    error = None
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current = contextvars.ContextVar('trace_span', default=None)
+
+
+# ----------------------------------------------------------------------
+# Exporters
+# ----------------------------------------------------------------------
+
+class InMemoryExporter:
+    """Keeps the most recent finished traces as lists of span dicts (for tests and debugging)"""
+
+    def __init__(self, max_traces=1000):
+        self.max_traces = max_traces
+        self.traces = []
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Dict]):
+        with self._lock:
+            self.traces.append(spans)
+            del self.traces[:-self.max_traces]
+
+    def clear(self):
+        with self._lock:
+            self.traces.clear()
+
+    def close(self):
+        pass
+
+
+class JsonlExporter:
+    """Appends one JSON object per span to a file"""
+
+    def __init__(self, path=TRACE_FILE):
+        self.path = path
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def export(self, spans: List[Dict]):
+        self._file.write(''.join(json.dumps(span, ensure_ascii=False, default=str) + '\n' for span in spans))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _otlp_value(value) -> Dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+class OtlpExporter:
+    """
+    Posts traces to an OTLP/HTTP collector in the protobuf-JSON encoding
+    (e.g. http://collector:4318/v1/traces); no OpenTelemetry SDK needed
+    """
+
+    def __init__(self, endpoint=TRACE_OTLP_ENDPOINT, service_name=TRACE_SERVICE_NAME, timeout=5):
+        import requests
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def encode(self, spans: List[Dict]) -> Dict:
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]},
+            'scopeSpans': [{
+                'scope': {'name': __name__},
+                'spans': [{
+                    'traceId': span['trace_id'],
+                    'spanId': span['span_id'],
+                    'parentSpanId': span['parent_id'] or '',
+                    'name': span['name'],
+                    # 2 = server for the request's root span, 1 = internal
+                    'kind': 1 if span['parent_id'] else 2,
+                    'startTimeUnixNano': str(span['start_ns']),
+                    'endTimeUnixNano': str(span['end_ns']),
+                    'attributes': [{'key': key, 'value': _otlp_value(value)}
+                                   for key, value in span['attributes'].items() if value is not None],
+                    'status': {'code': 2, 'message': span['error']} if span['error'] else {'code': 1},
+                } for span in spans],
+            }],
+        }]}
+
+    def export(self, spans: List[Dict]):
+        response = self.session.post(self.endpoint, json=self.encode(spans), timeout=self.timeout)
+        response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+EXPORTERS = {
+    'memory': InMemoryExporter,
+    'jsonl': JsonlExporter,
+    'otlp': OtlpExporter,
+}
+
+
+class _ExportQueue:
+    """Bounded queue of finished traces drained by one background thread"""
+
+    def __init__(self, exporter, queue_size=TRACE_QUEUE_SIZE):
+        self.exporter = exporter
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.exported = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def _ensure_thread(self):
+        # A forked worker inherits the queue but not the thread
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+                self._thread.start()
+
+    def put(self, trace: Trace):
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            with self._stats_lock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            trace = self._queue.get()
+            try:
+                if trace is None:
+                    return
+                self.exporter.export([span.to_dict() for span in trace.spans])
+                with self._stats_lock:
+                    self.exported += 1
+            except Exception as e:
+                with self._stats_lock:
+                    self.errors += 1
+                logger.warning("Trace export failed: %s", e)
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {'exported': self.exported, 'export_dropped': self.dropped, 'export_errors': self.errors}
+
+    def flush(self, timeout=5.0) -> bool:
+        """Wait until every queued trace is exported; False on timeout"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def close(self):
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+        self.exporter.close()
+
+
+_export_queue = None
+_export_lock = threading.Lock()
+_stats = {'traces': 0, 'kept': 0, 'discarded': 0}
+_stats_lock = threading.Lock()
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+def set_exporter(exporter):
+    """Install `exporter` (anything with export(spans) and close()); None turns tracing off"""
+    global _export_queue
+    with _export_lock:
+        previous, _export_queue = _export_queue, (_ExportQueue(exporter) if exporter is not None else None)
+    if previous is not None:
+        previous.close()
+
+def get_exporter():
+    return _export_queue.exporter if _export_queue is not None else None
+
+def configure_tracing(exporter=TRACE_EXPORTER):
+    """Build the exporter named by TRACE_EXPORTER; 'none' leaves tracing off"""
+    if exporter == 'none' or _export_queue is not None:
+        return
+    set_exporter(EXPORTERS[exporter]())
+    atexit.register(flush)
+
+def flush(timeout=5.0) -> bool:
+    return _export_queue.flush(timeout) if _export_queue is not None else True
+
+def tracing_stats() -> Dict:
+    """Traces started, kept and discarded by sampling, and exporter queue counts"""
+    with _stats_lock:
+        stats = dict(_stats)
+    export_queue = _export_queue
+    if export_queue is not None:
+        stats.update(export_queue.stats())
+    return stats
+
+
+# ----------------------------------------------------------------------
+# Spans
+# ----------------------------------------------------------------------
+
+def start_trace(name: str, request_id: Optional[str] = None, traceparent: Optional[str] = None, **attributes):
+    """
+    Begin the trace of a request and make its root span current
+
+    Returns NOOP_SPAN when tracing is off, or when the request is neither
+    head-sampled nor subject to tail sampling. A W3C `traceparent` header
+    continues the caller's trace ID.
+    """
+    if _export_queue is None:
+        _current.set(None)
+        return NOOP_SPAN
+    trace_id = parent_id = None
+    sampled = False
+    match = _TRACEPARENT.fullmatch(traceparent or '')
+    if match:
+        trace_id, parent_id = match.group(1), match.group(2)
+        sampled = bool(int(match.group(3), 16) & 1)
+    if not sampled:
+        sampled = random.random() < TRACE_SAMPLE_RATE
+    _count('traces')
+    if not sampled and not TAIL_SAMPLING:
+        _count('discarded')
+        _current.set(None)
+        return NOOP_SPAN
+    if request_id:
+        attributes['request_id'] = request_id
+    root = Span(Trace(trace_id or _new_id(128), request_id, sampled), name, parent_id, attributes)
+    _current.set(root)
+    return root
+
+def end_trace(root, error=None):
+    """End the root span and export the trace if the sampling policy keeps it"""
+    _current.set(None)
+    if root is NOOP_SPAN or root is None:
+        return
+    root.end(error)
+    trace = root.trace
+    trace.finished = True
+    keep = (trace.sampled
+            or (TRACE_TAIL_ERRORS and any(span.error for span in trace.spans))
+            or (TRACE_TAIL_SLOW_MS > 0 and root.duration_ms >= TRACE_TAIL_SLOW_MS))
+    export_queue = _export_queue
+    if keep and export_queue is not None:
+        _count('kept')
+        export_queue.put(trace)
+    else:
+        _count('discarded')
+
+def current_span():
+    return _current.get() or NOOP_SPAN
+
+def start_span(name: str, **attributes):
+    """
+    Start a child of the current span without making it current, for
+    callback-style hooks that end it elsewhere
+    """
+    parent = _current.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+class span:
+    """
+    Context manager timing its block as a child of the current span, which
+    it becomes for the duration; exceptions mark it failed
+    """
+
+    __slots__ = ('name', 'attributes', '_span', '_token')
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self._token = None
+
+    def __enter__(self):
+        parent = _current.get()
+        if parent is None:
+            self._span = NOOP_SPAN
+            return NOOP_SPAN
+        self._span = Span(parent.trace, self.name, parent.span_id, self.attributes)
+        self._token = _current.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._token is not None:
+            _current.reset(self._token)
+            self._span.end(exc)
+        return False
+
+def recording() -> bool:
+    """Whether spans started now would be recorded (lets callers skip building attributes)"""
+    return _current.get() is not None
+
+def traceparent() -> Optional[str]:
+    """W3C traceparent header for an outbound call from the current span"""
+    current = _current.get()
+    if current is None:
+        return None
+    return f'00-{current.trace.trace_id}-{current.span_id}-{"01" if current.trace.sampled else "00"}'
+
+
+# ----------------------------------------------------------------------
+# botocore
+# ----------------------------------------------------------------------
+
+def _before_parameter_build(params, context, **kwargs):
+    # before-call only sees the serialized request, so note the model here
+    context['trace_model_id'] = params.get('modelId')
+
+def _before_call(model, context, **kwargs):
+    if _current.get() is None:
+        return
+    context['trace_span'] = start_span(
+        f"{model.service_model.service_name}.{model.name}",
+        **{'rpc.service': model.service_model.service_name, 'rpc.method': model.name,
+           'model_id': context.get('trace_model_id')}
+    )
+
+def _after_call(http_response, parsed, context, **kwargs):
+    span_ = context.pop('trace_span', None)
+    if span_ is None:
+        return
+    metadata = parsed.get('ResponseMetadata', {})
+    span_.set(**{'http.status_code': http_response.status_code,
+                 'aws.request_id': metadata.get('RequestId'),
+                 'retries': metadata.get('RetryAttempts', 0)})
+    error = parsed.get('Error', {}).get('Code')
+    if error is None and http_response.status_code >= 400:
+        error = f'HTTP {http_response.status_code}'
+    span_.end(error)
+
+def _after_call_error(exception, context, **kwargs):
+    span_ = context.pop('trace_span', None)
+    if span_ is not None:
+        span_.end(exception)
+
+def instrument_botocore(client):
+    """Record a span for every API call `client` makes, retries included"""
+    events = client.meta.events
+    events.register('before-parameter-build.*.*', _before_parameter_build, unique_id='zed-trace-parameters')
+    events.register('before-call.*.*', _before_call, unique_id='zed-trace-before-call')
+    events.register('after-call.*.*', _after_call, unique_id='zed-trace-after-call')
+    events.register('after-call-error.*.*', _after_call_error, unique_id='zed-trace-after-call-error')
+    return client
@@ -0,0 +1,532 @@
+"""
+Write-behind usage logging for ZED AI
+Queues usage_logs rows in process and writes them in batches from a
+background thread, off the chat response path
+"""
+
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import pymysql
+
+from database import PoolTimeout, borrow_connection
+
+logger = logging.getLogger(__name__)
+
+# Write-behind configuration
+USAGE_WRITE_BEHIND = os.getenv('USAGE_WRITE_BEHIND', 'true').lower() == 'true'
+USAGE_QUEUE_SIZE = int(os.getenv('USAGE_QUEUE_SIZE', 10000))
+USAGE_BATCH_SIZE = int(os.getenv('USAGE_BATCH_SIZE', 500))
+USAGE_FLUSH_INTERVAL_MS = int(os.getenv('USAGE_FLUSH_INTERVAL_MS', 200))
+USAGE_PUT_TIMEOUT_MS = int(os.getenv('USAGE_PUT_TIMEOUT_MS', 50))
+# Append-only spool for queued events; empty disables it
+USAGE_SPOOL_PATH = os.getenv('USAGE_SPOOL_PATH', '')
+# A batch failing this many times for a reason other than the database
+# being unreachable is written event by event, and the events that still
+# fail are parked as JSON lines in the dead-letter file
+USAGE_MAX_BATCH_ATTEMPTS = int(os.getenv('USAGE_MAX_BATCH_ATTEMPTS', 5))
+USAGE_DEAD_LETTER_PATH = os.getenv('USAGE_DEAD_LETTER_PATH', 'usage_dead_letter.jsonl')
+
+# Longest wait between retries while the database is unavailable
+MAX_RETRY_DELAY = 5.0
+
+# Billing period key of usage by users without a subscription period. It is
+# one fixed value, not the time of the request, so their usage accumulates in
+# one rollup per action type and model, as their requests_used counter does.
+UNBILLED_PERIOD = datetime(2000, 1, 1)
+
+INSERT_USAGE_SQL = """
+    INSERT INTO usage_logs
+    (user_id, action_type, tokens_used, input_tokens, output_tokens,
+     latency_ms, model_id, session_id, created_at, billing_period_start,
+     billing_period_end, is_overage)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+ROLLUP_COLUMNS = """
+    (user_id, billing_period_start, billing_period_end, action_type, model_id,
+     requests, overage_requests, tokens_used, input_tokens, output_tokens,
+     latency_ms, timed_output_tokens)
+"""
+
+# Adds the inserted totals to an existing usage_rollups row
+ROLLUP_ON_DUPLICATE = """
+    ON DUPLICATE KEY UPDATE
+        requests = requests + VALUES(requests),
+        overage_requests = overage_requests + VALUES(overage_requests),
+        tokens_used = tokens_used + VALUES(tokens_used),
+        input_tokens = input_tokens + VALUES(input_tokens),
+        output_tokens = output_tokens + VALUES(output_tokens),
+        latency_ms = latency_ms + VALUES(latency_ms),
+        timed_output_tokens = timed_output_tokens + VALUES(timed_output_tokens)
+"""
+
+UPSERT_ROLLUP_SQL = (
+    "INSERT INTO usage_rollups" + ROLLUP_COLUMNS
+    + "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)" + ROLLUP_ON_DUPLICATE
+)
+
+
+def rollup_rows(rows):
+    """
+    Aggregate usage_logs rows (in INSERT_USAGE_SQL column order) into
+    usage_rollups upsert rows, sorted by key so concurrent writers lock
+    rollup rows in the same order
+    """
+    totals = {}
+    for (user_id, action_type, tokens_used, input_tokens, output_tokens, latency_ms,
+         model_id, _session_id, _created_at, period_start, period_end, is_overage) in rows:
+        key = (user_id, period_start, period_end, action_type, model_id or '')
+        total = totals.setdefault(key, [0, 0, 0, 0, 0, 0, 0])
+        total[0] += 1
+        total[1] += 1 if is_overage else 0
+        total[2] += tokens_used or 0
+        total[3] += input_tokens or 0
+        total[4] += output_tokens or 0
+        if latency_ms is not None:
+            total[5] += latency_ms
+            total[6] += output_tokens or 0
+    return [key + tuple(total) for key, total in sorted(totals.items(), key=lambda item: item[0])]
+
+
+def _transient(error) -> bool:
+    """Whether a write failed because the database was unreachable rather than because of the batch"""
+    return isinstance(error, (pymysql.err.OperationalError, pymysql.err.InterfaceError, PoolTimeout, OSError))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class UsageWriter:
+    """
+    Bounded in-process queue of usage events with a background flusher
+
+    submit() appends an event (and, with a spool path, one JSON line to this
+    process's spool file) and returns immediately. The flusher wakes every
+    `flush_interval_ms` or as soon as `batch_size` events are queued and
+    writes everything queued in one transaction: a multi-row INSERT into
+    usage_logs, one upsert per usage_rollups row touched and one aggregated
+    requests_used UPDATE per user.
+
+    The spool file is rotated into a segment each time the queue is drained
+    and the segment is deleted once its events are committed, so segments on
+    disk are exactly the events not yet written. Segments left behind by a
+    crashed process are replayed when the next writer starts. Delivery is
+    at-least-once: a crash between commit and segment deletion replays that
+    batch.
+
+    When queued plus unwritten events reach `max_queue`, submit() waits up
+    to `put_timeout_ms` for room and then returns False, leaving the caller
+    to write synchronously.
+
+    While the database is unreachable the oldest batch is retried with
+    backoff indefinitely. A batch failing for any other reason (a bad value,
+    a constraint) `max_batch_attempts` times is written one event at a time
+    instead, and the events that still fail are appended to
+    `dead_letter_path` so the batches behind them can go through.
+    """
+
+    def __init__(self, connection_factory=borrow_connection, max_queue=USAGE_QUEUE_SIZE,
+                 batch_size=USAGE_BATCH_SIZE, flush_interval_ms=USAGE_FLUSH_INTERVAL_MS,
+                 put_timeout_ms=USAGE_PUT_TIMEOUT_MS, spool_path=USAGE_SPOOL_PATH,
+                 max_batch_attempts=USAGE_MAX_BATCH_ATTEMPTS, dead_letter_path=USAGE_DEAD_LETTER_PATH):
+        self.connection_factory = connection_factory
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.put_timeout = put_timeout_ms / 1000
+        self.spool_path = spool_path or None
+        self.max_batch_attempts = max_batch_attempts
+        self.dead_letter_path = dead_letter_path
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._queue = []
+        self._pending = deque()  # (segment path or None, events) awaiting a commit
+        self._pending_count = 0
+        self._head_failures = 0  # non-transient failures of the oldest pending batch
+        self._spool = None
+        self._segment_seq = 0
+        self._thread = None
+        self._pid = os.getpid()
+        self._stopping = False
+        self._enqueued = 0
+        self._written = 0
+        self._batches = 0
+        self._flush_errors = 0
+        self._rejected = 0
+        self._full_waits = 0
+        self._dropped = 0
+        self._replayed = 0
+        self._dead_lettered = 0
+        self._max_depth = 0
+        self._last_flush_ms = 0.0
+        self._last_flush_at = None
+
+    # ------------------------------------------------------------------
+    # Producer side
+    # ------------------------------------------------------------------
+
+    def submit(self, event) -> bool:
+        """
+        Queue one usage event
+
+        `event` holds the usage_logs columns (user_id, action_type,
+        tokens_used, input_tokens, output_tokens, latency_ms, model_id,
+        session_id), is_overage, and count_request (whether to add it to
+        users.requests_used). is_overage of a request counted by
+        reserve_quota must be the reservation's flag; requests_used may
+        include later reservations by the time the batch is written.
+        Returns False if the queue stayed full.
+        """
+        self._ensure_started()
+        event = dict(event)
+        event.setdefault('created_at', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        deadline = time.monotonic() + self.put_timeout
+        with self._cond:
+            if self._depth() >= self.max_queue:
+                self._full_waits += 1
+            while self._depth() >= self.max_queue:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._rejected += 1
+                    return False
+                self._cond.wait(remaining)
+
+            if self.spool_path:
+                try:
+                    spool = self._open_spool()
+                    spool.write(json.dumps(event, default=str) + '\n')
+                    spool.flush()
+                except OSError as e:
+                    logger.error(f"Usage spool write error: {e}")
+            self._queue.append(event)
+            self._enqueued += 1
+            self._max_depth = max(self._max_depth, self._depth())
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def _depth(self):
+        return len(self._queue) + self._pending_count
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid != os.getpid():
+                # Forked: the parent still owns its queue and spool file
+                self._reset()
+            if self._thread is None:
+                if self.spool_path:
+                    self._claim_orphaned_segments()
+                self._thread = threading.Thread(target=self._run, name='usage-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.shutdown)
+
+    # ------------------------------------------------------------------
+    # Spool
+    # ------------------------------------------------------------------
+
+    def _active_spool_path(self):
+        return f"{self.spool_path}.{self._pid}"
+
+    def _open_spool(self):
+        if self._spool is None:
+            self._spool = open(self._active_spool_path(), 'a', encoding='utf-8')
+        return self._spool
+
+    def _rotate_spool(self):
+        """Turn the active spool file into a segment holding the events being drained"""
+        if self._spool is None:
+            return None
+        self._spool.close()
+        self._spool = None
+        self._segment_seq += 1
+        segment = f"{self._active_spool_path()}.{self._segment_seq}"
+        try:
+            os.replace(self._active_spool_path(), segment)
+        except OSError as e:
+            logger.error(f"Usage spool rotate error: {e}")
+            return None
+        return segment
+
+    def _claim_orphaned_segments(self):
+        """Queue spool files of processes that are no longer running for replay"""
+        prefix = f"{self.spool_path}."
+        for path in sorted(glob.glob(f"{glob.escape(self.spool_path)}.*")):
+            owner = path[len(prefix):].split('.', 1)[0]
+            if not owner.isdigit() or int(owner) == self._pid or _pid_alive(int(owner)):
+                continue
+            self._segment_seq += 1
+            claimed = f"{self._active_spool_path()}.{self._segment_seq}"
+            try:
+                os.replace(path, claimed)
+                with open(claimed, encoding='utf-8') as f:
+                    events = [json.loads(line) for line in f if line.strip()]
+            except FileNotFoundError:
+                continue  # claimed by another process first
+            except (OSError, ValueError) as e:
+                logger.error(f"Usage spool replay error for {path}: {e}")
+                continue
+            if events:
+                self._pending.append((claimed, events))
+                self._pending_count += len(events)
+                self._replayed += len(events)
+            else:
+                os.remove(claimed)
+        if self._replayed:
+            logger.info(f"Replaying {self._replayed} spooled usage events")
+
+    # ------------------------------------------------------------------
+    # Flusher
+    # ------------------------------------------------------------------
+
+    def _run(self):
+        retry_delay = self.flush_interval
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._queue) < self.batch_size and not self._stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                stopping = self._stopping
+                if self._queue:
+                    self._pending.append((self._rotate_spool(), self._queue))
+                    self._pending_count += len(self._queue)
+                    self._queue = []
+
+            if self._write_pending():
+                retry_delay = self.flush_interval
+            elif stopping:
+                return
+            else:
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+
+            if stopping:
+                with self._cond:
+                    if not self._queue:
+                        return
+
+    def _write_pending(self) -> bool:
+        """Write unwritten batches oldest first; False if the database failed"""
+        while self._pending:
+            segment, events = self._pending[0]
+            started = time.monotonic()
+            parked = 0
+            try:
+                written = self._write(events)
+            except Exception as e:
+                with self._cond:
+                    self._flush_errors += 1
+                logger.error(f"Usage flush error ({len(events)} events): {e}")
+                if _transient(e):
+                    return False
+                self._head_failures += 1
+                if self._head_failures < self.max_batch_attempts:
+                    return False
+                try:
+                    written, parked = self._write_each(events)
+                except Exception as e:
+                    logger.error(f"Usage flush error while isolating a failing batch: {e}")
+                    return False
+            self._head_failures = 0
+
+            if segment:
+                try:
+                    os.remove(segment)
+                except OSError as e:
+                    logger.error(f"Usage spool cleanup error: {e}")
+            with self._cond:
+                self._pending.popleft()
+                self._pending_count -= len(events)
+                self._written += written
+                self._dropped += len(events) - written - parked
+                self._batches += 1
+                self._last_flush_ms = (time.monotonic() - started) * 1000
+                self._last_flush_at = time.monotonic()
+                self._cond.notify_all()  # room for blocked producers
+        return True
+
+    def _write_each(self, events) -> int:
+        """
+        Write the oldest pending batch one event at a time, parking events
+        that fail for a non-transient reason in the dead-letter file; returns
+        (rows written, events parked). If the database or the dead-letter
+        file fails, the events not yet handled stay pending and the error
+        propagates.
+        """
+        written = parked = 0
+        for index, event in enumerate(events):
+            try:
+                try:
+                    written += self._write([event])
+                except Exception as e:
+                    if _transient(e):
+                        raise
+                    self._dead_letter(event, e)
+                    parked += 1
+            except Exception:
+                remaining = events[index:]
+                with self._cond:
+                    self._pending[0] = (self._pending[0][0], remaining)
+                    self._pending_count -= index
+                    self._written += written
+                    self._dropped += index - written - parked
+                    self._cond.notify_all()
+                raise
+        return written, parked
+
+    def _dead_letter(self, event, error):
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(dict(event, error=str(error)), default=str) + '\n')
+        with self._cond:
+            self._dead_lettered += 1
+        logger.error(f"Usage event for user {event.get('user_id')} parked in {self.dead_letter_path}: {error}")
+
+    def _write(self, events) -> int:
+        """Insert one batch of events in a single transaction; returns rows written"""
+        user_ids = sorted({int(event['user_id']) for event in events})
+        with self.connection_factory() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    placeholders = ', '.join(['%s'] * len(user_ids))
+                    cursor.execute(f"""
+                        SELECT id, current_period_start, current_period_end,
+                               requests_used, monthly_quota
+                        FROM users WHERE id IN ({placeholders})
+                    """, user_ids)
+                    users = {row['id']: row for row in cursor.fetchall()}
+
+                    rows = []
+                    counts = {}
+                    for event in events:
+                        user = users.get(int(event['user_id']))
+                        if user is None:
+                            continue
+                        is_overage = event.get('is_overage')
+                        if is_overage is None:
+                            # Events without the flag of their reservation (spooled
+                            # by an older writer) fall back to the counter; reserved
+                            # requests are already part of requests_used
+                            if event.get('count_request', True):
+                                used = user['requests_used'] + counts.get(user['id'], 0)
+                                is_overage = used >= user['monthly_quota']
+                            else:
+                                is_overage = user['requests_used'] > user['monthly_quota']
+                        rows.append((
+                            user['id'], event['action_type'], event.get('tokens_used', 1),
+                            event.get('input_tokens', 0), event.get('output_tokens', 0),
+                            event.get('latency_ms'), event.get('model_id'), event.get('session_id'),
+                            event['created_at'],
+                            user['current_period_start'] or UNBILLED_PERIOD,
+                            user['current_period_end'] or UNBILLED_PERIOD,
+                            bool(is_overage)
+                        ))
+                        if event.get('count_request', True):
+                            counts[user['id']] = counts.get(user['id'], 0) + 1
+
+                    for start in range(0, len(rows), self.batch_size):
+                        # PyMySQL sends each chunk as one multi-row INSERT
+                        cursor.executemany(INSERT_USAGE_SQL, rows[start:start + self.batch_size])
+                    if rows:
+                        cursor.executemany(UPSERT_ROLLUP_SQL, rollup_rows(rows))
+                    if counts:
+                        cursor.executemany("""
+                            UPDATE users
+                            SET requests_used = requests_used + %s
+                            WHERE id = %s
+                        """, [(count, user_id) for user_id, count in counts.items()])
+                connection.commit()
+                return len(rows)
+            except Exception:
+                connection.rollback()
+                raise
+
+    # ------------------------------------------------------------------
+    # Lifecycle and metrics
+    # ------------------------------------------------------------------
+
+    def flush(self, timeout=5.0) -> bool:
+        """Wait until everything submitted so far is written; False on timeout"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._depth() and self._thread is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, self.flush_interval))
+        return True
+
+    def shutdown(self, timeout=5.0):
+        """Write what is queued and stop the flusher; unwritten events stay spooled"""
+        with self._cond:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        thread.join(timeout)
+        with self._cond:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+            self._thread = None
+            self._stopping = False
+
+    def stats(self):
+        """Queue depth, throughput and backpressure counters"""
+        with self._cond:
+            return {
+                'depth': self._depth(),
+                'max_depth': self._max_depth,
+                'max_queue': self.max_queue,
+                'enqueued': self._enqueued,
+                'written': self._written,
+                'batches': self._batches,
+                'avg_batch': round(self._written / self._batches, 1) if self._batches else 0.0,
+                'flush_errors': self._flush_errors,
+                'full_waits': self._full_waits,
+                'rejected': self._rejected,
+                'dropped': self._dropped,
+                'replayed': self._replayed,
+                'dead_lettered': self._dead_lettered,
+                'last_flush_ms': round(self._last_flush_ms, 2),
+                'seconds_since_flush': round(time.monotonic() - self._last_flush_at, 3) if self._last_flush_at else None,
+            }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_usage_writer() -> UsageWriter:
+    """Return the process-wide usage writer"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = UsageWriter()
+    return _writer
+
+def get_usage_writer_stats():
+    """Stats of the process-wide usage writer"""
+    return get_usage_writer().stats()
@@ -0,0 +1,261 @@
+"""
+Background processing of LemonSqueezy webhooks for ZED AI
+The webhook route only verifies and stores each event; a pool of worker
+threads applies stored subscription_events rows off the request path
+"""
+
+import atexit
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from database import borrow_connection
+from lemonsqueezy import LemonSqueezyService
+
+logger = logging.getLogger(__name__)
+
+# Webhook worker configuration
+WEBHOOK_ASYNC = os.getenv('WEBHOOK_ASYNC', 'true').lower() == 'true'
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+WEBHOOK_POLL_INTERVAL_MS = int(os.getenv('WEBHOOK_POLL_INTERVAL_MS', 1000))
+WEBHOOK_BATCH_SIZE = int(os.getenv('WEBHOOK_BATCH_SIZE', 20))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 8))
+WEBHOOK_RETRY_BASE_MS = int(os.getenv('WEBHOOK_RETRY_BASE_MS', 1000))
+WEBHOOK_RETRY_MAX_MS = int(os.getenv('WEBHOOK_RETRY_MAX_MS', 300000))
+# A claim older than this is considered abandoned by a crashed worker
+WEBHOOK_CLAIM_TIMEOUT = int(os.getenv('WEBHOOK_CLAIM_TIMEOUT', 300))
+
+# Oldest pending event of each subscription that is due and not claimed.
+# Later events of a subscription wait until every earlier one is processed
+# or given up on, so a subscription's events are applied in arrival order.
+CLAIMABLE_EVENTS_SQL = """
+    SELECT e.id FROM subscription_events e
+    WHERE e.processed = FALSE AND e.failed = FALSE
+      AND (e.next_attempt_at IS NULL OR e.next_attempt_at <= %s)
+      AND (e.locked_at IS NULL OR e.locked_at < %s)
+      AND NOT EXISTS (
+          SELECT 1 FROM subscription_events p
+          WHERE p.subscription_id = e.subscription_id AND p.id < e.id
+            AND p.processed = FALSE AND p.failed = FALSE
+      )
+    ORDER BY e.id
+    LIMIT %s
+"""
+
+
+def retry_delay(attempts, base_ms=WEBHOOK_RETRY_BASE_MS, max_ms=WEBHOOK_RETRY_MAX_MS) -> float:
+    """Seconds before retry number `attempts`: capped exponential backoff with jitter"""
+    delay = min(max_ms, base_ms * 2 ** max(attempts - 1, 0)) / 1000
+    return delay * random.uniform(0.5, 1.0)
+
+
+class WebhookWorkerPool:
+    """
+    Worker threads applying unprocessed subscription_events rows
+
+    Each worker claims due events with a conditional UPDATE (so a row is
+    owned by one worker across all processes), applies them through
+    LemonSqueezyService.process_stored_event and, on failure, schedules a
+    retry with exponential backoff. After `max_attempts` failures an event
+    is marked failed and no longer blocks the subscription's later events.
+    notify() wakes the workers as soon as a new event is stored; otherwise
+    they poll every `poll_interval_ms`.
+    """
+
+    def __init__(self, service=None, connection_factory=borrow_connection, workers=WEBHOOK_WORKERS,
+                 poll_interval_ms=WEBHOOK_POLL_INTERVAL_MS, batch_size=WEBHOOK_BATCH_SIZE,
+                 max_attempts=WEBHOOK_MAX_ATTEMPTS, claim_timeout=WEBHOOK_CLAIM_TIMEOUT):
+        self.service = service or LemonSqueezyService()
+        self.connection_factory = connection_factory
+        self.workers = workers
+        self.poll_interval = poll_interval_ms / 1000
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.claim_timeout = claim_timeout
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._threads = []
+        self._pid = os.getpid()
+        self._worker_id = f"{socket.gethostname()}:{self._pid}"
+        self._stopping = False
+        self._wakeups = 0
+        self._processed = 0
+        self._retried = 0
+        self._failed = 0
+        self._claim_errors = 0
+        self._total_ms = 0.0
+
+    def start(self):
+        """Start the worker threads (again after a fork)"""
+        if self._threads and self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset()
+            if not self._threads:
+                for i in range(self.workers):
+                    thread = threading.Thread(target=self._run, name=f"webhook-worker-{i}", daemon=True)
+                    thread.start()
+                    self._threads.append(thread)
+                atexit.register(self.shutdown)
+
+    def notify(self):
+        """Wake the workers for a newly stored event"""
+        self.start()
+        with self._cond:
+            self._wakeups += 1
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                if not self._wakeups:
+                    self._cond.wait(self.poll_interval)
+                self._wakeups = 0
+                if self._stopping:
+                    return
+
+            try:
+                claimed = self._claim()
+            except Exception as e:
+                with self._cond:
+                    self._claim_errors += 1
+                logger.error(f"Webhook claim error: {e}")
+                continue
+
+            for event_row_id in claimed:
+                self._process(event_row_id)
+            if len(claimed) == self.batch_size:
+                # Probably more due; look again without waiting
+                with self._cond:
+                    self._wakeups += 1
+
+    def _claim(self):
+        """Claim up to batch_size due events; returns their row ids"""
+        now = datetime.now()
+        stale = now - timedelta(seconds=self.claim_timeout)
+        claimed = []
+        with self.connection_factory() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(CLAIMABLE_EVENTS_SQL, (now, stale, self.batch_size))
+                    candidates = [row['id'] for row in cursor.fetchall()]
+                    connection.commit()
+                    for event_row_id in candidates:
+                        cursor.execute("""
+                            UPDATE subscription_events
+                            SET locked_by = %s, locked_at = %s
+                            WHERE id = %s AND processed = FALSE
+                              AND (locked_at IS NULL OR locked_at < %s)
+                        """, (self._worker_id, now, event_row_id, stale))
+                        connection.commit()
+                        if cursor.rowcount:
+                            claimed.append(event_row_id)
+            except Exception:
+                connection.rollback()
+                raise
+        return claimed
+
+    def _process(self, event_row_id):
+        started = time.monotonic()
+        try:
+            result = self.service.process_stored_event(event_row_id)
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        elapsed_ms = (time.monotonic() - started) * 1000
+
+        if result.get('success'):
+            with self._cond:
+                self._processed += 1
+                self._total_ms += elapsed_ms
+            return
+        try:
+            self._schedule_retry(event_row_id, result.get('error', 'unknown error'))
+        except Exception as e:
+            # The claim expires after claim_timeout and the event is retried then
+            logger.error(f"Webhook retry scheduling error for event {event_row_id}: {e}")
+
+    def _schedule_retry(self, event_row_id, error):
+        with self.connection_factory() as connection:
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        "SELECT attempts FROM subscription_events WHERE id = %s", (event_row_id,)
+                    )
+                    attempts = cursor.fetchone()['attempts'] + 1
+                    failed = attempts >= self.max_attempts
+                    cursor.execute("""
+                        UPDATE subscription_events
+                        SET attempts = %s, last_error = %s, failed = %s, next_attempt_at = %s,
+                            locked_by = NULL, locked_at = NULL
+                        WHERE id = %s
+                    """, (
+                        attempts, str(error)[:1000], failed,
+                        datetime.now() + timedelta(seconds=retry_delay(attempts)),
+                        event_row_id
+                    ))
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+
+        with self._cond:
+            if failed:
+                self._failed += 1
+            else:
+                self._retried += 1
+        if failed:
+            logger.error(f"Webhook event {event_row_id} failed after {attempts} attempts: {error}")
+        else:
+            logger.warning(f"Webhook event {event_row_id} attempt {attempts} failed, will retry: {error}")
+
+    def shutdown(self, timeout=5.0):
+        """Stop the workers after the events they are applying"""
+        with self._cond:
+            threads = self._threads
+            if not threads or self._pid != os.getpid():
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in threads:
+            thread.join(timeout)
+        with self._cond:
+            self._threads = []
+            self._stopping = False
+
+    def stats(self):
+        """Events processed, retried and given up on by this process"""
+        with self._cond:
+            return {
+                'workers': len(self._threads),
+                'processed': self._processed,
+                'retried': self._retried,
+                'failed': self._failed,
+                'claim_errors': self._claim_errors,
+                'avg_ms': round(self._total_ms / self._processed, 2) if self._processed else 0.0,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_webhook_pool() -> WebhookWorkerPool:
+    """Return the process-wide webhook worker pool"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = WebhookWorkerPool()
+    return _pool
+
+def get_webhook_pool_stats():
+    """Stats of the process-wide webhook worker pool"""
+    return get_webhook_pool().stats()